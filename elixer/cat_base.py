@@ -8,12 +8,16 @@ try:
     from elixer import science_image
     from elixer import cat_bayesian
     from elixer import observation as elixer_observation
+    from elixer import spatial_index
+    from elixer import sqlite_utils
     #from elixer import utilities
 except:
     import global_config as G
     import science_image
     import cat_bayesian
     import observation as elixer_observation
+    import spatial_index
+    import sqlite_utils
     #import utilities
 
 import os.path as op
@@ -179,6 +183,56 @@ class Catalog:
 
         return result
 
+    @classmethod
+    def bid_box(cls,ra_min,ra_max,dec_min,dec_max,df=None):
+        """
+        Rows of the catalog inside the RA, Dec box (the usual bid target search window). Uses the (cached)
+        spatial index for the DataFrame, falling back to a full column search if there is no index.
+
+        :param df: DataFrame to search (with 'RA' and 'DEC' columns). If None, cls.df
+        :return: DataFrame (copy) of the matching rows in catalog order (or None if there is no catalog)
+        """
+        if df is None:
+            df = cls.df
+        if df is None:
+            return None
+
+        index = spatial_index.index_for(df)
+        if index is None:
+            return df[(df['RA'] >= ra_min) & (df['RA'] <= ra_max) &
+                      (df['DEC'] >= dec_min) & (df['DEC'] <= dec_max)].copy()
+
+        return df.iloc[index.box(ra_min,ra_max,dec_min,dec_max)].copy()
+
+    @classmethod
+    def match_many(cls,ras,decs,radius,df=None):
+        """
+        Bulk cone search of the catalog, i.e. for all the detections in a run at once
+
+        :param ras: array of decimal degrees
+        :param decs: array of decimal degrees
+        :param radius: arcsec (scalar or one per position)
+        :param df: DataFrame to search (with 'RA' and 'DEC' columns). If None, cls.df
+        :return: list (one per position) of arrays of row positions (for df.iloc) within radius, in catalog order
+        """
+        if df is None:
+            df = cls.df
+        if df is None:
+            return [np.zeros(0,dtype=int) for _ in range(len(np.atleast_1d(ras)))]
+
+        radius = np.asarray(radius,dtype=np.float64) / 3600.0
+        index = spatial_index.index_for(df)
+        if index is not None:
+            return index.match_many(ras,decs,radius)
+
+        cat_ra = df['RA'].values
+        cat_dec = df['DEC'].values
+        ras = np.atleast_1d(ras)
+        decs = np.atleast_1d(decs)
+        radius = np.broadcast_to(radius,len(ras))
+        return [np.where(spatial_index.angular_sep(np.full(len(cat_ra),r),np.full(len(cat_dec),d),
+                                                   cat_ra,cat_dec) <= rad)[0] for r,d,rad in zip(ras,decs,radius)]
+
     @classmethod
     def read_main_catalog(cls):
         if cls.df is not None:
@@ -336,6 +390,40 @@ class Catalog:
             log.warning("Exception in cat_base::Catalog::sort_bid_targets_by_likelihood()",exc_info=True)
 
 
+    def prefetch_zpdfs(self,ras,decs):
+        """
+        For catalogs with photo-z PDF files (dataframe_of_bid_targets_photoz 'file' column) kept in a zPDF.db rather
+        than on disk, fetch those of the (displayed) bid targets in one query, so the per-target read_catalog()
+        calls that follow come from the cache
+
+        :param ras: bid target RAs (as passed to build_multiple_bid_target_figures_one_line)
+        :param decs: bid target Decs
+        :return: number of zPDFs fetched
+        """
+        try:
+            df = self.dataframe_of_bid_targets
+            df_photoz = getattr(self,"dataframe_of_bid_targets_photoz",None)
+            path = getattr(self,"SupportFilesLocation",None)
+            if (df is None) or (df_photoz is None) or (path is None) or ('file' not in df_photoz.columns):
+                return 0
+
+            ids = []
+            for r, d in zip(ras[0:G.MAX_COMBINE_BID_TARGETS],decs[0:G.MAX_COMBINE_BID_TARGETS]):
+                sel = df.loc[(df['RA'] == r[0]) & (df['DEC'] == d[0])]
+                if len(sel) > 0:
+                    ids.append(sel['ID'].values[0])
+
+            dbs = {} #zPDF.db : list of zPDF filenames
+            for fn in df_photoz.loc[df_photoz['ID'].isin(ids),'file'].values:
+                fn = op.join(path,str(fn))
+                if not op.exists(fn):
+                    dbs.setdefault(op.join(op.dirname(fn),"zPDF.db"),[]).append(fn)
+
+            return sum(sqlite_utils.prefetch_zpdfs(db,fns=fns) for db, fns in dbs.items())
+        except:
+            log.debug("Exception in cat_base::Catalog::prefetch_zpdfs()",exc_info=True)
+            return 0
+
     def clear_pages(self):
         if self.pages is None:
             self.pages = []
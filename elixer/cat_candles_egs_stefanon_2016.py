@@ -489,8 +489,7 @@ class CANDELS_EGS_Stefanon_2016(cat_base.Catalog):
 
         try:
             self.dataframe_of_bid_targets = \
-                self.df[(self.df['RA'] >= ra_min) & (self.df['RA'] <= ra_max) &
-                        (self.df['DEC'] >= dec_min) & (self.df['DEC'] <= dec_max)].copy()
+                self.bid_box(ra_min, ra_max, dec_min, dec_max)
 
             if self.dataframe_of_bid_targets is not None:
                 self.num_targets = self.dataframe_of_bid_targets.iloc[:, 0].count()
@@ -506,8 +505,7 @@ class CANDELS_EGS_Stefanon_2016(cat_base.Catalog):
             try:
 
                 self.dataframe_of_bid_targets = \
-                    self.cfhtls_df[(self.cfhtls_df['RA'] >= ra_min) & (self.cfhtls_df['RA'] <= ra_max) &
-                                   (self.cfhtls_df['DEC'] >= dec_min) & (self.cfhtls_df['DEC'] <= dec_max)].copy()
+                    self.bid_box(ra_min, ra_max, dec_min, dec_max, df=self.cfhtls_df)
 
                 # the CFHTLS dataframe is combined with photo-z (at least for now)
                 self.dataframe_of_bid_targets_photoz = self.dataframe_of_bid_targets
@@ -1050,6 +1048,7 @@ class CANDELS_EGS_Stefanon_2016(cat_base.Catalog):
 
 
         bid_colors = self.get_bid_colors(len(ras))
+        self.prefetch_zpdfs(ras,decs) #one database query for all the displayed targets' photo-z PDFs
 
         if G.ZOO:
             text = "Separation\n" + \
@@ -317,8 +317,7 @@ class DECALS(cat_base.Catalog):
 
         try:
             self.dataframe_of_bid_targets = \
-                self.df[(self.df['RA'] >= ra_min) & (self.df['RA'] <= ra_max) &
-                        (self.df['DEC'] >= dec_min) & (self.df['DEC'] <= dec_max)].copy()
+                self.bid_box(ra_min, ra_max, dec_min, dec_max)
             #may contain duplicates (across tiles)
             #remove duplicates (assuming same RA,DEC between tiles has same data)
             #so, different tiles that have the same ra,dec and filter get dropped (keep only 1)
@@ -9,6 +9,7 @@ try:
     from elixer import line_prob
     from elixer import utilities
     from elixer import spectrum_utilities as SU
+    from elixer import cutout_cache
 except:
     import global_config as G
     import science_image
@@ -17,9 +18,9 @@ except:
     import line_prob
     import utilities
     import spectrum_utilities as SU
+    import cutout_cache
 
 from astropy.coordinates import SkyCoord
-import astropy.io.fits as fits
 import os.path as op
 import copy
 import io
@@ -36,7 +37,6 @@ import astropy.table
 #from astroquery.sdss import SDSS as SDSS_API
 from astropy import coordinates as coords
 from astropy import units as u
-import requests
 
 
 #log = G.logging.getLogger('Cat_logger')
@@ -47,6 +47,43 @@ log.setlevel(G.LOG_LEVEL)
 pd.options.mode.chained_assignment = None  #turn off warning about setting the distance field
 
 
+def decals_cutout_url(ra,dec,band):
+    #from http://legacysurvey.org/dr8/description/
+    # The maximum size for cutouts( in number of pixels) is currently 512.
+    # Pixscale=0.262 will return (approximately) the native pixels used by the Tractor.
+    #
+    # appears to be 256x256 maximum and NOT specifying &pixscale=%f   where %f=0.262  seems to give the maximum resolution
+    return "http://legacysurvey.org/viewer/fits-cutout?ra=%f&dec=%f&layer=%s&bands=%s" %(ra,dec,"dr8",band)
+
+
+def cutout_request(ra,dec,band):
+    """
+    :return: (survey, band, ra, dec, size, fetch) for cutout_cache.get_cutout() or prefetch()
+    """
+    #should normally be 200k+, so anything under 5000 bytes is not an image
+    return ("decals",band,ra,dec,0,lambda: cutout_cache.fetch_url(decals_cutout_url(ra,dec,band),min_bytes=5000))
+
+
+def get_image(ra,dec,band):
+    """
+    DECaLS fits-cutout (from the local cutout cache if available)
+
+    :param ra: decimal degrees
+    :param dec: decimal degrees
+    :param band: filter (g,r,z)
+    :return: HDUList or None
+    """
+    hdulist = cutout_cache.get_hdulist(*cutout_request(ra,dec,band))
+    try:
+        if (hdulist is not None) and (hdulist[0].header['NAXIS'] != 2):
+            log.debug("Bad response (no image?) from DECaLS. Missing NAXIS in header.")
+            hdulist = None
+    except:
+        log.debug("Exception in DECaLS",exc_info=True)
+        hdulist = None
+    return hdulist
+
+
 
 def decals_count_to_mag(count,cutout=None,headers=None):
 #from http://legacysurvey.org/dr8/description/
@@ -121,6 +158,12 @@ class DECaLS(cat_base.Catalog):#DECaLS
             factor = 0.0
         return factor
 
+    def cutout_requests(self,ra,dec,error=None):
+        """
+        :return: list of the (cutout_cache) requests for all the imaging this catalog would fetch at ra, dec
+        """
+        return [cutout_request(ra,dec,f) for f in self.Filters]
+
     def get_filters(self,ra=None,dec=None):
         #return ['u','g', 'r', 'i', 'z']
         return ['g','r','z']
@@ -275,28 +318,9 @@ class DECaLS(cat_base.Catalog):#DECaLS
 
             log.info("DECaLS query (%f,%f) at %f arcsec for band %s ..." % (ra, dec, query_radius, f))
 
-            #build up the request URL
-            url = "http://legacysurvey.org/viewer/fits-cutout?ra=%f&dec=%f&layer=%s&bands=%s" %(ra,dec,"dr8",f)
-
-            #from http://legacysurvey.org/dr8/description/
-            # The maximum size for cutouts( in number of pixels) is currently 512.
-            # Pixscale=0.262 will return (approximately) the native pixels used by the Tractor.
-            #
-            # appears to be 256x256 maximum and NOT specifying &pixscale=%f   where %f=0.262  seems to give the maximum resolution
-
             try:
-                response = requests.get(url, allow_redirects=True)
-                if response.status_code != 200: #"OK" response
-                    log.debug("DECaLS http response code = %d (%s)" %(response.status_code,response.reason))
-                    continue
-                if len(response.content) < 5000: #should normally be 200k+
-                    log.debug("Bad (short) response (no image?) from DECaLS")
-                    continue
-
-                hdulist = fits.open(io.BytesIO(response.content))
-
-                if hdulist[0].header['NAXIS'] != 2:
-                    log.debug("Bad response (no image?) from DECaLS. Missing NAXIS in header.")
+                hdulist = get_image(ra,dec,f)
+                if hdulist is None:
                     continue
 
                 hdulist_array = [hdulist]
@@ -984,27 +1008,12 @@ class DECaLS(cat_base.Catalog):#DECaLS
         try:
 
             log.info("DECaLS query (%f,%f) at %f arcsec for band %s ..." % (ra, dec, query_radius, filter))
-            #build up the request URL
-            url = "http://legacysurvey.org/viewer/fits-cutout?ra=%f&dec=%f&layer=%s&bands=%s" %(ra,dec,"dr8",filter)
-
             try:
-                response = requests.get(url, allow_redirects=True)
-
-                if response.status_code != 200:  # "OK" response
-                    log.debug("DECaLS http response code = %d (%s)" % (response.status_code, response.reason))
+                hdulist = get_image(ra,dec,filter)
+                if hdulist is None:
                     hdulist_array = None
-
-                if len(response.content) < 5000:  # should normally be 200k+
-                    log.debug("Bad response (no image?) from DECaLS")
-                    hdulist_array = None
-
-                hdulist = fits.open(io.BytesIO(response.content))
-
-                if hdulist[0].header['NAXIS'] != 2:
-                    log.debug("Bad response (no image?) from DECaLS")
-                    hdulist_array = None
-
-                hdulist_array = [hdulist]
+                else:
+                    hdulist_array = [hdulist]
             except:
                 log.debug("Exception in DECaLS",exc_info=True)
                 hdulist_array = None
@@ -388,8 +388,7 @@ class GOODS_N(cat_base.Catalog):
 
         try:
             self.dataframe_of_bid_targets = \
-                self.df[(self.df['RA'] >= ra_min) & (self.df['RA'] <= ra_max) &
-                        (self.df['DEC'] >= dec_min) & (self.df['DEC'] <= dec_max)].copy()
+                self.bid_box(ra_min, ra_max, dec_min, dec_max)
 
             # ID matches between both catalogs
             self.dataframe_of_bid_targets_photoz = \
@@ -912,6 +911,7 @@ class GOODS_N(cat_base.Catalog):
 
 
         bid_colors = self.get_bid_colors(len(ras))
+        self.prefetch_zpdfs(ras,decs) #one database query for all the displayed targets' photo-z PDFs
 
         if G.ZOO:
             text = "Separation\n" + \
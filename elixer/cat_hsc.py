@@ -27,7 +27,8 @@ try:
     from elixer import cat_base
     from elixer import match_summary
     from elixer import line_prob
-    from elixer import hsc_meta
+    from elixer import tile_meta
+    from elixer import frame_cache
     from elixer import utilities
     from elixer import spectrum_utilities as SU
     from elixer import cat_kpno
@@ -37,7 +38,8 @@ except:
     import cat_base
     import match_summary
     import line_prob
-    import hsc_meta
+    import tile_meta
+    import frame_cache
     import utilities
     import spectrum_utilities as SU
     import cat_kpno
@@ -116,17 +118,17 @@ class HSC(cat_base.Catalog):#Hyper Suprime Cam
 
     CONT_EST_BASE = None
 
-    df = None
-    loaded_tracts = []
+    df = None #the catalog tract(s) for the most recent read_catalog() call
+    loaded_tracts = [] #the tract(s) in df
+    tract_frames = [] #the (cached) DataFrame for each of the loaded_tracts
+    Tract_Cache = frame_cache.FrameCache(G.HSC_CATALOG_CACHE_MB) #each loaded tract, least recently used dropped first
 
     MainCatalog = None #there is no Main Catalog ... must load individual catalog tracts
     Name = "HyperSuprimeCam"
 
-    Image_Coord_Range = hsc_meta.Image_Coord_Range
-    Tile_Dict = hsc_meta.HSC_META_DICT
-    #correct the basepaths
-    for k in Tile_Dict.keys():
-        Tile_Dict[k]['path'] = op.join(G.HSC_IMAGE_PATH,Tile_Dict[k]['tract'],op.basename(Tile_Dict[k]['path']))
+    #loaded (memory-mapped) on first use, the tile paths are built from the configured image path
+    Tile_Dict = tile_meta.TileMeta("hsc_meta","HSC_META_DICT",path_func=lambda k,t: op.join(G.HSC_IMAGE_PATH,t['tract'],k))
+    Image_Coord_Range = tile_meta.CoordRange(Tile_Dict)
 
 
     Filters = ['r'] #case is important ... needs to be lowercase
@@ -482,51 +484,103 @@ class HSC(cat_base.Catalog):#Hyper Suprime Cam
             return None
 
 
-        if set(fqtract).issubset(cls.loaded_tracts):
+        if fqtract == cls.loaded_tracts:
             log.info("Catalog tract (%s) already loaded." %fqtract)
             return cls.df
 
-
-
         #todo: future more than just the R filter if any are ever added
+        frames = []
+        loaded = [] #only the tracts that actually loaded (so a failed tract is tried again on the next call)
         for t in fqtract:
-            if t in cls.loaded_tracts: #skip if already loaded
-                continue
+            df = cls.Tract_Cache.get(t)
+            if df is None:
+                df = cls.read_catalog_tract(t,name)
+                if df is None:
+                    continue
+                cls.Tract_Cache.put(t,df)
+            frames.append(df)
+            loaded.append(t)
+
+        cls.tract_frames = frames
+        cls.loaded_tracts = loaded
+        if len(frames) == 0:
+            cls.df = None
+        elif len(frames) == 1:
+            cls.df = frames[0]
+        else:
+            cls.df = pd.concat(frames)
 
-            cat_name = t
-            cat_loc = op.join(cls.HSC_CAT_PATH, cat_name)
-            header = cls.BidCols
+        return cls.df
 
-            if not op.exists(cat_loc):
-                log.error("Cannot load catalog tract for HSC. File does not exist: %s" %cat_loc)
+    @classmethod
+    def bid_box(cls,ra_min,ra_max,dec_min,dec_max,df=None):
+        """
+        As cat_base.Catalog.bid_box, but searches each of the loaded tracts with its own (cached) spatial index
+        rather than re-indexing the combination of tracts.
+        """
+        if (df is None) and (len(cls.tract_frames) > 1):
+            return pd.concat([super(HSC,cls).bid_box(ra_min,ra_max,dec_min,dec_max,df=f) for f in cls.tract_frames])
+        return super(HSC,cls).bid_box(ra_min,ra_max,dec_min,dec_max,df=df)
 
-            log.debug("Building " + cls.Name + " " + cat_name + " dataframe...")
+    @classmethod
+    def read_catalog_tract(cls,t,name=None):
+        """
+        Read a single catalog tract, from the binary sidecar if there is a current one, else from the
+        (whitespace delimited) text catalog, in which case the sidecar is (re)written for next time.
 
-            try:
-                df = pd.read_csv(cat_loc, names=header,
-                                 delim_whitespace=True, header=None, index_col=None, skiprows=0)
+        :param t: the fully qualified tract (as a partial path), i.e. "16814/R_P2_8.cat"
+        :param name:
+        :return: DataFrame or None
+        """
+        if name is None:
+            name = cls.Name
 
-                old_names = ['Dec']
-                new_names = ['DEC']
-                df.rename(columns=dict(zip(old_names, new_names)), inplace=True)
+        cat_name = t
+        cat_loc = op.join(cls.HSC_CAT_PATH, cat_name)
+        header = cls.BidCols
 
-                df['FILTER'] = 'r' #add the FILTER to the dataframe !!! case is important. must be lowercase
+        if not op.exists(cat_loc):
+            log.error("Cannot load catalog tract for HSC. File does not exist: %s" %cat_loc)
 
-                if cls.df is not None:
-                    cls.df = pd.concat([cls.df, df])
+        sidecar = None
+        if G.HSC_CATALOG_SIDECAR_PATH is not None:
+            sidecar = op.join(G.HSC_CATALOG_SIDECAR_PATH, op.splitext(cat_name)[0] + ".npy")
+            try:
+                if op.exists(sidecar) and op.exists(cat_loc) and (op.getmtime(sidecar) < op.getmtime(cat_loc)):
+                    log.debug("Stale sidecar for " + cls.Name + " " + cat_name)
                 else:
-                    cls.df = df
-                cls.loaded_tracts.append(t)
-
+                    df = frame_cache.read_sidecar(sidecar)
+                    if df is not None:
+                        df['FILTER'] = 'r'
+                        return df
             except:
-                log.error(name + " Exception attempting to build pandas dataframe", exc_info=True)
-                continue
+                pass
 
-        return cls.df
+        log.debug("Building " + cls.Name + " " + cat_name + " dataframe...")
+
+        try:
+            df = pd.read_csv(cat_loc, names=header,
+                             delim_whitespace=True, header=None, index_col=None, skiprows=0)
+
+            old_names = ['Dec']
+            new_names = ['DEC']
+            df.rename(columns=dict(zip(old_names, new_names)), inplace=True)
+
+            if sidecar is not None:
+                frame_cache.write_sidecar(sidecar,df)
+
+            df['FILTER'] = 'r' #add the FILTER to the dataframe !!! case is important. must be lowercase
+        except:
+            log.error(name + " Exception attempting to build pandas dataframe", exc_info=True)
+            return None
+
+        return df
 
     def build_catalog_of_images(self):
 
-        for t in self.Tile_Dict.keys(): #tile is the key (the filename)
+        #read the tract and position of every tile at once, rather than a Tile_Dict lookup per tile (and filter)
+        for t, tract, pos in zip(self.Tile_Dict.keys(),self.Tile_Dict.column('tract'),self.Tile_Dict.column('pos')):
+            #tile is the key (the filename)
             for f in self.Filters:
                 try:
                     if G.HSC_S15A:
@@ -536,11 +590,11 @@ class HSC(cat_base.Catalog):#Hyper Suprime Cam
                         t1,t2 = toks[4][0],toks[4][1]
                         name = toks[0] + "-" + toks[1] + "-" + toks[2] + "-" + toks[3] + "-" + t1 + "," + t2 +".fits"
                     else:
-                        path = op.join(self.HSC_IMAGE_PATH,self.Tile_Dict[t]['tract'])
+                        path = op.join(self.HSC_IMAGE_PATH,tract)
                         name = t
                         wcs_manual = False
                 except:
-                    path = op.join(self.HSC_IMAGE_PATH,self.Tile_Dict[t]['tract'])
+                    path = op.join(self.HSC_IMAGE_PATH,tract)
                     name = t
                     wcs_manual = False
 
@@ -548,7 +602,7 @@ class HSC(cat_base.Catalog):#Hyper Suprime Cam
                     {'path': path,
                      'name': name, #filename is the tilename
                      'tile': t,
-                     'pos': self.Tile_Dict[t]['pos'], #the position tuple i.e. (0,3) or (2,8) ... in the name as 03 or 28
+                     'pos': pos, #the position tuple i.e. (0,3) or (2,8) ... in the name as 03 or 28
                      'filter': f,
                      'instrument': "HSC",
                      'cols': [],
@@ -569,16 +623,10 @@ class HSC(cat_base.Catalog):#Hyper Suprime Cam
         tracts = []
         positions = []
         keys = []
-        for k in self.Tile_Dict.keys():
-            # don't bother to load if ra, dec not in range
-            try:
-                if not ((ra >= self.Tile_Dict[k]['RA_min']) and (ra <= self.Tile_Dict[k]['RA_max']) and
-                        (dec >= self.Tile_Dict[k]['Dec_min']) and (dec <= self.Tile_Dict[k]['Dec_max'])) :
-                    continue
-                else:
-                    keys.append(k)
-            except:
-                pass
+        try:
+            keys = self.Tile_Dict.index.overlapping_keys(ra,dec) #all tiles whose bounds include ra, dec
+        except:
+            log.warning("Exception searching tile index.",exc_info=True)
 
         if len(keys) == 0: #we're done ... did not find any
             return None, None, None
@@ -944,12 +992,11 @@ class HSC(cat_base.Catalog):#Hyper Suprime Cam
             log.info("Could not locate tile for HSC. Discontinuing search of this catalog.")
             return -1,None,None
 
-        #could be none or could be not loaded yet
-        #if self.df is None or not (self.Tile_Dict[tile]['tract'] in self.loaded_tracts):
-        if self.df is None or not (set(tracts).issubset(self.loaded_tracts)):
-            #self.read_main_catalog()
-            #self.read_catalog(tract=self.Tile_Dict[tile]['tract'])
-            self.read_catalog(tract=tracts,position=positions)
+        #only the tract(s) covering this position (cached, so usually already loaded)
+        self.read_catalog(tract=tracts,position=positions)
+        if self.df is None:
+            log.info("Could not load catalog tract(s) for HSC. Discontinuing search of this catalog.")
+            return -1,None,None
 
         error_in_deg = np.float64(error) / 3600.0
 
@@ -985,24 +1032,22 @@ class HSC(cat_base.Catalog):#Hyper Suprime Cam
 
             if s15a:
                 self.dataframe_of_bid_targets = \
-                    self.df[(self.df['RA'] >= ra_min) & (self.df['RA'] <= ra_max) &
-                        (self.df['DEC'] >= dec_min) & (self.df['DEC'] <= dec_max)].copy()
+                    self.bid_box(ra_min, ra_max, dec_min, dec_max)
             else:
+                df = self.bid_box(ra_min, ra_max, dec_min, dec_max)
                 self.dataframe_of_bid_targets = \
-                    self.df[  (self.df['RA'] >= ra_min) & (self.df['RA'] <= ra_max)
-                        & (self.df['DEC'] >= dec_min) & (self.df['DEC'] <= dec_max)
-                        & (self.df['children'] == 0)
-                        & (self.df['outside'] == False)
-                        & (self.df['interpix_center'] == False)
-                        & (self.df['saturatedpix_center'] == False)
-                        & (self.df['cosmic_center'] == False)
-                        & (self.df['bad_pix'] == False)
-                        & (self.df['near_bright_obj'] == False)
-                        & (self.df['footprint_bright_obj'] == False)
-                        & (self.df['general_flag'] == False)
-                        & (self.df['inner_coadd_tract'] == True)
-                        & (self.df['inner_coadd_patch'] == True)
-                        & (self.df['num_images'] > 2)
+                    df[   (df['children'] == 0)
+                        & (df['outside'] == False)
+                        & (df['interpix_center'] == False)
+                        & (df['saturatedpix_center'] == False)
+                        & (df['cosmic_center'] == False)
+                        & (df['bad_pix'] == False)
+                        & (df['near_bright_obj'] == False)
+                        & (df['footprint_bright_obj'] == False)
+                        & (df['general_flag'] == False)
+                        & (df['inner_coadd_tract'] == True)
+                        & (df['inner_coadd_patch'] == True)
+                        & (df['num_images'] > 2)
                         ].copy()
             #may contain duplicates (across tiles)
             #remove duplicates (assuming same RA,DEC between tiles has same data)
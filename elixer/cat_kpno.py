@@ -12,7 +12,7 @@ try:
     from elixer import cat_base
     from elixer import match_summary
     from elixer import line_prob
-    from elixer import kpno_meta
+    from elixer import tile_meta
     from elixer import utilities
     from elixer import spectrum_utilities as SU
 except:
@@ -21,7 +21,7 @@ except:
     import cat_base
     import match_summary
     import line_prob
-    import kpno_meta
+    import tile_meta
     import utilities
     import spectrum_utilities as SU
 
@@ -76,11 +76,9 @@ class KPNO(cat_base.Catalog):#Kit Peak
     Name = "KPNO"
 
     mean_FWHM = 1.0 #typically better, but this is an okay worst case
-    Image_Coord_Range = kpno_meta.Image_Coord_Range
-    Tile_Dict = kpno_meta.KPNO_META_DICT
-    #correct the paths
-    for k in Tile_Dict.keys():
-        Tile_Dict[k]['path'] = op.join(G.KPNO_IMAGE_PATH,op.basename(Tile_Dict[k]['path']))
+    #loaded (memory-mapped) on first use, the tile paths are built from the configured image path
+    Tile_Dict = tile_meta.TileMeta("kpno_meta","KPNO_META_DICT",path_func=lambda k,t: op.join(G.KPNO_IMAGE_PATH,k))
+    Image_Coord_Range = tile_meta.CoordRange(Tile_Dict)
 
     Filters = ['g'] #case is important ... needs to be lowercase
     Cat_Coord_Range = {'RA_min': None, 'RA_max': None, 'Dec_min': None, 'Dec_max': None}
@@ -154,16 +152,10 @@ class KPNO(cat_base.Catalog):#Kit Peak
         #   not find matching objects for the associated tract)
         tile = None
         keys = []
-        for k in self.Tile_Dict.keys():
-            # don't bother to load if ra, dec not in range
-            try:
-                if not ((ra >= self.Tile_Dict[k]['RA_min']) and (ra <= self.Tile_Dict[k]['RA_max']) and
-                        (dec >= self.Tile_Dict[k]['Dec_min']) and (dec <= self.Tile_Dict[k]['Dec_max'])) :
-                    continue
-                else:
-                    keys.append(k)
-            except:
-                pass
+        try:
+            keys = self.Tile_Dict.index.overlapping_keys(ra,dec) #all tiles whose bounds include ra, dec
+        except:
+            log.warning("Exception searching tile index.",exc_info=True)
 
         if len(keys) == 0: #we're done ... did not find any
             return None
@@ -262,8 +254,7 @@ class KPNO(cat_base.Catalog):#Kit Peak
 
         try:
             self.dataframe_of_bid_targets = \
-                self.df[(self.df['RA'] >= ra_min) & (self.df['RA'] <= ra_max) &
-                        (self.df['DEC'] >= dec_min) & (self.df['DEC'] <= dec_max)].copy()
+                self.bid_box(ra_min, ra_max, dec_min, dec_max)
             #may contain duplicates (across tiles)
             #remove duplicates (assuming same RA,DEC between tiles has same data)
             #so, different tiles that have the same ra,dec and filter get dropped (keep only 1)
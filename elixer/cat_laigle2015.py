@@ -243,8 +243,7 @@ class LAIGLE2015(cat_base.Catalog):
 
         try:
             self.dataframe_of_bid_targets = \
-                self.df[(self.df['RA'] >= ra_min) & (self.df['RA'] <= ra_max) &
-                        (self.df['DEC'] >= dec_min) & (self.df['DEC'] <= dec_max)].copy()
+                self.bid_box(ra_min, ra_max, dec_min, dec_max)
 
         except:
             log.error(self.Name + " Exception in build_list_of_bid_targets", exc_info=True)
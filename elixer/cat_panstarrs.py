@@ -9,6 +9,7 @@ try:
     from elixer import line_prob
     from elixer import utilities
     from elixer import spectrum_utilities as SU
+    from elixer import cutout_cache
 except:
     import global_config as G
     import science_image
@@ -17,6 +18,7 @@ except:
     import line_prob
     import utilities
     import spectrum_utilities as SU
+    import cutout_cache
 
 
 import os.path as op
@@ -38,7 +40,6 @@ import astropy.table
 from astropy import coordinates as coords
 from astropy import units as u
 from astropy.table import Table
-from astropy.io import fits
 
 #log = G.logging.getLogger('Cat_logger')
 #log.setLevel(G.logging.DEBUG)
@@ -193,6 +194,20 @@ def getgrayim(ra, dec, size=240, output_size=None, filter="g", format="jpg"):
     im = Image.open(BytesIO(r.content))
     return im
 
+def cutout_request(ra,dec,radius,band):
+    """
+    :return: (survey, band, ra, dec, size, fetch) for cutout_cache.get_cutout() or prefetch()
+    """
+    def fetch():
+        fitsurl = geturl(ra, dec, size=arcsec2pix(radius), filters=band, format="fits")
+        if len(fitsurl) == 0:
+            return b"" #no imaging in this band
+        #having some issues with PanSTARRS certificate, so (unless PYTHONHTTPSVERIFY is set) do not validate it
+        return cutout_cache.fetch_url(fitsurl[0],verify=bool(os.environ.get('PYTHONHTTPSVERIFY', '')))
+
+    return ("panstarrs",band,ra,dec,radius,fetch)
+
+
 def get_image(ra,dec,radius,filters):
     """
 
@@ -211,9 +226,7 @@ def get_image(ra,dec,radius,filters):
         ssl._create_default_https_context = ssl._create_unverified_context
 
     try:
-        size = arcsec2pix(radius)
-        fitsurl = geturl(ra, dec, size=size, filters=filters, format="fits")
-        hdulist = fits.open(fitsurl[0])
+        hdulist = cutout_cache.get_hdulist(*cutout_request(ra,dec,radius,filters))
     except:
         log.error("Exception in cat_panstarrs.py::get_image",exc_info=True)
 
@@ -265,6 +278,13 @@ Median seeing	grizy = 1.31, 1.19, 1.11, 1.07, 1.02 arcsec
         self.num_targets = 0
         self.master_cutout = None
 
+    def cutout_requests(self,ra,dec,error):
+        """
+        :return: list of the (cutout_cache) requests for all the imaging this catalog would fetch at ra, dec
+        """
+        query_radius = max(error*1.5,30.0) #as build_cat_summary_figure
+        return [cutout_request(ra,dec,query_radius,f) for f in self.Filters]
+
     def get_filters(self,ra=None,dec=None):
         return ['g', 'r', 'i', 'z', 'y']
 
@@ -9,6 +9,7 @@ try:
     from elixer import line_prob
     from elixer import utilities
     from elixer import spectrum_utilities as SU
+    from elixer import cutout_cache
 except:
     import global_config as G
     import science_image
@@ -17,8 +18,8 @@ except:
     import line_prob
     import utilities
     import spectrum_utilities as SU
+    import cutout_cache
 
-from astropy.coordinates import SkyCoord
 import os.path as op
 import copy
 import io
@@ -45,6 +46,36 @@ log.setlevel(G.LOG_LEVEL)
 pd.options.mode.chained_assignment = None  #turn off warning about setting the distance field
 
 
+def cutout_request(ra,dec,radius,band):
+    """
+    :return: (survey, band, ra, dec, size, fetch) for cutout_cache.get_cutout() or prefetch()
+    """
+    def fetch():
+        pos = coords.SkyCoord(ra,dec,unit="deg",frame='icrs')
+        hdulist_array = SDSS_API.get_images(coordinates=pos, radius=radius*u.arcsec, band=band)
+        if (hdulist_array is None) or (len(hdulist_array) == 0):
+            return b"" #no imaging
+        return cutout_cache.hdulist_to_bytes(hdulist_array[0]) #only the first is ever used
+
+    return ("sdss",band,ra,dec,radius,fetch)
+
+
+def get_images(ra,dec,radius,band):
+    """
+    SDSS imaging (from the local cutout cache if available)
+
+    :param ra: decimal degrees
+    :param dec: decimal degrees
+    :param radius: query radius in arcsec
+    :param band: filter
+    :return: list of (one) HDUList or None
+    """
+    hdulist = cutout_cache.get_hdulist(*cutout_request(ra,dec,radius,band))
+    if hdulist is None:
+        return None
+    return [hdulist]
+
+
 
 def sdss_count_to_mag(count,cutout=None,headers=None):
 
@@ -129,6 +160,13 @@ class SDSS(cat_base.Catalog):#SDSS
         self.num_targets = 0
         self.master_cutout = None
 
+    def cutout_requests(self,ra,dec,error):
+        """
+        :return: list of the (cutout_cache) requests for all the imaging this catalog would fetch at ra, dec
+        """
+        query_radius = max(error*1.5,30.0) #as build_cat_summary_figure
+        return [cutout_request(ra,dec,query_radius,f) for f in self.Filters]
+
     def get_filters(self,ra=None,dec=None):
         return ['u','g', 'r', 'i', 'z']
 
@@ -281,8 +319,6 @@ class SDSS(cat_base.Catalog):#SDSS
         exptime_cont_est = -1
         index = 0 #images go in positions 1+ (0 is for the fiber positions)
 
-        pos = coords.SkyCoord(ra,dec,unit="deg",frame='icrs')
-
         for f in self.Filters:
             index += 1
 
@@ -300,7 +336,7 @@ class SDSS(cat_base.Catalog):#SDSS
                 mag_func = None
 
             log.info("SDSS query (%f,%f) at %f arcsec for band %s ..." % (ra, dec, query_radius, f))
-            hdulist_array = SDSS_API.get_images(coordinates=pos, radius=query_radius*u.arcsec,band=f)
+            hdulist_array = get_images(ra,dec,query_radius,f)
 
             if hdulist_array is None:
                 log.info("SDSS query (%f,%f) at %f arcsec for band %s returned None" %(ra,dec,query_radius,f))
@@ -942,12 +978,10 @@ class SDSS(cat_base.Catalog):#SDSS
 
         query_radius = max(window*1.5, 30.0)
 
-        pos = SkyCoord(ra,dec,unit='deg')
-
         try:
 
             log.info("SDSS query (%f,%f) at %f arcsec for band %s ..." % (ra, dec, query_radius, filter))
-            hdulist_array = SDSS_API.get_images(coordinates=pos, radius=query_radius * u.arcsec, band=filter)
+            hdulist_array = get_images(ra,dec,query_radius,filter)
 
             if hdulist_array is None:
                 log.info("SDSS query (%f,%f) at %f arcsec for band %s returned None" % (ra, dec, query_radius, filter))
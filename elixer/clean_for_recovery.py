@@ -15,9 +15,33 @@ import glob
 import os
 import numpy as np
 import sys
+try:
+    from elixer import manifest
+except:
+    import manifest
 
 MINIMUM_PDF_FILESIZE = 100000 #100k bytes
 
+def forget(files):
+    """
+    Record the removed report files in their dispatch's completion manifest, so recovery does not take the
+    detection as done
+
+    :param files: list of removed files (dispatch_xxxx/<name>/<detectid>*)
+    """
+    removed = {} #(manifest file, key) : stages
+    for f in files:
+        key, stage = manifest.parse_output_name(f)
+        if key is not None:
+            stages = removed.setdefault((manifest.manifest_filename(os.path.dirname(f)),key),set())
+            if stage == "pdf": #as for the file check, no pdf means not done (even if a png is in a report db)
+                stages.update(manifest.REPORT_STAGES)
+            else:
+                stages.add(stage)
+    for (fn, key), stages in removed.items():
+        manifest.append_removed(fn,key,sorted(stages))
+
+
 alldets = None
 args = list(map(str.lower,sys.argv))
 if "--dets" in args: #overide default if specified on command line
@@ -134,6 +158,7 @@ if remove_no_imaging:
                     os.remove(f)
                 except:
                     pass
+            forget(files)
 # else:
 #     print(f"{len(missing)} reports without imaging ... ")
 #     for d in missing:
@@ -257,6 +282,7 @@ for d in alldets:
 
         except:
            pass
+        forget([x for x in (pdf_path,rpt_path,nei_path,mini_path) if x])
 
     elif not png_okay and (pdf_idx > -1):
         if remove_no_png:
@@ -265,6 +291,7 @@ for d in alldets:
                 os.remove(pdf_path)
             except:
                 pass
+            forget([pdf_path])
         else:
             #try to build png from os call
             print("OS call to pdftoppm for " + str(d) + "...")
@@ -281,6 +308,7 @@ for d in alldets:
             os.remove(rpt_path)
         except:
             pass
+        forget([rpt_path])
 
         #todo: should we add these to a list to check again at the end (after a pause to complete?)
 
@@ -0,0 +1,353 @@
+"""
+Measured per-detection cost (run time) model for sizing the SLURM jobs (selixer.py).
+
+ELiXer records the wall time each detection spends in each stage (STAGES) of the detection loop, appending one
+row per detection to a tab separated sidecar (<name>/<name>_timing.tsv), plus one "startup" row per process (the
+time to get from launch to the first detection: imports, catalog loading, etc).
+
+selixer reads the timing files of earlier runs and fits a simple model: the mean and variance of the per-detection
+time by run configuration (detection type, HDF5 vs forced extraction, neighborhood map on/off), falling back to
+coarser groupings where there are too few timings, and the measured time of any detection that was timed before
+(same configuration). The model replaces the hand-tuned per-host MAX_TIME_PER_TASK and TIME_OVERHEAD.
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import glob
+import os
+import socket
+import time
+import numpy as np
+
+log = G.Global_Logger('cost_model')
+log.setlevel(G.LOG_LEVEL)
+
+PROCESS_START = time.time() #close enough to the process launch (imported with elixer)
+
+STAGES = ("load","catalogs","classify","render","neighborhood","other")
+CONFIG_COLUMNS = ("type","extraction","nei")
+COLUMNS = ("time","host","version","key") + CONFIG_COLUMNS + STAGES + ("total",)
+STARTUP_KEY = "startup"
+
+#timing files of earlier runs: the other run directories next to this one (selixer runs from inside the run dir)
+DEFAULT_HISTORY = [os.path.join("..","*","dispatch_*","*","*_timing.tsv"),
+                   os.path.join("..","*","*","*_timing.tsv")]
+
+
+def host_name():
+    """
+    :return: short host (cluster) name, as selixer uses it (i.e. stampede2)
+    """
+    hostname = socket.gethostname()
+    if "tacc.utexas.edu" in hostname:
+        hostname = hostname.split(".")[1]
+    return hostname
+
+
+def run_config(args):
+    """
+    The run options that most change the per-detection cost
+
+    :param args: the (parsed) command line args
+    :return: (detection type, extraction type, neighborhood) tuple of strings
+    """
+    if getattr(args,"continuum",False):
+        det_type = "continuum"
+    elif getattr(args,"broadline",False):
+        det_type = "broad"
+    else:
+        det_type = "line"
+
+    if getattr(args,"fcsdir",None) is not None:
+        extraction = "fcsdir"
+    elif getattr(args,"aperture",None):
+        extraction = "forced"
+    else:
+        extraction = "hdf5"
+
+    neighborhood_only = getattr(args,"neighborhood_only",None)
+    neighborhood = getattr(args,"neighborhood",None)
+    if (neighborhood_only is not None) and (neighborhood_only > 0):
+        nei = "only"
+    elif (neighborhood is not None) and (neighborhood > 0):
+        nei = "on"
+    else:
+        nei = "off"
+
+    return det_type, extraction, nei
+
+
+def detection_key(detection):
+    """
+    :param detection: a detectid, an explicit extraction row (ra, dec, shot, ...) or an fcsdir
+    :return: string key as written to the timing file and as listed in a dispatch_xxxx file
+    """
+    if isinstance(detection,(list,tuple,np.ndarray)):
+        return " ".join(str(x) for x in detection)
+    elif isinstance(detection,str):
+        return os.path.basename(detection.rstrip("/"))
+    return str(detection)
+
+
+def timing_filename(args):
+    return os.path.join(args.name, args.name + "_timing.tsv")
+
+
+def append_rows(fn,rows):
+    """
+    Append rows (tuples in COLUMNS order) to a timing file in a single write (the --workers processes share it)
+
+    :param fn: timing file
+    :param rows: list of tuples
+    :return: True if written
+    """
+    if len(rows) == 0:
+        return True
+    try:
+        lines = ""
+        if not os.path.isfile(fn):
+            lines = "#" + "\t".join(COLUMNS) + "\n"
+        for r in rows:
+            lines += "\t".join(("%0.3f" % x) if isinstance(x,float) else str(x) for x in r) + "\n"
+        with open(fn,"a") as f:
+            f.write(lines)
+        return True
+    except:
+        log.info(f"Unable to write timing file {fn}",exc_info=True)
+        return False
+
+
+def record_startup(args):
+    """
+    Record the time from the process launch to here (call just before the first detection is started)
+
+    :param args: the (parsed) command line args
+    """
+    if not G.RECORD_TIMING:
+        return
+    startup = time.time() - PROCESS_START
+    row = (int(time.time()),host_name(),G.__version__,STARTUP_KEY) + run_config(args) + \
+          tuple(0.0 for _ in STAGES[:-1]) + (startup,startup)
+    append_rows(timing_filename(args),[row])
+
+
+class StageTimer:
+    """
+    Per-detection stage timing for one pass of the detection loop.
+
+    The time between marks is charged to the named stage, split evenly over the detections (keys) it was spent on
+    (all the detections seen in the pass, unless given).
+    """
+
+    def __init__(self,args):
+        self.enabled = G.RECORD_TIMING
+        self.fn = timing_filename(args)
+        self.config = run_config(args)
+        self.times = {} #key : {stage : seconds}
+        self.obj_keys = {} #id(object) : key, i.e. for a HETDEX object, the detection it was built for
+        self.last = time.perf_counter()
+
+    def restart(self):
+        self.times = {}
+        self.obj_keys = {}
+        self.last = time.perf_counter()
+
+    def add_key(self,key,obj=None):
+        """
+        :param key: detection (see detection_key())
+        :param obj: optional object (i.e. HETDEX) to associate with the detection
+        :return: the key string
+        """
+        key = detection_key(key)
+        if key not in self.times:
+            self.times[key] = dict.fromkeys(STAGES,0.0)
+        if obj is not None:
+            self.obj_keys[id(obj)] = key
+        return key
+
+    def key_of(self,obj):
+        return self.obj_keys.get(id(obj))
+
+    def mark(self,stage,keys=None):
+        """
+        Charge the time since the last mark to a stage
+
+        :param stage: one of STAGES
+        :param keys: list of detection keys (default: all in this pass)
+        """
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.last = now
+
+        if keys is None:
+            keys = list(self.times.keys())
+        else:
+            keys = [self.add_key(k) for k in keys if k is not None]
+
+        if len(keys) == 0:
+            return
+        share = elapsed / len(keys)
+        for k in keys:
+            self.times[k][stage] += share
+
+    def totals(self):
+        """
+        :return: {key : total seconds} for this pass' detections
+        """
+        return {key: sum(t.values()) for key, t in self.times.items()}
+
+    def write(self):
+        """
+        Append this pass' detections to the timing file and restart
+        """
+        if self.enabled and len(self.times) > 0:
+            now = int(time.time())
+            host = host_name()
+            rows = []
+            for key, t in self.times.items():
+                rows.append((now,host,G.__version__,key) + self.config + tuple(t[s] for s in STAGES) +
+                            (sum(t.values()),))
+            append_rows(self.fn,rows)
+        self.restart()
+
+
+def read_timing_files(patterns=None):
+    """
+    :param patterns: list of timing files, directories (searched recursively) or glob patterns
+                     (default DEFAULT_HISTORY)
+    :return: list of dictionaries (one per row, COLUMNS keys)
+    """
+    if patterns is None:
+        patterns = DEFAULT_HISTORY
+
+    fns = set()
+    for p in patterns:
+        if os.path.isdir(p):
+            p = os.path.join(p,"**","*_timing.tsv")
+        fns.update(glob.glob(p,recursive=True))
+
+    rows = []
+    for fn in sorted(fns):
+        try:
+            with open(fn,"r") as f:
+                for line in f:
+                    if line.startswith("#"):
+                        continue
+                    toks = line.rstrip("\n").split("\t")
+                    if len(toks) != len(COLUMNS):
+                        continue
+                    try:
+                        r = dict(zip(COLUMNS,toks))
+                        r["total"] = float(r["total"])
+                        rows.append(r)
+                    except:
+                        pass
+        except:
+            log.info(f"Unable to read timing file {fn}",exc_info=True)
+
+    return rows
+
+
+class CostModel:
+    """
+    Per-detection cost (seconds) fitted from the timings of earlier runs
+    """
+
+    def __init__(self,rows,config,host=None):
+        """
+        :param rows: as from read_timing_files()
+        :param config: run_config() of the run to be sized
+        :param host: if given (and there are at least G.COST_MODEL_MIN_ROWS timings from it), use only timings
+                     from this host
+        """
+        self.config = tuple(config)
+
+        if host is not None:
+            host_rows = [r for r in rows if r["host"] == host]
+            if len(host_rows) >= G.COST_MODEL_MIN_ROWS:
+                rows = host_rows
+
+        startup = [r["total"] for r in rows if r["key"] == STARTUP_KEY]
+        rows = [r for r in rows if r["key"] != STARTUP_KEY]
+
+        #(most to least specific) group of timings that best matches the run configuration
+        self.mean = None
+        self.var = None
+        self.level = None
+        self.count = 0
+        for level in range(len(CONFIG_COLUMNS),-1,-1):
+            match = [r["total"] for r in rows if tuple(r[c] for c in CONFIG_COLUMNS[:level]) == self.config[:level]]
+            if len(match) >= G.COST_MODEL_MIN_ROWS:
+                self.mean = float(np.mean(match))
+                self.var = float(np.var(match))
+                self.level = level
+                self.count = len(match)
+                break
+
+        #detections timed before with the same configuration
+        self.known = {}
+        for r in rows:
+            if tuple(r[c] for c in CONFIG_COLUMNS) == self.config:
+                self.known.setdefault(r["key"],[]).append(r["total"])
+
+        if len(startup) >= G.COST_MODEL_MIN_ROWS:
+            self.startup = float(np.percentile(startup,G.COST_MODEL_PERCENTILE))
+        else:
+            self.startup = None
+
+    def usable(self):
+        return self.mean is not None
+
+    def estimate(self,detections):
+        """
+        :param detections: list of detections (see detection_key())
+        :return: per detection mean and variance (seconds) arrays
+        """
+        means = np.full(len(detections),self.mean)
+        variances = np.full(len(detections),self.var)
+        if len(self.known) > 0:
+            for i, d in enumerate(detections):
+                t = self.known.get(detection_key(d))
+                if t is not None:
+                    means[i] = np.mean(t)
+        return means, variances
+
+    def summary(self):
+        return (f"{self.count} timings ({', '.join(self.config[:self.level]) if self.level else 'all'}): "
+                f"mean {self.mean:0.1f}s, sd {np.sqrt(self.var):0.1f}s per detection, "
+                f"startup {'n/a' if self.startup is None else '%0.1fs' % self.startup}, "
+                f"{len(self.known)} detections timed before")
+
+
+def fit(args,host=None,patterns=None):
+    """
+    :param args: the (parsed) command line args of the run to be sized
+    :param host: (optional) host name, to prefer its timings
+    :param patterns: timing files, directories or glob patterns of earlier runs (default DEFAULT_HISTORY)
+    :return: CostModel, or None if there are too few timings
+    """
+    rows = read_timing_files(patterns)
+    if len(rows) == 0:
+        return None
+    model = CostModel(rows,run_config(args),host)
+    if not model.usable():
+        return None
+    log.info("Cost model: " + model.summary())
+    return model
+
+
+def task_seconds(means,variances,indices):
+    """
+    Expected run time of a task (one dispatch_xxxx list) with a safety margin of G.COST_MODEL_SIGMA standard
+    deviations
+
+    :param means: per detection mean seconds
+    :param variances: per detection variance
+    :param indices: the detections in the task
+    :return: seconds (excluding startup)
+    """
+    idx = np.asarray(list(indices),dtype=int)
+    return float(np.sum(means[idx]) + G.COST_MODEL_SIGMA * np.sqrt(np.sum(variances[idx])))
@@ -0,0 +1,330 @@
+"""
+Local, on-disk cache of the imaging (FITS) fetched from the web-backed catalogs (DECaLS, Pan-STARRS, SDSS)
+with a concurrent prefetcher.
+
+Cutouts are content addressed: the file name is a hash of (survey, band, position rounded to a
+G.CUTOUT_CACHE_GRID_ARCSEC grid, size), so the same request from any detection, run, or process (all sharing the
+G.CUTOUT_CACHE_PATH directory) is only ever downloaded once. The cache is bounded (G.CUTOUT_CACHE_MAX_MB); the least
+recently used cutouts are dropped first. Positions with no imaging are cached as empty files so they are not
+re-queried.
+
+With G.CUTOUT_CACHE_OFFLINE, nothing is fetched; only cached cutouts are used (i.e. for --recover reruns).
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import os
+import io
+import time
+import hashlib
+import threading
+
+log = G.Global_Logger('cutout_cache')
+log.setlevel(G.LOG_LEVEL)
+
+
+class CutoutCache:
+
+    def __init__(self,path,max_mb=None):
+        """
+        :param path: (shared, writable) cache directory
+        :param max_mb: size budget (MB); least recently used cutouts are removed once the total exceeds this
+        """
+        if max_mb is None:
+            max_mb = G.CUTOUT_CACHE_MAX_MB
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.total_bytes = None #lazy, on first put
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(survey,band,ra,dec,size):
+        """
+        :param survey: i.e. "decals"
+        :param band: filter, i.e. "g"
+        :param ra: decimal degrees
+        :param dec: decimal degrees
+        :param size: cutout size or query radius (arcsec)
+        :return: content address (hex string)
+        """
+        grid = G.CUTOUT_CACHE_GRID_ARCSEC / 3600.
+        s = "%s|%s|%d|%d|%0.1f" % (str(survey).lower(),str(band),int(round(ra / grid)),int(round(dec / grid)),
+                                   float(size))
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def filename(self,key):
+        return os.path.join(self.path,key[0:2],key + ".fits")
+
+    def get(self,survey,band,ra,dec,size):
+        """
+        :return: cached bytes, b"" if cached as having no imaging, or None if not cached
+        """
+        fn = self.filename(self.key(survey,band,ra,dec,size))
+        try:
+            with open(fn,"rb") as f:
+                data = f.read()
+            try:
+                os.utime(fn) #mark as recently used
+            except:
+                pass
+            return data
+        except FileNotFoundError:
+            return None
+        except:
+            log.info(f"Unable to read cached cutout {fn}",exc_info=True)
+            return None
+
+    def put(self,survey,band,ra,dec,size,data):
+        """
+        :param data: bytes (None or b"" to record that there is no imaging)
+        :return: True if written
+        """
+        if data is None:
+            data = b""
+
+        fn = self.filename(self.key(survey,band,ra,dec,size))
+        tmp_fn = fn + ".%d.%d.tmp" % (os.getpid(),threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(fn),exist_ok=True)
+            with open(tmp_fn,"wb") as f:
+                f.write(data)
+            os.replace(tmp_fn,fn) #concurrent readers never see a partial file
+        except:
+            log.info(f"Unable to write cached cutout {fn}",exc_info=True)
+            try:
+                os.remove(tmp_fn)
+            except:
+                pass
+            return False
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(f[2] for f in self._files())
+            else:
+                self.total_bytes += len(data)
+
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+        return True
+
+    def _files(self):
+        """
+        :return: list of (last used time, filename, size) of all cached cutouts
+        """
+        files = []
+        try:
+            for sub in os.scandir(self.path):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.name.endswith(".fits"):
+                        try:
+                            st = entry.stat()
+                            files.append((st.st_mtime,entry.path,st.st_size))
+                        except:
+                            pass
+        except:
+            log.info("Unable to scan cutout cache",exc_info=True)
+        return files
+
+    def evict(self,target_fraction=0.9):
+        """
+        Remove the least recently used cutouts until the cache is under target_fraction of the budget
+        (the directory is rescanned, since other processes share it)
+        """
+        files = sorted(self._files())
+        total = sum(f[2] for f in files)
+        target = self.max_bytes * target_fraction
+        removed = 0
+        for _, fn, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(fn)
+                total -= size
+                removed += 1
+            except:
+                pass
+        self.total_bytes = total
+        log.debug(f"Cutout cache evicted {removed} cutouts. {total/1e6:0.1f} MB remain.")
+
+
+_cache = None
+_cache_path = None
+
+
+def get_cache():
+    """
+    :return: the CutoutCache for G.CUTOUT_CACHE_PATH or None if caching is not configured
+    """
+    global _cache, _cache_path
+    if G.CUTOUT_CACHE_PATH is None:
+        return None
+    if (_cache is None) or (_cache_path != G.CUTOUT_CACHE_PATH):
+        _cache = CutoutCache(G.CUTOUT_CACHE_PATH)
+        _cache_path = G.CUTOUT_CACHE_PATH
+    return _cache
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def http_session():
+    """
+    :return: a (per process) requests.Session with a connection pool sized for the prefetch threads
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if (_session is None) or (_session_pid != os.getpid()): #not shared across a fork
+            import requests
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=G.CUTOUT_PREFETCH_WORKERS,
+                                                    pool_maxsize=G.CUTOUT_PREFETCH_WORKERS)
+            _session.mount("http://",adapter)
+            _session.mount("https://",adapter)
+            _session_pid = os.getpid()
+    return _session
+
+
+def fetch_url(url,min_bytes=0,retries=None,timeout=None,backoff=1.0,verify=True):
+    """
+    HTTP GET with retry (and exponential backoff) on connection errors, timeouts, 429 and 5xx responses
+
+    :param url:
+    :param min_bytes: a (200) response shorter than this is treated as "no imaging"
+    :param retries: max attempts (default G.CUTOUT_FETCH_RETRIES)
+    :param timeout: seconds (default G.CUTOUT_FETCH_TIMEOUT)
+    :param backoff: seconds before the first retry (doubles each retry)
+    :param verify: if False, do not validate the server certificate
+    :return: content (bytes), b"" if there is no imaging (4xx or short response), None if the fetch failed
+    """
+    if retries is None:
+        retries = G.CUTOUT_FETCH_RETRIES
+    if timeout is None:
+        timeout = G.CUTOUT_FETCH_TIMEOUT
+
+    for attempt in range(max(1,retries)):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            response = http_session().get(url,allow_redirects=True,timeout=timeout,verify=verify)
+            if response.status_code == 200:
+                if len(response.content) < min_bytes:
+                    log.debug(f"Bad (short) response (no image?) from {url}")
+                    return b""
+                return response.content
+            elif (response.status_code == 429) or (response.status_code >= 500):
+                log.debug(f"http response code = {response.status_code} ({response.reason}) from {url}. Will retry.")
+            else:
+                log.debug(f"http response code = {response.status_code} ({response.reason}) from {url}")
+                return b""
+        except:
+            log.debug(f"Exception fetching {url}. Will retry.",exc_info=True)
+
+    log.info(f"Unable to fetch {url} after {retries} attempts.")
+    return None
+
+
+def get_cutout(survey,band,ra,dec,size,fetch):
+    """
+    Get the imaging bytes from the cache or fetch (and cache) them
+
+    :param survey: i.e. "decals"
+    :param band: filter
+    :param ra: decimal degrees
+    :param dec: decimal degrees
+    :param size: cutout size or query radius (arcsec)
+    :param fetch: function() that returns the bytes, b"" if there is no imaging, None on a (transient) failure
+    :return: bytes or None (no imaging or not available)
+    """
+    cache = get_cache()
+    if cache is not None:
+        data = cache.get(survey,band,ra,dec,size)
+        if data is not None:
+            return data if len(data) > 0 else None
+
+    if G.CUTOUT_CACHE_OFFLINE:
+        log.info(f"Offline. {survey} ({ra},{dec}) band {band} is not in the cutout cache.")
+        return None
+
+    try:
+        data = fetch()
+    except:
+        log.info(f"Exception fetching {survey} ({ra},{dec}) band {band}",exc_info=True)
+        data = None
+
+    if (cache is not None) and (data is not None):
+        cache.put(survey,band,ra,dec,size,data)
+
+    return data if (data is not None) and (len(data) > 0) else None
+
+
+def get_hdulist(survey,band,ra,dec,size,fetch):
+    """
+    get_cutout() opened as a FITS HDUList
+
+    :return: astropy HDUList or None
+    """
+    data = get_cutout(survey,band,ra,dec,size,fetch)
+    if data is None:
+        return None
+    try:
+        from astropy.io import fits
+        return fits.open(io.BytesIO(data))
+    except:
+        log.info(f"Unable to open {survey} ({ra},{dec}) band {band} as FITS",exc_info=True)
+        return None
+
+
+def hdulist_to_bytes(hdulist):
+    """
+    :return: the HDUList as FITS bytes (b"" if None)
+    """
+    if hdulist is None:
+        return b""
+    buffer = io.BytesIO()
+    hdulist.writeto(buffer)
+    return buffer.getvalue()
+
+
+def prefetch(cutout_requests,workers=None):
+    """
+    Fetch (concurrently) into the cache all the requested cutouts that are not already cached
+
+    :param cutout_requests: list of (survey, band, ra, dec, size, fetch) as for get_cutout()
+    :param workers: number of fetch threads (default G.CUTOUT_PREFETCH_WORKERS)
+    :return: number of cutouts fetched
+    """
+    cache = get_cache()
+    if (cache is None) or G.CUTOUT_CACHE_OFFLINE or (len(cutout_requests) == 0):
+        return 0
+
+    if workers is None:
+        workers = G.CUTOUT_PREFETCH_WORKERS
+
+    #unique and not already cached
+    todo = {}
+    for r in cutout_requests:
+        k = cache.key(*r[0:5])
+        if (k not in todo) and (not os.path.isfile(cache.filename(k))):
+            todo[k] = r
+
+    if len(todo) == 0:
+        return 0
+
+    import concurrent.futures
+    start_time = time.time()
+    fetched = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,workers)) as pool:
+        for data in pool.map(lambda r: get_cutout(*r),todo.values()):
+            if data is not None:
+                fetched += 1
+
+    elapsed = max(time.time() - start_time,1e-6)
+    log.info(f"Prefetched {fetched} of {len(todo)} cutouts in {elapsed:0.1f}s ({len(todo)/elapsed:0.1f} requests/s).")
+    return fetched
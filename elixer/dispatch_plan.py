@@ -0,0 +1,273 @@
+"""
+Locality-aware planning of the SLURM dispatch_xxxx lists (selixer.py).
+
+Rather than split the detections into dispatches by count (in list order), detections are grouped by shot (the
+shot HDF5 each has to load) and by imaging tile (the HSC tract, KPNO tile or, off those footprints, a coarse sky
+cell for the wide-area and web catalogs), and the groups are packed into the dispatches so that each dispatch
+touches as few shots and tiles as possible while the dispatches stay balanced by estimated cost.
+
+The cost of a dispatch is the sum of its detections' costs, plus G.DISPATCH_SHOT_COST for each shot and
+G.DISPATCH_TILE_COST for each imaging tile it has to load.
+"""
+
+try:
+    from elixer import global_config as G
+    from elixer import h5_pool
+    from elixer import tile_meta
+except:
+    import global_config as G
+    import h5_pool
+    import tile_meta
+
+import heapq
+import numpy as np
+
+log = G.Global_Logger('dispatch_plan')
+log.setlevel(G.LOG_LEVEL)
+
+NO_SHOT = -1
+
+_tile_metas = None #list of (survey, TileMeta, tile key -> group name cache)
+
+
+def _imaging_tiles():
+    global _tile_metas
+    if _tile_metas is None:
+        _tile_metas = []
+        for survey, module_name, dict_name in (("hsc","hsc_meta","HSC_META_DICT"),("kpno","kpno_meta","KPNO_META_DICT")):
+            try:
+                meta = tile_meta.TileMeta(module_name,dict_name)
+                if len(meta) > 0:
+                    _tile_metas.append((survey,meta,{}))
+            except:
+                log.info(f"Unable to load {survey} tile metadata. Not used for dispatch planning.",exc_info=True)
+    return _tile_metas
+
+
+def imaging_key(ra,dec):
+    """
+    The imaging a detection will load: the HSC tract or KPNO tile covering the position, else the sky cell
+    (G.DISPATCH_SKY_CELL_DEG on a side) it falls in
+
+    :param ra: decimal degrees
+    :param dec: decimal degrees
+    :return: string key (i.e. "hsc:9813", "kpno:<tile>", "sky:41_-3"), or None if the position is not valid
+    """
+    try:
+        if not (np.isfinite(ra) and np.isfinite(dec)):
+            return None
+    except:
+        return None
+
+    for survey, meta, names in _imaging_tiles():
+        tile = meta.index.best_tile(ra,dec)
+        if tile is None:
+            continue
+        name = names.get(tile)
+        if name is None:
+            if survey == "hsc":
+                name = "hsc:" + str(meta[tile]['tract']) #all the tiles of a tract share the tract catalog
+            else:
+                name = survey + ":" + str(tile)
+            names[tile] = name
+        return name
+
+    cell = G.DISPATCH_SKY_CELL_DEG
+    return "sky:%d_%d" % (int(np.floor(ra / cell)),int(np.floor(dec / cell)))
+
+
+def detection_locality(hdf5_fn,detectids):
+    """
+    Shot and position of HETDEX detections (batched lookup in the Detections table)
+
+    :param hdf5_fn: HETDEX detections HDF5 file
+    :param detectids: list of detectids
+    :return: shotids, ras, decs arrays aligned with detectids (NO_SHOT and NaN where not found)
+    """
+    shotids = np.full(len(detectids),NO_SHOT,dtype=np.int64)
+    ras = np.full(len(detectids),np.nan)
+    decs = np.full(len(detectids),np.nan)
+
+    try:
+        rows = h5_pool.read_by_detectids(hdf5_fn,"/Detections",detectids)
+        for i, d in enumerate(detectids):
+            r = rows.get(np.int64(d))
+            if r is not None and len(r) > 0:
+                shotids[i] = r['shotid'][0]
+                ras[i] = r['ra'][0]
+                decs[i] = r['dec'][0]
+    except:
+        log.warning("Unable to look up detection shots and positions for dispatch planning.",exc_info=True)
+
+    return shotids, ras, decs
+
+
+def coord_locality(rows):
+    """
+    Shot and position of re-extraction (--aperture) rows
+
+    :param rows: list of [ra, dec, shotid (or None), ...] rows or detectids
+    :return: shotids, ras, decs arrays aligned with rows (NO_SHOT and NaN where not given)
+    """
+    shotids = np.full(len(rows),NO_SHOT,dtype=np.int64)
+    ras = np.full(len(rows),np.nan)
+    decs = np.full(len(rows),np.nan)
+
+    for i, row in enumerate(rows):
+        try:
+            if np.isscalar(row) or len(row) < 2:
+                continue
+            ras[i] = float(row[0])
+            decs[i] = float(row[1])
+            if (len(row) > 2) and (row[2] is not None):
+                shotids[i] = int(row[2])
+        except:
+            pass
+
+    return shotids, ras, decs
+
+
+def plan_dispatches(shotids,tiles,tasks,costs=None):
+    """
+    Pack the detections into dispatches by locality
+
+    The detections are grouped by (imaging tile, shot). Any group costing more than an even share of the total is
+    split (in order) into even-share sized pieces. Pieces are placed largest first: into the least loaded dispatch
+    that already has the same shot or tile (if it stays under the even share plus G.DISPATCH_PLAN_SLACK), otherwise
+    into the least loaded dispatch. Within each dispatch, detections are ordered by tile and shot.
+
+    :param shotids: shotid per detection (NO_SHOT if unknown)
+    :param tiles: imaging key per detection (see imaging_key(); None if unknown)
+    :param tasks: number of dispatches
+    :param costs: estimated cost per detection (default 1.0 each)
+    :return: list (one per dispatch) of lists of indices into the detections (no dispatch is empty if there are at
+             least as many detections as tasks)
+    """
+    n = len(shotids)
+    tasks = max(1,min(int(tasks),n))
+    if costs is None:
+        costs = np.ones(n)
+    else:
+        costs = np.asarray(costs,dtype=float)
+
+    tiles = ["" if t is None else str(t) for t in tiles]
+
+    #groups of (tile, shot), in order
+    groups = {}
+    for i in range(n):
+        groups.setdefault((tiles[i],int(shotids[i])),[]).append(i)
+
+    num_shots = len(set(shot for _, shot in groups.keys() if shot != NO_SHOT))
+    num_tiles = len(set(tile for tile, _ in groups.keys() if tile != ""))
+    share = (np.sum(costs) + G.DISPATCH_SHOT_COST * num_shots + G.DISPATCH_TILE_COST * num_tiles) / tasks
+    capacity = share * (1.0 + G.DISPATCH_PLAN_SLACK)
+
+    pieces = [] #(cost, order, tile, shot, indices)
+    for (tile, shot), idx in sorted(groups.items()):
+        piece = []
+        piece_cost = 0.0
+        for i in idx:
+            if (len(piece) > 0) and (piece_cost + costs[i] > share):
+                pieces.append((piece_cost,len(pieces),tile,shot,piece))
+                piece = []
+                piece_cost = 0.0
+            piece.append(i)
+            piece_cost += costs[i]
+        pieces.append((piece_cost,len(pieces),tile,shot,piece))
+
+    pieces.sort(key=lambda p: (-p[0],p[1]))
+
+    loads = np.zeros(tasks)
+    members = [[] for _ in range(tasks)]
+    shots_in = [set() for _ in range(tasks)]
+    tiles_in = [set() for _ in range(tasks)]
+    by_shot = {} #shot : set of dispatches holding it
+    by_tile = {} #tile : set of dispatches holding it
+    heap = [(0.0,d) for d in range(tasks)] #(load, dispatch), lazily updated
+
+    def added_cost(d,cost,tile,shot):
+        extra = cost
+        if (shot != NO_SHOT) and (shot not in shots_in[d]):
+            extra += G.DISPATCH_SHOT_COST
+        if (tile != "") and (tile not in tiles_in[d]):
+            extra += G.DISPATCH_TILE_COST
+        return extra
+
+    for cost, _, tile, shot, idx in pieces:
+        best = None
+        for d in by_shot.get(shot,set()) | by_tile.get(tile,set()): #(unknown shots and tiles are not tracked)
+            load = loads[d] + added_cost(d,cost,tile,shot)
+            if (load <= capacity) and ((best is None) or (load < best[0])):
+                best = (load,d)
+
+        if best is None:
+            while True: #least loaded dispatch
+                load, d = heapq.heappop(heap)
+                if load == loads[d]:
+                    break
+            best = (loads[d] + added_cost(d,cost,tile,shot),d)
+
+        load, d = best
+        loads[d] = load
+        heapq.heappush(heap,(load,d))
+        members[d].append(idx)
+        shots_in[d].add(shot)
+        tiles_in[d].add(tile)
+        if shot != NO_SHOT:
+            by_shot.setdefault(shot,set()).add(d)
+        if tile != "":
+            by_tile.setdefault(tile,set()).add(d)
+
+    dispatches = []
+    for m in members:
+        idx = [i for piece in m for i in piece]
+        idx.sort(key=lambda i: (tiles[i],int(shotids[i]),i))
+        dispatches.append(idx)
+
+    #no empty dispatches: split the largest ones
+    for d in range(tasks):
+        if len(dispatches[d]) == 0:
+            big = int(np.argmax([len(x) for x in dispatches]))
+            half = len(dispatches[big]) // 2
+            dispatches[d] = dispatches[big][half:]
+            dispatches[big] = dispatches[big][:half]
+
+    return dispatches
+
+
+def plan(subdirs,tasks,hdf5_fn=None,costs=None):
+    """
+    Locality-aware dispatch plan for the selixer detection list
+
+    :param subdirs: list of detectids or of re-extraction rows (ra, dec, shotid, ...)
+    :param tasks: number of dispatches
+    :param hdf5_fn: HETDEX detections HDF5 file (to look up the detectids)
+    :param costs: estimated cost per detection (default 1.0 each)
+    :return: list (one per dispatch) of lists of indices into subdirs, or None if the locality is unknown
+    """
+    if len(subdirs) == 0:
+        return None
+
+    if all(np.isscalar(s) for s in subdirs):
+        if hdf5_fn is None:
+            return None
+        try:
+            detectids = [np.int64(s) for s in subdirs]
+        except:
+            return None
+        shotids, ras, decs = detection_locality(hdf5_fn,detectids)
+    else:
+        shotids, ras, decs = coord_locality(subdirs)
+
+    if np.all(shotids == NO_SHOT) and not np.any(np.isfinite(ras)):
+        return None
+
+    tiles = [imaging_key(r,d) for r, d in zip(ras,decs)]
+    dispatches = plan_dispatches(shotids,tiles,tasks,costs)
+
+    loads = [len(set((tiles[i],shotids[i]) for i in x)) for x in dispatches]
+    log.info(f"Dispatch plan: {len(subdirs)} detections in {len(set(zip(tiles,shotids)))} (tile, shot) groups "
+             f"over {len(dispatches)} dispatches. (Tile, shot) groups per dispatch: mean {np.mean(loads):0.1f}, "
+             f"max {np.max(loads)}.")
+
+    return dispatches
@@ -14,6 +14,12 @@ try:
     from elixer import science_image
     from elixer import elixer_hdf5
     from elixer import spectrum_utilities as SU
+    from elixer import h5_pool
+    from elixer import report_image
+    from elixer import report_db
+    from elixer import cost_model
+    from elixer import work_queue
+    from elixer import manifest
 except:
     import hetdex
     import match_summary
@@ -23,6 +29,12 @@ except:
     import science_image
     import elixer_hdf5
     import spectrum_utilities as SU
+    import h5_pool
+    import report_image
+    import report_db
+    import cost_model
+    import work_queue
+    import manifest
 
 from hetdex_api import survey as hda_survey
 
@@ -44,6 +56,7 @@ import os
 import fnmatch
 import errno
 import time
+import signal
 import numpy as np
 #import re
 from PIL import Image as PIL_Image
@@ -323,6 +336,15 @@ def parse_commandline(auto_force=False):
                         action='store_true', default=False)
     parser.add_argument('--png', help='Also save report in PNG format.', required=False,
                         action='store_true', default=False)
+    parser.add_argument('--direct_image', help='Render the --png/--jpg report images directly from the report figures '
+                                               '(no PDF to image conversion).', required=False,
+                        action='store_true', default=False)
+    parser.add_argument('--no_pdf', help='With --direct_image, do not also write the PDF report.', required=False,
+                        action='store_true', default=False)
+    parser.add_argument('--report_db', help='Directory of SQLite report databases into which the PNG report images '
+                                            '(report, _nei, _mini) are written as they are made, instead of as '
+                                            'individual files. Combine the per-process parts afterward with '
+                                            'make_report_db.py --merge.', required=False, default=None)
 
     #1.9.0a3 keeping this around for backward compatibility (if anyone passes it on the call
     #the default behavior now IS blind, so add a not_blind switch to force validation
@@ -400,6 +422,13 @@ def parse_commandline(auto_force=False):
                                        " Force (2) and override any other catalog",
                         required=False, default=1,type=int) #default to -1 auto shuts off if in dispatch mode
 
+    parser.add_argument('--cutout_cache', help="Directory in which to cache (and share between runs) the imaging fetched "
+                                               "from the web (DECaLS, Pan-STARRS, SDSS).", required=False, default=None)
+
+    parser.add_argument('--cutout_offline', help="Do not fetch any imaging from the web; use only what is in the "
+                                                 "--cutout_cache (i.e. for --recover reruns).", required=False,
+                        action='store_true', default=False)
+
     parser.add_argument('--nophoto', help='Turn OFF the use of archival photometric catalogs.', required=False,
                         action='store_true', default=False)
 
@@ -436,6 +465,21 @@ def parse_commandline(auto_force=False):
     parser.add_argument('--lyc', help='Toggle [ON] Lyman Continuum special switch. Do not use unless you know what you are doing.',
                         required=False, action='store_true', default=False)
 
+    parser.add_argument('--dispatch_plan', help="For use with SLURM only. How to split the detections into dispatches: "
+                                                "'locality' (default) groups them by shot and imaging tile; 'count' "
+                                                "splits them in list order", required=False, default="locality")
+
+    parser.add_argument('--work_queue', help="For use with SLURM only. Directory (created under the run directory) of a "
+                                             "shared queue of detection batches that the tasks claim from until it is "
+                                             "empty, instead of each task processing a fixed dispatch_xxxx list. "
+                                             "With --recover, unfinished batches are requeued.", required=False)
+
+    parser.add_argument('--cost_history', help="For use with SLURM only. Comma separated list of ELiXer timing files "
+                                               "(*_timing.tsv), directories or glob patterns of earlier runs from which "
+                                               "to fit the per-detection cost model that sizes the job. Default: the "
+                                               "other run directories next to this one. 'none' to use the fixed "
+                                               "per-host estimates", required=False)
+
     parser.add_argument('--dependency', help="For use with SLURM only. Set optional condition and SLURM_ID of job to "
                                              "finish prior to this one starting. e.g: afterok:123456  or afterany:123456",
                         required=False)
@@ -445,6 +489,10 @@ def parse_commandline(auto_force=False):
 
     parser.add_argument('--known_z', help="Produce plots using this value for redshift", required=False, type=float)
 
+    parser.add_argument('--workers', help="Number of worker processes over which to fan out the detections (each worker "
+                                          "preloads its own catalogs). Default (1) processes detections serially.",
+                        required=False, type=int, default=1)
+
     # parser.add_argument('--sky_residual', help='Toggle [ON] shot-specific sky residual subtraction for forced-extracions.',
     #                     required=False, action='store_true', default=False)
 
@@ -470,6 +518,7 @@ def parse_commandline(auto_force=False):
         #if in dispatch mode (SLURM mode) we are already using all/most the cores (as balanced vs memory, etc)
         #so the multiprocess call actually slows down the overall execution
         G.GET_SPECTRA_MULTIPROCESS = False
+        G.RASTER_SEARCH_WORKERS = 1
 
     #reminder to self ... this is pointless with SLURM given the bash wraper (which does not know about the
     #speccific dir name and just builds elixer.run
@@ -665,6 +714,23 @@ def parse_commandline(auto_force=False):
         G.ALLOW_EMPTY_IMAGE = True
 
 
+    if args.cutout_cache is not None:
+        G.CUTOUT_CACHE_PATH = args.cutout_cache
+
+    if args.cutout_offline:
+        G.CUTOUT_CACHE_OFFLINE = True
+
+    if args.direct_image:
+        G.REPORT_IMAGE_DIRECT = True
+        if args.no_pdf:
+            G.REPORT_PDF = False
+    elif args.no_pdf:
+        print("Ignoring --no_pdf (valid only with --direct_image).")
+        log.warning("Ignoring --no_pdf (valid only with --direct_image).")
+
+    if args.report_db is not None:
+        G.REPORT_DB_PATH = args.report_db
+
     if args.nophoto:
         G.USE_PHOTO_CATS = False
 
@@ -908,6 +974,9 @@ def parse_commandline(auto_force=False):
     if args.include_all_amps:
         G.INCLUDE_ALL_AMPS = True
 
+    if (args.workers is None) or (args.workers < 1):
+        args.workers = 1
+
     if valid_parameters(args):
         return args
     else:
@@ -1160,6 +1229,95 @@ def build_pages (pdfname,match,ra,dec,error,cats,pages,num_hits=0,idstring="",ba
     return pages, count
 
 
+def prefetch_web_cutouts(coords,cats,cat_decals_web,cat_panstarrs,cat_sdss,error):
+    """
+    Concurrently download (into the cutout cache) the web catalog imaging for all the detections that will use it,
+    following the same choice of web catalog as main() (forced, or as the fallback when no local catalog covers
+    the position). Does nothing if there is no cutout cache or it is offline.
+
+    :param coords: list of (ra, dec) decimal degrees, one per detection
+    :param cats: local catalogs
+    :return: number of cutouts fetched
+    """
+    if (G.CUTOUT_CACHE_PATH is None) or G.CUTOUT_CACHE_OFFLINE:
+        return 0
+
+    try:
+        try:
+            from elixer import cutout_cache
+        except:
+            import cutout_cache
+
+        cutout_requests = []
+        for ra, dec in coords:
+            if (ra is None) or (dec is None):
+                continue
+
+            web_cat = None
+            if G.DECALS_WEB_FORCE:
+                web_cat = cat_decals_web
+            elif G.PANSTARRS_FORCE:
+                web_cat = cat_panstarrs
+            elif G.SDSS_FORCE:
+                web_cat = cat_sdss
+            elif not any(c.position_in_cat(ra=ra, dec=dec, error=error) for c in cats):
+                if G.DECALS_WEB_ALLOW:
+                    web_cat = cat_decals_web
+                elif G.PANSTARRS_ALLOW:
+                    web_cat = cat_panstarrs
+                elif G.SDSS_ALLOW:
+                    web_cat = cat_sdss
+
+            if (web_cat is not None) and hasattr(web_cat,"cutout_requests"):
+                cutout_requests += web_cat.cutout_requests(ra,dec,error)
+
+        return cutout_cache.prefetch(cutout_requests)
+    except:
+        log.info("Exception prefetching web cutouts.",exc_info=True)
+        return 0
+
+
+def detection_coords(emis_list):
+    """
+    :param emis_list: list of DetObj
+    :return: list of (ra, dec) the imaging is built around, one per DetObj (the weighted RA and Dec if available)
+    """
+    coords = []
+    for e in emis_list:
+        if (e.wra is not None) and (e.wdec is not None):  # weighted RA and Dec
+            coords.append((e.wra, e.wdec))
+        else:
+            coords.append((e.ra, e.dec))
+    return coords
+
+
+def prefetch_detections(args,detections,cats,cat_decals_web,cat_panstarrs,cat_sdss):
+    """
+    Ahead of building a chunk of (HDF5 run) detections: bulk read their HETDEX HDF5 rows and download (concurrently)
+    the web imaging the whole chunk will need, rather than one detection at a time
+
+    :param args: the (parsed) command line args
+    :param detections: the chunk of the master hdf5 detection list (detectids or explicit extraction RA, Dec, ...)
+    :param cats: local catalogs
+    :return: None
+    """
+    detectids = [d for d in detections if np.isscalar(d)]
+    coords = []
+    for d in detections:
+        if (not np.isscalar(d)) and (len(d) >= 2):
+            try:
+                coords.append((float(d[0]),float(d[1])))
+            except:
+                pass
+
+    if (len(detectids) > 0) and (args.hdf5 is not None):
+        hetdex.DetObj.prefetch_hdf5(args.hdf5,detectids)
+        coords += hetdex.DetObj.prefetched_coords(args.hdf5,detectids)
+
+    if not args.neighborhood_only: #(no catalog imaging is built for neighborhood only reports)
+        prefetch_web_cutouts(coords,cats,cat_decals_web,cat_panstarrs,cat_sdss,args.error)
+
+
 def open_report(report_name):
     return PdfPages(report_name)
 
@@ -1224,6 +1382,11 @@ def build_report_part(report_name,pages,page_num=None):
         else:
             part_name = report_name + ".part%s" % (str(page_num).zfill(4))
 
+        if G.REPORT_IMAGE_DIRECT:
+            report_image.write_part(part_name,pages)
+            if not G.REPORT_PDF:
+                return
+
         pdf = PdfPages(part_name)
         rows = len(pages)
 
@@ -1419,6 +1582,8 @@ def join_report_parts(report_name, bid_count=0):
 
         writer.write(report_name)
 
+    if os.path.isfile(report_name):
+        manifest.note(report_name)
     print("File written: " + report_name)
 
 
@@ -1427,6 +1592,7 @@ def delete_report_parts(report_name):
         report_name = report_name.rstrip("!")
     for f in glob.glob(report_name+".part*"):
         os.remove(f)
+    report_image.discard_parts(report_name) #(any rasterized parts not joined)
 
 def confirm(hits,force):
 
@@ -1671,12 +1837,14 @@ def convert_pdf(filename, resolution=150, jpeg=True, png=False):
                         img.format = 'jpg'
                         image_name = filename.rstrip(".pdf") + ".jpg"
                         img.save(filename=image_name)
+                        manifest.note(image_name)
                         print("File written: " + image_name)
 
                     if png:
                         img.format = 'png'
                         image_name = filename.rstrip(".pdf") + ".png"
                         img.save(filename=image_name)
+                        manifest.note(image_name)
                         print("File written: " + image_name)
         else:
             pages = convert_from_path(filename,resolution)
@@ -1686,7 +1854,9 @@ def convert_pdf(filename, resolution=150, jpeg=True, png=False):
                         image_name = filename.rstrip(".pdf") + "_p%02d.png" %i
                     else:
                         image_name = filename.rstrip(".pdf") + ".png"
-                    pages[i].save(image_name,"PNG")
+                    buffer = io.BytesIO()
+                    pages[i].save(buffer,"PNG")
+                    report_db.save_image_bytes(image_name,buffer.getvalue())
                     print("File written: " + image_name)
 
             if jpeg:
@@ -1696,6 +1866,7 @@ def convert_pdf(filename, resolution=150, jpeg=True, png=False):
                     else:
                         image_name = filename.rstrip(".pdf") + ".jpg"
                     pages[i].save(image_name,"JPEG")
+                    manifest.note(image_name)
                     print("File written: " + image_name)
 
     except Exception as e:
@@ -1762,7 +1933,7 @@ def get_hdf5_detectids_by_coord(hdf5,ra,dec,error,sort=False):
                 return detectids
 
         log.info("Searching for records by RA, Dec + error (this may take a while) ... ")
-        with tables.open_file(hdf5, mode="r") as h5:
+        with h5_pool.handle(hdf5) as h5:
             dtb = h5.root.Detections
             dec_correction = np.cos(np.deg2rad(dec))
             ra1 = ra - error/dec_correction
@@ -2424,7 +2595,11 @@ def merge_hdf5(args=None):
 
         #fn_list.append(sorted(glob.glob("dispatch_*/*/*_cat.h5")))
         if len(fn_list) != 0:
-            merge_fn = elixer_hdf5.merge_elixer_hdf5_files(merge_fn,fn_list)
+            workers = getattr(args,"workers",None)
+            if (workers is not None) and (workers > 1):
+                merge_fn = elixer_hdf5.merge_elixer_hdf5_files_tree(merge_fn,fn_list,workers=workers)
+            else:
+                merge_fn = elixer_hdf5.merge_elixer_hdf5_files(merge_fn,fn_list)
             if merge_fn is not None:
                 print("Done: " + merge_fn)
             else:
@@ -2514,6 +2689,19 @@ def prune_detection_list(args,fcsdir_list=None,hdf5_detectid_list=None):
         extension = "nei.png"
     else:
         extension = ".pdf"
+
+    #the completion manifest, if there is one, saves a stat per detection (on a shared filesystem, that adds up);
+    #detections it does not list (i.e. from before it was kept) fall back to looking for the file
+    done = manifest.completed(args.name)
+
+    def already_done(filename,require=None):
+        if done is not None:
+            for key in (args.name + "_" + filename, filename):
+                if key in done:
+                    return manifest.is_done(done[key],args.neighborhood_only,require)
+        return os.path.isfile(os.path.join(args.name, args.name + "_" + filename + extension)) or \
+               os.path.isfile(os.path.join(args.name, filename + extension))
+
     if (hdf5_detectid_list is not None) and (len(hdf5_detectid_list) > 0):
 
         for d in hdf5_detectid_list:
@@ -2521,8 +2709,13 @@ def prune_detection_list(args,fcsdir_list=None,hdf5_detectid_list=None):
             #todo: this should be made common code, so naming is consistent
             filename = str(d)
 
-            if os.path.isfile(os.path.join(args.name, args.name + "_" + filename + extension)) or \
-                os.path.isfile(os.path.join(args.name, filename + extension)):
+            #the catalog rows are buffered (see elixer_hdf5.CatalogWriter), so a report alone does not mean done
+            if G.BUILD_HDF5_CATALOG and (not args.neighborhood_only) and isinstance(d,(int,np.integer)):
+                require = "h5"
+            else:
+                require = None
+
+            if already_done(filename,require):
                 log.info("Already processed %s. Will skip recovery." %(filename))
             else:
                 log.info("Not found (%s). Will process ..." %(filename))
@@ -2533,8 +2726,7 @@ def prune_detection_list(args,fcsdir_list=None,hdf5_detectid_list=None):
 
         for d in fcsdir_list:
             filename = os.path.basename(str(d))
-            if os.path.isfile(os.path.join(args.name, args.name + "_" + filename + extension)) or \
-                os.path.isfile(os.path.join(args.name, filename + extension)):
+            if already_done(filename):
                 log.info("Already processed %s. Will skip recovery." %(filename))
             else:
                 log.info("Not found (%s). Will process ..." %(filename))
@@ -2742,11 +2934,11 @@ def build_3panel_zoo_image(fname, image_2d_fiber, image_1d_fit, image_cutout_fib
             plt.gca().axis('off')
 
             #fig.tight_layout()
-            plt.savefig(fname, format='png', dpi=300,bbox_inches='tight',transparent=False,facecolor=fig.get_facecolor())
+            report_db.savefig(fname, format='png', dpi=300,bbox_inches='tight',transparent=False,facecolor=fig.get_facecolor())
             log.debug("File written: %s" % (fname))
             plt.close()
         else:
-            plt.savefig(fname, format='png', dpi=300, bbox_inches='tight', transparent=False,facecolor=fig.get_facecolor())
+            report_db.savefig(fname, format='png', dpi=300, bbox_inches='tight', transparent=False,facecolor=fig.get_facecolor())
             log.debug("File written: %s" % (fname))
             plt.close()
 
@@ -2839,7 +3031,7 @@ def build_neighborhood_map(hdf5=None,cont_hdf5=None,detectid=None,ra=None, dec=N
 
     if (detectid is not None) and (ra is None):
         try:
-            with tables.open_file(hdf5, mode="r") as h5_detect:
+            with h5_pool.handle(hdf5) as h5_detect:
                 id = detectid
                 detection_table = h5_detect.root.Detections
                 rows = detection_table.read_where("detectid==id")
@@ -3132,7 +3324,7 @@ def build_neighborhood_map(hdf5=None,cont_hdf5=None,detectid=None,ra=None, dec=N
     wave = []
     emis = []
     shot = []
-    with tables.open_file(hdf5, mode="r") as h5_detect:
+    with h5_pool.handle(hdf5) as h5_detect:
         stb = h5_detect.root.Spectra
         dtb = h5_detect.root.Detections
         for d in detectids:
@@ -3161,7 +3353,7 @@ def build_neighborhood_map(hdf5=None,cont_hdf5=None,detectid=None,ra=None, dec=N
     #now add the continuum sources if any
     if len(cont_detectids) > 0:
         try:
-            with tables.open_file(cont_hdf5, mode="r") as h5_detect:
+            with h5_pool.handle(cont_hdf5) as h5_detect:
                 stb = h5_detect.root.Spectra
                 dtb = h5_detect.root.Detections
                 for d in cont_detectids:
@@ -3201,7 +3393,7 @@ def build_neighborhood_map(hdf5=None,cont_hdf5=None,detectid=None,ra=None, dec=N
     #now add the BROAD LINE sources if any
     if len(broad_detectids) > 0:
         try:
-            with tables.open_file(broad_hdf5, mode="r") as h5_detect:
+            with h5_pool.handle(broad_hdf5) as h5_detect:
                 stb = h5_detect.root.Spectra
                 dtb = h5_detect.root.Detections
                 for d in broad_detectids:
@@ -3400,7 +3592,7 @@ def build_neighborhood_map(hdf5=None,cont_hdf5=None,detectid=None,ra=None, dec=N
 
     if fname is not None:
         try:
-            plt.savefig(fname,format='png', dpi=75)
+            report_db.savefig(fname,format='png', dpi=75)
             log.debug("File written: %s" %(fname))
 
             # if False:
@@ -3422,53 +3614,12 @@ def build_neighborhood_map(hdf5=None,cont_hdf5=None,detectid=None,ra=None, dec=N
     return buf, nei_buf
 
 
-def check_package_versions():
-    """
-    very basic, check the common packages are at minimum levels
+def load_catalogs():
     """
-    pass
-
-def main():
-
-    global G_PDF_FILE_NUM
-    
-    already_launched_viewer = False #skip the PDF viewer laun
-
-    log.critical(f"log level {G.LOG_LEVEL}")
-    #G.gc.enable()
-    #G.gc.set_debug(G.gc.DEBUG_LEAK)
-    try:
-        args = parse_commandline()
-    except:
-        log.critical("Exception in command line.",exc_info=True)
-        exit(0)
-
-    try: #may be used for refrerence later
-         #several arguments can be modified during runtime and the original may need to be references
-        original_command_line_args = copy.deepcopy(args)
-    except:
-        pass
-
-    if args.upgrade_hdf5:
-        upgrade_hdf5(args)
-        exit(0)
-
-    if args.remove_duplicates:
-        remove_h5_duplicate_rows(args)
-        exit(0)
-
-    if args.merge_unique:
-        merge_unique(args)
-        exit(0)
-
-    if args.merge:
-        merge(args)
-        exit(0)
-
-    #later, below most of the processing will be skipped and only the neighborhood map is generated
-    if args.neighborhood_only:
-        args.neighborhood = args.neighborhood_only
+    Load the imaging/photometric catalogs used for the catalog matching phase.
 
+    :return: tuple of (cats, catch_all_cat, cat_sdss, cat_panstarrs, cat_decals_web)
+    """
     if G.USE_PHOTO_CATS:
         cat_library = catalogs.CatalogLibrary()
         cats = cat_library.get_full_catalog_list()
@@ -3477,113 +3628,64 @@ def main():
         cat_panstarrs = cat_library.get_panstarrs()
         cat_decals_web = cat_library.get_decals_web()
     else:
-        cat_library = []
         cats = []
         catch_all_cat = []
         cat_sdss = []
         cat_panstarrs = []
         cat_decals_web = []
 
-    #
-    # build_neighborhood_map(args.hdf5, 1000525650,None, None, args.neighborhood,cwave=None,fname='lycon/test_nei.png')
-    # exit()
+    return cats, catch_all_cat, cat_sdss, cat_panstarrs, cat_decals_web
 
 
-    log.critical(f"***** ELiXer version {G.__version__} *****")
-    log.critical(f"***** HETDEX DATA RELEASE {G.HDR_Version} *****")
-
-    pages = []
-
-    viewer_file_list = []
-
-    #if a --line file was provided ... old way (pre-April 2018)
-    #always build ifu_list
-    ifu_list = ifulist_from_detect_file(args)
-
-    hd_list = [] #if --line provided, one entry for each amp (or side) and dither
-    #for rsp1 variant, hd_list should be one per detection (one per rsp subdirectory) or just one hd object?
-    file_list = [] #output pdfs (parts)
-
-    fcsdir_list = []
-    hdf5_detectid_list = []
-    explicit_extraction = False
-    #is this an explicit extraction?
-    if args.aperture and args.ra and args.dec:
-        #args.wavelength, args.shotid are optional
-        print("Explicit extraction ...") #single explicit extraction
-        explicit_extraction = True
-    elif args.fcsdir is not None:
-        fcsdir_list = get_fcsdir_subdirs_to_process(args) #list of rsp1 style directories to process (each represents one detection)
-        if fcsdir_list is not None:
-            log.info("Processing %d entries in FCSDIR" %(len(fcsdir_list)))
-            print("Processing %d entries in FCSDIR" %(len(fcsdir_list)))
-
-    elif not args.neighborhood_only:
-        if args.aperture: #still
-            explicit_extraction = True
-            print("Explicit extraction ...") #list of explicit extractions
-
-        hdf5_detectid_list = get_hdf5_detectids_to_process(args)
-        if hdf5_detectid_list is not None:
-            log.info("Processing %d entries in HDF5" %(len(hdf5_detectid_list)))
-            print("Processing %d entries in HDF5" %(len(hdf5_detectid_list)))
-
-    #add as a payload to args so can easily check later
-    args.explicit_extraction = explicit_extraction
-
-    PDF_File(args.name, 1) #use to pre-create the output dir (just toss the returned pdf container)
+def process_detections(args,catalog_set,ifu_list,fcsdir_list,hdf5_detectid_list,explicit_extraction,
+                       master_loop_length=1,master_fcsdir_list=[],master_hdf5_detectid_list=[],h5name=None,
+                       catalog=None):
+    """
+    The main detection loop: build the HETDEX object(s), match against the catalogs, build the report(s),
+    the ELiXer HDF5 catalog entries, neighborhood maps, etc. for the supplied detections.
+    (Split out of main() so it can also be run by the --workers pool processes)
+
+    :param args: the (parsed) command line args
+    :param catalog_set: tuple as returned by load_catalogs()
+    :param ifu_list: (old style --line) list of IFUs
+    :param fcsdir_list: list of rsp style directories to process
+    :param hdf5_detectid_list: list of HDF5 detectids (or coordinate tuples for explicit extractions) to process
+    :param explicit_extraction: bool
+    :param master_loop_length: number of passes (one detection per pass if the master lists are populated)
+    :param master_fcsdir_list:
+    :param master_hdf5_detectid_list:
+    :param h5name: ELiXer HDF5 catalog to write (if None, use the default under args.name)
+    :param catalog: (optional) elixer_hdf5.CatalogWriter that outlives this call (i.e. a --workers process'); it is
+                    only flushed here when a batch is full, the caller flushes the rest
+    :return: list of files for the PDF viewer, bool (True if the viewer was already launched)
+    """
 
+    cats, catch_all_cat, cat_sdss, cat_panstarrs, cat_decals_web = catalog_set
 
+    if h5name is None:
+        h5name = os.path.join(args.name, args.name + "_cat.h5")
 
-    #if this is a re-run (recovery run) remove any detections that have already been processed
-    master_loop_length = 1
-    master_fcsdir_list = []
-    master_hdf5_detectid_list = []
-
-    if G.RECOVERY_RUN:
-        if args.aperture is not None:
-            #G.RECOVERY_RUN = False
-            log.info("Forced extraction does not fully support RECOVERY MODE (behavior may be unexpected).")
-            print("Forced extraction does not fully support RECOVERY MODE (behavior may be unexpected).")
-            #still want the master loop, though
-            master_loop_length = len(hdf5_detectid_list)
-            master_hdf5_detectid_list = hdf5_detectid_list
-        elif len(hdf5_detectid_list) > 0:
-            hdf5_detectid_list = prune_detection_list(args,None,hdf5_detectid_list)
-            if len(hdf5_detectid_list) == 0:
-                print("[RECOVERY MODE] All detections already processed. Exiting...")
-                log.info("[RECOVERY MODE] All detections already processed. Exiting...")
-                log.critical("Main complete.")
-                exit(0)
-            else:
-                master_loop_length = len(hdf5_detectid_list)
-                master_hdf5_detectid_list = hdf5_detectid_list
-                log.info("[RECOVERY] Processing %d entries in HDF5" % (len(hdf5_detectid_list)))
-                print("[RECOVERY] Processing %d entries in HDF5" % (len(hdf5_detectid_list)))
-        elif len(fcsdir_list):
-            fcsdir_list = prune_detection_list(args,fcsdir_list,None)
-            if len(fcsdir_list) == 0:
-                print("[RECOVERY MODE] All detections already processed. Exiting...")
-                log.info("[RECOVERY MODE] All detections already processed. Exiting...")
-                log.critical("Main complete.")
-                exit(0)
-            else:
-                master_loop_length = len(fcsdir_list)
-                master_fcsdir_list = fcsdir_list
-                log.info("[RECOVERY] Processing %d entries in FCSDIR" % (len(fcsdir_list)))
-                print("[RECOVERY] Processing %d entries in FCSDIR" % (len(fcsdir_list)))
-        else:
-            G.RECOVERY_RUN = False
-            log.debug("No list (hdf5 or fcsdir) of detections, so RECOVERY MODE turned off.")
-
-    #now, we have only the detections that have NOT been processed
+    already_launched_viewer = False
+    pages = []
+    viewer_file_list = []
+    hd_list = []
+    file_list = []
+    timer = cost_model.StageTimer(args) #per detection stage timings (for the selixer cost model)
+    own_catalog = catalog is None
+    if own_catalog and G.BUILD_HDF5_CATALOG: #rows are buffered and written every G.HDF5_CATALOG_BATCH_DETS detections
+        catalog = elixer_hdf5.CatalogWriter(h5name,overwrite=True,estimated_dets=master_loop_length)
 
     for master_loop_idx in range(master_loop_length):
+        timer.restart()
 
         #stupid, but works until I can properly reorganize
         #on each run through this loop, set the list to one element
         if len(master_hdf5_detectid_list) > 0: #this is an hdf5 run
             hdf5_detectid_list = [master_hdf5_detectid_list[master_loop_idx]]
+            if master_loop_idx % G.HDF5_PREFETCH_DETECTIONS == 0: #read ahead the next chunk of detections
+                prefetch_detections(args,
+                                    master_hdf5_detectid_list[master_loop_idx:master_loop_idx+G.HDF5_PREFETCH_DETECTIONS],
+                                    cats,cat_decals_web,cat_panstarrs,cat_sdss)
         elif len(master_fcsdir_list) > 0:
             fcsdir_list = [master_fcsdir_list[master_loop_idx]]
 
@@ -3614,6 +3716,7 @@ def main():
                 for ifu in ifu_list:
                     args.ifuslot = int(ifu)
                     hd = hetdex.HETDEX(args,basic_only=basic_only)
+                    timer.mark("load",[timer.add_key("ifu" + str(ifu),hd)])
                     if (hd is not None) and (hd.status != -1):
                         hd_list.append(hd)
             elif len(fcsdir_list) > 0: #rsp style
@@ -3631,6 +3734,7 @@ def main():
                 for key in obs_dict.keys():
                     plt.close('all')
                     hd = hetdex.HETDEX(args,fcsdir_list=obs_dict[key],basic_only=basic_only) #builds out the hd object (with fibers, DetObj, etc)
+                    timer.mark("load",[timer.add_key(key,hd)])
                     #todo: maybe join all hd objects that have the same observation
                     # could save in loading catalogs (assuming all from the same observation)?
                     # each with then multiple detections (DetObjs)
@@ -3644,10 +3748,13 @@ def main():
 
                         if isinstance(d,np.int64): #this is a detetid, not list of values RA, Dec, ...
                             hd = hetdex.HETDEX(args, fcsdir_list=None, hdf5_detectid_list=[d], basic_only=basic_only)
+                            timer.mark("load",[timer.add_key(d,hd)])
                             if hd.status == 0:
                                 hd_list.append(hd)
                             continue
 
+                        d_key = timer.add_key(d)
+
                         #otherwise this a a list of RA, Dec, ...
                         #update the args with the ra dec and shot to build an appropriate hetdex object for extraction
                         try:
@@ -3695,10 +3802,12 @@ def main():
                                 for s in shotlist:
                                     args.shotid = s
                                     hd = hetdex.HETDEX(args, basic_only=basic_only)
+                                    timer.add_key(d_key,hd)
                                     if hd.status == 0:
                                         hd_list.append(hd)
                             else:
                                 hd = hetdex.HETDEX(args,basic_only=basic_only)
+                                timer.add_key(d_key,hd)
                                 if hd.status == 0:
                                     hd_list.append(hd)
                         except:
@@ -3707,11 +3816,14 @@ def main():
                             args.ra = None
                             args.dec = None
                             args.shotid = None
+                        timer.mark("load",[d_key])
                 else:
                     #only one detection per hetdex object
+                    #(the HDF5 rows were bulk read ahead for the chunk, see prefetch_detections())
                     for d in hdf5_detectid_list:
                         plt.close('all')
                         hd = hetdex.HETDEX(args,fcsdir_list=None,hdf5_detectid_list=[d],basic_only=basic_only)
+                        timer.mark("load",[timer.add_key(d,hd)])
 
                         if hd.status == 0:
                             hd_list.append(hd)
@@ -3773,6 +3885,11 @@ def main():
                     if hd.status == 0:
                         hd_list.append(hd)
 
+        for hd in hd_list: #any not built from a listed detection (single explicit extraction, etc)
+            if timer.key_of(hd) is None:
+                timer.add_key(args.name,hd)
+        timer.mark("load")
+
         if not args.neighborhood_only:
 
             if args.score:
@@ -3831,6 +3948,12 @@ def main():
                         #matched_cats = []  ... here matched_cats needs to be per each emission line (DetObj)
                         num_hits = 0
 
+                        #fetch (concurrently) any web imaging these detections will need, ahead of building them
+                        #(HDF5 runs already fetched it for the whole chunk, see prefetch_detections())
+                        if len(master_hdf5_detectid_list) == 0:
+                            prefetch_web_cutouts(detection_coords(hd.emis_list),cats,cat_decals_web,cat_panstarrs,
+                                                 cat_sdss,args.error)
+
                         for e in hd.emis_list:
                             plt.close('all')
                             log.info("Processing catalogs for eid(%s) ... " %str(e.entry_id))
@@ -3886,6 +4009,8 @@ def main():
                                     else:
                                         e.matched_cats.append(catch_all_cat)
 
+                        timer.mark("catalogs",[timer.key_of(hd)])
+
                         if (args.annulus is None) and (not confirm(num_hits,args.force)):
                             log.critical("Main exit. User cancel.")
                             exit(0)
@@ -3956,6 +4081,8 @@ def main():
 
                                 file_list.append(pdf)
 
+                        timer.mark("render",[timer.key_of(hd)])
+
                 # else: #for multi calls (which are common now) this is of no use
                    #     print("\nNo emission detections meet minimum criteria for specified IFU. Exiting.\n"
                    #     log.warning("No emission detections meet minimum criteria for specified IFU. Exiting.")
@@ -4100,6 +4227,7 @@ def main():
                         #         build_report_part(os.path.join(e.outdir, e.pdf_name), [make_zeroth_row_header(header_text)], 0)
                         #     except:
                         #         log.debug("Exception calling build_report_part", exc_info=True)
+                    timer.mark("classify",[timer.key_of(h)])
             elif G.CONTINUUM_RULES:
                 header_text = "Continuum Source"
                 try:
@@ -4110,10 +4238,25 @@ def main():
             if len(file_list) > 0:
                 for f in file_list:
                     build_report(f.pages,f.filename)
+                    if f.filename[-1] == "!": #made, but with a problem to recover later
+                        manifest.note_stage(manifest.parse_output_name(f.filename)[0],"error")
             else:
                 build_report(pages,args.name)
 
-            if PyPDF is not None:
+            if G.REPORT_IMAGE_DIRECT and (args.jpg or args.png):
+                if len(file_list) > 0:
+                    for f in file_list:
+                        try:
+                            report_image.join_report_images(f.filename,G_PDF_FILE_NUM,jpeg=args.jpg,png=args.png)
+                        except:
+                            log.error("Joining report images failed for %s" % f.filename, exc_info=True)
+                else:
+                    try:
+                        report_image.join_report_images(args.name,G_PDF_FILE_NUM,jpeg=args.jpg,png=args.png)
+                    except:
+                        log.error("Joining report images failed for %s" % args.name, exc_info=True)
+
+            if (PyPDF is not None) and G.REPORT_PDF:
                 if len(file_list) > 0:
                     try:
                         for f in file_list:
@@ -4124,25 +4267,17 @@ def main():
                 else:
                     join_report_parts(args.name)
                     delete_report_parts(args.name)
+            elif G.REPORT_IMAGE_DIRECT:
+                if len(file_list) > 0:
+                    for f in file_list:
+                        delete_report_parts(f.filename)
+                else:
+                    delete_report_parts(args.name)
 
 
             if G.BUILD_HDF5_CATALOG: #change to HDF5 catalog
                 try:
-                    h5name = os.path.join(args.name, args.name + "_cat.h5")
-                    elixer_hdf5.extend_elixer_hdf5(h5name,hd_list,overwrite=True)
-                    for hd in hd_list:
-                        for e in hd.emis_list:
-                            if e.status >=0:
-                                d_id = e.hdf5_detectid
-                                entry_ct = elixer_hdf5.detectid_in_file(h5name,d_id)
-                                if entry_ct != 1:
-                                    log.warning(f"Unexpected number of entries in h5 file for detectid {d_id}, file {h5name}")
-                                    if entry_ct == 0:
-                                        log.warning(f"Retry insertion into h5 file. detectid = {d_id}")
-                                        elixer_hdf5.extend_elixer_hdf5(h5name, [d_id], overwrite=True)
-                                        entry_ct = elixer_hdf5.detectid_in_file(h5name, d_id)
-                                        if entry_ct != 1:
-                                            log.warning(f"No retry: Unexpected number of entries in h5 file for detectid {d_id}, file {h5name}")
+                    catalog.add_list(hd_list)
                 except:
                     log.error("Exception building HDF5 catalog",exc_info=True)
 
@@ -4189,7 +4324,7 @@ def main():
                 except:
                     log.error("Exception copying line file: ", exc_info=True)
 
-            if (args.jpg or args.png) and (PyPDF is not None):
+            if (args.jpg or args.png) and (PyPDF is not None) and (not G.REPORT_IMAGE_DIRECT):
                 if len(file_list) > 0:
                     for f in file_list:
                         if (G.LAUNCH_PDF_VIEWER is not None) and args.viewer:
@@ -4216,6 +4351,8 @@ def main():
                     if (G.LAUNCH_PDF_VIEWER is not None) and args.viewer:
                         viewer_file_list.append(args.name + ".pdf")
 
+        timer.mark("render")
+
         #do neighborhood 1st so can use broad cutout for --mini
         nei_mini_buf = None
         if G.ZOO_MINI or ((args.neighborhood is not None) and (args.neighborhood > 0.0)):
@@ -4253,6 +4390,7 @@ def main():
                                            broad_hdf5=G.HDF5_BROAD_DETECT_FN)
                     except:
                         log.warning("Exception calling build_neighborhood_map.",exc_info=True)
+                    timer.mark("neighborhood",[timer.key_of(h)])
 
             if len(hd_list) == 0: #there were not any hetdex detections to anchor, just use RA, Dec?
                 if (args.ra is not None) and (args.dec is not None):
@@ -4267,6 +4405,7 @@ def main():
                     except:
                         log.warning("Exception calling build_neighborhood_map.",exc_info=True)
 
+            timer.mark("neighborhood")
 
 
         if G.ZOO_MINI and not args.neighborhood_only:
@@ -4356,7 +4495,8 @@ def main():
                             log.info(f"{e.entry_id} gridsearch ({ra},{dec},{cw}) at {x}x{y}x{len(shotlist)}")
 
                             edict = SU.raster_search(ra_meshgrid, dec_meshgrid, shotlist, cw,
-                                                     max_velocity=args.gridsearch[2],max_fwhm=args.gridsearch[3],aperture=3.0)
+                                                     max_velocity=args.gridsearch[2],max_fwhm=args.gridsearch[3],aperture=3.0,
+                                                     checkpoint=savefn)
                             #show most common (others are available via direct call to the saved py file)
                             z = SU.make_raster_plots(edict, ra_meshgrid, dec_meshgrid, cw,"fitflux",
                                                           save=savefn,savepy=savefn,show=args.gridsearch[4])
@@ -4371,8 +4511,421 @@ def main():
                         except:
                             log.info(f"Exception grid search {e.entry_id}", exc_info=True)
 
+        last_pass = own_catalog and (master_loop_idx == master_loop_length - 1)
+        if (catalog is not None) and ((catalog.pending() >= G.HDF5_CATALOG_BATCH_DETS) or last_pass):
+            try:
+                catalog.flush() #(notes the verified detections in the manifest)
+            except:
+                log.error("Exception writing HDF5 catalog",exc_info=True)
+
+        if last_pass:
+            report_db.flush_writer() #so the last images are committed (and noted) before the manifest is written
+
+        timer.mark("other")
+        manifest.write(args.name,timer.totals())
+        timer.write()
+
     #end for master_loop_idx in range(master_loop_length):
 
+    if own_catalog and (catalog is not None) and (catalog.pending() > 0): #i.e. the loop was cut short
+        try:
+            catalog.flush()
+            manifest.write(args.name)
+        except:
+            log.error("Exception writing HDF5 catalog",exc_info=True)
+
+    return viewer_file_list, already_launched_viewer
+
+
+#per-process catalogs for the --workers pool (loaded once per worker by _init_detection_worker)
+_worker_catalog_set = None
+_worker_hdf5_catalog = None #the worker's (per-process) ELiXer HDF5 CatalogWriter
+
+def _init_detection_worker(name=None,estimated_dets=1):
+    """
+    Pool initializer for --workers mode. Each worker process loads the catalogs once and reuses them
+    for every detection it is handed.
+
+    :param name: the run's output directory (args.name)
+    :param estimated_dets: about how many detections this worker will get (sizes its HDF5 catalog)
+    """
+    import multiprocessing.util
+    global _worker_catalog_set, _worker_hdf5_catalog
+    _worker_catalog_set = load_catalogs()
+    if G.BUILD_HDF5_CATALOG and (name is not None):
+        _worker_hdf5_catalog = elixer_hdf5.CatalogWriter(worker_h5name(name),overwrite=True,
+                                                         estimated_dets=estimated_dets)
+    #pool workers leave through os._exit(), so atexit handlers never run; write out the buffered catalog rows and
+    #report images at worker shutdown instead
+    multiprocessing.util.Finalize(None,_finish_detection_worker,args=(name,),exitpriority=10)
+
+
+def _finish_detection_worker(name):
+    if _worker_hdf5_catalog is not None:
+        _worker_hdf5_catalog.flush()
+    report_db.close_writer()
+    if name is not None:
+        manifest.write(name)
+
+
+def worker_h5name(name):
+    """
+    :return: this (--workers pool) process' ELiXer HDF5 catalog
+    """
+    return os.path.join(name, name + "_cat_w" + str(os.getpid()) + ".h5")
+
+
+def _run_detection_worker(args,detection,is_fcsdir,explicit_extraction):
+    """
+    Process a single detection in a --workers pool process.
+    The HDF5 catalog entries are written (in batches, the rest at worker shutdown) to a per-process file (so there
+    is only ever one writer per file) and the parent merges these into the final catalog once all detections are done.
+
+    :param args: the (parsed) command line args
+    :param detection: a single HDF5 detectid (or explicit extraction tuple) or a single fcsdir
+    :param is_fcsdir: if True, detection is an fcsdir
+    :param explicit_extraction: bool
+    :return: detection, the per-process HDF5 filename, status (0 = okay, -1 = failed)
+    """
+    h5name = worker_h5name(args.name)
+    status = 0
+    try:
+        if is_fcsdir:
+            process_detections(args,_worker_catalog_set,[],[detection],[],explicit_extraction,
+                               1,[detection],[],h5name=h5name,catalog=_worker_hdf5_catalog)
+        else:
+            process_detections(args,_worker_catalog_set,[],[],[detection],explicit_extraction,
+                               1,[],[detection],h5name=h5name,catalog=_worker_hdf5_catalog)
+    except SystemExit: #the detection loop can exit() on fatal conditions, do not let that take down the worker
+        log.error(f"Worker ({os.getpid()}) exit called while processing {detection}")
+        status = -1
+    except:
+        log.error(f"Worker ({os.getpid()}) exception processing {detection}",exc_info=True)
+        status = -1
+
+    return detection, h5name, status
+
+
+def run_detection_workers(args,fcsdir_list,hdf5_detectid_list,explicit_extraction):
+    """
+    --workers mode: fan the detections out (one at a time, so the load balances) over a pool of worker processes
+    on this node, then merge the per-worker ELiXer HDF5 catalogs into the final catalog (single writer).
+
+    :param args: the (parsed) command line args
+    :param fcsdir_list: list of rsp style directories to process (used if hdf5_detectid_list is empty)
+    :param hdf5_detectid_list: list of HDF5 detectids (or explicit extraction tuples) to process
+    :param explicit_extraction: bool
+    :return: number of detections that failed
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    if len(hdf5_detectid_list) > 0:
+        detections = hdf5_detectid_list
+        is_fcsdir = False
+    else:
+        detections = fcsdir_list
+        is_fcsdir = True
+
+    num_workers = min(args.workers,len(detections))
+    msg = f"Processing {len(detections)} detections over {num_workers} workers ..."
+    log.info(msg)
+    print(msg)
+
+    args.force = True #no one to answer the confirmation prompts from inside the workers
+    h5_list = []
+    num_failed = 0
+
+    #fork (not spawn) so the workers inherit the command line configured global_config state
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                mp_context=multiprocessing.get_context("fork"),
+                                                initializer=_init_detection_worker,
+                                                initargs=(args.name,-(-len(detections) // num_workers))) as pool:
+        futures = [pool.submit(_run_detection_worker,args,d,is_fcsdir,explicit_extraction) for d in detections]
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                d, h5name, status = f.result()
+                if status != 0:
+                    num_failed += 1
+                if h5name not in h5_list:
+                    h5_list.append(h5name)
+            except:
+                num_failed += 1
+                log.error("Exception collecting worker result.",exc_info=True)
+
+    if G.BUILD_HDF5_CATALOG:
+        h5_list = [f for f in h5_list if os.path.isfile(f)]
+        if len(h5_list) > 0:
+            h5name = os.path.join(args.name, args.name + "_cat.h5")
+            try:
+                if elixer_hdf5.merge_elixer_hdf5_files(h5name,h5_list) is not None:
+                    for f in h5_list:
+                        os.remove(f)
+                else:
+                    log.error(f"Unable to merge worker HDF5 catalogs into {h5name}. Worker catalogs left in place.")
+            except:
+                log.error("Exception merging worker HDF5 catalogs.",exc_info=True)
+
+    msg = f"Workers done. {len(detections)-num_failed} detections processed, {num_failed} failed."
+    log.info(msg)
+    print(msg)
+
+    return num_failed
+
+
+def install_sigterm_handler(args):
+    """
+    SLURM ends a job at its walltime with SIGTERM (and SIGKILL a little later): write out the buffered ELiXer HDF5
+    catalog rows and report images and the completion manifest before exiting, so recovery sees what was finished
+
+    :param args: the (parsed) command line args
+    """
+    def on_sigterm(signum,frame):
+        log.critical(f"Signal {signum} received. Writing buffered output and exiting.")
+        try:
+            elixer_hdf5.flush_open_writers()
+            report_db.close_writer()
+            manifest.write(args.name)
+        except:
+            log.error("Exception writing buffered output on SIGTERM.",exc_info=True)
+        os._exit(128 + signum) #(not exit(): the bare excepts in the detection loop would catch SystemExit)
+
+    try:
+        signal.signal(signal.SIGTERM,on_sigterm)
+    except:
+        log.info("Unable to install SIGTERM handler.",exc_info=True)
+
+
+def run_work_queue(args):
+    """
+    --work_queue mode (SLURM, set up by selixer): claim a batch of detections from the shared queue, process it
+    just as a dispatch_xxxx list would be, record it done (or failed) and repeat until the queue is empty.
+    The catalogs are loaded once for all the batches.
+
+    :param args: the (parsed) command line args
+    :return: number of batches processed, number failed
+    """
+    queue = work_queue.WorkQueue(args.work_queue)
+    G.MANIFEST_SHARED_RUN = True #a requeued batch may have been partly done from another dispatch_xxxx
+    explicit_extraction = bool(args.aperture)
+    args.explicit_extraction = explicit_extraction
+    catalog_set = None
+    num_batches = 0
+    num_failed = 0
+
+    while True:
+        batch = queue.claim()
+        if batch is None:
+            break
+
+        num_batches += 1
+        args.dispatch = batch #the claimed batch file is a dispatch_xxxx style list
+        try:
+            fcsdir_list = []
+            hdf5_detectid_list = []
+            if args.fcsdir is not None:
+                fcsdir_list = get_fcsdir_subdirs_to_process(args)
+            else:
+                hdf5_detectid_list = get_hdf5_detectids_to_process(args)
+
+            PDF_File(args.name, 1) #use to pre-create the output dir
+
+            #one detection per pass, skipping any already processed (a requeued batch may be partly done)
+            if len(hdf5_detectid_list) > 0:
+                if G.RECOVERY_RUN and (args.aperture is None):
+                    hdf5_detectid_list = prune_detection_list(args,None,hdf5_detectid_list)
+                master_hdf5_detectid_list = hdf5_detectid_list
+                master_fcsdir_list = []
+            else:
+                if G.RECOVERY_RUN and len(fcsdir_list) > 0:
+                    fcsdir_list = prune_detection_list(args,fcsdir_list,None)
+                master_hdf5_detectid_list = []
+                master_fcsdir_list = fcsdir_list
+
+            master_loop_length = max(len(master_hdf5_detectid_list),len(master_fcsdir_list))
+            if master_loop_length > 0:
+                if catalog_set is None:
+                    catalog_set = load_catalogs()
+                    cost_model.record_startup(args)
+                process_detections(args,catalog_set,[],fcsdir_list,hdf5_detectid_list,explicit_extraction,
+                                   master_loop_length,master_fcsdir_list,master_hdf5_detectid_list)
+            queue.done(batch)
+        except SystemExit: #the detection loop can exit() on fatal conditions, keep working the queue
+            log.error(f"Exit called while processing work queue batch {batch}")
+            queue.failed(batch)
+            num_failed += 1
+        except:
+            log.error(f"Exception processing work queue batch {batch}",exc_info=True)
+            queue.failed(batch)
+            num_failed += 1
+
+    msg = f"Work queue empty. {num_batches} batches processed, {num_failed} failed."
+    log.info(msg)
+    print(msg)
+
+    return num_batches, num_failed
+
+
+def check_package_versions():
+    """
+    very basic, check the common packages are at minimum levels
+    """
+    pass
+
+def main():
+
+    global G_PDF_FILE_NUM
+    
+    already_launched_viewer = False #skip the PDF viewer laun
+
+    log.critical(f"log level {G.LOG_LEVEL}")
+    #G.gc.enable()
+    #G.gc.set_debug(G.gc.DEBUG_LEAK)
+    try:
+        args = parse_commandline()
+    except:
+        log.critical("Exception in command line.",exc_info=True)
+        exit(0)
+
+    try: #may be used for refrerence later
+         #several arguments can be modified during runtime and the original may need to be references
+        original_command_line_args = copy.deepcopy(args)
+    except:
+        pass
+
+    if args.upgrade_hdf5:
+        upgrade_hdf5(args)
+        exit(0)
+
+    if args.remove_duplicates:
+        remove_h5_duplicate_rows(args)
+        exit(0)
+
+    if args.merge_unique:
+        merge_unique(args)
+        exit(0)
+
+    if args.merge:
+        merge(args)
+        exit(0)
+
+    #later, below most of the processing will be skipped and only the neighborhood map is generated
+    if args.neighborhood_only:
+        args.neighborhood = args.neighborhood_only
+
+    #
+    # build_neighborhood_map(args.hdf5, 1000525650,None, None, args.neighborhood,cwave=None,fname='lycon/test_nei.png')
+    # exit()
+
+
+    log.critical(f"***** ELiXer version {G.__version__} *****")
+    log.critical(f"***** HETDEX DATA RELEASE {G.HDR_Version} *****")
+
+    install_sigterm_handler(args)
+
+    if args.work_queue is not None:
+        if work_queue.exists(args.work_queue):
+            run_work_queue(args)
+            report_db.close_writer()
+            log.critical("Main complete.")
+            exit(0)
+        else:
+            print(f"No work queue at {args.work_queue}. Ignoring --work_queue.")
+            log.warning(f"No work queue at {args.work_queue}. Ignoring --work_queue.")
+
+    viewer_file_list = []
+
+    #if a --line file was provided ... old way (pre-April 2018)
+    #always build ifu_list
+    ifu_list = ifulist_from_detect_file(args)
+
+    fcsdir_list = []
+    hdf5_detectid_list = []
+    explicit_extraction = False
+    #is this an explicit extraction?
+    if args.aperture and args.ra and args.dec:
+        #args.wavelength, args.shotid are optional
+        print("Explicit extraction ...") #single explicit extraction
+        explicit_extraction = True
+    elif args.fcsdir is not None:
+        fcsdir_list = get_fcsdir_subdirs_to_process(args) #list of rsp1 style directories to process (each represents one detection)
+        if fcsdir_list is not None:
+            log.info("Processing %d entries in FCSDIR" %(len(fcsdir_list)))
+            print("Processing %d entries in FCSDIR" %(len(fcsdir_list)))
+
+    elif not args.neighborhood_only:
+        if args.aperture: #still
+            explicit_extraction = True
+            print("Explicit extraction ...") #list of explicit extractions
+
+        hdf5_detectid_list = get_hdf5_detectids_to_process(args)
+        if hdf5_detectid_list is not None:
+            log.info("Processing %d entries in HDF5" %(len(hdf5_detectid_list)))
+            print("Processing %d entries in HDF5" %(len(hdf5_detectid_list)))
+
+    #add as a payload to args so can easily check later
+    args.explicit_extraction = explicit_extraction
+
+    PDF_File(args.name, 1) #use to pre-create the output dir (just toss the returned pdf container)
+
+
+
+    #if this is a re-run (recovery run) remove any detections that have already been processed
+    master_loop_length = 1
+    master_fcsdir_list = []
+    master_hdf5_detectid_list = []
+
+    if G.RECOVERY_RUN:
+        if args.aperture is not None:
+            #G.RECOVERY_RUN = False
+            log.info("Forced extraction does not fully support RECOVERY MODE (behavior may be unexpected).")
+            print("Forced extraction does not fully support RECOVERY MODE (behavior may be unexpected).")
+            #still want the master loop, though
+            master_loop_length = len(hdf5_detectid_list)
+            master_hdf5_detectid_list = hdf5_detectid_list
+        elif len(hdf5_detectid_list) > 0:
+            hdf5_detectid_list = prune_detection_list(args,None,hdf5_detectid_list)
+            if len(hdf5_detectid_list) == 0:
+                print("[RECOVERY MODE] All detections already processed. Exiting...")
+                log.info("[RECOVERY MODE] All detections already processed. Exiting...")
+                log.critical("Main complete.")
+                exit(0)
+            else:
+                master_loop_length = len(hdf5_detectid_list)
+                master_hdf5_detectid_list = hdf5_detectid_list
+                log.info("[RECOVERY] Processing %d entries in HDF5" % (len(hdf5_detectid_list)))
+                print("[RECOVERY] Processing %d entries in HDF5" % (len(hdf5_detectid_list)))
+        elif len(fcsdir_list):
+            fcsdir_list = prune_detection_list(args,fcsdir_list,None)
+            if len(fcsdir_list) == 0:
+                print("[RECOVERY MODE] All detections already processed. Exiting...")
+                log.info("[RECOVERY MODE] All detections already processed. Exiting...")
+                log.critical("Main complete.")
+                exit(0)
+            else:
+                master_loop_length = len(fcsdir_list)
+                master_fcsdir_list = fcsdir_list
+                log.info("[RECOVERY] Processing %d entries in FCSDIR" % (len(fcsdir_list)))
+                print("[RECOVERY] Processing %d entries in FCSDIR" % (len(fcsdir_list)))
+        else:
+            G.RECOVERY_RUN = False
+            log.debug("No list (hdf5 or fcsdir) of detections, so RECOVERY MODE turned off.")
+
+    #now, we have only the detections that have NOT been processed
+
+    if (args.workers > 1) and (len(ifu_list) == 0) and (not args.score) and \
+            (max(len(hdf5_detectid_list),len(fcsdir_list)) > 1):
+        #recovery pruning (if any) already applied above, so the base lists are what is left to process
+        cost_model.record_startup(args)
+        run_detection_workers(args,fcsdir_list,hdf5_detectid_list,explicit_extraction)
+    else:
+        catalog_set = load_catalogs()
+        cost_model.record_startup(args)
+        viewer_file_list, already_launched_viewer = process_detections(args,catalog_set,ifu_list,fcsdir_list,
+                                                                       hdf5_detectid_list,explicit_extraction,
+                                                                       master_loop_length,master_fcsdir_list,
+                                                                       master_hdf5_detectid_list)
+
 
     if (G.LAUNCH_PDF_VIEWER is not None) and args.viewer and (len(viewer_file_list) > 0) \
             and not args.neighborhood_only and not already_launched_viewer:
@@ -4412,6 +4965,8 @@ def main():
     #
 
 
+    report_db.close_writer()
+
     log.critical("Main complete.")
 
     exit(0)
@@ -10,16 +10,20 @@ __version__ = '0.2.5' #catalog version ... can merge if major and minor version
 try:
     from elixer import hetdex
     from elixer import match_summary
+    from elixer import manifest
     from elixer import global_config as G
 except:
     import hetdex
     import match_summary
+    import manifest
     import global_config as G
 
 import numpy as np
 import tables
 import os
 import time
+import atexit
+import weakref
 
 
 UNSET_FLOAT = -999.999
@@ -29,6 +33,12 @@ UNSET_STR = ""
 log = G.Global_Logger('hdf5_logger')
 log.setlevel(G.LOG_LEVEL)
 
+#compression for the catalog tables (zlib, so any HDF5 reader can open them; shuffle helps the numeric columns)
+if G.HDF5_CATALOG_COMPLEVEL > 0:
+    CATALOG_FILTERS = tables.Filters(complevel=G.HDF5_CATALOG_COMPLEVEL,complib='zlib',shuffle=True)
+else:
+    CATALOG_FILTERS = None
+
 
 #make a class for each table
 class Version(tables.IsDescription):
@@ -490,31 +500,31 @@ def get_hdf5_filehandle(fname,append=False,allow_overwrite=True,must_exist=False
 
             fileh.create_table(fileh.root, 'Detections', Detections,
                                'ELiXer Detection Summary Table',
-                               expectedrows=estimated_dets)
+                               expectedrows=estimated_dets,filters=CATALOG_FILTERS)
 
             fileh.create_table(fileh.root, 'SpectraLines', SpectraLines,
                                'ELiXer Identified SpectraLines Table',
-                               expectedrows=estimated_dets)
+                               expectedrows=estimated_dets,filters=CATALOG_FILTERS)
 
             fileh.create_table(fileh.root, 'CalibratedSpectra', CalibratedSpectra,
                                'HETDEX Flux Calibrated, PSF Weighted Summed Spectra Table',
-                               expectedrows=estimated_dets)
+                               expectedrows=estimated_dets,filters=CATALOG_FILTERS)
 
             fileh.create_table(fileh.root, 'Aperture', Aperture,
                                'ELiXer Aperture Photometry Table',
-                               expectedrows=estimated_dets*3) #mostly a g and r aperture, sometimes more
+                               expectedrows=estimated_dets*3,filters=CATALOG_FILTERS) #mostly a g and r aperture, sometimes more
 
             fileh.create_table(fileh.root, 'CatalogMatch', CatalogMatch,
                                'ELiXer Catalog Matched Objected Table',
-                               expectedrows=estimated_dets*3)
+                               expectedrows=estimated_dets*3,filters=CATALOG_FILTERS)
 
             fileh.create_table(fileh.root, 'ExtractedObjects',ExtractedObjects,
                                'ELiXer Image Extracted Objects Table',
-                               expectedrows=estimated_dets*30) #multiple filters, many objects
+                               expectedrows=estimated_dets*30,filters=CATALOG_FILTERS) #multiple filters, many objects
 
             fileh.create_table(fileh.root, 'ElixerApertures', ElixerApertures,
                                'ELiXer Image Circular Apertures Table',
-                               expectedrows=estimated_dets*3) #mostly a g and r aperture, sometimes more
+                               expectedrows=estimated_dets*3,filters=CATALOG_FILTERS) #mostly a g and r aperture, sometimes more
 
             #todo: any actual images tables? (imaging cutouts, 2D fibers, etc)??
 
@@ -524,53 +534,334 @@ def get_hdf5_filehandle(fname,append=False,allow_overwrite=True,must_exist=False
     return fileh
 
 
-def append_entry(fileh,det,overwrite=False):
+class _BufferedRow:
+    """
+    Stands in for a tables.Table.row: the values are set into a one row structured array that append() adds to
+    the table's buffer
     """
 
-    :param fileh: file handle to the HDF5 file
-    :param det: ELiXer DetObj
-    :return:
+    def __init__(self,table):
+        self.table = table
+        self.rec = table.template.copy()
+        self.values = self.rec[0]
+
+    def __getitem__(self,key):
+        return self.values[key]
+
+    def __setitem__(self,key,value):
+        self.values[key] = value
+
+    def append(self):
+        self.table.records.append(self.rec)
+
+
+class _BufferedTable:
     """
-    try:
-        #get tables
-        dtb = fileh.root.Detections
-        stb = fileh.root.CalibratedSpectra
-        ltb = fileh.root.SpectraLines
-        atb = fileh.root.Aperture
-        ctb = fileh.root.CatalogMatch
+    Stands in for a tables.Table while the catalog rows for the detections are built (see _entry_rows()), keeping
+    the rows in memory (as numpy structured arrays) until they are appended to the HDF5 table in one go
+    """
+
+    def __init__(self,description=None,template=None):
+        if template is None:
+            desc = tables.Description(description.columns)
+            template = np.zeros(1,dtype=desc._v_dtype)
+            for col, dflt in desc._v_dflts.items():
+                template[col] = dflt
+        self.template = template
+        self.records = []
+
+    def scratch(self):
+        """
+        :return: a new, empty _BufferedTable for the same table
+        """
+        return _BufferedTable(template=self.template)
+
+    @property
+    def row(self):
+        return _BufferedRow(self)
+
+    def flush(self):
+        pass #rows are written by CatalogWriter
+
+    def __len__(self):
+        return len(self.records)
+
+    def drop(self,detectid):
+        self.records = [r for r in self.records if r['detectid'][0] != detectid]
+
+    def take(self,detectids=None):
+        """
+        :param detectids: if provided, only the rows for these detectids are returned (any others are dropped)
+        :return: all the buffered rows as one structured array (and clear the buffer)
+        """
+        records = self.records
+        self.records = []
+        if detectids is not None:
+            records = [r for r in records if r['detectid'][0] in detectids]
+        if len(records) == 0:
+            return self.template[:0]
+        return np.concatenate(records)
+
+
+#(table name, description, expected rows per detection, title)
+CATALOG_TABLES = [('Detections',Detections,1,'ELiXer Detection Summary Table'),
+                  ('CalibratedSpectra',CalibratedSpectra,1,'HETDEX Flux Calibrated, PSF Weighted Summed Spectra Table'),
+                  ('SpectraLines',SpectraLines,1,'ELiXer Identified SpectraLines Table'),
+                  ('Aperture',Aperture,3,'ELiXer Aperture Photometry Table'),
+                  ('CatalogMatch',CatalogMatch,3,'ELiXer Catalog Matched Objected Table'),
+                  ('ExtractedObjects',ExtractedObjects,30,'ELiXer Image Extracted Objects Table'),
+                  ('ElixerApertures',ElixerApertures,3,'ELiXer Image Circular Apertures Table')]
+
+_open_writers = weakref.WeakSet() #CatalogWriters with (possibly) unwritten rows, flushed at exit
+
+
+def _as_table_rows(rows,table):
+    """
+    Match the buffered rows to the table's columns (an existing catalog may be an older engineering version,
+    missing newer columns)
+
+    :param rows: structured array (this version's columns)
+    :param table: tables.Table to append to
+    :return: structured array with the table's dtype
+    """
+    if rows.dtype == table.dtype:
+        return rows
+    out = np.zeros(len(rows),dtype=table.dtype)
+    for col in out.dtype.names:
+        if col in rows.dtype.names:
+            out[col] = rows[col]
+        elif col in table.coldflts:
+            out[col] = table.coldflts[col]
+    return out
+
+
+class CatalogWriter:
+    """
+    Buffered writer for the ELiXer HDF5 catalog.
+
+    The rows for each added detection are built in memory (as numpy structured arrays, one buffer per table) and
+    written with one Table.append() per table when flushed, rather than row by row with a flush after each. The
+    duplicate check is against the set of detectids already in the file (read once) plus those buffered.
+    Detections verified in the file after a flush are noted ("h5", and "imaging" if they have Aperture rows) in the
+    completion manifest.
+    """
+
+    def __init__(self,fname=None,overwrite=False,estimated_dets=tables.parameters.EXPECTED_ROWS_TABLE):
+        """
+        :param fname: the ELiXer HDF5 catalog (for flush(); may be None if only using write())
+        :param overwrite: if TRUE, "remove" matching entries and replace with new ones per detectid
+        :param estimated_dets: expected number of detections (sizes the tables if the file is created)
+        """
+        self.fname = fname
+        self.overwrite = overwrite
+        self.estimated_dets = estimated_dets
+        self.tables = {name: _BufferedTable(desc) for name, desc, _, _ in CATALOG_TABLES}
+        self.pending_ids = {} #detectid : None (an ordered set) of the buffered detections
+        self.file_ids = None #detectids in the file
+        self.file_ids_fn = None
+        self.pid = os.getpid() #a forked child must not write a copy of the parent's buffers
+        self.busy = False #in flush() (flush_open_writers() from a signal handler must not re-enter)
+        _open_writers.add(self)
+
+    def pending(self):
+        """
+        :return: number of buffered (unwritten) detections
+        """
+        return len(self.pending_ids)
+
+    def add(self,det):
+        """
+        Build and buffer the catalog rows for one detection
+
+        :param det: ELiXer DetObj
+        :return: True if added
+        """
+        q_detectid = det.hdf5_detectid
+        if (q_detectid in self.pending_ids) and (not self.overwrite):
+            log.info("Detection (%d) already buffered for HDF5. Skipping." % (q_detectid))
+            return False
+
+        #build the rows apart from the buffers, so a failure (or a SIGTERM flush) part way through never leaves a
+        #partial detection in them
+        scratch = {name: t.scratch() for name, t in self.tables.items()}
+        if not _entry_rows(det,scratch):
+            return False
+
+        if q_detectid in self.pending_ids:
+            log.info("Detection (%d) already buffered for HDF5. Will replace." % (q_detectid))
+            for t in self.tables.values():
+                t.drop(q_detectid)
+
+        for name, t in self.tables.items():
+            t.records += scratch[name].records
+        self.pending_ids[q_detectid] = None
+        return True
+
+    def add_list(self,hd_list):
+        """
+        :param hd_list: list of hetdex (hd) collections; their (good status) detections are added
+        """
+        for h in hd_list:  # iterate over all hetdex (hd) collections
+            for e in h.emis_list: #for each detection in each hd collection
+                if e.status >= 0:
+                    self.add(e)
+
+    def _table(self,fileh,name):
         try:
-            etb = fileh.root.ExtractedObjects
+            return fileh.root[name]
+        except: #older catalogs might not have ExtractedObjects or ElixerApertures tables
+            desc, per_det, title = [(d, n, x) for t, d, n, x in CATALOG_TABLES if t == name][0]
+            return fileh.create_table(fileh.root, name, desc, title,
+                                      expectedrows=max(self.estimated_dets,1)*per_det,filters=CATALOG_FILTERS)
+
+    def write(self,fileh):
+        """
+        Append the buffered rows to an open catalog (one append per table) and clear the buffers
+
+        :param fileh: file handle to the HDF5 file
+        :return: dictionary of the detectids written : number of Aperture rows for each
+        """
+        if len(self.pending_ids) == 0:
+            return {}
+
+        try:
+            dtb = fileh.root.Detections
+            if (self.file_ids is None) or (self.file_ids_fn != fileh.filename):
+                self.file_ids = set(dtb.col('detectid').tolist())
+                self.file_ids_fn = fileh.filename
+
+            for q_detectid in [d for d in self.pending_ids if d in self.file_ids]:
+                if self.overwrite:
+                    log.info("Detection (%d) already exists in HDF5. Will replace." % (q_detectid))
+                    try:
+                        for name, _, _, _ in CATALOG_TABLES:
+                            t = self._table(fileh,name)
+                            idx = t.get_where_list("detectid==q_detectid")
+                            for i in np.flip(idx): #index gets updated, so delete in reverse order
+                                t.remove_row(i)
+                    except:
+                        log.info("Remove row(s) failed for %d. Skipping remainder." %(q_detectid),exc_info=True)
+                        for t in self.tables.values():
+                            t.drop(q_detectid)
+                        del self.pending_ids[q_detectid]
+                else:
+                    log.info("Detection (%d) already exists in HDF5. Skipping." %(q_detectid))
+                    for t in self.tables.values():
+                        t.drop(q_detectid)
+                    del self.pending_ids[q_detectid]
+
+            aperture_ct = {}
+            for name, _, _, _ in CATALOG_TABLES:
+                rows = self.tables[name].take(self.pending_ids) #(only whole, pending detections)
+                if name == 'Aperture':
+                    ids, cts = np.unique(rows['detectid'],return_counts=True)
+                    aperture_ct = dict(zip(ids.tolist(),cts.tolist()))
+                if len(rows) > 0:
+                    t = self._table(fileh,name)
+                    t.append(_as_table_rows(rows,t))
+                    t.flush()
         except:
-            fileh.create_table(fileh.root, 'ExtractedObjects',ExtractedObjects,
-                               'ELiXer Image Extracted Objects Table')
-            etb = fileh.root.ExtractedObjects
+            log.error("Exception! in elixer_hdf5::CatalogWriter::write",exc_info=True)
+            for t in self.tables.values():
+                t.take()
+            self.pending_ids = {}
+            return {}
+
+        written = {d: aperture_ct.get(d,0) for d in self.pending_ids}
+        self.file_ids.update(written.keys())
+        self.pending_ids = {}
+        return written
+
+    def flush(self,reindex=True):
+        """
+        Open the catalog (creating it if need be), write the buffered rows, (re)index and close it
+
+        :param reindex: if False, skip the detectid (re)index
+        :return: dictionary of the detectids written (with exactly one Detections row each) : number of Aperture rows
+        """
+        if (len(self.pending_ids) == 0) or (self.pid != os.getpid()) or self.busy:
+            return {}
+
+        fileh = get_hdf5_filehandle(self.fname,append=True,estimated_dets=self.estimated_dets)
+
+        if fileh is None:
+            print("Unable to build ELiXer catalog.")
+            log.error("Unable to build ELiXer catalog.")
+            return {}
+
+        written = {}
+        self.busy = True
+        try:
+            written = self.write(fileh)
+            flush_all(fileh,reindex=reindex)
+
+            #one check of the detectids just written (vs a query per detection)
+            if len(written) > 0:
+                ids, cts = np.unique(fileh.root.Detections.col('detectid'),return_counts=True)
+                counts = dict(zip(ids.tolist(),cts.tolist()))
+                for d in list(written.keys()):
+                    if counts.get(d,0) != 1:
+                        log.warning(f"Unexpected number of entries ({counts.get(d,0)}) in h5 file for detectid {d}, "
+                                    f"file {self.fname}")
+                        del written[d]
+        except:
+            log.error("Exception! in elixer_hdf5::CatalogWriter::flush",exc_info=True)
+        finally:
+            fileh.close()
+            self.busy = False
+
+        for d, aperture_ct in written.items():
+            manifest.note_stage(d,"h5",self.fname)
+            if aperture_ct > 0: #has Aperture table rows
+                manifest.note_stage(d,"imaging",self.fname)
+
+        print("File written: %s" %self.fname)
+        log.info("File written: %s (%d detections)" %(self.fname,len(written)))
+        return written
 
+
+@atexit.register
+def flush_open_writers():
+    """
+    Write the buffered rows of all of this process' CatalogWriters (at exit, or from a SIGTERM handler)
+    """
+    for w in list(_open_writers):
         try:
-            xtb = fileh.root.ElixerApertures
+            if (w.fname is not None) and (w.pending() > 0):
+                w.flush()
         except:
-            fileh.create_table(fileh.root, 'ElixerApertures', ElixerApertures,
-                               'ELiXer Image Circular Apertures Table')
-            xtb = fileh.root.ElixerApertures
+            pass
 
-        list_tables = [dtb,stb,ltb,atb,ctb,etb,xtb]
 
-        q_detectid = det.hdf5_detectid
-        rows = dtb.read_where("detectid==q_detectid")
+def append_entry(fileh,det,overwrite=False):
+    """
 
-        if rows.size > 0:
-            if overwrite:
-                log.info("Detection (%d) already exists in HDF5. Will replace." % (q_detectid))
-                try:
-                    for t in list_tables:
-                        idx = t.get_where_list("detectid==q_detectid")
-                        for i in np.flip(idx): #index gets updated, so delete in reverse order
-                            t.remove_row(i)
-                except:
-                    log.info("Remove row(s) failed for %d. Skipping remainder." %(q_detectid),exc_info=True)
-                    return
-            else:
-                log.info("Detection (%d) already exists in HDF5. Skipping." %(q_detectid))
-                return
+    :param fileh: file handle to the HDF5 file
+    :param det: ELiXer DetObj
+    :return:
+    """
+    writer = CatalogWriter(overwrite=overwrite)
+    writer.add(det)
+    writer.write(fileh)
+
+
+def _entry_rows(det,tbs):
+    """
+    Build the catalog rows for one detection
+
+    :param det: ELiXer DetObj
+    :param tbs: dictionary of table name : _BufferedTable (see CatalogWriter)
+    :return: True if all the rows were built
+    """
+    try:
+        #get tables
+        dtb = tbs['Detections']
+        stb = tbs['CalibratedSpectra']
+        ltb = tbs['SpectraLines']
+        atb = tbs['Aperture']
+        ctb = tbs['CatalogMatch']
+        etb = tbs['ExtractedObjects']
+        xtb = tbs['ElixerApertures']
 
         #############################
         #Detection (summary) table
@@ -1061,8 +1352,9 @@ def append_entry(fileh,det,overwrite=False):
 
     except:
         log.error("Exception! in elixer_hdf5::append_entry",exc_info=True)
+        return False
 
-    return
+    return True
 
 
 def build_elixer_hdf5(fname,hd_list=[],overwrite=False):
@@ -1076,18 +1368,17 @@ def build_elixer_hdf5(fname,hd_list=[],overwrite=False):
     #build a new HDF5 file from the current active run
     #this is like the old ELiXer creating _cat.txt and _fib.txt
 
-    fileh = get_hdf5_filehandle(fname,append=False)
+    writer = CatalogWriter(fname,overwrite)
+    writer.add_list(hd_list)
+
+    fileh = get_hdf5_filehandle(fname,append=False,estimated_dets=writer.pending())
 
     if fileh is None:
         print("Unable to build ELiXer catalog.")
         log.error("Unable to build ELiXer catalog.")
         return
 
-    for h in hd_list:  # iterate over all hetdex (hd) collections
-        for e in h.emis_list: #for each detection in each hd collection
-            if e.status >= 0:
-                append_entry(fileh,e,overwrite)
-
+    writer.write(fileh)
 
     flush_all(fileh)
     fileh.close()
@@ -1100,28 +1391,14 @@ def extend_elixer_hdf5(fname,hd_list=[],overwrite=False):
     :param fname:
     :param hd_list:
     :param overwrite: if TRUE, "remove" matching entries and replace with new ones per detectid
-    :return:
+    :return: dictionary of the detectids written : number of Aperture rows for each (see CatalogWriter.flush())
     """
     #build a new HDF5 file from the current active run
     #this is like the old ELiXer creating _cat.txt and _fib.txt
 
-    fileh = get_hdf5_filehandle(fname,append=True)
-
-    if fileh is None:
-        print("Unable to build ELiXer catalog.")
-        log.error("Unable to build ELiXer catalog.")
-        return
-
-    for h in hd_list:  # iterate over all hetdex (hd) collections
-        for e in h.emis_list: #for each detection in each hd collection
-            if e.status >= 0:
-                append_entry(fileh,e,overwrite)
-
-
-    flush_all(fileh)
-    fileh.close()
-    print("File written: %s" %fname)
-    log.info("File written: %s" %fname)
+    writer = CatalogWriter(fname,overwrite)
+    writer.add_list(hd_list)
+    return writer.flush()
 
 def detectid_in_file(fname,det_id):
     """
@@ -1617,89 +1894,256 @@ def merge_unique(newfile,file1,file2):
     return True
 
 
-def merge_elixer_hdf5_files(fname,flist=[]):
+MERGE_TABLES = ['Detections','CalibratedSpectra','SpectraLines','Aperture','CatalogMatch',
+                'ExtractedObjects','ElixerApertures'] #all tables (other than Version) copied by a merge
+
+
+def remove_all_indices(fileh):
     """
+    Drop the detectid index on all tables (if present) so that appends do not (re)index as they go.
+    flush_all(fileh,reindex=True) builds them again.
+
+    :param fileh: open (writable) ELiXer HDF5 file handle
+    :return: None
+    """
+    for t in MERGE_TABLES:
+        try:
+            tb = fileh.root[t]
+            if tb.cols.detectid.is_indexed:
+                tb.cols.detectid.remove_index()
+        except:
+            pass
+
+
+def copy_table_rows(src,dst,chunk_mb=None):
+    """
+    Append all rows of src to dst, a bounded chunk of rows at a time (never the whole table in memory)
+
+    :param src: source tables.Table
+    :param dst: destination tables.Table (same description)
+    :param chunk_mb: max (approximate) MB to read at a time (default G.HDF5_MERGE_CHUNK_MB)
+    :return: number of rows, number of bytes copied
+    """
+    if chunk_mb is None:
+        chunk_mb = G.HDF5_MERGE_CHUNK_MB
+
+    nrows = src.nrows
+    chunk_rows = max(1,int(chunk_mb * 1024 * 1024) // max(1,src.rowsize))
+
+    for start in range(0,nrows,chunk_rows):
+        dst.append(src.read(start,min(start+chunk_rows,nrows)))
+
+    return nrows, nrows * src.rowsize
+
+
+def merge_elixer_hdf5_files(fname,flist=[],reindex=True,chunk_mb=None,failed=None):
+    """
+    Streaming merge. Each input is opened once (read-only) and its tables are copied in bounded chunks.
+    The detectid indices are built once, after all inputs are merged. If an input fails partway through, the rows
+    already copied from it are truncated away, so an input is merged either completely or not at all.
 
     :param fname: the output (final/merged) HDF5 file
     :param flist:  list of all files to merge
+    :param reindex: if False, do not build the indices (i.e. for an intermediate file that is itself to be merged)
+    :param chunk_mb: max (approximate) MB of rows held in memory at a time (default G.HDF5_MERGE_CHUNK_MB)
+    :param failed: (optional) list to which the inputs that could not be merged are appended
     :return: None or filename
     """
 
-    #first, estimate the number of detections
-    max_dets = 0
-    for f in flist:
-        if f == fname: #could be the output file is one of those to merge
-            continue #just skip and move on
+    flist = [f for f in flist if f != fname] #could be the output file is one of those to merge, just skip it
+    fileh = None
+    num_files = 0
+    num_dets = 0
+    num_bytes = 0
+    start_time = time.time()
 
-        fh = get_hdf5_filehandle(f,append=False,allow_overwrite=False,must_exist=True)
+    log.info(f"Merging {len(flist)} files into {fname} ...")
 
-        if fh is None:
+    for f in flist:
+        try:
+            merge_fh = tables.open_file(f,'r')
+        except:
+            log.error("Unable to merge: %s" %(f),exc_info=True)
+            if failed is not None:
+                failed.append(f)
             continue
-        else:
-            max_dets += len(fh.root.Detections)
 
-    #merging existing distinct HDF5 files w/o new additions from an active run
-    fileh = get_hdf5_filehandle(fname,append=True,estimated_dets=max_dets)
+        start_rows = None
+        try:
+            if fileh is None:
+                #first readable input; estimate the number of detections from it rather than opening everything twice
+                estimated_dets = len(merge_fh.root.Detections) * len(flist)
+                fileh = get_hdf5_filehandle(fname,append=True,estimated_dets=estimated_dets)
+
+                if fileh is None:
+                    log.error("Unable to merge ELiXer catalogs.")
+                    merge_fh.close()
+                    return None
+
+                remove_all_indices(fileh) #if appending to an existing (indexed) catalog
+
+            start_rows = {t: fileh.root[t].nrows for t in MERGE_TABLES}
+            file_dets = 0
+            file_bytes = 0
+            for t in MERGE_TABLES:
+                try:
+                    m_tb = merge_fh.root[t]
+                except: #might not have ExtractedObjects or ElixerApertures tables
+                    continue
+
+                rows, nbytes = copy_table_rows(m_tb,fileh.root[t],chunk_mb)
+                file_bytes += nbytes
+                if t == 'Detections':
+                    file_dets += rows
+
+            num_dets += file_dets
+            num_bytes += file_bytes
+            num_files += 1
+        except:
+            log.error("Exception! merging: %s" %(f),exc_info=True)
+            if failed is not None:
+                failed.append(f)
+            if start_rows is not None: #drop this input's partial rows
+                try:
+                    for t, nrows in start_rows.items():
+                        if fileh.root[t].nrows > nrows:
+                            fileh.root[t].truncate(nrows)
+                except:
+                    log.error(f"Unable to remove the partial rows of {f} from {fname}. Aborting merge.",
+                              exc_info=True)
+                    merge_fh.close()
+                    fileh.close()
+                    return None
+
+        #close the merge input file
+        merge_fh.close()
 
     if fileh is None:
-        log.error("Unable to merge ELiXer catalogs.")
+        log.error("Unable to merge ELiXer catalogs. No readable input files.")
         return None
 
-    #set up new HDF5 tables (into which to append)
-    dtb = fileh.root.Detections
+    flush_all(fileh,reindex=reindex) #one (re)index over the final tables
+    fileh.close()
 
-    stb = fileh.root.CalibratedSpectra
-    ltb = fileh.root.SpectraLines
-    atb = fileh.root.Aperture
-    ctb = fileh.root.CatalogMatch
-    etb = fileh.root.ExtractedObjects
-    xtb = fileh.root.ElixerApertures
+    elapsed = max(time.time() - start_time,1e-6)
+    log.info(f"Merged {num_dets} detections ({num_bytes/1e6:0.1f} MB) from {num_files} of {len(flist)} files "
+             f"into {fname} in {elapsed:0.1f}s ({num_files/elapsed:0.1f} files/s, {num_dets/elapsed:0.1f} dets/s, "
+             f"{num_bytes/1e6/elapsed:0.1f} MB/s)")
 
-    log.info(f"Merging approximately {max_dets} in {len(flist)} files ...")
+    return fname
 
-    for f in flist:
-        if f == fname: #could be the output file is one of those to merge
-            continue #just skip and move on
 
-        merge_fh = get_hdf5_filehandle(f,append=True)
+def _merge_group(fname,flist,reindex):
+    """
+    merge_elixer_hdf5_files for a single (process pool) task
 
-        if merge_fh is None:
-            log.error("Unable to merge: %s" %(f))
-            continue
+    :return: None or filename, list of the inputs that were not merged
+    """
+    failed = []
+    try:
+        return merge_elixer_hdf5_files(fname,flist,reindex=reindex,failed=failed), failed
+    except:
+        log.error(f"Exception! merging group into {fname}",exc_info=True)
+        return None, list(flist)
 
-        m_dtb = merge_fh.root.Detections
-        m_stb = merge_fh.root.CalibratedSpectra
-        m_ltb = merge_fh.root.SpectraLines
-        m_atb = merge_fh.root.Aperture
-        m_ctb = merge_fh.root.CatalogMatch
 
+def merge_elixer_hdf5_files_tree(fname,flist=[],workers=None,fan_in=None):
+    """
+    Merge as a tree: the inputs are split into groups of at most fan_in files, each group is merged
+    (unindexed, in parallel over the workers) into an intermediate file, and so on until there are at most fan_in
+    files left, which are merged (and indexed once) into fname. Intermediate files are removed as they are consumed;
+    the inputs that fail to merge (or a whole group's, if its merge fails) are carried forward to the next level, and
+    an intermediate that still cannot be merged into fname is kept (and logged) rather than removed.
 
-        #now merge
-        dtb.append(m_dtb.read())
-        stb.append(m_stb.read())
-        ltb.append(m_ltb.read())
-        atb.append(m_atb.read())
-        ctb.append(m_ctb.read())
+    :param fname: the output (final/merged) HDF5 file
+    :param flist: list of all files to merge
+    :param workers: number of merge processes (default is the number of CPUs)
+    :param fan_in: max number of files per merge (default G.HDF5_MERGE_FAN_IN)
+    :return: None or filename
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    if fan_in is None:
+        fan_in = G.HDF5_MERGE_FAN_IN
+    fan_in = max(2,int(fan_in))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1,int(workers))
+
+    start_time = time.time()
+    flist = [f for f in flist if f != fname]
+    level = 0
+    intermediates = [] #files created here (and safe to remove)
+    keep = None #intermediates not to remove (not merged into fname)
+    result = None
 
-        try: #might not have ExtractedObjects table
-            m_etb = merge_fh.root.ExtractedObjects
-            etb.append(m_etb.read())
-        except:
-            pass
+    try:
+        while len(flist) > fan_in:
+            groups = [flist[i:i+fan_in] for i in range(0,len(flist),fan_in)]
+            outnames = [f"{fname}.tree_{level}_{i:05d}.working" for i in range(len(groups))]
+            log.info(f"Tree merge level {level}: {len(flist)} files in {len(groups)} groups over {workers} workers ...")
+
+            for fn in outnames:
+                if os.path.exists(fn): #left over from a failed run
+                    os.remove(fn)
+
+            if workers > 1 and len(groups) > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers,len(groups)),
+                                                            mp_context=multiprocessing.get_context("fork")) as pool:
+                    results = list(pool.map(_merge_group,outnames,groups,[False]*len(groups)))
+            else:
+                results = [_merge_group(fn,g,False) for fn, g in zip(outnames,groups)]
 
-        try: #might not have ElixerApertures table
-            m_xtb = merge_fh.root.ElixerApertures
-            xtb.append(m_xtb.read())
-        except:
-            pass
+            #a failed group's inputs are carried forward to the next level; only the inputs of the successful
+            #groups are done with (and removed, if they are this function's intermediates)
+            next_flist = []
+            for fn, g, (r, failed) in zip(outnames,groups,results):
+                if (r is not None) and (len(failed) == len(g)): #nothing merged
+                    try:
+                        os.remove(r)
+                    except:
+                        pass
+                    r = None
 
-        flush_all(fileh,reindex=True) #for now, just to be safe, reindex anyway
-        #close the merge input file
-        merge_fh.close()
+                if r is None:
+                    log.error(f"Tree merge failed for group {fn} ({len(g)} files). Carrying those files forward.")
+                    next_flist += g
+                else:
+                    if len(failed) > 0:
+                        log.error(f"Tree merge group {fn}: {len(failed)} files not merged. Carrying those forward.")
+                    for f in g:
+                        if f in failed:
+                            next_flist.append(f)
+                        elif f in intermediates:
+                            os.remove(f)
+                            intermediates.remove(f)
+                    next_flist.append(r)
+                    intermediates.append(r)
+
+            level += 1
+            if len(next_flist) >= len(flist): #nothing merged, so another level would not get any further
+                log.error(f"Tree merge level {level-1}: every group failed. Merging the {len(flist)} files directly.")
+                break
+            flist = next_flist
+
+        failed = []
+        result = merge_elixer_hdf5_files(fname,flist,reindex=True,failed=failed)
+        keep = flist if result is None else failed
+    finally:
+        if keep is None: #exception: do not remove what has not been merged
+            keep = flist
+        for f in intermediates:
+            if f in keep:
+                log.error(f"Tree merge: {f} was not merged into {fname}. Keeping it.")
+                continue
+            try:
+                os.remove(f)
+            except:
+                pass
 
-    flush_all(fileh,reindex=True)
-    fileh.close()
-    return fname
+    log.info(f"Tree merge into {fname} done in {time.time()-start_time:0.1f}s ({level+1} levels).")
+    return result
 
 
 
@@ -7,6 +7,9 @@ It looks for detections in the entire data release and returns a list of detecti
 3) have no neighborhood map (no entry in the *_nei.db)
 4) have no mini png (no entry in the *_mini.db)
 
+With --manifest <glob> (i.e. "/scratch/run/dispatch_*/run/run_manifest.tsv") the completion manifests the runs wrote
+are read instead of the report dbs and the ELiXer HDF5.
+
 """
 
 import sys
@@ -16,6 +19,10 @@ import glob
 import os
 from hetdex_api.config import HDRconfig
 import sqlite3
+try:
+    from elixer import manifest
+except:
+    import manifest
 #from hetdex_api import sqlite_utils as sql
 HDRVERSION = "hdr2.1"
 which_catalog = 0 #0 = standard, 6 = broad, 9 = continuum
@@ -63,6 +70,34 @@ if "--stop" in args: #overide default if specified on command line
 
 
 
+manifest_done = None #{detectid (as str) : set of stages} from the completion manifests (--manifest)
+if "--manifest" in args:
+    try:
+        i = args.index("--manifest")
+        manifest_done = manifest.load(sys.argv[i + 1].split(","))
+        if manifest_done is None:
+            print(f"No manifests found: {sys.argv[i + 1]}")
+            exit(-1)
+        print(f"{len(manifest_done)} detections in the manifests")
+    except Exception as e:
+        print(e)
+        exit(-1)
+
+def manifest_dets(stages):
+    """
+    :param stages: set of manifest stages, any of which counts
+    :return: array of the detectids with any of them
+    """
+    dets = []
+    for key, done in manifest_done.items():
+        if len(done & stages) > 0:
+            try:
+                dets.append(int(key))
+            except: #not a detectid (i.e. a forced extraction)
+                pass
+    return np.array(dets,dtype=int)
+
+
 #todo: make configurable (which hdr version)
 cfg = HDRconfig(survey=HDRVERSION)
 
@@ -119,10 +154,13 @@ else:
 
 print(f"len(alldets) == {len(alldets)}")
 
-print ("Reading ELiXer h5 file ...")
-elixer_h5 = tables.open_file(elixer_h5_path, "r")
-dtb = elixer_h5.root.Detections
-elixer_dets = dtb.read(field="detectid")
+if manifest_done is not None:
+    elixer_dets = manifest_dets({"h5"})
+else:
+    print ("Reading ELiXer h5 file ...")
+    elixer_h5 = tables.open_file(elixer_h5_path, "r")
+    dtb = elixer_h5.root.Detections
+    elixer_dets = dtb.read(field="detectid")
 missing_elixer_dets = np.setdiff1d(alldets,elixer_dets)
 
 print(f"{len(missing_elixer_dets)} with no elixer.h5 entry")
@@ -157,75 +195,80 @@ all_mini = []
 #main reports
 SQL_QUERY = "SELECT detectid from report;"
 
-print("loading detectids from elixer_reports_xxx.db ... ")
-dbs = sorted(glob.glob(os.path.join(db_path,"elixer_reports_" + report_prefix + "*[0-9].db")))
-for db in dbs:
-    okay = True #only read in those dbs that have a prefix that is in our start-stop range
-    try:
-        pr = int(os.path.basename(db).split('_')[2].split('.')[0])
-        if not (pr in prefix):
-            okay = False
-    except:
-        pass
-
-    if not okay:
-        print(f"{db} NOT OKAY")
-        continue
-
-    print(f"{db} querying ... ")
-    conn = sqlite3.connect("file:" + db + "?mode=ro",uri=True)
-    cursor = conn.cursor()
-    cursor.execute(SQL_QUERY)
-    dets = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    all_rpts.extend([x[0] for x in dets])
-
-dbs = sorted(glob.glob(os.path.join(db_path,"elixer_reports_" + report_prefix + "*nei.db")))
-for db in dbs:
-    okay = True
-    try:
-        pr = int(os.path.basename(db).split('_')[2].split('.')[0])
-        if not (pr in prefix):
-            okay = False
-    except:
-        pass
-
-    if not okay:
-        print(f"{db} NOT OKAY")
-        continue
-
-    print(f"{db} querying ... ")
-    conn = sqlite3.connect("file:" + db + "?mode=ro",uri=True)
-    cursor = conn.cursor()
-    cursor.execute(SQL_QUERY)
-    dets = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    all_nei.extend([x[0] for x in dets])
-
-dbs = sorted(glob.glob(os.path.join(db_path,"elixer_reports_" + report_prefix + "*mini.db")))
-for db in dbs:
-    okay = True
-    try:
-        pr = int(os.path.basename(db).split('_')[2].split('.')[0])
-        if not (pr in prefix):
-            okay = False
-    except:
-        pass
-
-    if not okay:
-        print(f"{db} NOT OKAY")
-        continue
-
-    print(f"{db} querying ... ")
-    conn = sqlite3.connect("file:" + db + "?mode=ro",uri=True)
-    cursor = conn.cursor()
-    cursor.execute(SQL_QUERY)
-    dets = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    all_mini.extend([x[0] for x in dets])
+if manifest_done is not None:
+    all_rpts = manifest_dets(manifest.REPORT_STAGES)
+    all_nei = manifest_dets({"nei"})
+    all_mini = manifest_dets({"mini"})
+else:
+    print("loading detectids from elixer_reports_xxx.db ... ")
+    dbs = sorted(glob.glob(os.path.join(db_path,"elixer_reports_" + report_prefix + "*[0-9].db")))
+    for db in dbs:
+        okay = True #only read in those dbs that have a prefix that is in our start-stop range
+        try:
+            pr = int(os.path.basename(db).split('_')[2].split('.')[0])
+            if not (pr in prefix):
+                okay = False
+        except:
+            pass
+
+        if not okay:
+            print(f"{db} NOT OKAY")
+            continue
+
+        print(f"{db} querying ... ")
+        conn = sqlite3.connect("file:" + db + "?mode=ro",uri=True)
+        cursor = conn.cursor()
+        cursor.execute(SQL_QUERY)
+        dets = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        all_rpts.extend([x[0] for x in dets])
+
+    dbs = sorted(glob.glob(os.path.join(db_path,"elixer_reports_" + report_prefix + "*nei.db")))
+    for db in dbs:
+        okay = True
+        try:
+            pr = int(os.path.basename(db).split('_')[2].split('.')[0])
+            if not (pr in prefix):
+                okay = False
+        except:
+            pass
+
+        if not okay:
+            print(f"{db} NOT OKAY")
+            continue
+
+        print(f"{db} querying ... ")
+        conn = sqlite3.connect("file:" + db + "?mode=ro",uri=True)
+        cursor = conn.cursor()
+        cursor.execute(SQL_QUERY)
+        dets = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        all_nei.extend([x[0] for x in dets])
+
+    dbs = sorted(glob.glob(os.path.join(db_path,"elixer_reports_" + report_prefix + "*mini.db")))
+    for db in dbs:
+        okay = True
+        try:
+            pr = int(os.path.basename(db).split('_')[2].split('.')[0])
+            if not (pr in prefix):
+                okay = False
+        except:
+            pass
+
+        if not okay:
+            print(f"{db} NOT OKAY")
+            continue
+
+        print(f"{db} querying ... ")
+        conn = sqlite3.connect("file:" + db + "?mode=ro",uri=True)
+        cursor = conn.cursor()
+        cursor.execute(SQL_QUERY)
+        dets = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        all_mini.extend([x[0] for x in dets])
 
 #todo: is it worth the overhead to remove 'd' from the various all_xxx lists
 # once it has been checked (so that the next check has a shorter list?)
@@ -245,7 +288,11 @@ missing_aperture
 
 
 #costly upfront, but much faster overall
-if check_imaging:
+if check_imaging and (manifest_done is not None):
+    aperture_dets = manifest_dets({"imaging"})
+    missing_aperture = np.setdiff1d(alldets,aperture_dets)
+    elixer_h5 = None
+elif check_imaging:
     # elixer_h5 = tables.open_file(cfg.elixerh5,"r") #"elixer_merged_cat.h5","r")
     elixer_h5 = tables.open_file(elixer_h5_path, "r")
     apt = elixer_h5.root.Aperture
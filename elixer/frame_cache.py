@@ -0,0 +1,117 @@
+"""
+Bounded (by memory) least recently used cache of pandas DataFrames, i.e. one imaging catalog tract per entry,
+with optional binary (.npy) sidecars so that a whitespace delimited text catalog only has to be parsed once.
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import os
+import os.path as op
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+log = G.Global_Logger('frame_cache')
+log.setlevel(G.LOG_LEVEL)
+
+
+def frame_nbytes(df):
+    """
+    :return: approximate in-memory size (bytes) of the DataFrame
+    """
+    try:
+        return int(df.memory_usage(index=True,deep=True).sum())
+    except:
+        return 0
+
+
+class FrameCache:
+
+    def __init__(self,max_mb):
+        """
+        :param max_mb: memory budget (MB); least recently used frames are dropped once the total exceeds this
+                       (the most recently used frame is always kept, even if on its own it is over the budget)
+        """
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.frames = OrderedDict() #key to (DataFrame, nbytes)
+        self.total_bytes = 0
+
+    def __contains__(self,key):
+        return key in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def keys(self):
+        return list(self.frames.keys())
+
+    def get(self,key):
+        """
+        :return: the cached DataFrame (marked as most recently used) or None
+        """
+        entry = self.frames.get(key)
+        if entry is None:
+            return None
+        self.frames.move_to_end(key)
+        return entry[0]
+
+    def put(self,key,df):
+        if key in self.frames:
+            self.total_bytes -= self.frames.pop(key)[1]
+
+        nbytes = frame_nbytes(df)
+        self.frames[key] = (df,nbytes)
+        self.total_bytes += nbytes
+
+        while (self.total_bytes > self.max_bytes) and (len(self.frames) > 1):
+            old_key, (old_df, old_nbytes) = self.frames.popitem(last=False)
+            self.total_bytes -= old_nbytes
+            log.debug(f"FrameCache dropped {old_key} ({old_nbytes} bytes)")
+
+    def clear(self):
+        self.frames = OrderedDict()
+        self.total_bytes = 0
+
+
+def read_sidecar(fn):
+    """
+    :param fn: .npy sidecar filename
+    :return: DataFrame or None if there is no (usable) sidecar
+    """
+    try:
+        if (fn is not None) and op.isfile(fn):
+            return pd.DataFrame(np.load(fn,allow_pickle=False))
+    except:
+        log.info(f"Unable to read catalog sidecar {fn}",exc_info=True)
+    return None
+
+
+def write_sidecar(fn,df):
+    """
+    Save the whole DataFrame as a .npy record array (without pickling, so a frame with object, i.e. string,
+    columns is not written). Written to a temporary and renamed so concurrent readers never see a partial file.
+
+    :param fn: .npy sidecar filename
+    :param df: DataFrame
+    :return: True if written
+    """
+    tmp_fn = None
+    try:
+        os.makedirs(op.dirname(fn),exist_ok=True)
+        tmp_fn = fn + ".%d.tmp" % os.getpid()
+        with open(tmp_fn,"wb") as f:
+            np.save(f,df.to_records(index=False),allow_pickle=False)
+        os.replace(tmp_fn,fn)
+        return True
+    except:
+        log.info(f"Unable to write catalog sidecar {fn}",exc_info=True)
+        try:
+            if tmp_fn is not None:
+                os.remove(tmp_fn)
+        except:
+            pass
+    return False
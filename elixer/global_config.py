@@ -718,6 +718,7 @@ NEGATIVE_Z_ERROR = -0.001 #if compuated z is negative, but greater than this, as
 
 MC_PLAE_SAMPLE_SIZE = 250 #number of random samples to run
 MC_PLAE_CONF_INTVL = 0.68 #currently supported 0.68, 0.95, 0.99
+PLAE_USE_TABLES = True #if True, use the precomputed (cached) LAE/OII classifier tables instead of the full calculation
 
 CLASSIFY_WITH_OTHER_LINES = True
 SPEC_MAX_OFFSET_SPREAD = 2.75 #AA #maximum spread in (velocity) offset (but in AA) across all lines in a solution
@@ -809,13 +810,59 @@ PANSTARRS_FORCE = False  #ignore local catalogs and Force the use of only Pan-ST
 SDSS_ALLOW = True #if no other catalogs match, try SDSS as online query (default if not dispatch mode)
 SDSS_FORCE = False  #ignore local catalogs and Force the use of only SDSS
 
+CUTOUT_CACHE_PATH = None #if set, a (shared, writable) directory to cache the imaging fetched from DECaLS, Pan-STARRS, SDSS
+CUTOUT_CACHE_MAX_MB = 4096 #least recently used cutouts are removed from the cache beyond this
+CUTOUT_CACHE_GRID_ARCSEC = 0.5 #requested positions are rounded to this grid for the cache key
+CUTOUT_CACHE_OFFLINE = False #if True, never fetch from the web, only use cached cutouts
+CUTOUT_PREFETCH_WORKERS = 8 #number of concurrent downloads when prefetching the cutouts for all detections
+CUTOUT_FETCH_RETRIES = 3 #max attempts per (web) cutout request
+CUTOUT_FETCH_TIMEOUT = 60 #seconds per (web) cutout request
+
 USE_PHOTO_CATS = True  #default normal is True .... use photometry catalogs (if False only generate the top (HETDEX) part)
 
 MAX_NEIGHBORS_IN_MAP = 15
 
 BUILD_HDF5_CATALOG = True
 
+HDF5_HANDLE_POOL_SIZE = 16 #max number of read-only HDF5 handles (detections, survey, multifits) kept open per process
+HDF5_PREFETCH_DETECTIONS = 100 #number of detections to bulk read (Detections, Spectra, Fibers rows) at a time
+HDF5_MERGE_CHUNK_MB = 64 #max (approximate) MB of table rows held in memory at a time when merging ELiXer HDF5 catalogs
+HDF5_MERGE_FAN_IN = 64 #max number of input files per (intermediate) merge when merging as a tree
+HDF5_CATALOG_BATCH_DETS = 25 #detections buffered before their ELiXer HDF5 catalog rows are written (one append per table)
+HDF5_CATALOG_COMPLEVEL = 1 #zlib compression level for the ELiXer HDF5 catalog tables (0 = none)
+HSC_CATALOG_CACHE_MB = 2048 #memory budget for the per-tract HSC catalogs kept loaded (least recently used are dropped)
+HSC_CATALOG_SIDECAR_PATH = None #if set, a (writable) directory for binary copies of the HSC catalog tracts (parsed once)
+
 ALLOW_SYSTEM_CALL_PDF_CONVERSION = True #if True, if the Python PDF to PNG fails, attempt a system call to pdftoppm
+REPORT_IMAGE_DIRECT = False #if True, the PNG/JPG reports are rendered directly from the figures (no PDF conversion)
+REPORT_IMAGE_DPI = 150 #resolution of the PNG/JPG reports (same as the PDF conversion)
+REPORT_PDF = True #if False (and REPORT_IMAGE_DIRECT), the PDF report is not written
+REPORT_DB_PATH = None #if set, a directory of SQLite report databases the PNG report images are written into (not as files)
+REPORT_DB_SHARED = False #if True, all processes write the same (canonical) shard databases (WAL); only safe on one node
+REPORT_DB_KEEP_FILES = False #if True, (with REPORT_DB_PATH) also write the PNG files
+REPORT_DB_BATCH_SIZE = 50 #number of report images buffered (per database) before they are committed in one transaction
+REPORT_DB_TIMEOUT = 120 #seconds to wait on a locked report database
+SQLITE_BLOB_CACHE_SIZE = 256 #max number of (decompressed) blobs (i.e. zPDFs) kept per SQLite database
+SQLITE_MMAP_MB = 256 #memory map (up to) this much of each read-only SQLite database (0 = off)
+BATCH_GAUSS_FIT = False #if True, the gaussian fits for all candidate lines (peak finders, additional lines) are made at once (vectorized)
+                        #(off until checked against the stored test spectra; not always the same minimum as curve_fit)
+BATCH_GAUSS_FIT_VALIDATE = 5 #every Nth accepted batch fit is re-fit with curve_fit; if any ends at a worse chi2, all the
+                             #fits of that batch fall back to curve_fit
+
+DISPATCH_SHOT_COST = 0.5 #(selixer dispatch plan) cost, in detections, of loading one more shot in a dispatch
+DISPATCH_TILE_COST = 1.0 #(selixer dispatch plan) cost, in detections, of loading one more imaging tile (tract) in a dispatch
+DISPATCH_SKY_CELL_DEG = 0.5 #(selixer dispatch plan) side of the sky cells that group detections off the HSC and KPNO tiles
+DISPATCH_PLAN_SLACK = 0.10 #(selixer dispatch plan) fraction over an even share a dispatch may go to keep a shot or tile together
+
+RECORD_TIMING = True #record per-detection stage timings to <name>/<name>_timing.tsv (for the selixer cost model)
+COST_MODEL_MIN_ROWS = 20 #(selixer cost model) minimum number of earlier timings to fit (a grouping of) the model
+COST_MODEL_PERCENTILE = 90 #(selixer cost model) percentile of the measured process startup times used as the per-task overhead
+COST_MODEL_SIGMA = 3.0 #(selixer cost model) standard deviations of the summed detection times added to each task's expected time
+COST_MODEL_TIME_MARGIN = 0.15 #(selixer cost model) fractional margin added to the requested wall time
+
+WORK_QUEUE_BATCH_SIZE = 5 #(selixer --work_queue) detections per batch claimed from the shared queue
+RECORD_MANIFEST = True #append each detection's completed outputs to <name>/<name>_manifest.tsv (used by recovery)
+MANIFEST_SHARED_RUN = False #(set by --work_queue) recovery also consults the manifests of the run's other dispatch_xxxx
 
 DISPLAY_PSEUDO_COLOR = False  #display in upper left the pseudo-color from the HETDEX spectrum
 
@@ -845,5 +892,7 @@ ALLOW_BROADLINE_FIT = True
 SUBTRACT_HETDEX_SKY_RESIDUAL = False #if true compute a per-shot sky residual, convolve with per-shot PSF and subtract
 # from the HETDEX spectrum (only applies to re-extractions (forced extractions) with ffsky
 # requires --aperture xx  --ffsky --sky_residual
+SKY_RESIDUAL_CACHE_PATH = None #if set, a (shared, writable) directory for the per-shot sky residuals (built once per shot)
 
-GET_SPECTRA_MULTIPROCESS = True #auto sets to False if in SLURM/dispatch mode
\ No newline at end of file
+GET_SPECTRA_MULTIPROCESS = True #auto sets to False if in SLURM/dispatch mode
+RASTER_SEARCH_WORKERS = 4 #max number of shots extracted in parallel (processes) for a --gridsearch raster
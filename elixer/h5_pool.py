@@ -0,0 +1,204 @@
+"""
+Process-wide pool of read-only HDF5 (PyTables) file handles, keyed by path.
+
+The HETDEX detection, survey and multifits HDF5 files are large and (on Lustre) slow to open and to load indices
+for, so rather than open/close them for every detection, the handles are kept open here and re-used.
+Least recently used handles are closed once more than G.HDF5_HANDLE_POOL_SIZE are open.
+
+Fork safety: a child process never re-uses (or closes) handles it inherited from its parent; it silently forgets
+them and opens its own on first use.
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import atexit
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import tables
+
+log = G.Global_Logger('h5_pool')
+log.setlevel(G.LOG_LEVEL)
+
+
+class H5HandlePool:
+    """
+    LRU pool of read-only PyTables file handles
+    """
+
+    def __init__(self,max_handles=None):
+        if max_handles is None:
+            max_handles = G.HDF5_HANDLE_POOL_SIZE
+        self.max_handles = max(1,int(max_handles))
+        self.handles = OrderedDict() #key = absolute path, value = tables.File
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+
+    def _check_fork(self):
+        """
+        If we are in a forked child, drop (but do not close) the parent's handles
+        """
+        if self.pid != os.getpid():
+            self.handles = OrderedDict()
+            self.pid = os.getpid()
+            self.lock = threading.RLock()
+
+    def get(self,fn):
+        """
+        Return an open (read-only) handle for the HDF5 file, opening it if necessary.
+        Raises the same exceptions as tables.open_file() if the file cannot be opened.
+
+        :param fn: HDF5 filename
+        :return: tables.File
+        """
+        self._check_fork()
+        key = os.path.abspath(fn)
+        with self.lock:
+            fileh = self.handles.get(key)
+            if (fileh is not None) and fileh.isopen:
+                self.handles.move_to_end(key)
+                return fileh
+
+            log.debug(f"h5_pool opening {key}")
+            fileh = tables.open_file(key,mode="r")
+            self.handles[key] = fileh
+
+            while len(self.handles) > self.max_handles:
+                old_key, old_fileh = self.handles.popitem(last=False)
+                try:
+                    old_fileh.close()
+                    log.debug(f"h5_pool closed (LRU) {old_key}")
+                except:
+                    log.debug(f"h5_pool exception closing {old_key}",exc_info=True)
+
+            return fileh
+
+    def close(self,fn):
+        """
+        Close the handle for the file (if open in the pool)
+        """
+        self._check_fork()
+        key = os.path.abspath(fn)
+        with self.lock:
+            fileh = self.handles.pop(key,None)
+            if fileh is not None:
+                try:
+                    fileh.close()
+                except:
+                    log.debug(f"h5_pool exception closing {key}",exc_info=True)
+
+    def close_all(self):
+        """
+        Close all handles owned by this process
+        """
+        if self.pid != os.getpid():
+            self._check_fork()
+            return
+
+        with self.lock:
+            for key in list(self.handles.keys()):
+                self.close(key)
+
+
+_pool = H5HandlePool()
+
+try:
+    os.register_at_fork(after_in_child=_pool._check_fork)
+except:
+    pass #older python, the pid check in the pool still covers it
+
+atexit.register(_pool.close_all)
+
+
+def get_handle(fn):
+    """
+    :param fn: HDF5 filename
+    :return: open, read-only tables.File from the process-wide pool (do not close it, the pool owns it)
+    """
+    return _pool.get(fn)
+
+
+@contextmanager
+def handle(fn):
+    """
+    Drop-in for "with tables.open_file(fn,mode='r') as h5:" that uses the pooled handle
+    (and so does NOT close the file on exit)
+    """
+    yield _pool.get(fn)
+
+
+def close(fn):
+    _pool.close(fn)
+
+
+def close_all():
+    _pool.close_all()
+
+
+def _detectid_runs(detectids,max_gap):
+    """
+    Split sorted, unique detectids into runs where neighbors differ by no more than max_gap
+    :return: list of (low, high) detectids
+    """
+    if len(detectids) == 0:
+        return []
+    breaks = np.where(np.diff(detectids) > max_gap)[0]
+    lows = np.concatenate(([detectids[0]],detectids[breaks+1]))
+    highs = np.concatenate((detectids[breaks],[detectids[-1]]))
+    return list(zip(lows,highs))
+
+
+def read_by_detectids(fn,table_path,detectids,max_gap=1000):
+    """
+    Batched lookup of all the rows for many detectids in one table (e.g. Detections, Spectra, Fibers in the
+    HETDEX detections file). Instead of one read_where() per detectid, the detectids are grouped into
+    (nearly) contiguous runs, each run is one (indexed) range query for the row coordinates, and all the
+    matching rows are then fetched in a single read_coordinates() pass.
+
+    :param fn: HDF5 filename
+    :param table_path: path to the table in the file, e.g. "/Detections"
+    :param detectids: array-like of detectids
+    :param max_gap: detectids further apart than this go into separate range queries
+    :return: dictionary, key = detectid, value = structured array of that detectid's rows (in table order);
+             detectids not found are not included
+    """
+    detectids = np.unique(np.array(detectids,dtype=np.int64))
+    result = {}
+    if detectids.size == 0:
+        return result
+
+    fileh = get_handle(fn)
+    table = fileh.get_node(table_path)
+
+    coords = []
+    for low, high in _detectid_runs(detectids,max_gap):
+        coords.append(table.get_where_list("(detectid >= low) & (detectid <= high)"))
+
+    coords = np.sort(np.concatenate(coords))
+    if coords.size == 0:
+        return result
+
+    #only keep the coordinates for the requested detectids (the runs can include some in-between ones)
+    ids = table.read_coordinates(coords,field="detectid")
+    sel = np.isin(ids,detectids)
+    coords = coords[sel]
+    ids = ids[sel]
+
+    rows = table.read_coordinates(coords)
+
+    #group by detectid (stable, so rows stay in table order within each detectid)
+    order = np.argsort(ids,kind='stable')
+    ids = ids[order]
+    rows = rows[order]
+    uniq, starts = np.unique(ids,return_index=True)
+    ends = np.append(starts[1:],len(ids))
+    for d, s, e in zip(uniq,starts,ends):
+        result[d] = rows[s:e]
+
+    return result
@@ -11,6 +11,8 @@ try:
     from elixer import weighted_biweight
     from elixer import utilities as utils
     from elixer import shot_sky
+    from elixer import h5_pool
+    from elixer import manifest
 except:
     import global_config as G
     import line_prob
@@ -23,6 +25,8 @@ except:
     import weighted_biweight
     import utilities as utils
     import shot_sky
+    import h5_pool
+    import manifest
 
 
 from hetdex_tools.get_spec import get_spectra as hda_get_spectra
@@ -69,8 +73,6 @@ import fnmatch
 import os.path as op
 from copy import copy, deepcopy
 
-import tables
-
 #todo: write a class wrapper for log
 #an instance called log that has functions .Info, .Debug, etc
 #they all take a string (the message) and the exc_info flag
@@ -482,6 +484,10 @@ class Dither():
 class DetObj:
     '''mostly a container for an emission line or continuum detection from detect_line.dat or detect_cont.dat file'''
 
+    #rows pre-read in bulk by prefetch_hdf5(): key = (HDF5 filename, table name), value = dict of detectid:rows
+    #entries are consumed (popped) as each DetObj loads, so this only holds the not-yet-loaded detections
+    hdf5_prefetch = {}
+
     def __init__(self,tokens,emission=True,line_number=None,fcs_base=None,fcsdir=None,basic_only=False):
         #fcs_base is a basename of a single fcs directory, fcsdir is the entire FQdirname
         #fcsdir is more specific
@@ -3561,7 +3567,7 @@ class DetObj:
 
         log.debug("Loading shot info from HDF5 ...")
 
-        with tables.open_file(hdf5_fn, mode="r") as h5_survey:
+        with h5_pool.handle(hdf5_fn) as h5_survey:
             survey = h5_survey.root.Survey
 
             try:
@@ -4419,6 +4425,99 @@ class DetObj:
             pass
 
 
+    @classmethod
+    def prefetch_hdf5(cls,hdf5_fn,detectids):
+        """
+        Bulk read the Detections, Spectra and Fibers rows for all the detectids (one batched pass per table,
+        see h5_pool.read_by_detectids) so that load_hdf5_fluxcalibrated_spectra() does not need its own
+        per-detection read_where() calls. Replaces any earlier prefetch for the same file.
+
+        :param hdf5_fn: HETDEX detections HDF5 file
+        :param detectids: array-like of detectids (sorted is best)
+        :return: number of detectids found
+        """
+        key = op.abspath(hdf5_fn)
+        try:
+            for table_name in ["Detections","Spectra","Fibers"]:
+                cls.hdf5_prefetch[(key,table_name)] = h5_pool.read_by_detectids(hdf5_fn,"/"+table_name,detectids)
+            return len(cls.hdf5_prefetch[(key,"Detections")])
+        except:
+            log.warning(f"Exception prefetching detections from {hdf5_fn}. Will load individually.",exc_info=True)
+            for table_name in ["Detections","Spectra","Fibers"]:
+                cls.hdf5_prefetch.pop((key,table_name),None)
+            return 0
+
+    @classmethod
+    def prefetched_coords(cls,hdf5_fn,detectids):
+        """
+        :param hdf5_fn: HETDEX detections HDF5 file
+        :param detectids: array-like of detectids
+        :return: list of (ra, dec) of those detectids that are in the bulk prefetch (see prefetch_hdf5())
+        """
+        rows = cls.hdf5_prefetch.get((op.abspath(hdf5_fn),"Detections"),{})
+        coords = []
+        for d in detectids:
+            r = rows.get(np.int64(d))
+            if (r is not None) and (len(r) > 0):
+                coords.append((float(r['ra'][0]),float(r['dec'][0])))
+        return coords
+
+    @classmethod
+    def load_many_from_hdf5(cls,hdf5_fn,detectids,survey_fn=None,basic_only=False,init=None):
+        """
+        Build DetObjs for many detectids from one bulk read of the HETDEX detections HDF5 file
+        (rather than three read_where() calls per detection). Detectids already in the prefetch
+        (see prefetch_hdf5(), e.g. a chunk of the whole dispatch read ahead by elixer) are not read again.
+
+        :param hdf5_fn: HETDEX detections HDF5 file
+        :param detectids: array-like of detectids
+        :param survey_fn: (optional) HETDEX survey HDF5 file, if provided also load the shot info
+        :param basic_only:
+        :param init: (optional) function called with each new DetObj before it is loaded (to set annulus, etc)
+        :return: list of DetObjs (only those that loaded with status >= 0), in detectids order
+        """
+        detectids = np.array(detectids,dtype=np.int64)
+        prefetched = cls.hdf5_prefetch.get((op.abspath(hdf5_fn),"Detections"),{})
+        missing = [d for d in detectids if d not in prefetched]
+        if len(missing) > 1: #a lone detectid is just as fast with its own read_where() calls
+            cls.prefetch_hdf5(hdf5_fn,np.sort(detectids))
+
+        det_list = []
+        for d in detectids:
+            e = cls(None, emission=True, basic_only=basic_only)
+            if init is not None:
+                init(e)
+            e.entry_id = d
+            G.UNIQUE_DET_ID_NUM += 1
+            e.id = G.UNIQUE_DET_ID_NUM
+            e.load_hdf5_fluxcalibrated_spectra(hdf5_fn,d,basic_only=basic_only)
+            if survey_fn and e.survey_shotid and (e.status >= 0):
+                e.load_hdf5_shot_info(survey_fn,e.survey_shotid)
+            if e.status >= 0:
+                det_list.append(e)
+            else:
+                log.info(f"Unable to continue with eid({d}) from {hdf5_fn}. No report will be generated.")
+
+        return det_list
+
+    def read_hdf5_rows(self,hdf5_fn,table,id):
+        """
+        Rows for the detectid from the table, served from the bulk prefetch if available,
+        otherwise with a (single) read_where().
+
+        :param hdf5_fn: HDF5 file that contains the table
+        :param table: the PyTables table (Detections, Spectra, Fibers)
+        :param id: detectid
+        :return: structured array of rows
+        """
+        prefetch = self.__class__.hdf5_prefetch.get((op.abspath(hdf5_fn),table.name))
+        if prefetch is not None:
+            rows = prefetch.pop(np.int64(id),None)
+            if rows is not None:
+                return rows
+
+        return table.read_where("detectid==id",condvars={"id":id})
+
     def load_hdf5_fluxcalibrated_spectra(self,hdf5_fn,id,basic_only=False):
         """
 
@@ -4448,7 +4547,7 @@ class DetObj:
         del self.sumspec_fluxerr_zoom[:]
 
         log.debug("Loading base detection data from HDF5 ...")
-        with tables.open_file(hdf5_fn,mode="r") as h5_detect:
+        with h5_pool.handle(hdf5_fn) as h5_detect:
 
             detection_table = h5_detect.root.Detections
             fiber_table = h5_detect.root.Fibers
@@ -4458,7 +4557,7 @@ class DetObj:
             #get the multi-fits equivalent info
             #can't use "detectid==detectid" ... context is confused
             try:
-                rows = detection_table.read_where("detectid==id")
+                rows = self.read_hdf5_rows(hdf5_fn,detection_table,id)
             except:
                 log.error("Exception in hetdex::DetObj::load_hdf5_fluxcalibrated_spectra reading rows from detection_table",
                           exc_info=True)
@@ -4581,7 +4680,7 @@ class DetObj:
             #get the weighted and summed spectra info
             ############################################
             log.debug("Loading summed spectra data from HDF5 ...")
-            rows = spectra_table.read_where("detectid==id")
+            rows = self.read_hdf5_rows(hdf5_fn,spectra_table,id)
             if (rows is None) or (rows.size != 1):
                 self.status = -1
                 log.error("Problem loading detectid. Multiple rows or no rows in Spectra table.")
@@ -4783,7 +4882,7 @@ class DetObj:
              #    panacea_fiber_index=-1, detect_id = -1):
 
             log.debug(f"Loading base fiber data from HDF5 ({id})...")
-            rows = fiber_table.read_where("detectid == id")
+            rows = self.read_hdf5_rows(hdf5_fn,fiber_table,id)
             subset_norm = 0.0 #for the relative weights
 
             num_fibers = rows.size
@@ -6202,8 +6301,14 @@ class HETDEX:
 
                 if self.recover: #this is a recover operation and we can now check for the .pdf
                     try:
-                        if os.path.isfile(os.path.join(e.outdir, str(e.id) + ".pdf")) or \
-                           os.path.isfile(os.path.join(e.outdir,e.outdir + "_" + str(e.id).zfill(3) + ".pdf")):
+                        done = manifest.completed(e.outdir) #(detections not in the manifest: look for the file)
+                        keys = [k for k in (str(e.id), e.outdir + "_" + str(e.id).zfill(3)) if (done is not None) and (k in done)]
+                        if len(keys) > 0:
+                            already_done = manifest.is_done(done[keys[0]])
+                        else:
+                            already_done = os.path.isfile(os.path.join(e.outdir, str(e.id) + ".pdf")) or \
+                                           os.path.isfile(os.path.join(e.outdir,e.outdir + "_" + str(e.id).zfill(3) + ".pdf"))
+                        if already_done:
 
                             log.info(f"Already processed ({e.ra},{e.dec}) shot ({e.survey_shotid}). Will skip (recovery)." )
                             e.status = -1
@@ -6258,47 +6363,31 @@ class HETDEX:
         if len(self.emis_list) > 0:
             del self.emis_list[:]
 
+        detectids = []
         for d in self.hdf5_detectid_list:
             try:
-                d = np.int64(d)
+                detectids.append(np.int64(d))
             except:
                 log.error(f"Skipping invalid detectid: {d}")
-                continue
-            #build an empty Detect Object and then populate
-            e = DetObj(None, emission=True,basic_only=basic_only)
-            if e is not None:
-                if self.known_z is not None:
-                    e.known_z = self.known_z
-
-                e.entry_id = d #aka detect_id from HDF5
-                e.annulus = self.annulus
-                e.target_wavelength = self.target_wavelength
-                e.ra = self.target_ra
-                e.dec = self.target_dec
-                e.extraction_ffsky = self.extraction_ffsky
-
-                #just internal (ELiXer) numbering here
-                G.UNIQUE_DET_ID_NUM += 1
-                e.id = G.UNIQUE_DET_ID_NUM
 
-                if e.outdir is None:
-                    e.outdir = self.output_filename
-
-                #todo: load the HDF5 data here ...
-                #e.load_fluxcalibrated_spectra()
-                e.load_hdf5_fluxcalibrated_spectra(self.hdf5_detect_fqfn,d,basic_only=basic_only)
-                #need the shotid from the detection
-                if e.survey_shotid and (e.status >= 0):
-                    e.load_hdf5_shot_info(self.hdf5_survey_fqfn, e.survey_shotid)
-
-                if e.status >= 0:
-                    if G.CHECK_FOR_METEOR:
-                        e.check_for_meteor()
-
-                    self.emis_list.append(e)
-
-                else:
-                    log.info("Unable to continue with eid(%s). No report will be generated." % (str(e.entry_id)))
+        def init(e):
+            if self.known_z is not None:
+                e.known_z = self.known_z
+            e.annulus = self.annulus
+            e.target_wavelength = self.target_wavelength
+            e.ra = self.target_ra
+            e.dec = self.target_dec
+            e.extraction_ffsky = self.extraction_ffsky
+            if e.outdir is None:
+                e.outdir = self.output_filename
+
+        #need the shotid from the detection, so load_many_from_hdf5 also loads the shot info
+        for e in DetObj.load_many_from_hdf5(self.hdf5_detect_fqfn,detectids,survey_fn=self.hdf5_survey_fqfn,
+                                            basic_only=basic_only,init=init):
+            if G.CHECK_FOR_METEOR:
+                e.check_for_meteor()
+
+            self.emis_list.append(e)
 
     def read_fcsdirs(self):
         # we have either fcsdir and fcs_base or fcsdir_list
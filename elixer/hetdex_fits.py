@@ -1,10 +1,11 @@
 try:
     from elixer import global_config as G
+    from elixer import h5_pool
 except:
     import global_config as G
+    import h5_pool
 
 import numpy as np
-import tables
 
 from astropy.io import fits as pyfits
 from astropy.coordinates import Angle
@@ -287,7 +288,7 @@ class HetdexFits:
 
         try:
             log.debug("Reading HDF5 file: %s" %(self.filename))
-            with tables.open_file(self.filename, mode="r") as h5_multifits:
+            with h5_pool.handle(self.filename) as h5_multifits:
                 fibers_table = h5_multifits.root.Data.Fibers
                 images_table = h5_multifits.root.Data.Images
                 shots_table = h5_multifits.root.Shot
@@ -58,16 +58,40 @@ class InterpolatedEW(object):
                  if norm > 0.0:                    
                      data[i, :] /= norm
 
+         if not all(isfinite(data).flatten()):
+            raise NonFiniteInterpolationCube("Non finite values in the EW interpolation cube: {:s}".format(filename))
+
+         self._set_cube(self.zbcens, ew, data)
+
+     def _set_cube(self, zbcens, ew, data):
+         self.zbcens = zbcens
+         self.ew = ew
+         self.data = data
+
          self.minz = min(self.zbcens)
          self.maxz = max(self.zbcens)
          self.minew = min(ew)
          self.maxew = max(ew)
 
-         if not all(isfinite(data).flatten()):
-            raise NonFiniteInterpolationCube("Non finite values in the EW interpolation cube: {:s}".format(filename))
-
          self.interpolator = RegularGridInterpolator((self.zbcens, log10(ew)), data, method="linear", bounds_error=False)
 
+     @classmethod
+     def from_arrays(cls, zbcens, ew, data):
+         """
+         Build from an already read (i.e. cached) cube rather than
+         the FITS file
+
+         Parameters
+         ----------
+         zbcens, ew : array
+             the redshift and EW bin centers
+         data : 2D array
+             the n values (zbcens x ew)
+         """
+         obj = cls.__new__(cls)
+         obj._set_cube(array(zbcens), array(ew), array(data))
+         return obj
+
      def return_new(self, z, ew):
          """
          Return the interpolated values 
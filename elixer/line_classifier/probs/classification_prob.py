@@ -11,7 +11,7 @@ from __future__ import absolute_import
 
 
 from numpy import any as nany
-from numpy import pi, square, exp, array, power, zeros, ones, isnan, sqrt, mean
+from numpy import pi, square, exp, array, power, zeros, ones, isnan, sqrt, mean, size
 from scipy.stats import norm
 
 try:
@@ -426,7 +426,14 @@ def source_prob(config, ra, dec, zs, fluxes, flux_errs, ews_obs, ew_err, c_obs,
     prob_lae_given_data = nlae/(nlae + noii)
 
     prob_oii_give_data = noii/(nlae + noii)
-    if prob_oii_give_data > 0.0:
+    if size(prob_oii_give_data) > 1: #many sources (or many samples of one source) at once
+        _plgd = array(getattr(prob_lae_given_data,"value",prob_lae_given_data),dtype=float)
+        _pogd = array(getattr(prob_oii_give_data,"value",prob_oii_give_data),dtype=float)
+        posterior_odds = zeros(len(_pogd)) #undetermined
+        _sel = _pogd > 0.0
+        posterior_odds[_sel] = _plgd[_sel] / _pogd[_sel]
+        posterior_odds[~_sel & (_plgd > 0.0)] = 1000.0 #max value
+    elif prob_oii_give_data > 0.0:
         posterior_odds =  prob_lae_given_data / prob_oii_give_data
     elif prob_lae_given_data > 0.0:
         posterior_odds = 1000.0 #max value
@@ -0,0 +1,308 @@
+"""
+
+Precomputed (tabulated) version of the classification_prob.source_prob LAE/OII classifier.
+
+Everything in source_prob that depends only on the redshift (the comoving volume elements, luminosity distances,
+the Schechter L*, alpha and phi* with its incomplete gamma integral normalization and the EW classification
+correction) is tabulated once on a fine observed wavelength grid for a given universe.cfg. The observed EW
+distributions (the InterpolatedEW cubes) are stored alongside. The tables are saved to a versioned cache file
+(keyed by a hash of the config and the EW cubes) so later processes just load them.
+
+Evaluating a source (or a whole vector of Monte Carlo samples) is then a few interpolations and array operations.
+
+Build (or rebuild) the cache by hand with:
+    python classification_tables.py [path/to/universe.cfg]
+
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import os.path as op
+import sys
+
+import numpy as np
+
+try:
+    from elixer import global_config as G
+    from elixer.line_classifier.lfs_ews.luminosity_function import LuminosityFunction
+    from elixer.line_classifier.lfs_ews.equivalent_width import EquivalentWidthAssigner, InterpolatedEW
+    from elixer.line_classifier.misc.tools import generate_cosmology_from_config
+    from elixer.line_classifier.probs.classification_prob import return_delta_volume, n_additional_line
+except:
+    import global_config as G
+    from line_classifier.lfs_ews.luminosity_function import LuminosityFunction
+    from line_classifier.lfs_ews.equivalent_width import EquivalentWidthAssigner, InterpolatedEW
+    from line_classifier.misc.tools import generate_cosmology_from_config
+    from line_classifier.probs.classification_prob import return_delta_volume, n_additional_line
+
+_logger = G.Global_Logger("lae_prob_tables")
+_logger.setlevel(G.LOG_LEVEL)
+
+TABLE_VERSION = 1 #bump if the tabulated quantities or their layout change
+
+#observed wavelength grid (AA); covers the HETDEX spectral range with some room
+WL_MIN = 3400.0
+WL_MAX = 5700.0
+WL_STEP = 0.1
+
+_tables = {} #cache filename : ClassificationTables (one load per process)
+
+
+def ew_cube_files(config):
+    base_path = op.join(op.dirname(op.realpath(__file__)), "config")
+    return op.join(base_path, config.get("InterpolatedEW", "lae_file")), \
+           op.join(base_path, config.get("InterpolatedEW", "oii_file"))
+
+
+def config_hash(config):
+    """
+    Hash of everything the tables depend on: the table version and grid, every config entry, and the
+    (size and modification time of) the EW cube files
+    """
+    h = hashlib.sha1()
+    h.update(("%d %f %f %f\n" % (TABLE_VERSION, WL_MIN, WL_MAX, WL_STEP)).encode())
+    for section in sorted(config.sections()):
+        for k, v in sorted(config.items(section)):
+            h.update(("[%s] %s = %s\n" % (section, k, v)).encode())
+    for fn in ew_cube_files(config):
+        try:
+            h.update(("%s %d %d\n" % (op.basename(fn), op.getsize(fn), int(op.getmtime(fn)))).encode())
+        except OSError:
+            h.update(("%s missing\n" % op.basename(fn)).encode())
+    return h.hexdigest()
+
+
+def default_cache_fn(config_fn):
+    """
+    :param config_fn: the universe.cfg filename
+    :return: the tables cache filename (next to the config)
+    """
+    return op.splitext(config_fn)[0] + "_tables.npz"
+
+
+def _lf_columns(lf, ew_assigner, wls, line_wl, lae_wl, cosmo):
+    """
+    The redshift dependent parts of (L/L*)*dN/dL * dV for one line, on the wavelength grid
+    """
+    zs = wls / line_wl - 1.0
+    dvol = np.array(return_delta_volume(wls, line_wl, cosmo, wl_lae=lae_wl).value, dtype=float)
+    d = cosmo.luminosity_distance(zs).to('cm').value
+    four_pi_d2 = 4.0 * np.pi * d * d
+    lstar = np.broadcast_to(np.array(lf.Lstars_func(zs), dtype=float), zs.shape)
+    alpha = np.broadcast_to(np.array(lf.alphas_func(zs), dtype=float), zs.shape)
+    phi = np.broadcast_to(np.array(lf.phi_star_func(zs), dtype=float), zs.shape)
+    if ew_assigner:
+        corr = np.broadcast_to(np.array(ew_assigner.classification_correction(zs), dtype=float), zs.shape)
+    else:
+        corr = 1.0
+    return phi * corr * dvol, lstar, alpha, four_pi_d2
+
+
+def build_tables(config):
+    """
+    Tabulate the classifier for the config (same setup as classification_prob.source_prob)
+
+    :param config: ConfigParser (universe.cfg)
+    :return: dictionary of arrays (as saved in the cache file)
+    """
+    lae_ew = EquivalentWidthAssigner.from_config(config, 'LAE_EW')
+    lf_lae = LuminosityFunction.from_config(config, "LAE_LF", ew_assigner=lae_ew)
+    lf_oii = LuminosityFunction.from_config(config, "OII_LF")
+    cosmo = generate_cosmology_from_config(config)
+
+    lae_wl = config.getfloat("wavelengths", "LAE")
+    oii_wl = config.getfloat("wavelengths", "OII")
+    oii_zlim = config.getfloat("General", "oii_zlim")
+
+    wls = np.arange(WL_MIN, WL_MAX + WL_STEP / 2.0, WL_STEP)
+
+    lae_pref, lae_lstar, lae_alpha, lae_d2 = _lf_columns(lf_lae, lf_lae.ew_assigner, wls, lae_wl, lae_wl, cosmo)
+    oii_pref, oii_lstar, oii_alpha, oii_d2 = _lf_columns(lf_oii, lf_oii.ew_assigner, wls, oii_wl, lae_wl, cosmo)
+    oii_pref = np.array(oii_pref)
+    oii_pref[(wls / oii_wl - 1.0) < oii_zlim] = 0.0
+
+    lae_file, oii_file = ew_cube_files(config)
+    lae_ew_obs = InterpolatedEW(lae_file)
+    oii_ew_obs = InterpolatedEW(oii_file)
+
+    return {'version': np.array(TABLE_VERSION),
+            'config_hash': np.array(config_hash(config)),
+            'wl': wls,
+            'lae_wl': np.array(lae_wl),
+            'oii_wl': np.array(oii_wl),
+            'lae_pref': np.array(lae_pref), 'lae_lstar': np.array(lae_lstar),
+            'lae_alpha': np.array(lae_alpha), 'lae_d2': np.array(lae_d2),
+            'oii_pref': oii_pref, 'oii_lstar': np.array(oii_lstar),
+            'oii_alpha': np.array(oii_alpha), 'oii_d2': np.array(oii_d2),
+            'lae_ew_z': np.array(lae_ew_obs.zbcens), 'lae_ew_ew': np.array(lae_ew_obs.ew),
+            'lae_ew_data': np.array(lae_ew_obs.data),
+            'oii_ew_z': np.array(oii_ew_obs.zbcens), 'oii_ew_ew': np.array(oii_ew_obs.ew),
+            'oii_ew_data': np.array(oii_ew_obs.data),
+            'oii_ew_max': np.array(config.getfloat("InterpolatedEW", "oii_ew_max")),
+            'rel_line_strengths': np.array(json.dumps(dict(config.items("RelativeLineStrengths"))))}
+
+
+def save_tables(fn, tables):
+    """
+    Write the cache (to a temporary then renamed, so concurrent processes never see a partial file)
+    """
+    tmp_fn = fn + ".%d.tmp.npz" % os.getpid()
+    try:
+        np.savez(tmp_fn, **tables)
+        os.replace(tmp_fn, fn)
+        return True
+    except:
+        _logger.info("Unable to write classifier tables cache %s" % fn, exc_info=True)
+        try:
+            os.remove(tmp_fn)
+        except:
+            pass
+    return False
+
+
+class ClassificationTables(object):
+    """
+    Fast, vectorized evaluation of classification_prob.source_prob from the tables
+    """
+
+    def __init__(self, tables):
+        self.wl = np.array(tables['wl'])
+        self.lae_wl = float(tables['lae_wl'])
+        self.oii_wl = float(tables['oii_wl'])
+        self.columns = {k: np.array(tables[k]) for k in ['lae_pref', 'lae_lstar', 'lae_alpha', 'lae_d2',
+                                                       'oii_pref', 'oii_lstar', 'oii_alpha', 'oii_d2']}
+        self.lae_ew_obs = InterpolatedEW.from_arrays(tables['lae_ew_z'], tables['lae_ew_ew'], tables['lae_ew_data'])
+        self.oii_ew_obs = InterpolatedEW.from_arrays(tables['oii_ew_z'], tables['oii_ew_ew'], tables['oii_ew_data'])
+        self.oii_ew_max = float(tables['oii_ew_max'])
+        self.rel_line_strengths = {k: float(v) for k, v in json.loads(str(tables['rel_line_strengths'])).items()}
+        self.config_hash = str(tables['config_hash'])
+
+    def in_range(self, zs):
+        """
+        :param zs: LAE redshift(s)
+        :return: True if all are covered by the tables
+        """
+        wls = (np.asarray(zs, dtype=float) + 1.0) * self.lae_wl
+        return bool(np.all((wls >= self.wl[0]) & (wls <= self.wl[-1])))
+
+    def _n(self, which, wls, fluxes):
+        pref = np.interp(wls, self.wl, self.columns[which + '_pref'])
+        lstar = np.interp(wls, self.wl, self.columns[which + '_lstar'])
+        alpha = np.interp(wls, self.wl, self.columns[which + '_alpha'])
+        d2 = np.interp(wls, self.wl, self.columns[which + '_d2'])
+        x = fluxes * d2 / lstar
+        return pref * np.power(x, alpha + 1.0) * np.exp(-1.0 * x)
+
+    @staticmethod
+    def _ew_n(ews_obs, zs, ew_func):
+        ew_rest = ews_obs / (1. + zs)
+        return ew_func.return_new(zs, ew_rest) * ew_rest
+
+    def source_prob(self, zs, fluxes, flux_errs, ews_obs, addl_fluxes=None, addl_fluxes_error=None,
+                    addl_line_names=None):
+        """
+        Same as classification_prob.source_prob (without the extended output), for any number of sources
+        (or samples), each with its own redshift, flux and EW (or a single redshift for all)
+
+        :return: posterior_odds, prob_lae_given_data (arrays)
+        """
+        fluxes = np.atleast_1d(np.asarray(fluxes, dtype=float))
+        ews_obs = np.atleast_1d(np.asarray(ews_obs, dtype=float))
+        n = max(len(fluxes), len(ews_obs))
+        fluxes = np.broadcast_to(fluxes, n)
+        ews_obs = np.broadcast_to(ews_obs, n)
+        zs = np.broadcast_to(np.atleast_1d(np.asarray(zs, dtype=float)), n)
+
+        wls = (zs + 1.0) * self.lae_wl
+        zs_oii = wls / self.oii_wl - 1.0
+
+        # EW factors
+        ew_n_lae = np.array(self._ew_n(ews_obs, zs, self.lae_ew_obs), dtype=float)
+        ew_n_oii = np.array(self._ew_n(ews_obs, zs_oii, self.oii_ew_obs), dtype=float)
+
+        ew_n_oii[ews_obs < 0.0] = 0.0
+        ew_n_lae[ews_obs < 0.0] = 1.0
+        ew_n_oii[ews_obs > self.oii_ew_max] = 0.0
+        ew_n_lae[ews_obs > self.oii_ew_max] = 1.0
+
+        # Additional lines
+        n_lines_lae = 1.0
+        n_lines_oii = 1.0
+        if addl_line_names is not None:
+            for line_name, taddl_fluxes, taddl_fluxes_errors in zip(addl_line_names, addl_fluxes, addl_fluxes_error):
+                tn_lines_lae, tn_lines_oii = n_additional_line(fluxes, flux_errs, taddl_fluxes, taddl_fluxes_errors,
+                                                               self.rel_line_strengths[str(line_name).lower()])
+                n_lines_lae = n_lines_lae * tn_lines_lae
+                n_lines_oii = n_lines_oii * tn_lines_oii
+
+        nlae = self._n('lae', wls, fluxes) * n_lines_lae * ew_n_lae
+        noii = self._n('oii', wls, fluxes) * n_lines_oii * ew_n_oii
+
+        prob_lae_given_data = nlae / (nlae + noii)
+        prob_oii_give_data = noii / (nlae + noii)
+
+        posterior_odds = np.zeros(n) #undetermined
+        sel = prob_oii_give_data > 0.0
+        posterior_odds[sel] = prob_lae_given_data[sel] / prob_oii_give_data[sel]
+        posterior_odds[~sel & (prob_lae_given_data > 0.0)] = 1000.0 #max value
+
+        return posterior_odds, prob_lae_given_data
+
+
+def get_tables(config, cache_fn):
+    """
+    Load (once per process) the tables for the config, (re)building and saving them if the cache file is
+    missing, from an older version or for a different config.
+
+    :param config: ConfigParser (universe.cfg)
+    :param cache_fn: tables cache filename (see default_cache_fn)
+    :return: ClassificationTables or None if they cannot be built
+    """
+    tables = _tables.get(cache_fn)
+    if tables is not None:
+        return tables
+
+    try:
+        chash = config_hash(config)
+        data = None
+        if op.isfile(cache_fn):
+            try:
+                with np.load(cache_fn, allow_pickle=False) as npz:
+                    if (int(npz['version']) == TABLE_VERSION) and (str(npz['config_hash']) == chash):
+                        data = {k: npz[k] for k in npz.files}
+                    else:
+                        _logger.info("Classifier tables cache %s is stale. Rebuilding." % cache_fn)
+            except:
+                _logger.info("Unable to read classifier tables cache %s. Rebuilding." % cache_fn, exc_info=True)
+
+        if data is None:
+            _logger.info("Building classifier tables ...")
+            data = build_tables(config)
+            save_tables(cache_fn, data)
+
+        tables = ClassificationTables(data)
+        _tables[cache_fn] = tables
+        return tables
+    except:
+        _logger.warning("Unable to build classifier tables. Using full classifier.", exc_info=True)
+        return None
+
+
+if __name__ == "__main__":
+    try:
+        from ConfigParser import RawConfigParser
+    except ImportError:
+        from configparser import RawConfigParser
+
+    if len(sys.argv) > 1:
+        config_fn = sys.argv[1]
+    else:
+        config_fn = op.join(op.dirname(op.dirname(op.realpath(__file__))), "universe.cfg")
+
+    config = RawConfigParser()
+    config.read(config_fn)
+    cache_fn = default_cache_fn(config_fn)
+    if save_tables(cache_fn, build_tables(config)):
+        print("Wrote %s" % cache_fn)
@@ -17,10 +17,12 @@ try:
     from elixer import global_config as G
     from elixer import weighted_biweight as elixer_biweight
     import elixer.line_classifier.probs.classification_prob as LineClassifierPro
+    import elixer.line_classifier.probs.classification_tables as LineClassifierTables
 #    import elixer.line_classifier.probs.classification_prob_leung as LineClassifierPro_Leung
 except:
     import global_config as G
     import line_classifier.probs.classification_prob as LineClassifierPro
+    import line_classifier.probs.classification_tables as LineClassifierTables
     import weighted_biweight as elixer_biweight
 #    import line_classifier.probs.classification_prob_leung as LineClassifierPro_Leung
 
@@ -35,12 +37,39 @@ MIN_PLAE_POII = 0.001
 UNIVERSE_CONFIG = None
 FLUX_LIMIT_FN = None
 COSMOLOGY = None
+CLASSIFIER_TABLES = None #precomputed classifier, False if unavailable
 
 #log = G.logging.getLogger('line_prob_logger')
 #log.setLevel(G.logging.DEBUG)
 log = G.Global_Logger('line_prob_logger')
 log.setlevel(G.LOG_LEVEL)
 
+def get_classifier_tables(z_LyA=None):
+    """
+    The precomputed LAE/OII classifier (line_classifier.probs.classification_tables) for the UNIVERSE_CONFIG,
+    loaded once per process (and built and cached on first use).
+
+    :param z_LyA: (optional) the LyA redshift(s) to be classified; if not covered by the tables, returns None
+    :return: ClassificationTables or None (use the full LineClassifierPro.source_prob)
+    """
+    global CLASSIFIER_TABLES
+
+    if (not G.PLAE_USE_TABLES) or (UNIVERSE_CONFIG is None) or (CLASSIFIER_TABLES is False):
+        return None
+
+    if CLASSIFIER_TABLES is None:
+        config_fn = os.path.join(os.path.dirname(os.path.realpath(__file__)), G.RELATIVE_PATH_UNIVERSE_CONFIG)
+        CLASSIFIER_TABLES = LineClassifierTables.get_tables(UNIVERSE_CONFIG,
+                                                            LineClassifierTables.default_cache_fn(config_fn))
+        if CLASSIFIER_TABLES is None:
+            CLASSIFIER_TABLES = False #don't keep trying
+            return None
+
+    if (z_LyA is not None) and (not CLASSIFIER_TABLES.in_range(z_LyA)):
+        return None
+
+    return CLASSIFIER_TABLES
+
 def conf_interval_asym(data,avg,conf=0.68):
     """
 
@@ -542,17 +571,25 @@ def prob_LAE(wl_obs,lineFlux,lineFlux_err=None, ew_obs=None, ew_obs_err=None, c_
     posterior_odds_list = []
     prob_lae_given_data_list = []
 
+    tables = get_classifier_tables(z_LyA)
+
     for e in ew_list:
         try:
-            posterior_odds, prob_lae_given_data = LineClassifierPro.source_prob(UNIVERSE_CONFIG,
-                                                          np.array([ra]), np.array([dec]), np.array([z_LyA]),
-                                                          np.array([lineFlux]), np.array([lineFlux_err]),
-                                                          np.array([e]), np.array([ew_obs_err]),
-                                                          c_obs=None, which_color=None,
+            if tables is not None:
+                posterior_odds, prob_lae_given_data = tables.source_prob(z_LyA, lineFlux, np.array([lineFlux_err]), e,
                                                           addl_fluxes=np.array(extra_fluxes),
                                                           addl_fluxes_error=np.array(extra_fluxes_err),
-                                                          addl_line_names=np.array(extra_fluxes_name),
-                                                          flim_file=FLUX_LIMIT_FN,extended_output=False)
+                                                          addl_line_names=np.array(extra_fluxes_name))
+            else:
+                posterior_odds, prob_lae_given_data = LineClassifierPro.source_prob(UNIVERSE_CONFIG,
+                                                              np.array([ra]), np.array([dec]), np.array([z_LyA]),
+                                                              np.array([lineFlux]), np.array([lineFlux_err]),
+                                                              np.array([e]), np.array([ew_obs_err]),
+                                                              c_obs=None, which_color=None,
+                                                              addl_fluxes=np.array(extra_fluxes),
+                                                              addl_fluxes_error=np.array(extra_fluxes_err),
+                                                              addl_line_names=np.array(extra_fluxes_name),
+                                                              flim_file=FLUX_LIMIT_FN,extended_output=False)
 
 
             if isinstance(posterior_odds,list) or isinstance(posterior_odds,np.ndarray):
@@ -639,10 +676,7 @@ def prob_LAE(wl_obs,lineFlux,lineFlux_err=None, ew_obs=None, ew_obs_err=None, c_
 
         ratio_LAE_list.append(ratio_LAE)
         plgd_list.append(plgd)
-        if type(pogd) != float:
-            pogd_list.append(pogd.value)
-        else:
-            pogd_list.append(pogd)
+        pogd_list.append(float(getattr(pogd,"value",pogd))) #astropy Quantity from the full classifier
 
     #temporary -- compare results and note if the new method disagrees with the old
     # if old_ratio_LAE + ratio_LAE > 0.2: #if they are both small, don't bother
@@ -835,76 +869,67 @@ def mc_prob_LAE(wl_obs,lineFlux,lineFlux_err=None, continuum=None, continuum_err
 
         setup = {} #first run setup date for the LineClassifierPro ... will be populated by source_prob on first call
                    #then passed in on subsequent calls to speed up processing
-        #ct = 0
-        #for lf,ew in zip(lineflux_array,ew_obs_array):
-        for i in range(num_mc):
-            tryagain = 0
-            lf = 0
-            cn = 0
-            ew = 0
-            while tryagain < _max_sample_retry:
-                lf = np.random.normal(lineFlux, lineFlux_err)
-                cn = np.random.normal(continuum, continuum_err)
-                if lf > 0 and cn > 0:
-                    ew  = lf / cn
-                    break
-                else:
-                    tryagain += 1
-
-            if not (tryagain < _max_sample_retry):
-                log.info("Failed to properly sample lineflux and/or continuum. Cannot continue.")
+        #draw all the samples at once (as a truncated normal: only pairs with both lineflux and continuum > 0
+        #are kept, just as the one-at-a-time re-draws did), then call the classifier once on the whole vector
+        lf_array = np.zeros(0)
+        cn_array = np.zeros(0)
+        for _ in range(_max_sample_retry):
+            needed = num_mc - len(lf_array)
+            if needed <= 0:
                 break
+            lf = np.random.normal(lineFlux, lineFlux_err, needed)
+            cn = np.random.normal(continuum, continuum_err, needed)
+            sel = (lf > 0) & (cn > 0)
+            lf_array = np.concatenate((lf_array,lf[sel]))
+            cn_array = np.concatenate((cn_array,cn[sel]))
 
-            try:
-                #ct += 1
-                #log.debug("%d"%ct)
-                posterior_odds, prob_lae_given_data,setup  = LineClassifierPro.source_prob(UNIVERSE_CONFIG,
-                                                                                    np.array([ra]), np.array([dec]),
-                                                                                    np.array([z_LyA]),
-                                                                                    np.array([lf]),
-                                                                                    np.array([0.0]),
-                                                                                    np.array([ew]), np.array([0.0]),
-                                                                                    c_obs=None, which_color=None,
-                                                                                    addl_fluxes=np.array(extra_fluxes),
-                                                                                    addl_fluxes_error=np.array(
-                                                                                        extra_fluxes_err),
-                                                                                    addl_line_names=np.array(
-                                                                                        extra_fluxes_name),
-                                                                                    flim_file=FLUX_LIMIT_FN,
-                                                                                    extended_output=False,
-                                                                                    setup=setup)
-
-
-                if isinstance(posterior_odds,list) or isinstance(posterior_odds,np.ndarray):
-                    if len(posterior_odds) == 1:
-                        posterior_odds = posterior_odds[0]
-                    else:
-                        log.info("Weird. posterior_odds %s" %(posterior_odds))
-
-                if isinstance(prob_lae_given_data,list) or isinstance(prob_lae_given_data,np.ndarray):
-                    if len(prob_lae_given_data) == 1:
-                        prob_lae_given_data = prob_lae_given_data[0]
-                    else:
-                        log.info("Weird. prob_lae_given_data %s" %(prob_lae_given_data))
+        if len(lf_array) < num_mc:
+            log.info("Failed to properly sample lineflux and/or continuum. Using %d of %d samples."
+                     % (len(lf_array), num_mc))
 
-                if (posterior_odds is not None) and (posterior_odds != 0):
-                    pogd = np.float(prob_lae_given_data) / posterior_odds
+        if len(lf_array) > 0:
+            try:
+                ew_array = lf_array / cn_array
+                tables = get_classifier_tables(z_LyA)
+                if tables is not None:
+                    posterior_odds, prob_lae_given_data = tables.source_prob(z_LyA, lf_array, np.array([0.0]), ew_array,
+                                                                    addl_fluxes=np.array(extra_fluxes),
+                                                                    addl_fluxes_error=np.array(extra_fluxes_err),
+                                                                    addl_line_names=np.array(extra_fluxes_name))
                 else:
-                    pogd = 0.
-
-                plgd = np.float(prob_lae_given_data)
-                pogd = np.float(pogd)
+                    posterior_odds, prob_lae_given_data,setup  = LineClassifierPro.source_prob(UNIVERSE_CONFIG,
+                                                                                        np.array([ra]), np.array([dec]),
+                                                                                        np.array([z_LyA]),
+                                                                                        lf_array,
+                                                                                        np.array([0.0]),
+                                                                                        ew_array, np.array([0.0]),
+                                                                                        c_obs=None, which_color=None,
+                                                                                        addl_fluxes=np.array(extra_fluxes),
+                                                                                        addl_fluxes_error=np.array(
+                                                                                            extra_fluxes_err),
+                                                                                        addl_line_names=np.array(
+                                                                                            extra_fluxes_name),
+                                                                                        flim_file=FLUX_LIMIT_FN,
+                                                                                        extended_output=False,
+                                                                                        setup=setup)
+
+                posterior_odds = np.broadcast_to(np.array(getattr(posterior_odds,"value",posterior_odds),
+                                                          dtype=float),lf_array.shape)
+                plgd = np.broadcast_to(np.array(getattr(prob_lae_given_data,"value",prob_lae_given_data),
+                                                dtype=float),lf_array.shape)
+
+                pogd = np.zeros(len(plgd))
+                sel = posterior_odds != 0
+                pogd[sel] = plgd[sel] / posterior_odds[sel]
 
                 #the base code can limit this to 1000.0 (explicitly) if P(OII|Data) == 0,
                 #so we DO need to force these to the max of 1000.0 (which could otherwise be exceeded
                 #if P(OII|data) > 0 but very small)
+                posterior_odds = np.clip(posterior_odds,MIN_PLAE_POII,MAX_PLAE_POII)
 
-                posterior_odds = float(posterior_odds)
-                posterior_odds = max(MIN_PLAE_POII,min(MAX_PLAE_POII,posterior_odds))
-
-                lae_oii_ratio_list.append(float(posterior_odds))
-                p_lae_list.append(plgd)
-                p_oii_list.append(pogd)
+                lae_oii_ratio_list = posterior_odds.tolist()
+                p_lae_list = plgd.tolist()
+                p_oii_list = pogd.tolist()
 
             except:
                 log.debug("Exception calling prob_LAE in mc_prob_LAE",exc_info=True)
@@ -1,7 +1,6 @@
 #import sys
 #sys.path.append("/home/dustin/code/python/hetdex_api/hetdex_api")
 #sys.path.append("/work/03261/polonius/wrangler/code/hetdex_api/hetdex_api")
-from hetdex_api import sqlite_utils as sql
 import argparse
 import shutil
 import os
@@ -10,13 +9,19 @@ import os
 def parse_commandline(auto_force=False):
     desc = "make a single ELiXer report database (SQLite3)"
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument('--db_name', help="Database name (output)", required=True, type=str)
-    parser.add_argument('--img_dir', help="Directory with the images", required=True, type=str)
-    parser.add_argument('--img_name', help="Wildcard image name", required=True, type=str)
+    parser.add_argument('--db_name', help="Database name (output)", required=False, type=str)
+    parser.add_argument('--img_dir', help="Directory with the images", required=False, type=str)
+    parser.add_argument('--img_name', help="Wildcard image name", required=False, type=str)
     parser.add_argument('--mv2dir', help="mv to directory (leaves in cwd if not provided)",required=False,type=str)
+    parser.add_argument('--merge', help="Merge the per-process report database parts (written by elixer --report_db)"
+                                        " in this directory into the (per prefix) report databases", required=False,
+                        type=str)
 
     args = parser.parse_args()
 
+    if (args.merge is None) and ((args.db_name is None) or (args.img_dir is None) or (args.img_name is None)):
+        parser.error("--db_name, --img_dir and --img_name are required (unless using --merge)")
+
     return args
 
 
@@ -24,6 +29,22 @@ def main():
     #go blind?
     args = parse_commandline()
 
+    if args.merge is not None:
+        try:
+            from elixer import report_db
+        except:
+            import report_db
+
+        for db in report_db.merge_report_dbs(args.merge):
+            print(f"{db} complete")
+            if args.mv2dir:
+                if os.path.exists(args.mv2dir) and not os.path.exists(os.path.join(args.mv2dir,os.path.basename(db))):
+                    shutil.move(db, args.mv2dir)
+                else:
+                    print(f"Cannot move {db} to {args.mv2dir}. Does not exist or {db} already there.")
+        return
+
+    from hetdex_api import sqlite_utils as sql
     sql.build_elixer_report_image_db(args.db_name,args.img_dir,args.img_name)
 
     if args.mv2dir:
@@ -0,0 +1,232 @@
+"""
+Append-only completion manifest: which outputs (stages) each detection has, where they went, with which version and
+how long the detection took.
+
+Each run (each dispatch_xxxx under SLURM) appends to <name>/<name>_manifest.tsv, one row per detection per pass of
+the detection loop. Outputs are noted once they are on disk (report images when the report database commits them,
+the joined PDF, the direct JPEG, the ELiXer HDF5 entry once verified), so recovery (prune_detection_list(),
+HETDEX.make_extraction()), selixer --recover and find_dets_to_rerun.py can look up what is done instead of scanning
+the filesystem, report databases and HDF5 catalogs.
+
+Rows are keyed by the report name (the detectid, or <name>_<nnn> for forced extractions). Later rows add to the
+stages of earlier ones; a stage prefixed with "-" (written by clean_for_recovery.py when it removes an output)
+takes it away again.
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import os
+import re
+import glob
+import socket
+import time
+
+log = G.Global_Logger('manifest')
+log.setlevel(G.LOG_LEVEL)
+
+COLUMNS = ("time","host","version","key","stages","outputs","seconds")
+REPORT_STAGES = {"pdf","png","jpg"} #any one of these means the report was made (also: nei, mini, h5, imaging, error)
+
+_output_re = re.compile(r"^(.*?)(_nei|_mini)?(_p\d\d)?\.(pdf|png|jpg)$")
+
+_pending = {} #key : {stage : location}, noted (this process) since the last write()
+_cache = {} #manifest filename : (mtime, size, {key : set of stages})
+
+
+def manifest_filename(outdir):
+    """
+    :param outdir: the run's output directory (args.name)
+    """
+    return os.path.join(outdir, os.path.basename(os.path.normpath(outdir)) + "_manifest.tsv")
+
+
+def parse_output_name(fname):
+    """
+    :param fname: output filename, i.e. <dir>/2100012345.pdf, 2100012345_nei.png, run_001.jpg, 2100012345_p01.png
+    :return: (key, stage) or (None, None) if not a report output name
+    """
+    m = _output_re.match(os.path.basename(str(fname).rstrip("!")))
+    if m is None:
+        return None, None
+    if m.group(2) is not None:
+        return m.group(1), m.group(2)[1:]
+    return m.group(1), m.group(4)
+
+
+def note_stage(key,stage,location=""):
+    """
+    Record (for the next write()) that a detection completed a stage
+
+    :param key: report name (detectid)
+    :param stage: i.e. "h5"
+    :param location: where the output went
+    """
+    _pending.setdefault(str(key),{})[stage] = str(location)
+
+
+def note(fname,location=None):
+    """
+    Record an output file (or database entry) as written
+
+    :param fname: output filename (see parse_output_name())
+    :param location: where it actually went, if not fname (i.e. the report database)
+    """
+    key, stage = parse_output_name(fname)
+    if key is None:
+        return
+    note_stage(key,stage,fname if location is None else location)
+
+
+def write(outdir,seconds=None):
+    """
+    Append the noted outputs to the run's manifest (one write, the --workers processes share the file) and clear
+    them
+
+    :param outdir: the run's output directory (args.name)
+    :param seconds: optional dictionary of key : processing time (see cost_model.StageTimer.totals())
+    :return: True if written (or nothing to write)
+    """
+    global _pending
+    if (not G.RECORD_MANIFEST) or (len(_pending) == 0):
+        _pending = {}
+        return True
+
+    fn = manifest_filename(outdir)
+    now = int(time.time())
+    host = socket.gethostname().split(".")[0]
+    lines = ""
+    if not os.path.isfile(fn):
+        lines = "#" + "\t".join(COLUMNS) + "\n"
+    for key, stages in _pending.items():
+        t = "" if (seconds is None) or (key not in seconds) else "%0.1f" % seconds[key]
+        outputs = "|".join(f"{s}={loc}" for s, loc in stages.items() if loc)
+        lines += "\t".join((str(now),host,G.__version__,key,",".join(stages.keys()),outputs,t)) + "\n"
+
+    try:
+        with open(fn,"a") as f:
+            f.write(lines)
+        cached = _cache.get(fn)
+        if cached is not None: #keep the cached view current (unless someone else appended in between)
+            st = os.stat(fn)
+            if st.st_size == cached[1] + len(lines.encode()):
+                _apply(cached[2],_pending)
+                _cache[fn] = (st.st_mtime,st.st_size,cached[2])
+        _pending = {}
+        return True
+    except:
+        log.error(f"Unable to write manifest {fn}",exc_info=True)
+        return False
+
+
+def append_removed(fn,key,stages):
+    """
+    Record that outputs of a detection were removed (i.e. by clean_for_recovery.py) so it is redone
+
+    :param fn: manifest file
+    :param key: report name (detectid)
+    :param stages: list of the stages removed
+    """
+    if not os.path.isfile(fn):
+        return
+    try:
+        with open(fn,"a") as f:
+            f.write("\t".join((str(int(time.time())),socket.gethostname().split(".")[0],G.__version__,str(key),
+                               ",".join("-" + s for s in stages),"","")) + "\n")
+    except:
+        log.error(f"Unable to write manifest {fn}",exc_info=True)
+
+
+def _apply(done,rows):
+    """
+    :param done: {key : set of stages} to update
+    :param rows: {key : iterable of stages ("-" prefix removes)}
+    """
+    for key, stages in rows.items():
+        s = done.setdefault(key,set())
+        for stage in stages:
+            if stage.startswith("-"):
+                s.discard(stage[1:])
+            elif stage:
+                s.add(stage)
+
+
+def read(fn):
+    """
+    :param fn: manifest file
+    :return: {key : set of stages} (cached until the file changes)
+    """
+    try:
+        st = os.stat(fn)
+    except:
+        return {}
+
+    cached = _cache.get(fn)
+    if (cached is not None) and (cached[0] == st.st_mtime) and (cached[1] == st.st_size):
+        return cached[2]
+
+    done = {}
+    try:
+        with open(fn,"r") as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                toks = line.rstrip("\n").split("\t")
+                if len(toks) != len(COLUMNS):
+                    continue
+                _apply(done,{toks[3]: toks[4].split(",")})
+    except:
+        log.error(f"Unable to read manifest {fn}",exc_info=True)
+        return {}
+
+    _cache[fn] = (st.st_mtime,st.st_size,done)
+    return done
+
+
+def load(patterns):
+    """
+    :param patterns: list of manifest files or glob patterns
+    :return: {key : set of stages} over all of them, or None if there are no manifests
+    """
+    fns = set()
+    for p in patterns:
+        fns.update(glob.glob(p))
+    if len(fns) == 0:
+        return None
+
+    done = {}
+    for fn in sorted(fns):
+        for key, stages in read(fn).items():
+            done.setdefault(key,set()).update(stages)
+    return done
+
+
+def completed(outdir):
+    """
+    The completion manifest(s) recovery consults for a run: its own and, if G.MANIFEST_SHARED_RUN (--work_queue,
+    where a detection may be retried from a different dispatch_xxxx), those of the other dispatch_xxxx of the run
+
+    :param outdir: the run's output directory (args.name)
+    :return: {key : set of stages}, or None if there is no manifest
+    """
+    patterns = [manifest_filename(outdir)]
+    if G.MANIFEST_SHARED_RUN:
+        patterns.append(os.path.join("..","dispatch_*",outdir,os.path.basename(manifest_filename(outdir))))
+    return load(patterns)
+
+
+def is_done(stages,neighborhood_only=False,require=None):
+    """
+    :param stages: set of stages (or None)
+    :param neighborhood_only: if True, done means the neighborhood map was made, otherwise the report
+    :param require: (optional) a stage that must also be done, i.e. "h5" (the ELiXer HDF5 catalog rows)
+    """
+    if not stages:
+        return False
+    if (require is not None) and (require not in stages):
+        return False
+    if neighborhood_only:
+        return "nei" in stages
+    return len(stages & REPORT_STAGES) > 0
@@ -0,0 +1,372 @@
+"""
+Stream the finished report images (PNG) straight into the SQLite report databases as they are made, rather than
+writing one small file per image and packing them afterward (make_report_db.py).
+
+The databases have the same layout as the ones make_report_db.py (hetdex_api) builds: one per detectid prefix and
+report type, i.e. elixer_reports_21000.db, elixer_reports_21000_nei.db, elixer_reports_21000_mini.db each with a
+report (detectid, report_image) table.
+
+SQLite locking is not reliable across nodes on a shared (Lustre) filesystem, so unless G.REPORT_DB_SHARED, each
+process writes its own part of each shard (elixer_reports_21000.<host>_<pid>.db) and the parts are combined at
+the end with merge_report_dbs() (make_report_db.py --merge). Rows are inserted in batched transactions.
+
+ReportDBReader keeps its (read only) connections open and serves many detectids per query.
+"""
+
+try:
+    from elixer import global_config as G
+    from elixer import manifest
+except:
+    import global_config as G
+    import manifest
+
+import os
+import io
+import re
+import glob
+import socket
+import sqlite3
+import atexit
+
+log = G.Global_Logger('report_db')
+log.setlevel(G.LOG_LEVEL)
+
+DB_PREFIX = "elixer_reports_"
+TABLE_NAME = "report"
+REPORT_TYPES = {"report": "", "nei": "_nei", "mini": "_mini"} #report type : db filename and image filename suffix
+SHARD_DIVISOR = 100000 #detectid // SHARD_DIVISOR is the db prefix, i.e. 2100012345 -> 21000
+MAX_SQL_VARIABLES = 500 #max keys per SELECT ... IN (...)
+
+SQL_CREATE_TABLE = f"""CREATE TABLE IF NOT EXISTS {TABLE_NAME} (detectid BIGINT PRIMARY KEY, report_image BLOB)"""
+SQL_INSERT = f"""INSERT OR REPLACE INTO {TABLE_NAME} VALUES (?, ?)"""
+
+_image_name_re = re.compile(r"^(\d+)(_nei|_mini)?\.png$")
+
+
+def shard_prefix(detectid):
+    return int(detectid) // SHARD_DIVISOR
+
+
+def db_filename(db_dir,prefix,report_type="report",tag=None):
+    """
+    :param db_dir: directory of the report databases
+    :param prefix: shard prefix (see shard_prefix())
+    :param report_type: one of REPORT_TYPES
+    :param tag: if not None, the per-process part of the shard
+    :return: database filename
+    """
+    name = DB_PREFIX + str(prefix) + REPORT_TYPES[report_type]
+    if tag is not None:
+        name += "." + str(tag)
+    return os.path.join(db_dir,name + ".db")
+
+
+def parse_image_name(fname):
+    """
+    :param fname: report image filename, i.e. .../2100012345.png, .../2100012345_nei.png
+    :return: (detectid, report_type) or (None, None) if the name is not a report image for a detectid
+    """
+    m = _image_name_re.match(os.path.basename(str(fname)))
+    if m is None:
+        return None, None
+    if m.group(2) is None:
+        return int(m.group(1)), "report"
+    return int(m.group(1)), m.group(2)[1:]
+
+
+def connect(fn,readonly=False):
+    """
+    :return: sqlite3 connection (or None)
+    """
+    try:
+        if readonly:
+            return sqlite3.connect("file:" + fn + "?mode=ro",uri=True,check_same_thread=False)
+
+        conn = sqlite3.connect(fn,timeout=G.REPORT_DB_TIMEOUT)
+        if G.REPORT_DB_SHARED:
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(SQL_CREATE_TABLE)
+        conn.commit()
+        return conn
+    except:
+        log.error(f"Unable to open report database {fn}",exc_info=True)
+        return None
+
+
+class ReportDBWriter:
+
+    def __init__(self,db_dir,tag=None,batch_size=None):
+        """
+        :param db_dir: directory for the report databases (created if need be)
+        :param tag: per-process part name (None to write the shared, canonical shard databases)
+        :param batch_size: number of images to buffer (per database) before committing them in one transaction
+        """
+        if batch_size is None:
+            batch_size = G.REPORT_DB_BATCH_SIZE
+        self.db_dir = db_dir
+        self.tag = tag
+        self.batch_size = max(1,int(batch_size))
+        self.conns = {} #db filename : connection
+        self.pending = {} #db filename : list of (detectid, image bytes)
+        self.names = {} #db filename : list of the image filenames (for the completion manifest), parallel to pending
+        self.count = 0
+        self.pid = os.getpid()
+        os.makedirs(db_dir,exist_ok=True)
+
+    def add(self,detectid,image,report_type="report",fname=None):
+        """
+        :param detectid: integer detectid
+        :param image: PNG bytes
+        :param report_type: one of REPORT_TYPES
+        :param fname: (optional) the image filename, noted in the completion manifest once the image is committed
+        """
+        fn = db_filename(self.db_dir,shard_prefix(detectid),report_type,self.tag)
+        rows = self.pending.setdefault(fn,[])
+        rows.append((int(detectid),sqlite3.Binary(image)))
+        self.names.setdefault(fn,[]).append(fname)
+        if len(rows) >= self.batch_size:
+            self.flush(fn)
+
+    def flush(self,fn=None):
+        """
+        Commit the buffered images (for one database or, if fn is None, all)
+
+        :return: number of images committed
+        """
+        if fn is None:
+            return sum(self.flush(f) for f in list(self.pending.keys()))
+
+        rows = self.pending.get(fn)
+        if not rows:
+            return 0
+
+        conn = self.conns.get(fn)
+        if conn is None:
+            conn = connect(fn)
+            if conn is None:
+                return 0
+            self.conns[fn] = conn
+
+        try:
+            with conn: #one transaction
+                conn.executemany(SQL_INSERT,rows)
+            self.count += len(rows)
+            self.pending[fn] = []
+            for name in self.names.pop(fn,[]):
+                if name is not None:
+                    manifest.note(name,fn)
+            log.debug(f"Committed {len(rows)} report images to {fn}")
+            return len(rows)
+        except:
+            log.error(f"Exception writing {len(rows)} report images to {fn}. Will retry on next flush.",exc_info=True)
+            return 0
+
+    def close(self):
+        self.flush()
+        for fn, conn in self.conns.items():
+            try:
+                conn.close()
+            except:
+                log.info(f"Exception closing report database {fn}",exc_info=True)
+        self.conns = {}
+        unwritten = sum(len(r) for r in self.pending.values())
+        if unwritten > 0:
+            log.error(f"{unwritten} report images could not be written to the report databases.")
+
+
+_writer = None
+
+
+def default_tag():
+    return "%s_%d" % (socket.gethostname().split(".")[0],os.getpid())
+
+
+def get_writer():
+    """
+    :return: the (per process) ReportDBWriter for G.REPORT_DB_PATH or None if not streaming to the databases
+    """
+    global _writer
+    if G.REPORT_DB_PATH is None:
+        return None
+    if (_writer is not None) and (_writer.pid != os.getpid()):
+        _writer = None #inherited across a fork; the parent owns (and will flush) it
+    if (_writer is None) or (_writer.db_dir != G.REPORT_DB_PATH):
+        close_writer()
+        _writer = ReportDBWriter(G.REPORT_DB_PATH,tag=None if G.REPORT_DB_SHARED else default_tag())
+    return _writer
+
+
+def flush_writer():
+    """
+    Commit this process' buffered report images (i.e. before the completion manifest is written for the last time)
+    """
+    if (_writer is not None) and (_writer.pid == os.getpid()):
+        _writer.flush()
+
+
+def close_writer():
+    global _writer
+    if (_writer is not None) and (_writer.pid == os.getpid()):
+        _writer.close()
+        log.info(f"Wrote {_writer.count} report images to {_writer.db_dir}")
+        _writer = None
+
+
+atexit.register(close_writer)
+
+
+def save_image_bytes(fname,image):
+    """
+    Stream a (PNG) report image to the report database if configured (and fname is a detectid report image name),
+    otherwise (or also, with G.REPORT_DB_KEEP_FILES) write it to fname
+
+    :param fname: image filename, i.e. <dir>/2100012345.png, <dir>/2100012345_nei.png
+    :param image: PNG bytes
+    :return: True if stored (to the database and/or file)
+    """
+    writer = get_writer()
+    if writer is not None:
+        detectid, report_type = parse_image_name(fname)
+        if detectid is not None:
+            if not G.REPORT_DB_KEEP_FILES:
+                writer.add(detectid,image,report_type,fname) #(noted in the manifest when committed)
+                return True
+            writer.add(detectid,image,report_type)
+
+    try:
+        with open(fname,"wb") as f:
+            f.write(image)
+        manifest.note(fname)
+        return True
+    except:
+        log.error(f"Unable to write {fname}",exc_info=True)
+        return False
+
+
+def savefig(fname,fig=None,**kwargs):
+    """
+    Drop-in for plt.savefig(fname,format='png',...) that goes through save_image_bytes()
+
+    :param fname: image filename
+    :param fig: matplotlib figure (default: the current figure)
+    :param kwargs: passed on to savefig
+    """
+    if fig is None:
+        import matplotlib.pyplot as plt
+        fig = plt.gcf()
+    buffer = io.BytesIO()
+    fig.savefig(buffer,**kwargs)
+    return save_image_bytes(fname,buffer.getvalue())
+
+
+def merge_report_dbs(db_dir,remove_parts=True):
+    """
+    Combine the per-process parts (<shard>.<tag>.db) into the canonical shard databases (<shard>.db)
+
+    :param db_dir: directory of the report databases
+    :param remove_parts: if True, delete each part once merged
+    :return: list of the canonical databases updated
+    """
+    parts = {}
+    for fn in sorted(glob.glob(os.path.join(db_dir,DB_PREFIX + "*.*.db"))):
+        base = os.path.basename(fn).split(".")[0]
+        parts.setdefault(os.path.join(db_dir,base + ".db"),[]).append(fn)
+
+    merged = []
+    for dest, srcs in parts.items():
+        conn = connect(dest)
+        if conn is None:
+            continue
+        try:
+            for src in srcs:
+                conn.execute("ATTACH DATABASE ? AS part",(src,))
+                with conn:
+                    ct = conn.execute(f"INSERT OR REPLACE INTO {TABLE_NAME} SELECT * FROM part.{TABLE_NAME}").rowcount
+                conn.execute("DETACH DATABASE part")
+                log.info(f"Merged {ct} report images from {src} into {dest}")
+                if remove_parts:
+                    os.remove(src)
+            merged.append(dest)
+        except:
+            log.error(f"Exception merging report database parts into {dest}",exc_info=True)
+        finally:
+            conn.close()
+
+    return merged
+
+
+class ReportDBReader:
+
+    def __init__(self,db_dir):
+        """
+        :param db_dir: directory of the report databases (canonical shards and/or per-process parts)
+        """
+        self.db_dir = db_dir
+        self.conns = {} #db filename : read only connection
+        self.shard_files = {} #(prefix, report_type) : list of db filenames
+
+    def _files(self,prefix,report_type):
+        key = (prefix,report_type)
+        files = self.shard_files.get(key)
+        if files is None:
+            files = []
+            fn = db_filename(self.db_dir,prefix,report_type)
+            if os.path.isfile(fn):
+                files.append(fn)
+            files += sorted(glob.glob(db_filename(self.db_dir,prefix,report_type,"*")))
+            self.shard_files[key] = files
+        return files
+
+    def _conn(self,fn):
+        conn = self.conns.get(fn)
+        if conn is None:
+            conn = connect(fn,readonly=True)
+            if conn is not None:
+                self.conns[fn] = conn
+        return conn
+
+    def fetch_many(self,detectids,report_type="report"):
+        """
+        :param detectids: iterable of integer detectids
+        :param report_type: one of REPORT_TYPES
+        :return: dictionary of detectid : PNG bytes (detectids not found are not included)
+        """
+        by_shard = {}
+        for d in detectids:
+            by_shard.setdefault(shard_prefix(d),[]).append(int(d))
+
+        images = {}
+        for prefix, ids in by_shard.items():
+            for fn in self._files(prefix,report_type):
+                todo = [d for d in ids if d not in images]
+                if len(todo) == 0:
+                    break
+                conn = self._conn(fn)
+                if conn is None:
+                    continue
+                try:
+                    for i in range(0,len(todo),MAX_SQL_VARIABLES):
+                        chunk = todo[i:i + MAX_SQL_VARIABLES]
+                        sql = f"SELECT detectid, report_image FROM {TABLE_NAME} WHERE detectid IN " \
+                              f"({','.join('?' * len(chunk))})"
+                        for d, img in conn.execute(sql,chunk):
+                            images[int(d)] = bytes(img)
+                except:
+                    log.info(f"Exception reading report images from {fn}",exc_info=True)
+        return images
+
+    def fetch(self,detectid,report_type="report"):
+        """
+        :return: PNG bytes or None
+        """
+        return self.fetch_many([detectid],report_type).get(int(detectid))
+
+    def close(self):
+        for conn in self.conns.values():
+            try:
+                conn.close()
+            except:
+                pass
+        self.conns = {}
+        self.shard_files = {}
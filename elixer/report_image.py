@@ -0,0 +1,234 @@
+"""
+Direct (in-process, Agg) rasterization of the ELiXer report pages, as an alternative to writing PDF parts,
+joining them (pdfrw) and re-rasterizing the PDF (wand/ImageMagick or pdf2image).
+
+Each report part (the same list of matplotlib figures that would go to a PdfPages part file) is rendered once at
+G.REPORT_IMAGE_DPI and kept in memory as raw RGB pages (keyed by the would-be .pdf part name; nothing is written to
+the shared filesystem) until join_report_images() stacks them with the same layout elixer.join_report_parts() uses
+for the PDF and writes the final PNG and/or JPEG. elixer.delete_report_parts() discards any that are left over.
+"""
+
+try:
+    from elixer import global_config as G
+    from elixer import report_db
+    from elixer import manifest
+except:
+    import global_config as G
+    import report_db
+    import manifest
+
+import io
+import os
+import numpy as np
+from PIL import Image as PIL_Image
+
+log = G.Global_Logger('report_image')
+log.setlevel(G.LOG_LEVEL)
+
+PDF_POINTS_PER_INCH = 72.0
+
+_parts = {} #part name : list of RGB page arrays (held until joined or discarded)
+
+
+def figure_to_array(fig,dpi=None):
+    """
+    Render a matplotlib figure (Agg) to an RGB array, the same pixels (size and layout) a PDF page of the figure
+    would have when rasterized at dpi
+
+    :param fig: matplotlib figure
+    :param dpi: (default G.REPORT_IMAGE_DPI)
+    :return: (height,width,3) uint8 array
+    """
+    if dpi is None:
+        dpi = G.REPORT_IMAGE_DPI
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer,format='rgba',dpi=dpi)
+    rgba = np.frombuffer(buffer.getbuffer(),dtype=np.uint8)
+
+    width = int(fig.get_figwidth() * dpi)
+    height = len(rgba) // (4 * width) if width > 0 else 0
+    if (width <= 0) or (height * width * 4 != len(rgba)): #unexpected size, go the long way round
+        buffer = io.BytesIO()
+        fig.savefig(buffer,format='png',dpi=dpi)
+        buffer.seek(0)
+        rgba = np.asarray(PIL_Image.open(buffer).convert("RGBA"))
+    else:
+        rgba = rgba.reshape(height,width,4)
+
+    return flatten_alpha(rgba)
+
+
+def flatten_alpha(rgba):
+    """
+    :param rgba: (height,width,4) uint8 array
+    :return: (height,width,3) uint8 array composited over a white background
+    """
+    if rgba.shape[2] == 3:
+        return rgba
+    alpha = rgba[:,:,3:4].astype(np.uint16)
+    rgb = (rgba[:,:,0:3].astype(np.uint16) * alpha + 255 * (255 - alpha) + 127) // 255
+    return rgb.astype(np.uint8)
+
+
+def write_part(part_name,pages,dpi=None):
+    """
+    Rasterize the figures of a report part and hold them (in memory) for join_report_images()
+
+    :param part_name: the PDF part filename (i.e. <report>.part0001)
+    :param pages: list of matplotlib figures
+    :param dpi: (default G.REPORT_IMAGE_DPI)
+    :return: True if rasterized
+    """
+    try:
+        _parts[part_name] = [figure_to_array(p,dpi) for p in pages]
+        return True
+    except:
+        log.error(f"Exception rasterizing report part {part_name}",exc_info=True)
+        _parts.pop(part_name,None)
+        return False
+
+
+def read_part(part_name):
+    """
+    Take (and release) the rasterized pages of a report part
+
+    :param part_name: the PDF part filename (i.e. <report>.part0001)
+    :return: list of RGB page arrays (empty if there is no such part)
+    """
+    return _parts.pop(part_name,[])
+
+
+def discard_parts(report_name):
+    """
+    Release any rasterized parts of the report that were not joined
+
+    :param report_name: the report (PDF) filename (a trailing "!" error marker is ignored)
+    """
+    prefix = report_name.rstrip('!') + ".part"
+    for part_name in [k for k in _parts if k.startswith(prefix)]:
+        del _parts[part_name]
+
+
+def stack_pages(pages,overlaps=None):
+    """
+    Stack pages top to bottom, left aligned on a white background as wide as the widest page
+    (just as the PDF parts are merged onto a single page)
+
+    :param pages: list of RGB arrays (first is the top)
+    :param overlaps: optional list (one per page) of pixels to trim from the bottom of that page
+    :return: single RGB array
+    """
+    if overlaps is None:
+        overlaps = [0] * len(pages)
+
+    pages = [p[0:max(0,p.shape[0] - int(o))] for p, o in zip(pages,overlaps)]
+    width = max(p.shape[1] for p in pages)
+    height = sum(p.shape[0] for p in pages)
+
+    image = np.full((height,width,3),255,dtype=np.uint8)
+    y = 0
+    for p in pages:
+        image[y:y + p.shape[0],0:p.shape[1]] = p
+        y += p.shape[0]
+    return image
+
+
+def save_image(image,base_name,jpeg=True,png=False):
+    """
+    :param image: RGB array
+    :param base_name: filename without extension
+    :return: list of filenames written
+    """
+    written = []
+    img = PIL_Image.fromarray(image,"RGB")
+    for ok, ext, fmt in ((png,".png","PNG"),(jpeg,".jpg","JPEG")):
+        if not ok:
+            continue
+        fn = base_name + ext
+        tmp_fn = fn + ".%d.tmp" % os.getpid()
+        try:
+            if fmt == "PNG": #may go to the report database instead of a file
+                buffer = io.BytesIO()
+                img.save(buffer,fmt)
+                if not report_db.save_image_bytes(fn,buffer.getvalue()):
+                    continue
+            else:
+                img.save(tmp_fn,fmt)
+                os.replace(tmp_fn,fn)
+                manifest.note(fn)
+            written.append(fn)
+            print("File written: " + fn)
+        except:
+            log.error(f"Unable to write report image {fn}",exc_info=True)
+            try:
+                os.remove(tmp_fn)
+            except:
+                pass
+    return written
+
+
+def join_report_images(report_name,max_part_num,jpeg=True,png=False,dpi=None):
+    """
+    Compose the rasterized report parts into the final image(s), with the same layout as
+    elixer.join_report_parts() (+ elixer.convert_pdf()) produces:
+
+    G.SINGLE_PAGE_PER_DETECT: all pages of the first part and the first two pages of each following part are
+    stacked into <report>.png|jpg; any further pages go to <report>_p01.png|jpg, _p02, ...
+    otherwise, each page is its own image (<report>, <report>_p01, ...)
+
+    :param report_name: the report (PDF) filename (a trailing "!" error marker is ignored)
+    :param max_part_num: highest part number in use (elixer.G_PDF_FILE_NUM)
+    :return: list of filenames written
+    """
+    if dpi is None:
+        dpi = G.REPORT_IMAGE_DPI
+
+    report_name = report_name.rstrip('!')
+    if report_name.endswith(".pdf"):
+        base_name = report_name[:-4]
+    else:
+        base_name = report_name
+
+    main_pages = []
+    main_overlaps = []
+    extra_pages = []
+    first_part = True
+    for i in range(max_part_num + 1): #there may be a zeroth part (header)
+        pages = read_part(report_name + ".part%s" % str(i).zfill(4))
+        if len(pages) == 0:
+            continue
+
+        if not G.SINGLE_PAGE_PER_DETECT:
+            extra_pages += pages
+        elif first_part:
+            first_part = False
+            main_pages += pages
+        else:
+            main_pages += pages[0:2]
+            extra_pages += pages[2:]
+
+    if G.SINGLE_PAGE_PER_DETECT:
+        if len(main_pages) == 0:
+            log.info("No pages to merge for " + report_name)
+            print("No pages to merge for " + report_name)
+            return []
+
+        main_overlaps = [0] * len(main_pages)
+        if G.ZEROTH_ROW_HEADER and (len(main_pages) > 2):
+            #as in join_report_parts, trim excess vertical space (18pt) from the zeroth row header
+            main_overlaps[0] = int(round(18.0 / PDF_POINTS_PER_INCH * dpi))
+
+        images = [stack_pages(main_pages,main_overlaps)] + extra_pages
+    else:
+        images = extra_pages
+
+    written = []
+    for i, image in enumerate(images):
+        if i > 0:
+            name = base_name + "_p%02d" % i
+        else:
+            name = base_name
+        written += save_image(image,name,jpeg=jpeg,png=png)
+
+    return written
@@ -6,9 +6,19 @@ import errno
 try:
     from elixer import elixer
     from elixer import smerge
+    from elixer import dispatch_plan
+    from elixer import cost_model
+    from elixer import work_queue
+    from elixer import manifest
+    from elixer import global_config as G
 except:
     import elixer
     import smerge
+    import dispatch_plan
+    import cost_model
+    import work_queue
+    import manifest
+    import global_config as G
 
 import numpy as np
 from math import ceil
@@ -55,6 +65,34 @@ host = HOST_UNKNOWN
 #             skip_next = False
 #     return new_list
 
+
+def dispatch_line(row):
+    """
+    :param row: a detectid, fcsdir or (re)extraction row (ndarray of ra, dec, shot, ...)
+    :return: the line for a dispatch_xxxx list (or work queue batch)
+    """
+    if isinstance(row,np.ndarray):
+        return " ".join(row.astype(str)) #space separated
+    return str(row)
+
+
+def manifest_done(d,done,args):
+    """
+    :param d: a detectid or fcsdir (as in the detection list or a work queue batch line)
+    :param done: the merged completion manifests (see manifest.load())
+    :param args: the (parsed) command line args
+    :return: True if the manifests list the detection as complete
+    """
+    name = os.path.basename(str(d).strip().rstrip("/"))
+    stages = done.get(name, done.get(args.name + "_" + name))
+    #(detectids: the HDF5 catalog rows are buffered, so the report alone does not mean done)
+    if G.BUILD_HDF5_CATALOG and (not args.neighborhood_only) and \
+            (isinstance(d,(int,np.integer)) or (isinstance(d,str) and d.strip().isdigit())):
+        require = "h5"
+    else:
+        require = None
+    return manifest.is_done(stages,args.neighborhood_only,require)
+
 ### NAMING, NOTATION
 # job == an elixer dispatch
 # task == on the cluster ... generally == number of cores on that node (maybe artificially reduced to save memory)_
@@ -164,6 +202,7 @@ if "tacc.utexas.edu" in hostname:
     hostname = hostname.split(".")[1]
 
 FILL_CPU_TASKS = 10 #don't add another node until each CPU on the current node(s) hit this number
+FILL_CPU_MINUTES = 20.0 #(with a measured cost model) as FILL_CPU_TASKS, but in expected minutes of work per CPU
 MAX_DETECTS_PER_CPU = 9999999 #do not execute this job of the dispatch_xxxx list count exceeds this value
 MAX_TASKS_PER_NODE =1 #default (local machine)
 MAX_NODES=1
@@ -470,6 +509,7 @@ if i != -1:
 else:
     print(f"--nodes not specified. Auto set maximum nodes {hostname}:{MAX_NODES} ...")
 
+launch_dir = os.getcwd()
 if not MERGE:
     if not os.path.isdir(basename):
         try:
@@ -491,6 +531,10 @@ if ntasks_per_node < 1:
     ntasks_per_node = 1
 
 dets_per_dispatch =  [] #list of counts ... the number of detection directories to list in the corresponding dispatch_xxx file
+cost_means = None #per detection expected seconds (measured cost model), if there is enough timing history
+cost_vars = None
+cost_startup = None
+work_queue_dir = None #shared work queue (--work_queue) instead of fixed dispatch_xxxx lists
 if tasks == 1:
     print("Only 1 task. Will not use dispatch.")
     ntasks_per_node = 1
@@ -525,6 +569,80 @@ else: # multiple tasks
                 #either a --dets list or a --coords list, but either way, get a list of HETDEX detectids to process
                 subdirs = elixer.get_hdf5_detectids_to_process(args)
 
+        requeued = None #number of unfinished batches returned to an existing work queue (--recover)
+        if (not MERGE) and (args.work_queue is not None):
+            work_queue_dir = os.path.abspath(args.work_queue)
+            if recover_mode and work_queue.exists(work_queue_dir):
+                requeued = work_queue.requeue(work_queue_dir)
+
+                #a detection that fails inside a batch that still completes (the detection loop catches its own
+                #exceptions) is only found from the manifests; queue those again as new batches
+                #(explicit extraction lines have no fixed report name, so cannot be checked this way)
+                done = manifest.load([os.path.join("dispatch_*",args.name,args.name + "_manifest.tsv")])
+                if done is not None:
+                    seen = set(line for b in work_queue.pending_batches(work_queue_dir) for line in b)
+                    retry = []
+                    for b in work_queue.read_batches(work_queue_dir,work_queue.DONE):
+                        for line in b:
+                            if (len(line.split()) == 1) and (line not in seen) and \
+                                    (not manifest_done(line,done,args)):
+                                retry.append(line)
+                                seen.add(line)
+                    if len(retry) > 0:
+                        size = max(1,int(G.WORK_QUEUE_BATCH_SIZE))
+                        requeued += work_queue.add(work_queue_dir,[retry[i:i+size] for i in range(0,len(retry),size)])
+                    print(f"[RECOVERY] {len(retry)} incomplete detections from done batches queued again.")
+
+                queued_batches = work_queue.pending_batches(work_queue_dir)
+                subdirs = [line for b in queued_batches for line in b]
+                print(f"[RECOVERY] {requeued} unfinished batches requeued. {len(subdirs)} detections in "
+                      f"{len(queued_batches)} pending batches.")
+                if len(subdirs) == 0:
+                    print("Nothing left in the work queue. Exiting ...")
+                    exit(0)
+
+        #drop the detections the completion manifests of the earlier dispatches already list as done, so the
+        #recovery jobs are sized (and planned) for only what is left
+        if recover_mode and (not MERGE) and (requeued is None):
+            done = manifest.load([os.path.join("dispatch_*",args.name,args.name + "_manifest.tsv")])
+            if done is not None:
+                keep = []
+                for d in subdirs:
+                    if np.isscalar(d) and manifest_done(d,done,args):
+                        continue
+                    keep.append(d)
+                print(f"[RECOVERY] {len(subdirs) - len(keep)} detections already complete (manifest). "
+                      f"{len(keep)} to process.")
+                subdirs = keep
+                if len(subdirs) == 0:
+                    print("Nothing left to recover. Exiting ...")
+                    exit(0)
+                tasks = min(tasks,len(subdirs))
+
+        #fit the per detection cost from the timings of earlier runs
+        if (not MERGE) and (str(args.cost_history).lower() != "none"):
+            try:
+                if args.cost_history is None:
+                    patterns = None
+                else:
+                    patterns = [os.path.join(launch_dir,p) for p in args.cost_history.split(",")]
+                model = cost_model.fit(args,host=hostname,patterns=patterns)
+                if model is not None:
+                    cost_means, cost_vars = model.estimate(subdirs)
+                    cost_startup = model.startup
+                    print("Cost model: " + model.summary())
+                else:
+                    print("Insufficient timing history for a cost model. Using the per-host time estimates.")
+            except Exception as e:
+                print(e)
+                cost_means = None
+
+        #effective number of CPUs worth of work, for adding nodes
+        if cost_means is not None:
+            fill_cpus = np.sum(cost_means) / 60.0 / FILL_CPU_MINUTES
+        else:
+            fill_cpus = len(subdirs) / FILL_CPU_TASKS
+
         if tasks != 0:
             if tasks > len(subdirs):  # problem too many tasks requestd
                 print("Error! Too many tasks (%d) requested. Only %d directories to process." % (tasks, len(subdirs)))
@@ -561,7 +679,7 @@ else: # multiple tasks
                         nodes = min(tasks // MAX_TASKS_PER_NODE, MAX_NODES)
                         ntasks_per_node = tasks // nodes
 
-                    target_nodes = max(1, int(len(subdirs) / (FILL_CPU_TASKS * MAX_TASKS_PER_NODE)))
+                    target_nodes = max(1, int(fill_cpus / MAX_TASKS_PER_NODE))
                     target_tasks = min(tasks,target_nodes * MAX_TASKS_PER_NODE)
 
                     nodes = min(target_nodes, MAX_NODES)
@@ -608,7 +726,7 @@ else: # multiple tasks
                         #nodes = min(tasks // MAX_TASKS_PER_NODE, MAX_NODES)
                         #ntasks_per_node = tasks // nodes
 
-                        target_nodes = max(1,int(len(subdirs)/(FILL_CPU_TASKS * MAX_TASKS_PER_NODE)))
+                        target_nodes = max(1,int(fill_cpus/MAX_TASKS_PER_NODE))
                         target_tasks = min(tasks,target_nodes * MAX_TASKS_PER_NODE) #target_nodes * MAX_TASKS_PER_NODE
 
                         nodes = min(target_nodes,MAX_NODES)
@@ -645,16 +763,51 @@ else: # multiple tasks
             exit(0)
 
 
-        remainder = len(subdirs) % tasks
-        dets_per_dispatch = np.full(tasks,dirs_per_file)
-        dets_per_dispatch[0:remainder] += 1 #add one more per task to cover the remainder
+        #group the detections by shot and imaging tile so each task loads as few of them as possible
+        dispatch_indices = None #per dispatch, the indices into subdirs to list in its dispatch_xxxx file
+        if (not MERGE) and (args.fcsdir is None) and (requeued is None) and \
+                (str(args.dispatch_plan).lower() == "locality"):
+            try:
+                dispatch_indices = dispatch_plan.plan(subdirs,tasks,hdf5_fn=args.hdf5,costs=cost_means)
+            except Exception as e:
+                print(e)
+                dispatch_indices = None
+            if dispatch_indices is None:
+                print("Unable to plan the dispatches by locality. Splitting by count.")
+
+        if dispatch_indices is None:
+            remainder = len(subdirs) % tasks
+            dets_per_dispatch = np.full(tasks,dirs_per_file)
+            dets_per_dispatch[0:remainder] += 1 #add one more per task to cover the remainder
+            stops = np.cumsum(dets_per_dispatch)
+            dispatch_indices = [range(stop - ct,stop) for ct, stop in zip(dets_per_dispatch,stops)]
+        else:
+            dets_per_dispatch = np.array([len(idx) for idx in dispatch_indices])
+
+        if work_queue_dir is not None:
+            if requeued is None: #new queue, batches cut from the planned dispatches (keeps their locality)
+                batches = work_queue.make_batches(dispatch_indices)
+                work_queue.create(work_queue_dir,[[dispatch_line(subdirs[j]) for j in b] for b in batches])
+            else:
+                stops = np.cumsum([len(b) for b in queued_batches])
+                batches = [list(range(stop - len(b),stop)) for b, stop in zip(queued_batches,stops)]
+            print(f"{len(subdirs)} detections queued as {len(batches)} batches in {work_queue_dir}")
+
+            #each task's expected share (for the time estimate): every batch goes to whichever task frees up first
+            dispatch_indices = work_queue.simulate(batches,tasks,cost_means)
+            dets_per_dispatch = np.array([len(idx) for idx in dispatch_indices])
+
+            #the tasks all point to the queue (by absolute path, as they run from their dispatch_xxxx directories)
+            run_argv = list(sys.argv[1:])
+            run_argv[[a.lower() for a in run_argv].index("--work_queue") + 1] = work_queue_dir
+        else:
+            run_argv = sys.argv[1:]
 
         if not MERGE:
             f = open("elixer.run", 'w')
         else:
             f = open("elixer_merge.run", 'w')
 
-        start_idx = 0
         for i in range(int(tasks)):
 
             fn = "dispatch_" + str(i).zfill(4)
@@ -671,21 +824,14 @@ else: # multiple tasks
                         print ("Fatal. Cannot create output directory: %s" % fn)
                         exit(-1)
 
-            df = open(os.path.join(fn,fn2), 'w')
-            #content = ""
+            if work_queue_dir is None:
+                df = open(os.path.join(fn,fn2), 'w')
+                #content = ""
 
-            #start_idx = i * dirs_per_file
-            stop_idx = start_idx + dets_per_dispatch[i] #min(start_idx + dirs_per_file,len(subdirs))
-            if isinstance(subdirs[start_idx],np.ndarray):
-                for j in range(start_idx,stop_idx):
-                    df.write(" ".join(subdirs[j].astype(str)) + "\n") #space separated
-            else:
-                for j in range(start_idx,stop_idx):
-                    df.write(str(subdirs[j]) + "\n")
-
-            df.close()
+                for j in dispatch_indices[i]:
+                    df.write(dispatch_line(subdirs[j]) + "\n")
 
-            start_idx = stop_idx #start where we left off
+                df.close()
 
             #add  dispatch_xxx
             #run = "python " + path + ' ' + ' ' + ' '.join(sys.argv[1:]) + ' --dispatch ' + os.path.join(basename,fn) + ' -f \n'
@@ -695,7 +841,7 @@ else: # multiple tasks
             #parms = remove_ra_dec(sys.argv[1:])
             #run = "cd " + fn + " ; python " + path + ' ' + ' ' + ' '.join(parms) + ' --dispatch ' + fn + ' -f ; cd .. \n'
             if not MERGE:
-                run = "cd " + fn + " ; " + pre_python_cmd + python_cmd + path + ' ' + ' ' + ' '.join(sys.argv[1:]) + ' --dispatch ' + fn + ' -f ; cd .. \n'
+                run = "cd " + fn + " ; " + pre_python_cmd + python_cmd + path + ' ' + ' ' + ' '.join(run_argv) + ' --dispatch ' + fn + ' -f ; cd .. \n'
             else:
                 run = "cd " + fn + " ; " + pre_python_cmd + python_cmd + path + ' ' + ' ' + \
                       ' '.join(sys.argv[1:]) + ' --dispatch ' + fn2 + ' -f ; cd .. \n'
@@ -731,8 +877,19 @@ if not time_set: #update time
         if gridsearch_task_boost is not None:
             mx += gridsearch_task_boost
 
-        # set a minimum time ... always AT LEAST 5 or 10 minutes requested?
-        minutes = int(TIME_OVERHEAD + MAX_TIME_PER_TASK * mx * mult * base_time_multiplier)
+        if cost_means is not None:
+            #measured cost model: the slowest dispatch's expected time (with its spread), plus the startup
+            mx_seconds = max(cost_model.task_seconds(cost_means,cost_vars,idx) for idx in dispatch_indices)
+            if gridsearch_task_boost is not None:
+                mx_seconds += gridsearch_task_boost * np.mean(cost_means)
+            if cost_startup is not None:
+                startup = cost_startup
+            else:
+                startup = TIME_OVERHEAD * 60.0
+            minutes = int(ceil((startup + mx_seconds * base_time_multiplier) * mult / 60.0 * (1.0 + G.COST_MODEL_TIME_MARGIN)))
+        else:
+            # set a minimum time ... always AT LEAST 5 or 10 minutes requested?
+            minutes = int(TIME_OVERHEAD + MAX_TIME_PER_TASK * mx * mult * base_time_multiplier)
         time = str(timedelta(minutes=max(minutes,10.0)))
         print("--time %s" %time)
 
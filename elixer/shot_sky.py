@@ -3,13 +3,19 @@ Figure the sky residual for a single shot
 """
 try:
     from elixer import global_config as G
+    from elixer import weighted_biweight
 except:
     import global_config as G
+    import weighted_biweight
 
 import numpy as np
 import os
+import sys
+import warnings
 import tables
+import scipy.stats
 from astropy.table import Table
+from astropy.stats import biweight_location, biweight_scale
 
 log = G.Global_Logger('shot_sky')
 log.setlevel(G.LOG_LEVEL)
@@ -18,6 +24,13 @@ AMP_FLAG_TABLE = None
 
 STACKING_AVG_METHOD = "biweight" #"mean_68" "mean_95", "mean_std", "median" "biweight" "weighted_biweight"
 
+SKY_RESIDUAL_VERSION = "2" #bump whenever the fiber selection or stacking changes, so cached residuals are rebuilt
+SKY_RESIDUAL_MEMO = {} #in-process memo, (HDR version, stacking method, shotid) : (flux, err)
+SKY_RESIDUAL_FAILURES = {} #(HDR version, stacking method, shotid) : number of failed builds (this process)
+SKY_RESIDUAL_MAX_ATTEMPTS = 2 #failed builds of a shot's residual before the failure is memo'd as well
+FIBER_READ_CHUNK_ROWS = 5000 #number of Fibers table rows read (per column) at a time when collecting the sky fibers
+SKY_TRIM_FRACTION = 0.17 #fraction of the (good sky) fibers trimmed from each end (by summed flux) before stacking
+
 class DEX_Fiber:
     """
     A variation on Fiber, but closely associated with the HETDEX representation / storage of fiber data
@@ -250,6 +263,58 @@ def is_good_sky(flux,err,throughput,chi2):
 
 
 
+def good_sky_mask(flux,err,throughput,chi2):
+    """
+    Vectorized is_good_sky() over many fibers at once (same cuts)
+
+    :param flux: (N fibers x 1036) array (CALFIB wave grid, flux units, erg/s/cm^2 over 2AA)
+    :param err: (N x 1036) array
+    :param throughput: (N x 1036) array
+    :param chi2: (N x 1036) array
+    :return: boolean array (N), True for fibers that are good sky
+    """
+    flux = np.atleast_2d(np.asarray(flux,dtype=np.float64))
+    err = np.atleast_2d(np.asarray(err,dtype=np.float64))
+    throughput = np.atleast_2d(np.array(throughput,dtype=np.float64))
+    chi2 = np.atleast_2d(np.asarray(chi2,dtype=np.float64))
+
+    if len(flux) == 0:
+        return np.zeros(0,dtype=bool)
+
+    #ignore zeros in throughput as meaningless
+    throughput[throughput == 0] = 1.0
+
+    good = np.count_nonzero(flux[:,25:1001] == 0,axis=1) < 100
+    good &= np.count_nonzero((flux != 0) & (err == 0),axis=1) < 10 #these should never be zero
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore",RuntimeWarning) #all NaN slices
+        good &= ~(np.nanmin(throughput[:,25:1001],axis=1) < 0.08)
+        good &= ~(np.nanmax(chi2[:,25:1001],axis=1) > 6.0)
+
+        #see is_good_sky() for the (tuned) limits
+        max_flux = flux + err
+        good &= ~np.any(max_flux > 5.0,axis=1) #single_line_ceil
+        above = max_flux > 4.0 #adj_line_ceil
+        good &= ~np.any(above[:,:-1] & above[:,1:],axis=1) #adjacent wavebins
+
+        #overall continuum (3520-5472]
+        sum_flux = np.nansum(flux[:,25:1001],axis=1) / 1952.
+        sum_err = np.nansum(err[:,25:1001],axis=1) / 1952.
+        good &= ~(((sum_flux + sum_err) > 0.4) | ((sum_flux - sum_err) < -0.4))
+
+        # scan all 500AA wide sums (as running sums), [65] = 3600 to [716] = 4902
+        nbins = flux.shape[1]
+        cs_flux = np.concatenate((np.zeros((len(flux),1)),np.cumsum(np.nan_to_num(flux,nan=0.0),axis=1)),axis=1)
+        cs_err = np.concatenate((np.zeros((len(err),1)),np.cumsum(np.nan_to_num(err,nan=0.0),axis=1)),axis=1)
+        lo = np.arange(65,716)
+        hi = np.minimum(lo + 500,nbins)
+        qsum = (cs_flux[:,hi] - cs_flux[:,lo]) / 500.0
+        esum = (cs_err[:,hi] - cs_err[:,lo]) / 500.0
+        good &= ~np.any(((qsum + esum) > 0.5) | ((qsum - esum) < -0.5),axis=1)
+
+    return good
+
 
 def get_all_fibers(shotid,mf_list):
     """
@@ -300,146 +365,174 @@ def get_all_fibers(shotid,mf_list):
     return fiber_list
 
 
-def stack_sky_spectra(spectra, ffsky=True,straight_error=False):
+def get_all_fiber_arrays(shotid,mf_list,chunk_rows=None):
     """
+    Columnar get_all_fibers(): all good sky fibers (all exposures) from the list of multiframes within a single shot,
+    read a bounded chunk of Fibers table rows (and only the needed columns) at a time with the good sky cuts
+    applied as array masks (no per-fiber objects)
 
-    Here, we stack first in observed frame, then shift to a specified "rest" frame (as
-    set by the caller ... expected to be the rest frame of the detection for which this
-    sky is relevant)
-
-    :param spectra: list of Spectra objects (*note: not spectra bundle objects) to stack
-    :param z: rest-z of the detection for which this is relevant (0 = observed frame)
-    :param straight_error: if true, just use the error as is ... if False, divide by sqrt(N)
-    :return: single StackedSpectra object
+    :param shotid:
+    :param mf_list: list of (good) multiframes (as bytes, from get_multiframes_from_shot())
+    :param chunk_rows: number of rows to read at a time (default FIBER_READ_CHUNK_ROWS)
+    :return: ff (spec_fullsky_sub) and er (calfibe) as (N good fibers x 1036) arrays (or None, None)
     """
+    log.info(f"Collecting all fibers for shot {shotid}")
+
+    if chunk_rows is None:
+        chunk_rows = FIBER_READ_CHUNK_ROWS
 
+    ff_list = []
+    er_list = []
+    sh5 = None
     try:
-        with open("count.log","w") as f:
-            f.write(f"{len(spectra)}\n")
+        filename = os.path.join(G.PANACEA_HDF5_BASEDIR,str(shotid)[0:8] + "v"+str(shotid)[8:] + ".h5")
+        sh5 = tables.open_file(filename)
+        ftb = sh5.root.Data.Fibers
 
-    except:
-        log.info("Exception in shot_sky", exc_info=True)
+        in_mf = np.isin(ftb.read(field="multiframe"),np.array(mf_list))
+        nrows = len(in_mf)
 
-    long_grid = G.CALFIB_WAVEGRID[:] #this is in the rest frame
+        for start in range(0,nrows,chunk_rows):
+            stop = min(start + chunk_rows,nrows)
+            sel = in_mf[start:stop]
+            if not np.any(sel):
+                continue
 
-    if ffsky:
-        matrix = [x.spec_fullsky_sub for x in spectra]
-    else:
-        matrix = [x.calfib for x in spectra]
+            ff = ftb.read(start,stop,field='spec_fullsky_sub')[sel]
+            er = ftb.read(start,stop,field='calfibe')[sel]
+            good = good_sky_mask(ff,er,ftb.read(start,stop,field='Throughput')[sel],
+                                 ftb.read(start,stop,field='chi2')[sel])
+            if np.any(good):
+                ff_list.append(ff[good])
+                er_list.append(er[good])
 
-    er_matrix = [x.calfibe for x in spectra]
+        sh5.close()
+    except:
+        log.info("Exception in shot_sky", exc_info=True)
+        try:
+            sh5.close()
+        except:
+            pass
+        return None, None
 
-    stack_flux = np.zeros(len(long_grid))
-    stack_err = np.zeros(len(long_grid))
+    if len(ff_list) == 0:
+        return None, None
 
-    for i in range(len(long_grid)):
-        #build error first since wslice is modified and re-assigned
-        #build the error on the flux (wslice) so they stay lined up
+    return np.concatenate(ff_list), np.concatenate(er_list)
 
 
-        #have to remove the quantity here, just use the float values
-        wslice_err = np.array([m[i] for m in er_matrix])  # all rows, ith index
-        wslice = np.array([m[i] for m in matrix])   # all rows, ith index
+def trim_sky_fibers(ff,er,fraction=None):
+    """
+    Keep the interior of the fibers, as sorted by summed flux (3600AA-5400AA), trimming fraction from each end
 
-        wslice_err = wslice_err[np.where(wslice > -999)]  # so same as wslice, since these need to line up
-        wslice = wslice[np.where(wslice > -999)]  # git rid of the out of range interp values
+    :param ff: (N x 1036) flux array
+    :param er: (N x 1036) error array
+    :param fraction: fraction trimmed from each end (default SKY_TRIM_FRACTION)
+    :return: trimmed ff, er (in descending summed flux order)
+    """
+    if fraction is None:
+        fraction = SKY_TRIM_FRACTION
 
-        # git rid of any nans
-        wslice_err = wslice_err[~np.isnan(wslice)] #err first so the wslice is not modified
-        wslice_lo = wslice[~np.isnan(wslice)]
+    n = len(ff)
+    trim = int(fraction * n)
+    order = np.argsort(-np.sum(ff[:,65:966],axis=1),kind='stable') #avoid the ends, and bad skylines
+    keep = order[trim:n-trim]
+    return ff[keep], er[keep]
 
 
-        if len(wslice_err) > 0:
-            if straight_error or (STACKING_AVG_METHOD == 'mean_95'):
-                try:
-                    mean_cntr, var_cntr, std_cntr = scipy.stats.bayes_mvs(wslice, alpha=0.95)
-                    if np.isnan(mean_cntr[0]):
-                        raise( Exception('mean_ctr is nan'))
-                    stack_flux[i] = mean_cntr[0]
-                    #an average error
-                    stack_err[i] = 0.5 * (abs(mean_cntr[0]-mean_cntr[1][0]) + abs(mean_cntr[0]-mean_cntr[1][1]))
-                except:
-                    log.info("Exception in shot_sky. Straight Error failed (iter=%d,wave=%f). Switching to biweight at 2 sigma  ..." %(i,long_grid[i]),
-                             exc_info=True)
-                    try:
-                        stack_flux[i] = SU.biweight_location(wslice)
-                        stack_err[i] = SU.biweight_scale(wslice)#* 2. #2 sigma ~ 95%
-                    except:
-                        log.info("Exception in shot_sky",exc_info=True)
-            elif straight_error or (STACKING_AVG_METHOD == 'mean_68'):
+def stack_sky_matrix(flux,err,method=None,straight_error=False):
+    """
+    Stack (along the fiber axis) a (N spectra x N wavebins) flux matrix, one stacked value per wavebin.
+    Out of range (<= -999) and NaN values are ignored.
+
+    :param flux: (N x M) array
+    :param err: (N x M) array (used for the weighted_biweight method)
+    :param method: see STACKING_AVG_METHOD (the default)
+    :param straight_error: if true, use mean_95 (bayes_mvs)
+    :return: stack_flux, stack_err (each M)
+    """
+    if method is None:
+        method = STACKING_AVG_METHOD
+    if straight_error:
+        method = 'mean_95'
+
+    flux = np.array(flux,dtype=np.float64)
+    err = np.array(err,dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        flux[~(flux > -999)] = np.nan #out of range interp values (and NaNs)
+    err[np.isnan(flux)] = np.nan
+
+    count = np.count_nonzero(~np.isnan(flux),axis=0)
+    stack_flux = np.zeros(flux.shape[1])
+    stack_err = np.zeros(flux.shape[1])
+    cols = count > 0
+
+    if not np.any(cols):
+        return stack_flux, stack_err
+
+    f = flux[:,cols]
+    n = count[cols]
+
+    with np.errstate(invalid='ignore',divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore",RuntimeWarning)
+
+        if method == 'mean_std':
+            stack_flux[cols] = np.nanmean(f,axis=0)
+            stack_err[cols] = np.nanstd(f,axis=0) / np.sqrt(n)
+        elif method == 'median':
+            stack_flux[cols] = np.nanmedian(f,axis=0)
+            stack_err[cols] = np.nanstd(f,axis=0) / np.sqrt(n)
+        elif method == 'weighted_biweight':
+            stack_flux[cols], stack_err[cols] = weighted_biweight.stack_spectra(f,err[:,cols])
+        elif method in ['mean_95','mean_68']:
+            #no vectorized form; per wavebin
+            for i in np.where(cols)[0]:
+                sel = ~np.isnan(flux[:,i])
+                wslice = flux[sel,i]
                 try:
-                    mean_cntr, var_cntr, std_cntr = scipy.stats.bayes_mvs(wslice, alpha=0.68)
+                    mean_cntr, var_cntr, std_cntr = scipy.stats.bayes_mvs(wslice,alpha=0.95 if method == 'mean_95' else 0.68)
                     if np.isnan(mean_cntr[0]):
                         raise (Exception('mean_ctr is nan'))
                     stack_flux[i] = mean_cntr[0]
                     # an average error
                     stack_err[i] = 0.5 * (abs(mean_cntr[0] - mean_cntr[1][0]) + abs(mean_cntr[0] - mean_cntr[1][1]))
                 except:
-                    log.info("Exception in shot_sky Straight Error failed (iter=%d,wave=%f). Switching to biweight at 2 sigma  ..."
-                             % (i, long_grid[i]), exc_info=True)
-                    try:
-                        stack_flux[i] = SU.biweight_location(wslice)
-                        stack_err[i] = SU.biweight_scale(wslice)   # * 2. #2 sigma ~ 95%
-                    except:
-                        log.info("Exception in shot_sky", exc_info=True)
-            elif (STACKING_AVG_METHOD == 'mean_std'):
-                try:
-                    stack_flux[i] = np.nanmean(wslice)
-                    # an average error
-                    stack_err[i] = np.nanstd(wslice) / np.sqrt(len(wslice))
-                except:
-                    log.info("Exception in shot_sky. Straight Error failed (iter=%d,wave=%f). Switching to biweight at 2 sigma  ..."
-                             %(i,long_grid[i]),exc_info=True)
-                    try:
-                        stack_flux[i] = SU.biweight_location(wslice)
-                        stack_err[i] = SU.biweight_scale(wslice)#* 2. #2 sigma ~ 95%
-                    except:
-                        log.info("Exception in shot_sky", exc_info=True)
-
-            elif (STACKING_AVG_METHOD == 'median'):
-                try:
-                    stack_flux[i] = np.nanmedian(wslice)
-                    #an average error
-                    stack_err[i] =np.nanstd(wslice)/np.sqrt(len(wslice))
-                except Exception as e:
-                    log.info("Exception in shot_sky. Straight Error failed (iter=%d,wave=%f). Switching to biweight at 2 sigma  ..."
-                             %(i,long_grid[i]),exc_info=True)
-
-                    try:
-                        stack_flux[i] = SU.biweight_location(wslice)
-                        stack_err[i] = SU.biweight_scale(wslice) #* 2. #2 sigma ~ 95%
-                    except:
-                        log.info("Exception in shot_sky", exc_info=True)
-
-            elif (STACKING_AVG_METHOD == 'biweight'):
-                try:
-                    stack_flux[i] = SU.biweight_location(wslice)
-                    stack_err[i] = SU.biweight_scale(wslice) / np.sqrt(len(wslice))
-                except Exception as e:
-                    log.info("Exception in shot_sky.Straight Error failed (iter=%d,wave=%f). Switching to biweight at 2 sigma  ..."
-                             %(i,long_grid[i]),exc_info=True)
-                    try:
-                        stack_flux[i] = SU.biweight_location(wslice)
-                        stack_err[i] = SU.biweight_scale(wslice) #* 2. #2 sigma ~ 95%
-                    except:
-                        log.info("Exception in shot_sky", exc_info=True)
-            else: #weighted_biweight
-            #definitely keep the scale defaults (c=6,c=9) per Karl, etc .. these best wieght for Gaussian limits
-                try:
-                    stack_flux[i] = SU.biweight_location_errors(wslice, errors=wslice_err)
-                    stack_err[i] = SU.biweight_scale(wslice) / np.sqrt(len(wslice))
-                except:
-                    log.info("Exception in shot_sky", exc_info=True)
-                    stack_flux[i] = SU.biweight_location(wslice)
-                    stack_err[i] = SU.biweight_scale(wslice) / np.sqrt(len(wslice))
+                    log.info("Exception in shot_sky (wave=%f). Switching to biweight ..." %(G.CALFIB_WAVEGRID[i]),
+                             exc_info=True)
+                    stack_flux[i] = biweight_location(wslice)
+                    stack_err[i] = biweight_scale(wslice) / np.sqrt(len(wslice))
+        else: #biweight
+            stack_flux[cols] = biweight_location(f,axis=0,ignore_nan=True)
+            stack_err[cols] = biweight_scale(f,axis=0,ignore_nan=True) / np.sqrt(n)
+
+    return np.nan_to_num(stack_flux,nan=0.0), np.nan_to_num(stack_err,nan=0.0)
+
 
-    return stack_flux, stack_err
+def stack_sky_spectra(spectra, ffsky=True,straight_error=False):
+    """
+    Stack (in the observed frame) a list of DEX_Fiber objects
 
+    :param spectra: list of DEX_Fiber objects to stack
+    :param ffsky: if True stack the spec_fullsky_sub, else the calfib
+    :param straight_error: if true, just use the error as is ... if False, divide by sqrt(N)
+    :return: stack_flux, stack_err
+    """
 
+    if ffsky:
+        matrix = np.array([x.spec_fullsky_sub for x in spectra])
+    else:
+        matrix = np.array([x.calfib for x in spectra])
 
+    er_matrix = np.array([x.calfibe for x in spectra])
 
-def get_shot_sky_residual(shotid):
+    return stack_sky_matrix(matrix,er_matrix,straight_error=straight_error)
+
+
+
+
+def build_shot_sky_residual(shotid):
     """
+    Build (from the fibers, no caching) the sky residual for a shot.
     Really only make sense for the ffsky subtracted data, so that is the assumption
 
     :param shotid:
@@ -455,25 +548,193 @@ def get_shot_sky_residual(shotid):
         if mf_list is None or len(mf_list) == 0:
             return None, None
 
-        #collect all the fibers
-        fiber_list = get_all_fibers(shotid,mf_list)
+        #collect all the (good sky) fibers
+        ff, er = get_all_fiber_arrays(shotid,mf_list)
 
-        if fiber_list is None or len(fiber_list) == 0:
+        if ff is None or len(ff) == 0:
             return None, None
 
-        #now perform the sky-subselection (interior 2/3) on lo and ff (separetly)
-        fiber_list.sort(key=lambda x: x.ff_sum, reverse=True)
-        ff_selected_fiberids = [x.fiberid for x in fiber_list[int(0.17 * len(fiber_list)):-int(0.17 * len(fiber_list))]]
-        ff_selected_fibers = fiber_list[int(0.17 * len(fiber_list)):-int(0.17 * len(fiber_list))]
+        #now perform the sky-subselection (interior 2/3)
+        ff, er = trim_sky_fibers(ff,er)
 
         #now stack (biweight) in observed frame
-        ff_stack, ff_er_stack = stack_sky_spectra(ff_selected_fibers, ffsky=True)  # the er_stacks should be the same
+        ff_stack, ff_er_stack = stack_sky_matrix(ff,er)
     except:
         log.info("Exception in shot_sky", exc_info=True)
 
     return ff_stack, ff_er_stack
 
 
+def residual_cache_fn(shotid):
+    """
+    :param shotid: integer shotid
+    :return: the on-disk cache file for the shot's sky residual (per HDR version) or None if there is no cache
+    """
+    if G.SKY_RESIDUAL_CACHE_PATH is None:
+        return None
+    return os.path.join(G.SKY_RESIDUAL_CACHE_PATH,f"sky_residual_hdr{G.HDR_Version}_{shotid}.npz")
+
+
+def read_cached_residual(shotid):
+    """
+    :param shotid: integer shotid
+    :return: flux, err from the on-disk cache or None, None if not cached (or cached by a different version/method)
+    """
+    fn = residual_cache_fn(shotid)
+    try:
+        if (fn is not None) and os.path.isfile(fn):
+            with np.load(fn,allow_pickle=False) as npz:
+                if (str(npz['version']) == SKY_RESIDUAL_VERSION) and (str(npz['method']) == STACKING_AVG_METHOD) \
+                        and (len(npz['flux']) == len(G.CALFIB_WAVEGRID)):
+                    return np.array(npz['flux']), np.array(npz['err'])
+                log.info(f"Stale sky residual cache {fn}. Will rebuild.")
+    except:
+        log.info(f"Unable to read sky residual cache {fn}",exc_info=True)
+    return None, None
+
+
+def write_cached_residual(shotid,flux,err):
+    """
+    Save the residual to the on-disk cache. Written to a temporary and renamed so concurrent readers never see a
+    partial file.
+
+    :return: True if written
+    """
+    fn = residual_cache_fn(shotid)
+    if fn is None:
+        return False
+
+    tmp_fn = None
+    try:
+        os.makedirs(G.SKY_RESIDUAL_CACHE_PATH,exist_ok=True)
+        tmp_fn = fn + ".%d.tmp" % os.getpid()
+        with open(tmp_fn,"wb") as f:
+            np.savez(f,flux=np.asarray(flux,dtype=float),err=np.asarray(err,dtype=float),
+                     version=SKY_RESIDUAL_VERSION,method=STACKING_AVG_METHOD)
+        os.replace(tmp_fn,fn)
+        return True
+    except:
+        log.info(f"Unable to write sky residual cache {fn}",exc_info=True)
+        try:
+            if tmp_fn is not None:
+                os.remove(tmp_fn)
+        except:
+            pass
+    return False
+
+
+def get_shot_sky_residual(shotid):
+    """
+    Sky residual for the shot, built only once per shot: from the in-process memo, else the on-disk cache
+    (G.SKY_RESIDUAL_CACHE_PATH), else built from the fibers (and then saved to both). A shot that fails to build is
+    tried again up to SKY_RESIDUAL_MAX_ATTEMPTS times (per process).
 
+    :param shotid: integer shotid
+    :return: flux, err (or None, None if the residual cannot be built)
+    """
+    try:
+        shotid = int(shotid)
+    except:
+        pass
+
+    key = (G.HDR_Version, STACKING_AVG_METHOD, shotid)
+    if key in SKY_RESIDUAL_MEMO:
+        return SKY_RESIDUAL_MEMO[key]
 
+    flux, err = read_cached_residual(shotid)
+    if flux is None:
+        flux, err = build_shot_sky_residual(shotid)
+        if flux is not None:
+            write_cached_residual(shotid,flux,err)
 
+    if flux is not None:
+        SKY_RESIDUAL_MEMO[key] = (flux, err)
+    else:
+        #a failure can be transient (i.e. a read error), so it is tried again, but only a few times (most are not,
+        #i.e. no good sky fibers, and each attempt re-reads the whole shot)
+        SKY_RESIDUAL_FAILURES[key] = SKY_RESIDUAL_FAILURES.get(key,0) + 1
+        if SKY_RESIDUAL_FAILURES[key] >= SKY_RESIDUAL_MAX_ATTEMPTS:
+            log.info(f"Unable to build sky residual for {shotid} ({SKY_RESIDUAL_FAILURES[key]} attempts). Giving up.")
+            SKY_RESIDUAL_MEMO[key] = (None, None)
+    return flux, err
+
+
+def _precompute_one(shotid,overwrite=False):
+    """
+    Build and save (on-disk cache) the residual for one shot (a precompute_shot_sky_residuals pool task)
+
+    :return: shotid, True if the residual is in the cache
+    """
+    try:
+        if (not overwrite) and (read_cached_residual(shotid)[0] is not None):
+            return shotid, True
+        flux, err = build_shot_sky_residual(shotid)
+        if flux is None:
+            return shotid, False
+        return shotid, write_cached_residual(shotid,flux,err)
+    except:
+        log.info(f"Exception in shot_sky precomputing {shotid}",exc_info=True)
+        return shotid, False
+
+
+def precompute_shot_sky_residuals(shotids,workers=None,overwrite=False):
+    """
+    Build the on-disk cached sky residuals for a list of shots, in parallel
+
+    :param shotids: list of integer shotids
+    :param workers: number of processes (default is the number of CPUs)
+    :param overwrite: if True, rebuild even if already cached
+    :return: dictionary of shotid : True (cached) or False (failed)
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    if G.SKY_RESIDUAL_CACHE_PATH is None:
+        log.error("G.SKY_RESIDUAL_CACHE_PATH is not set. Cannot precompute sky residuals.")
+        return {}
+
+    shotids = list(dict.fromkeys(int(s) for s in shotids))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1,min(int(workers),len(shotids)))
+
+    status = {}
+    if workers > 1:
+        #fork (not spawn) so the workers inherit the configured global_config state
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=multiprocessing.get_context("fork")) as pool:
+            for shotid, ok in pool.map(_precompute_one,shotids,[overwrite]*len(shotids)):
+                status[shotid] = ok
+    else:
+        for shotid in shotids:
+            status[shotid] = _precompute_one(shotid,overwrite)[1]
+
+    log.info(f"Precomputed sky residuals for {sum(status.values())} of {len(shotids)} shots.")
+    return status
+
+
+if __name__ == '__main__':
+    #build the sky residual cache for a list of shots
+    import argparse
+    parser = argparse.ArgumentParser(description="Precompute the per-shot sky residuals into a cache directory.")
+    parser.add_argument('shots',help="shotids (i.e. 20190208023) or a file with one shotid per line",nargs='+')
+    parser.add_argument('--cache',help="output (cache) directory",required=True)
+    parser.add_argument('--workers',help="number of processes",type=int,default=None)
+    parser.add_argument('--overwrite',help="rebuild even if already cached",action='store_true',default=False)
+    cl = parser.parse_args()
+
+    G.SKY_RESIDUAL_CACHE_PATH = cl.cache
+    shot_list = []
+    for s in cl.shots:
+        if os.path.isfile(s):
+            with open(s) as f:
+                shot_list += [l.split()[0] for l in f if len(l.split()) > 0]
+        else:
+            shot_list.append(s)
+
+    status = precompute_shot_sky_residuals([int(s.replace("v","")) for s in shot_list],cl.workers,cl.overwrite)
+    failed = [k for k in status if not status[k]]
+    print(f"{len(status)-len(failed)} of {len(status)} shots cached in {cl.cache}")
+    if len(failed) > 0:
+        print(f"Failed: {failed}")
+        sys.exit(1)
@@ -3,10 +3,13 @@ SLURM merge
 Basic merging of elixer catalog HDF5 files in a simple SLURM wrapper
 only two generations of merge (assuming a maximum of 10,000 dispatch folders)
 and ~40 tasks yields 250 files per task in first merge and then 40 in the second (and final)
-Not the most efficient, but is fast to slap together and a big improvment over the linear merge
+The first generation (intermediate) merges are not indexed; only the final merge builds the indices.
+
+Alternatively, --tree [--workers N] merges all the dispatch catalogs in this one task as a parallel tree
+(see elixer_hdf5.merge_elixer_hdf5_files_tree) without the generational dispatch files.
 """
 
-#dont' bother with argparse ... we really only need the --dispatch <filename>
+#dont' bother with argparse ... we really only need the --dispatch <filename> (or --tree [--workers N])
 
 import glob
 import os
@@ -36,16 +39,22 @@ def get_base_merge_files(topdir=".",pattern="dispatch_*/*/*_cat.h5"):
     return files
 
 
-def merge_hdf5(fn_list=None,merge_fn="elixer_intermediate_merge.working"):
+def merge_hdf5(fn_list=None,merge_fn="elixer_intermediate_merge.working",reindex=True,workers=None):
     """
     Similar to merge ... replaces merge ... joins ELiXer HDF5 catlogs.
     Does not check for duplicate entries.
-    :param args:
+    :param fn_list: list of files to merge
+    :param merge_fn: output file
+    :param reindex: if False, skip building the indices (intermediate merges that are merged again later)
+    :param workers: if set (> 1), merge as a parallel tree over this many processes
     :return:
     """
     try:
         if len(fn_list) != 0:
-            merge_fn = elixer_hdf5.merge_elixer_hdf5_files(merge_fn,fn_list)
+            if (workers is not None) and (workers > 1):
+                merge_fn = elixer_hdf5.merge_elixer_hdf5_files_tree(merge_fn,fn_list,workers=workers)
+            else:
+                merge_fn = elixer_hdf5.merge_elixer_hdf5_files(merge_fn,fn_list,reindex=reindex)
             if merge_fn is not None:
                 if merge_fn == "elixer_intermediate_merge.working":
                     os.rename("elixer_intermediate_merge.working","elixer_intermediate_merge.h5")
@@ -77,6 +86,31 @@ def main():
     merge_list = []
     args = list(map(str.lower, sys.argv))
 
+    workers = None
+    if "--workers" in args:
+        try:
+            workers = int(sys.argv[args.index("--workers") + 1])
+        except:
+            print("Error! Invalid --workers parameter")
+            exit(-1)
+
+    if "--tree" in args:
+        #single task, parallel tree merge of everything
+        merge_list = get_base_merge_files()
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if os.path.exists("elixer_merged_cat.h5"):
+            merge_hdf5(merge_list, "elixer_merged_cat_new.h5",workers=workers)
+            os.rename("elixer_merged_cat.h5","elixer_merged_cat_old.h5")
+            merge_unique("elixer_merged_cat.h5","elixer_merged_cat_old.h5","elixer_merged_cat_new.h5")
+            for file in ["elixer_merged_cat_new.h5","elixer_merged_cat_old.h5"]:
+                if os.path.exists(file):
+                    os.remove(file)
+        else:
+            merge_hdf5(merge_list, "elixer_merged_cat.h5",workers=workers)
+        exit(0)
+
     i = -1
     if "--dispatch" in args:
         i = args.index("--dispatch")
@@ -155,7 +189,7 @@ def main():
 
         print(f"Merging {len(merge_list)} files ... ")
         print(merge_list)
-        merge_hdf5(merge_list)
+        merge_hdf5(merge_list,reindex=False) #the final merge builds the indices
         print("Intermediate merge complete")
 
 
@@ -0,0 +1,148 @@
+"""
+KD-tree spatial index over the RA, Dec of a (catalog) DataFrame for fast box and cone searches.
+
+Positions are indexed as unit vectors on the sphere, so the search is cos(dec) aware and has no problem with the
+RA wrap at 0/360. Box searches are answered by a cone (that encloses the box) on the tree and then the exact
+same RA, Dec box cut the catalogs have always used, but only on the handful of candidate rows, so the results are
+identical to the full column boolean masks. Results are row positions (for .iloc) in the DataFrame order.
+
+The index for each DataFrame is built once (on first use) and held only as long as the DataFrame itself.
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import weakref
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except:
+    cKDTree = None
+
+log = G.Global_Logger('spatial_index')
+log.setlevel(G.LOG_LEVEL)
+
+
+def radec_to_xyz(ra,dec):
+    """
+    :param ra: decimal degrees (scalar or array)
+    :param dec: decimal degrees (scalar or array)
+    :return: (N,3) array of unit vectors
+    """
+    ra = np.deg2rad(np.atleast_1d(np.asarray(ra,dtype=np.float64)))
+    dec = np.deg2rad(np.atleast_1d(np.asarray(dec,dtype=np.float64)))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
+def chord(radius_deg):
+    """
+    :param radius_deg: angular radius (decimal degrees)
+    :return: the equivalent (straight line) distance between unit vectors
+    """
+    return 2.0 * np.sin(np.deg2rad(np.minimum(np.asarray(radius_deg,dtype=np.float64),180.0)) / 2.0)
+
+
+def angular_sep(ra1,dec1,ra2,dec2):
+    """
+    :return: angular separation(s) in decimal degrees
+    """
+    d = np.linalg.norm(radec_to_xyz(ra1,dec1) - radec_to_xyz(ra2,dec2),axis=1)
+    return np.rad2deg(2.0 * np.arcsin(np.clip(d / 2.0,0.0,1.0)))
+
+
+class SpatialIndex:
+
+    def __init__(self,ra,dec):
+        """
+        :param ra: array of decimal degrees (NaN entries are not indexed and never match)
+        :param dec: array of decimal degrees
+        """
+        self.ra = np.asarray(ra,dtype=np.float64)
+        self.dec = np.asarray(dec,dtype=np.float64)
+        self.n = len(self.ra)
+        self.rows = np.where(np.isfinite(self.ra) & np.isfinite(self.dec))[0] #tree index to row position
+        self.tree = cKDTree(radec_to_xyz(self.ra[self.rows],self.dec[self.rows]))
+
+    def cone(self,ra,dec,radius):
+        """
+        :param ra: decimal degrees
+        :param dec: decimal degrees
+        :param radius: decimal degrees
+        :return: sorted array of row positions within radius of ra, dec
+        """
+        idx = self.tree.query_ball_point(radec_to_xyz(ra,dec)[0],chord(radius))
+        return np.sort(self.rows[np.array(idx,dtype=int)])
+
+    def box(self,ra_min,ra_max,dec_min,dec_max):
+        """
+        Same result as ((ra >= ra_min) & (ra <= ra_max) & (dec >= dec_min) & (dec <= dec_max))
+
+        :return: sorted array of row positions inside the RA, Dec box
+        """
+        if (ra_max < ra_min) or (dec_max < dec_min):
+            return np.zeros(0,dtype=int)
+
+        ra_c = 0.5 * (ra_min + ra_max)
+        dec_c = 0.5 * (dec_min + dec_max)
+
+        #the cone around the box center out to the farthest corner (or edge midpoint) encloses the box
+        edge_ra = [ra_min,ra_min,ra_max,ra_max,ra_c,ra_c,ra_min,ra_max]
+        edge_dec = [dec_min,dec_max,dec_min,dec_max,dec_min,dec_max,dec_c,dec_c]
+        radius = np.max(angular_sep(np.full(len(edge_ra),ra_c),np.full(len(edge_dec),dec_c),edge_ra,edge_dec))
+        radius = radius * (1.0 + 1e-6) + 1e-9
+
+        rows = self.cone(ra_c,dec_c,radius)
+        ra = self.ra[rows]
+        dec = self.dec[rows]
+        return rows[(ra >= ra_min) & (ra <= ra_max) & (dec >= dec_min) & (dec <= dec_max)]
+
+    def match_many(self,ras,decs,radius):
+        """
+        Bulk cone search.
+
+        :param ras: array of decimal degrees
+        :param decs: array of decimal degrees
+        :param radius: decimal degrees (scalar or one per position)
+        :return: list (one per position) of sorted arrays of row positions within radius
+        """
+        xyz = radec_to_xyz(ras,decs)
+        matches = self.tree.query_ball_point(xyz,chord(np.broadcast_to(radius,len(xyz))))
+        return [np.sort(self.rows[np.array(m,dtype=int)]) for m in matches]
+
+
+_index_cache = {} #id(DataFrame) : (weakref to DataFrame, SpatialIndex)
+
+
+def _forget(key):
+    _index_cache.pop(key,None)
+
+
+def index_for(df,ra_col='RA',dec_col='DEC'):
+    """
+    Get (or build on first use) the spatial index for the DataFrame
+
+    :param df: pandas DataFrame with ra_col and dec_col in decimal degrees
+    :return: SpatialIndex or None if an index cannot be built (the caller should fall back to a full search)
+    """
+    if (df is None) or (cKDTree is None):
+        return None
+
+    key = (id(df),ra_col,dec_col)
+    entry = _index_cache.get(key)
+    if entry is not None:
+        if (entry[0]() is df) and (entry[1].n == len(df)):
+            return entry[1]
+        _forget(key)
+
+    try:
+        index = SpatialIndex(df[ra_col].values,df[dec_col].values)
+        _index_cache[key] = (weakref.ref(df,lambda r, k=key: _forget(k)),index)
+        log.debug(f"Built spatial index over {index.n} rows.")
+        return index
+    except:
+        log.info("Unable to build spatial index.",exc_info=True)
+        return None
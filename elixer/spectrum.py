@@ -968,9 +968,259 @@ class EmissionLineInfo:
 
 
 #really should change this to use kwargs
+def gaussian_fit_window(wavelengths,values,errors,central,spectrum=None):
+    """
+    The (same) data window and constraints signal_score() fits a gaussian to
+
+    :param wavelengths:
+    :param values: (already normalized with norm_values())
+    :param errors: (already normalized with norm_values()) or None
+    :param central: line center (AA)
+    :param spectrum: (optional) Spectrum; if central is near one of its found peaks, central is moved to that peak
+    :return: central (possibly nudged), wave_x, wave_counts, wave_errors (or None), wave_err_sigma (or None), fit_range_AA
+    """
+    pix_size = abs(wavelengths[1] - wavelengths[0])  # aa per pix
+
+    #if near a peak we already found, nudge to align
+    if isinstance(spectrum,Spectrum):
+        w = spectrum.is_near_a_peak(central,pix_size)
+        if w:
+            central = w
+
+    wave_side = int(round(GAUSS_FIT_AA_RANGE / pix_size))  # pixels
+    fit_range_AA = max(GAUSS_FIT_PIX_ERROR * pix_size, GAUSS_FIT_AA_ERROR)
+
+    len_array = len(wavelengths)
+    idx = getnearpos(wavelengths,central)
+    min_idx = max(0,idx-wave_side)
+    max_idx = min(len_array,idx+wave_side)
+    wave_x = wavelengths[min_idx:max_idx+1]
+    wave_counts = values[min_idx:max_idx+1]
+    if (errors is not None) and (len(errors) == len(wavelengths)):
+        wave_errors = errors[min_idx:max_idx+1]
+        #replace any 0 with 1
+        wave_errors[np.where(wave_errors == 0)] = 1
+        wave_err_sigma = 1. / (wave_errors * wave_errors)
+    else:
+        wave_errors = None
+        wave_err_sigma = None
+
+    return central, wave_x, wave_counts, wave_errors, wave_err_sigma, fit_range_AA
+
+
+def batch_gaussian_fit(x,y,s,p0,lower,upper,max_iter=200,tol=1e-10):
+    """
+    Fit gaussian() (x0, sigma, a, y) to many (independent) data sets at once with a vectorized, bounded
+    (projected) Levenberg-Marquardt. The parameter covariance is computed just as scipy.optimize.curve_fit does
+    (absolute_sigma=False), so the results can be used in place of per-data-set curve_fit calls.
+
+    :param x: (K,M) wavelengths (data sets shorter than M are padded and given s = inf)
+    :param y: (K,M) values
+    :param s: (K,M) "sigma" of each point as passed to curve_fit (residuals are divided by this)
+    :param p0: (K,4) initial parameters (clipped to the bounds)
+    :param lower: (K,4) lower bounds
+    :param upper: (K,4) upper bounds
+    :param max_iter: max iterations
+    :param tol: relative change in cost (and parameters) for convergence
+    :return: parm (K,4), pcov (K,4,4), cost (K,) chi2, ok (K,) bool (False if not converged, stalled, on a bound
+             other than the amplitude's lower bound, or not usable)
+    """
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    w = 1.0 / np.asarray(s,dtype=np.float64)
+    w[~np.isfinite(w)] = 0.0
+    good = (w > 0) & np.isfinite(x) & np.isfinite(y)
+    w[~good] = 0.0
+    x = np.where(good,x,0.0)
+    y = np.where(good,y,0.0)
+    n = np.sum(good,axis=1)
+
+    lower = np.asarray(lower,dtype=np.float64)
+    upper = np.asarray(upper,dtype=np.float64)
+    p = np.clip(np.asarray(p0,dtype=np.float64),lower,upper)
+    K = len(p)
+
+    def model(p,rows):
+        dx = x[rows] - p[:,0:1]
+        sig = p[:,1:2]
+        g = np.exp(-0.5 * (dx / sig)**2) / np.sqrt(2. * np.pi * sig**2)
+        return p[:,2:3] * g + p[:,3:4], g, dx, sig
+
+    def residuals_and_jac(p,rows):
+        f, g, dx, sig = model(p,rows)
+        r = w[rows] * (f - y[rows])
+        J = np.empty(r.shape + (4,))
+        J[:,:,0] = p[:,2:3] * g * dx / sig**2
+        J[:,:,1] = p[:,2:3] * g * (dx**2 / sig**3 - 1. / sig)
+        J[:,:,2] = g
+        J[:,:,3] = 1.0
+        J *= w[rows][:,:,None]
+        return r, J
+
+    all_rows = np.arange(K)
+    lam = np.full(K,1e-3)
+    active = np.ones(K,dtype=bool)
+    converged = np.zeros(K,dtype=bool)
+    r, J = residuals_and_jac(p,all_rows)
+    cost = np.sum(r * r,axis=1)
+    eye = np.eye(4)
+
+    for _ in range(max_iter):
+        if not np.any(active):
+            break
+        a = np.where(active)[0]
+        Jt = np.transpose(J[a],(0,2,1))
+        JtJ = Jt @ J[a]
+        Jtr = (Jt @ r[a][:,:,None])[:,:,0]
+        D = np.diagonal(JtJ,axis1=1,axis2=2) + 1e-30
+        A = JtJ + lam[a,None,None] * D[:,:,None] * eye
+
+        #parameters on a bound that the step would push further out are held fixed (active set)
+        fixed = ((p[a] <= lower[a]) & (Jtr > 0)) | ((p[a] >= upper[a]) & (Jtr < 0))
+        if np.any(fixed):
+            free = ~fixed
+            A = A * (free[:,:,None] & free[:,None,:]) + fixed[:,:,None] * eye
+            Jtr = np.where(fixed,0.0,Jtr)
+        try:
+            step = -np.linalg.solve(A,Jtr[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('kij,kj->ki',np.linalg.pinv(A),Jtr)
+
+        p_new = np.clip(p[a] + step,lower[a],upper[a])
+        r_new, J_new = residuals_and_jac(p_new,a)
+        cost_new = np.sum(r_new * r_new,axis=1)
+
+        better = np.isfinite(cost_new) & (cost_new <= cost[a])
+        dcost = (cost[a] - cost_new) / np.maximum(cost[a],1e-300)
+        dp = np.max(np.abs(p_new - p[a]) / (np.abs(p[a]) + 1e-8),axis=1)
+
+        #only trust the convergence tests once near Gauss-Newton steps (a large lambda also makes for tiny changes)
+        near_gn = lam[a] <= 1e-2
+
+        acc = a[better]
+        p[acc] = p_new[better]
+        cost[acc] = cost_new[better]
+        r[acc] = r_new[better]
+        J[acc] = J_new[better]
+        lam[acc] = np.maximum(lam[acc] / 10.,1e-12)
+        lam[a[~better]] *= 10.
+
+        done = better & near_gn & ((dcost < tol) | (dp < tol))
+        stuck = (~better) & (lam[a] > 1e12) #stalled: not trusted, left to the caller's curve_fit fallback
+        converged[a[done]] = True
+        active[a[done | stuck]] = False
+
+    #covariance as curve_fit: pinv(J^T J) from the SVD of J, scaled by chi2/(N - 4)
+    _, sv, VT = np.linalg.svd(J,full_matrices=False)
+    threshold = np.finfo(np.float64).eps * np.maximum(n,4)[:,None] * sv[:,0:1]
+    inv_sv2 = np.zeros_like(sv)
+    np.divide(1.0,sv**2,out=inv_sv2,where=sv > threshold)
+    pcov = np.einsum('kji,kj,kjl->kil',VT,inv_sv2,VT)
+    dof = n - 4
+    scale = np.where(dof > 0,cost / np.maximum(dof,1),np.inf)
+    pcov = pcov * scale[:,None,None]
+
+    #a fit that ends on a bound can be a stall of the active set rather than the minimum curve_fit's trust region
+    #method finds from the same start, so leave those to the curve_fit fallback as well ... except for the amplitude
+    #pinned at its lower bound (0), which is the expected (converged) result for an absent line
+    at_bound = (p <= lower) | (p >= upper)
+    at_bound[:,2] = p[:,2] >= upper[:,2]
+    on_bound = np.any(at_bound,axis=1)
+    ok = converged & ~on_bound & np.all(np.isfinite(p),axis=1) & np.all(np.isfinite(pcov),axis=(1,2)) & (n > 4)
+    return p, pcov, cost, ok
+
+
+def batch_signal_fits(wavelengths,values,errors,centrals,values_units=0,spectrum=None,allow_broad=False):
+    """
+    Gaussian fits (as in signal_score()) for many candidate line centers on the same spectrum, all at once.
+    Pass each result as signal_score(..., fit=) to skip its own curve_fit.
+
+    Each candidate is fit from the same start as the curve_fit call (central, 1.5, 1.0, 0.0). Every
+    G.BATCH_GAUSS_FIT_VALIDATE-th accepted fit is also fit with curve_fit (and that result is used); if the batch fit
+    ended at a worse chi2 for any of those, none of the batch fits are used.
+
+    :param wavelengths:
+    :param values:
+    :param errors:
+    :param centrals: list of line centers (AA) as they would be passed to signal_score()
+    :param values_units:
+    :param spectrum: as passed to signal_score()
+    :param allow_broad: single bool or one per central, as passed to signal_score()
+    :return: list (one per central) of (parm, pcov) or None if the batch fit did not converge for that central
+             (signal_score() then falls back to curve_fit)
+    """
+    results = [None] * len(centrals)
+    if (wavelengths is None) or (values is None) or (len(wavelengths) < 2) or (len(centrals) == 0):
+        return results
+
+    try:
+        err_units = values_units
+        values, values_units = norm_values(values,values_units)
+        if (errors is not None) and (len(errors) == len(values)):
+            errors, err_units = norm_values(errors,err_units)
+        else:
+            errors = None
+
+        allow_broad = np.broadcast_to(np.asarray(allow_broad,dtype=bool),(len(centrals),))
+
+        windows = []
+        for c in centrals:
+            windows.append(gaussian_fit_window(wavelengths,values,errors,c,spectrum))
+
+        M = max(len(wnd[1]) for wnd in windows)
+        K = len(windows)
+        x = np.zeros((K,M))
+        y = np.zeros((K,M))
+        s = np.full((K,M),np.inf)
+        p0 = np.zeros((K,4))
+        lower = np.zeros((K,4))
+        upper = np.zeros((K,4))
+
+        for i, (central, wave_x, wave_counts, wave_errors, wave_err_sigma, fit_range_AA) in enumerate(windows):
+            m = len(wave_x)
+            if allow_broad[i]:
+                max_fit_sigma = GAUSS_FIT_MAX_SIGMA * 1.5 + 1.0
+            else:
+                max_fit_sigma = GAUSS_FIT_MAX_SIGMA + 1.0
+            x[i,0:m] = wave_x
+            y[i,0:m] = wave_counts
+            s[i,0:m] = 1.0 if wave_err_sigma is None else wave_err_sigma
+            p0[i] = (central,1.5,1.0,0.0)
+            lower[i] = (central - fit_range_AA, 1.0, 0.0, -100.0)
+            upper[i] = (central + fit_range_AA, max_fit_sigma, 1e5, 1e4)
+
+        parm, pcov, cost, ok = batch_gaussian_fit(x,y,s,p0,lower,upper)
+
+        validate = max(1,int(G.BATCH_GAUSS_FIT_VALIDATE))
+        for j, i in enumerate(np.where(ok)[0]):
+            if j % validate:
+                results[i] = (parm[i],pcov[i])
+                continue
+
+            #validation sample: the same curve_fit call as signal_score()
+            m = int(np.sum(np.isfinite(s[i])))
+            try:
+                cf_parm, cf_pcov = curve_fit(gaussian, np.float64(x[i,0:m]), np.float64(y[i,0:m]), p0=p0[i],
+                                             bounds=(lower[i],upper[i]),
+                                             sigma=None if windows[i][4] is None else s[i,0:m])
+            except:
+                continue #signal_score() will make (and fail) the same fit
+
+            cf_cost = np.sum(((gaussian(x[i,0:m],*cf_parm) - y[i,0:m]) / s[i,0:m])**2)
+            if cost[i] > cf_cost * (1.0 + 1e-6) + 1e-12:
+                log.debug(f"Batch gaussian fit at {windows[i][0]:0.2f} worse than curve_fit "
+                          f"(chi2 {cost[i]:0.4g} vs {cf_cost:0.4g}). Not using the batch fits.")
+                return [None] * len(centrals)
+            results[i] = (cf_parm,cf_pcov)
+    except:
+        log.info("Exception in spectrum::batch_signal_fits. Will fall back to individual fits.",exc_info=True)
+
+    return results
+
+
 def signal_score(wavelengths,values,errors,central,central_z = 0.0, spectrum=None,values_units=0, sbr=None,
                  min_sigma=GAUSS_FIT_MIN_SIGMA,show_plot=False,plot_id=None,plot_path=None,do_mcmc=False,absorber=False,
-                 force_score=False,values_dx=G.FLUX_WAVEBIN_WIDTH,allow_broad=False,broadfit=1):
+                 force_score=False,values_dx=G.FLUX_WAVEBIN_WIDTH,allow_broad=False,broadfit=1,fit=None):
     """
 
     :param wavelengths:
@@ -991,6 +1241,8 @@ def signal_score(wavelengths,values,errors,central,central_z = 0.0, spectrum=Non
     :param values_dx:
     :param allow_broad:
     :param broadfit: (median filter size used to smooth for a broadfit) 1 = no filter (or a bin of 1 which is no filter)
+    :param fit: (optional) precomputed gaussian fit (parm, pcov) for this central (see batch_signal_fits()); if None,
+                the fit is made here with curve_fit
     :return:
     """
 
@@ -1044,56 +1296,17 @@ def signal_score(wavelengths,values,errors,central,central_z = 0.0, spectrum=Non
     #sbr signal to background ratio
     pix_size = abs(wavelengths[1] - wavelengths[0])  # aa per pix
 
-    #if near a peak we already found, nudge to align
-    if isinstance(spectrum,Spectrum):
-        w = spectrum.is_near_a_peak(central,pix_size)
-        if w:
-            central = w
-
-    # want +/- 20 angstroms in pixel units (maybe should be 50 AA?
-    wave_side = int(round(GAUSS_FIT_AA_RANGE / pix_size))  # pixels
-    #1.5 seems to be good multiplier ... 2.0 is a bit too much;
-    # 1.0 is not bad, but occasionally miss something by just a bit
-
-    fit_range_AA = max(GAUSS_FIT_PIX_ERROR * pix_size, GAUSS_FIT_AA_ERROR)
-    #fit_range_AA = GAUSS_FIT_PIX_ERROR * pix_size #1.0  # peak must fit to within +/- fit_range AA
-                                  # this allows room to fit, but will enforce +/- pix_size after
-    #num_of_sigma = 3.0  # number of sigma to include on either side of the central peak to estimate noise
+    #window (and constraints) for the fit; if near a peak we already found, central is nudged to align
+    central, wave_x, wave_counts, wave_errors, wave_err_sigma, fit_range_AA = \
+        gaussian_fit_window(wavelengths,values,errors,central,spectrum)
+    #as a reminder, if the errors are all the same, then it does not matter what they are, it reduces to the standard
+    #arithmetic mean :  Sum 1 to N (x_n**2, sigma_n**2) / (Sum 1 to N (1/sigma_n**2) ==> 1/N * Sum(x_n**2)
+    # since sigma_n (as a constant) divides out
 
-    len_array = len(wavelengths)
-    idx = getnearpos(wavelengths,central)
-    min_idx = max(0,idx-wave_side)
-    max_idx = min(len_array,idx+wave_side)
-    wave_x = wavelengths[min_idx:max_idx+1]
-    wave_counts = values[min_idx:max_idx+1]
-    if (errors is not None) and (len(errors) == len(wavelengths)):
-        wave_errors = errors[min_idx:max_idx+1]
-        #replace any 0 with 1
-        wave_errors[np.where(wave_errors == 0)] = 1
-        wave_err_sigma = 1. / (wave_errors * wave_errors) #double checked and this is correct (assuming errors is +/- as expected)
-        #as a reminder, if the errors are all the same, then it does not matter what they are, it reduces to the standard
-        #arithmetic mean :  Sum 1 to N (x_n**2, sigma_n**2) / (Sum 1 to N (1/sigma_n**2) ==> 1/N * Sum(x_n**2)
-        # since sigma_n (as a constant) divides out
-    else:
-        wave_errors = None
-        wave_err_sigma = None
-
-    if False: #do I want to use a more narrow range for the gaussian fit? still uses the wider range for RMSE
-        min_idx = max(0, idx - wave_side/2)
-        max_idx = min(len_array, idx + wave_side/2)
-        narrow_wave_x = wavelengths[min_idx:max_idx+1]
-        narrow_wave_counts = values[min_idx:max_idx + 1]
-        if (wave_errors is not None):
-            narrow_wave_errors = wave_errors[min_idx:max_idx + 1]
-            narrow_wave_err_sigma =  wave_err_sigma[min_idx:max_idx + 1]
-        else:
-            narrow_wave_err_sigma = None
-            narrow_wave_errors = None
-    else:
-        narrow_wave_x = wave_x
-        narrow_wave_counts = wave_counts
-        narrow_wave_errors = wave_errors
-        narrow_wave_err_sigma = wave_err_sigma
+    narrow_wave_x = wave_x
+    narrow_wave_counts = wave_counts
+    narrow_wave_errors = wave_errors
+    narrow_wave_err_sigma = wave_err_sigma
 
     #blunt very negative values
     #wave_counts = np.clip(wave_counts,0.0,np.inf)
@@ -1142,15 +1355,18 @@ def signal_score(wavelengths,values,errors,central,central_z = 0.0, spectrum=Non
         #   log.warning("**** NO UNCERTAINTIES ****")
 
 
-        parm, pcov = curve_fit(gaussian, np.float64(narrow_wave_x), np.float64(narrow_wave_counts),
-                                p0=(central,1.5,1.0,0.0),
-                                bounds=((central-fit_range_AA, 1.0, 0.0, -100.0),
-                                        (central+fit_range_AA, max_fit_sigma, 1e5, 1e4)),
-                                #sigma=1./(narrow_wave_errors*narrow_wave_errors)
-                                sigma=narrow_wave_err_sigma#, #handles the 1./(err*err)
-                               #note: if sigma == None, then curve_fit uses array of all 1.0
-                               #method='trf'
-                               )
+        if fit is not None:
+            parm, pcov = fit
+        else:
+            parm, pcov = curve_fit(gaussian, np.float64(narrow_wave_x), np.float64(narrow_wave_counts),
+                                   p0=(central,1.5,1.0,0.0),
+                                   bounds=((central-fit_range_AA, 1.0, 0.0, -100.0),
+                                           (central+fit_range_AA, max_fit_sigma, 1e5, 1e4)),
+                                   #sigma=1./(narrow_wave_errors*narrow_wave_errors)
+                                   sigma=narrow_wave_err_sigma#, #handles the 1./(err*err)
+                                   #note: if sigma == None, then curve_fit uses array of all 1.0
+                                   #method='trf'
+                                   )
 
         perr = np.sqrt(np.diag(pcov)) #1-sigma level errors on the fitted parameters
         #e.g. flux = a = parm[2]   +/- perr[2]*num_of_sigma_confidence
@@ -2120,6 +2336,251 @@ def est_peak_strength(wavelengths,values,central,values_units=0,dw=DEFAULT_BACKG
     return sbr
 
 
+def peak_valley_walk(x,v,h,delta,maxtab,mintab,first=0,state=None):
+    """
+    The peak (and valley) walk of peakdet() and simple_peaks(), one bin at a time
+    (after the MATLAB script at http://billauer.co.il/peakdet.html)
+
+    :param x: coordinates (wavelengths)
+    :param v: values
+    :param h: minimum height of a peak
+    :param delta: a peak (valley) must be this much above (below) the values on either side
+    :param maxtab: list to append the peaks to, as (index, x, value)
+    :param mintab: list to append the valleys to, as (index, x, value)
+    :param first: bin to start (resume) the walk from
+    :param state: (lookformax, maxv, maxpos, maxidx, minv, minpos, minidx) to resume from (None to start fresh)
+    """
+    if state is None:
+        lookformax, maxv, maxpos, maxidx, minv, minpos, minidx = True, -np.inf, np.nan, None, np.inf, np.nan, None
+    else:
+        lookformax, maxv, maxpos, maxidx, minv, minpos, minidx = state
+
+    for i in np.arange(first,len(v)):
+        thisv = v[i]
+        if thisv > maxv:
+            maxv = thisv
+            maxpos = x[i]
+            maxidx = i
+        if thisv < minv:
+            minv = thisv
+            minpos = x[i]
+            minidx = i
+        if lookformax:
+            if (thisv >= h) and (thisv < maxv - delta):
+                #i-1 since we are now on the right side of the peak and want the index associated with max
+                maxtab.append((maxidx,maxpos, maxv))
+                minv = thisv
+                minpos = x[i]
+                lookformax = False
+        else:
+            if thisv > minv + delta:
+                mintab.append((minidx,minpos, minv))
+                maxv = thisv
+                maxpos = x[i]
+                lookformax = True
+
+
+def peak_valley_scan(x,v,h,delta):
+    """
+    peak_valley_walk() over the whole spectrum
+
+    Kept as the reference for peak_valley_search() and used by it for spectra with non-finite values.
+
+    :return: maxtab, mintab as lists of (index, x, value) for the peaks and the valleys
+    """
+    maxtab = []
+    mintab = []
+    peak_valley_walk(x,v,h,delta,maxtab,mintab)
+    return maxtab, mintab
+
+
+def peak_valley_search(x,v,h,delta,chunk=64,min_leg=32):
+    """
+    Vectorized peak_valley_scan(), with identical results.
+
+    The walk alternates between looking for a peak and looking for a valley. Each leg is a search with running
+    (cumulative) max or min from where the leg started, over a window that doubles until the turn is found, so
+    there is one numpy pass per peak or valley instead of a python step per bin. Where the turns come more often
+    than every min_leg bins (noisy spectra, small delta) that is no faster, so the rest of the spectrum is walked
+    bin by bin (peak_valley_walk()) from the last turn.
+
+    The reported index follows the bin walk exactly: it is the last bin that set a new running max (min), which can
+    be from before the running value was reset at the turn, so it can differ from the position.
+
+    :param x: coordinates (wavelengths)
+    :param v: values
+    :param h: minimum height of a peak
+    :param delta: a peak (valley) must be this much above (below) the values on either side
+    :param chunk: initial search window (bins)
+    :param min_leg: average bins per leg (since the start) below which to switch to the bin walk
+    :return: maxtab, mintab as lists of (index, x, value) for the peaks and the valleys
+    """
+    v = np.asarray(v)
+    n = len(v)
+    if (n == 0) or not np.all(np.isfinite(v)):
+        return peak_valley_scan(x,v,h,delta)
+
+    maxtab = []
+    mintab = []
+    neg_v = -v #the running max is tracked as the running min of -v
+
+    def next_turn(start,first,look_for_max):
+        #first index >= first where the leg that started at start turns
+        end = min(n,first + chunk)
+        while first < n:
+            seg = v[start:end]
+            if look_for_max:
+                hit = (seg[first - start:] >= h) & (seg[first - start:] < np.maximum.accumulate(seg)[first - start:] - delta)
+            else:
+                hit = seg[first - start:] > np.minimum.accumulate(seg)[first - start:] + delta
+            k = hit.argmax()
+            if hit[k]:
+                return first + int(k)
+            if end >= n:
+                break
+            end = min(n,start + 2 * (end - start))
+        return None
+
+    def last_update(w,reset,idx_at_reset,i):
+        #index of the last bin up to i that set a new running min of w (the running min was reset to w[reset])
+        if i > reset:
+            j = reset + 1 + int(w[reset + 1:i + 1].argmin())
+            if w[j] < w[reset]:
+                return j
+        return idx_at_reset
+
+    #the running max (min) tracker: bin of its last reset and its index at that reset
+    max_reset, max_idx_at_reset = 0, 0
+    min_reset, min_idx_at_reset = 0, 0
+    min_started = False #the running min is from the first bin until the first peak
+
+    start = 0
+    look_for_max = True
+    turn = next_turn(0,0,True)
+    while turn is not None:
+        if look_for_max:
+            i = start + int(v[start:turn + 1].argmax())
+            maxidx = last_update(neg_v,max_reset,max_idx_at_reset,turn)
+            maxtab.append((maxidx,x[i],v[i]))
+            #the running min is reset to this bin
+            if min_started:
+                before = last_update(v,min_reset,min_idx_at_reset,turn - 1)
+                lowest = v[min_reset:turn].min()
+            elif turn > 0:
+                before = int(v[0:turn].argmin())
+                lowest = v[before]
+            else:
+                before = None
+                lowest = np.inf
+            min_reset, min_idx_at_reset = turn, (turn if v[turn] < lowest else before)
+            min_started = True
+            state = (False,v[i],x[i],maxidx,v[turn],x[turn],min_idx_at_reset)
+        else:
+            i = start + int(v[start:turn + 1].argmin())
+            minidx = last_update(v,min_reset,min_idx_at_reset,turn)
+            mintab.append((minidx,x[i],v[i]))
+            #the running max is reset to this bin
+            before = last_update(neg_v,max_reset,max_idx_at_reset,turn - 1)
+            highest = v[max_reset:turn].max()
+            max_reset, max_idx_at_reset = turn, (turn if v[turn] > highest else before)
+            state = (True,v[turn],x[turn],max_idx_at_reset,v[i],x[i],minidx)
+
+        if (len(maxtab) + len(mintab)) * min_leg > turn: #turning too often to gain from the search
+            peak_valley_walk(x,v,h,delta,maxtab,mintab,first=turn + 1,state=state)
+            break
+
+        start = turn
+        look_for_max = not look_for_max
+        turn = next_turn(start,turn + 1,look_for_max)
+
+    return maxtab, mintab
+
+
+def sn_peak_positions(v,sn,dx=3,rx=2,dv=2.0,dvmx=3.0):
+    """
+    The candidate line positions of sn_peakdet(): runs of adjacent bins with S/N above dv (a run is also split
+    where it rises then falls for at least rx bins each) that are at least dx bins long and reach dvmx in S/N.
+
+    The runs are found with array operations; only runs long enough to both rise and fall rx bins are walked bin by
+    bin to place the splits. As with the original walk, the final run is not evaluated and (for dx < 2) the first
+    bin is also evaluated on its own.
+
+    :param v: values
+    :param sn: signal to noise (v/error)
+    :param dx: minimum number of bins in a run
+    :param rx: like dx but just for rise and fall
+    :param dv: minimum S/N for a bin to be in a run
+    :param dvmx: at least one bin in the run must be >= to this in S/N
+    :return: list of indices (the highest value in each run)
+    """
+    hvi = np.where(sn > dv)[0] #hvi high v indicies (where > dv)
+    if len(hvi) < 1:
+        return []
+
+    vh = v[hvi]
+    snh = sn[hvi]
+
+    #segments of adjacent bins
+    seg_starts = np.concatenate(([0],np.where(np.diff(hvi) != 1)[0] + 1))
+    seg_ends = np.concatenate((seg_starts[1:],[len(hvi)]))
+
+    rising = np.zeros(len(hvi),dtype=bool)
+    rising[1:] = vh[1:] >= vh[:-1] #(only meaningful inside a segment)
+    step = np.ones(len(hvi),dtype=int)
+    step[seg_starts] = 0
+    num_rise = np.add.reduceat(step * rising,seg_starts)
+    num_fall = np.add.reduceat(step * ~rising,seg_starts)
+
+    #a segment can only be split if it has enough rising and falling steps to set both triggers
+    can_split = (num_rise >= max(rx - 1,1)) & (num_fall >= max(rx,1))
+    run_starts = [seg_starts]
+    for s, e in zip(seg_starts[can_split],seg_ends[can_split]):
+        rise = 1
+        fall = 0
+        rise_trigger = False
+        fall_trigger = False
+        splits = []
+        for k in range(s + 1,e):
+            if rising[k]:
+                rise += 1
+                if rise >= rx:
+                    rise_trigger = True
+                    fall = 0
+            else:
+                fall += 1
+                if fall >= rx: #assume the end of a line and trigger a new run
+                    fall_trigger = True
+                    rise = 0
+            if rise_trigger and fall_trigger: #call this a peak, start a new run
+                splits.append(k)
+                rise = 1
+                fall = 0
+                rise_trigger = False
+                fall_trigger = False
+        run_starts.append(np.array(splits,dtype=int))
+    run_starts = np.unique(np.concatenate(run_starts))
+
+    #the last run is never closed out, so is not evaluated
+    run_ends = run_starts[1:]
+    run_starts = run_starts[:-1]
+
+    pos = []
+    if (dx <= 1) and (snh[0] >= dvmx): #the initial, single bin run
+        pos.append(hvi[0])
+
+    if len(run_starts) > 0:
+        vh = vh[0:run_ends[-1]]
+        snh = snh[0:run_ends[-1]]
+        run_max = np.maximum.reduceat(vh,run_starts)
+        keep = ((run_ends - run_starts) >= dx) & (np.maximum.reduceat(snh,run_starts) >= dvmx)
+        #first (as argmax) position of the max in each run
+        at_max = np.where(vh == np.repeat(run_max,run_ends - run_starts))[0]
+        first = at_max[np.searchsorted(at_max,run_starts)]
+        pos += list(hvi[first[keep]])
+
+    return pos
+
+
 #todo: update to deal with flux instead of counts
 #def simple_peaks(x,v,h=MIN_HEIGHT,delta_v=2.0,values_units=0):
 def simple_peaks(x, v, h=None, delta_v=None, values_units=0):
@@ -2131,9 +2592,6 @@ def simple_peaks(x, v, h=None, delta_v=None, values_units=0):
               2 3D arrays: index, wavelength, value for (1) peaks and (2) valleys
     """
 
-    maxtab = []
-    mintab = []
-
     if h is None:
         h = np.mean(v)*0.8 #assume the mean to be roughly like the continuum level ... make min height with some slop
 
@@ -2152,34 +2610,7 @@ def simple_peaks(x, v, h=None, delta_v=None, values_units=0):
         log.warning('simple_peaks: Input vectors v and x must have same length')
         return None,None
 
-    minv, maxv = np.Inf, -np.Inf
-    minpos, maxpos = np.NaN, np.NaN
-
-    lookformax = True
-
-    for i in np.arange(len(v)):
-        thisv = v[i]
-        if thisv > maxv:
-            maxv = thisv
-            maxpos = x[i]
-            maxidx = i
-        if thisv < minv:
-            minv = thisv
-            minpos = x[i]
-            minidx = i
-        if lookformax:
-            if (thisv >= h) and (thisv < maxv - delta_v):
-                #i-1 since we are now on the right side of the peak and want the index associated with max
-                maxtab.append((maxidx,maxpos, maxv))
-                minv = thisv
-                minpos = x[i]
-                lookformax = False
-        else:
-            if thisv > minv + delta_v:
-                mintab.append((minidx,minpos, minv))
-                maxv = thisv
-                maxpos = x[i]
-                lookformax = True
+    maxtab, mintab = peak_valley_search(x,v,h,delta_v)
 
     #return np.array(maxtab)[:, 0], np.array(maxtab)[:, 1], np.array(maxtab)[:, 2]
     return np.array(maxtab), np.array(mintab)
@@ -2209,54 +2640,13 @@ def sn_peakdet_no_fit(wave,spec,spec_err,dx=3,rx=2,dv=2.0,dvmx=3.0):
         v = np.array(spec)
         e = np.array(spec_err)
         sn = v/e
-        hvi = np.where(sn > dv)[0] #hvi high v indicies (where > dv)
 
-        if len(hvi) < 1:
-            log.debug(f"sn_peak - no bins above minimum snr {dv}")
-            return []
+        #indicies in the original arrays of the highest values in runs of high S/N bins
+        pos = sn_peak_positions(v,sn,dx=dx,rx=rx,dv=dv,dvmx=dvmx)
 
-        pos = [] #positions to search (indicies into original wave array)
-        run = [hvi[0],]
-        rise = [hvi[0],] #assume start with a rise
-        fall = []
-
-        #two ways to trigger a peak:
-        #several bins in a row above the SNR cut, then one below
-        #or many bins in a row, that rise then fall with lengths of rise and fall above the dx length
-        for h in hvi:
-            if (h-1) == run[-1]: #the are adjacent in the original arrays
-                #what about sharp drops in value? like multiple peaks above continuum?
-                if v[h] >= v[run[-1]]: #rising
-                    rise.append(h)
-                    if len(rise) >= rx:
-                        rise_trigger = True
-                        fall = []
-                else: #falling
-                    fall.append(h)
-                    if len(fall) >= rx: #assume the end of a line and trigger a new run
-                        fall_trigger = True
-                        rise = []
-                if rise_trigger and fall_trigger: #call this a peak, start a new run
-                    if len(run) >= dx and np.any(sn[run] >= dvmx):
-                        mx = np.argmax(v[run])  # find largest value in the original arrays from these indicies
-                        pos.append(mx + run[0])  # append that position to pos
-                    run = [h]  # start a new run
-                    rise = [h]
-                    fall = []
-                    fall_trigger = False
-                    rise_trigger = False
-                else:
-                    run.append(h)
-
-            else: #not adjacent, are there enough in run to append?
-                if len(run) >= dx and np.any(sn[run] >= dvmx):
-                    mx = np.argmax(v[run]) #find largest value in the original arrays from these indicies
-                    pos.append(mx+run[0]) #append that position to pos
-                run = [h] #start a new run
-                rise = [h]
-                fall = []
-                fall_trigger = False
-                rise_trigger = False
+        if len(pos) < 1:
+            log.debug(f"sn_peak - no runs of bins above minimum snr {dv}")
+            return []
     except:
         log.error("Exception in sn_peakdet",exc_info=True)
         return []
@@ -2293,60 +2683,23 @@ def sn_peakdet(wave,spec,spec_err,dx=3,rx=2,dv=2.0,dvmx=3.0,values_units=0,
         v = np.array(spec)
         e = np.array(spec_err)
         sn = v/e
-        hvi = np.where(sn > dv)[0] #hvi high v indicies (where > dv)
 
-        if len(hvi) < 1:
-            log.debug(f"sn_peak - no bins above minimum snr {dv}")
+        #indicies in the original arrays of the highest values in runs of high S/N bins
+        pos = sn_peak_positions(v,sn,dx=dx,rx=rx,dv=dv,dvmx=dvmx)
+
+        if len(pos) < 1:
+            log.debug(f"sn_peak - no runs of bins above minimum snr {dv}")
             return []
 
-        pos = [] #positions to search (indicies into original wave array)
-        run = [hvi[0],]
-        rise = [hvi[0],] #assume start with a rise
-        fall = []
-
-        #two ways to trigger a peak:
-        #several bins in a row above the SNR cut, then one below
-        #or many bins in a row, that rise then fall with lengths of rise and fall above the dx length
-        for h in hvi:
-            if (h-1) == run[-1]: #the are adjacent in the original arrays
-                #what about sharp drops in value? like multiple peaks above continuum?
-                if v[h] >= v[run[-1]]: #rising
-                    rise.append(h)
-                    if len(rise) >= rx:
-                        rise_trigger = True
-                        fall = []
-                else: #falling
-                    fall.append(h)
-                    if len(fall) >= rx: #assume the end of a line and trigger a new run
-                        fall_trigger = True
-                        rise = []
-                if rise_trigger and fall_trigger: #call this a peak, start a new run
-                    if len(run) >= dx and np.any(sn[run] >= dvmx):
-                        mx = np.argmax(v[run])  # find largest value in the original arrays from these indicies
-                        pos.append(mx + run[0])  # append that position to pos
-                    run = [h]  # start a new run
-                    rise = [h]
-                    fall = []
-                    fall_trigger = False
-                    rise_trigger = False
-                else:
-                    run.append(h)
-
-            else: #not adjacent, are there enough in run to append?
-                if len(run) >= dx and np.any(sn[run] >= dvmx):
-                    mx = np.argmax(v[run]) #find largest value in the original arrays from these indicies
-                    pos.append(mx+run[0]) #append that position to pos
-                run = [h] #start a new run
-                rise = [h]
-                fall = []
-                fall_trigger = False
-                rise_trigger = False
+        if G.BATCH_GAUSS_FIT:
+            fits = batch_signal_fits(wave,spec,spec_err,[wave[p] for p in pos],values_units=values_units)
+        else:
+            fits = [None] * len(pos)
 
-        #now pos has the indicies in the original arrays of the highest values in runs of high S/N bins
-        for p in pos:
+        for p, fit in zip(pos,fits):
             try:
                 eli = signal_score(wave, spec, spec_err, wave[p], values_units=values_units, min_sigma=min_sigma,
-                               absorber=absorber,do_mcmc=do_mcmc)
+                               absorber=absorber,do_mcmc=do_mcmc,fit=fit)
 
                 # if (eli is not None) and (eli.score > 0) and (eli.snr > 7.0) and (eli.fit_sigma > 1.6) and (eli.eqw_obs > 5.0):
                 if (eli is not None) and ((not enforce_good) or eli.is_good()):
@@ -2486,34 +2839,7 @@ def peakdet(x,v,err=None,dw=MIN_FWHM,h=MIN_HEIGHT,dh=MIN_DELTA_HEIGHT,zero=0.0,v
     v /= 5.0
     x = x[2:-2]
 
-    minv, maxv = np.Inf, -np.Inf
-    minpos, maxpos = np.NaN, np.NaN
-
-    lookformax = True
-
-    for i in np.arange(len(v)):
-        thisv = v[i]
-        if thisv > maxv:
-            maxv = thisv
-            maxpos = x[i]
-            maxidx = i
-        if thisv < minv:
-            minv = thisv
-            minpos = x[i]
-            minidx = i
-        if lookformax:
-            if (thisv >= h) and (thisv < maxv - delta):
-                #i-1 since we are now on the right side of the peak and want the index associated with max
-                maxtab.append((maxidx,maxpos, maxv))
-                minv = thisv
-                minpos = x[i]
-                lookformax = False
-        else:
-            if thisv > minv + delta:
-                mintab.append((minidx,minpos, minv))
-                maxv = thisv
-                maxpos = x[i]
-                lookformax = True
+    maxtab, mintab = peak_valley_search(x,v,h,delta)
 
 
     if len(maxtab) < 1:
@@ -2554,52 +2880,35 @@ def peakdet(x,v,err=None,dw=MIN_FWHM,h=MIN_HEIGHT,dh=MIN_DELTA_HEIGHT,zero=0.0,v
             sub = peaks
         gm = np.mean(sub)
 
+    #check fwhm (assume 0 is the continuum level)
+    shapes = [] #(pix_width, centroid_pos) per peak
     for pi,px,pv in maxtab:
-        #check fwhm (assume 0 is the continuum level)
+        hm = float((pv - zero) / 2.0)
 
+        #bins on either side of the peak down to half max (for the width and centroid)
+        below = np.where(~(v[:pi] >= hm))[0]
+        hm_left = below[-1] + 1 if len(below) > 0 else 0
+        below = np.where(~(v[pi + 1:] >= hm))[0]
+        hm_right = pi + 1 + below[0] if len(below) > 0 else len(v)
+
+        #check local region around centroid (centroid is an index)
+        centroid_pos = np.sum(x[hm_left:hm_right] * v[hm_left:hm_right]) / np.sum(v[hm_left:hm_right])
+        shapes.append((hm_right - hm_left - 1,centroid_pos))
+
+    #fit all the peaks that are wide enough (and not already found) at once
+    fits = {}
+    if G.BATCH_GAUSS_FIT:
+        already_found = np.array([e.fit_x0 for e in eli_list])
+        fit_x = [px for (pi,px,pv),(pix_width,_) in zip(maxtab,shapes)
+                 if not (pix_width < dw) and not np.any(abs(already_found-px) < 2.0)]
+        fits = dict(zip(fit_x,batch_signal_fits(x_0,v_0,err,fit_x,values_units=values_units_0)))
+
+    for (pi,px,pv),(pix_width,centroid_pos) in zip(maxtab,shapes):
         #minium height above the mean of the peaks (w/o outliers)
         if False:
             if (pv < 1.333 * gm):
                 continue
 
-        hm = float((pv - zero) / 2.0)
-        pix_width = 0
-
-        #for centroid (though only down to fwhm)
-        sum_pos_val = x[pi] * v[pi]
-        sum_pos = x[pi]
-        sum_val = v[pi]
-
-        #check left
-        pix_idx = pi -1
-
-        try:
-            while (pix_idx >=0) and (v[pix_idx] >= hm):
-                sum_pos += x[pix_idx]
-                sum_pos_val += x[pix_idx] * v[pix_idx]
-                sum_val += v[pix_idx]
-                pix_width += 1
-                pix_idx -= 1
-
-        except:
-            pass
-
-        #check right
-        pix_idx = pi + 1
-
-        try:
-            while (pix_idx < num_pix) and (v[pix_idx] >= hm):
-                sum_pos += x[pix_idx]
-                sum_pos_val += x[pix_idx] * v[pix_idx]
-                sum_val += v[pix_idx]
-                pix_width += 1
-                pix_idx += 1
-        except:
-            pass
-
-        #check local region around centroid
-        centroid_pos = sum_pos_val / sum_val #centroid is an index
-
         #what is the average value in the vacinity of the peak (exlcuding the area under the peak)
         #should be 20 AA not 20 pix
         side_pix = max(wave_side,pix_width)
@@ -2625,7 +2934,8 @@ def peakdet(x,v,err=None,dw=MIN_FWHM,h=MIN_HEIGHT,dh=MIN_DELTA_HEIGHT,zero=0.0,v
             if np.any(abs(already_found-px) < 2.0):
                 pass #skip and move on
             else:
-                eli = signal_score(x_0, v_0, err, px,values_units=values_units_0,min_sigma=min_sigma,absorber=absorber)
+                eli = signal_score(x_0, v_0, err, px,values_units=values_units_0,min_sigma=min_sigma,absorber=absorber,
+                                   fit=fits.get(px))
 
                 #if (eli is not None) and (eli.score > 0) and (eli.snr > 7.0) and (eli.fit_sigma > 1.6) and (eli.eqw_obs > 5.0):
                 if (eli is not None) and ((not enforce_good) or eli.is_good()):
@@ -3895,6 +4205,27 @@ class Spectrum:
         max_w = max(wavelengths)
         min_w = min(wavelengths)
 
+        #fit all the candidate (additional line) positions for all the solutions at once
+        batch_fits = {} #(a_central, allow_broad) : (parm, pcov) or None
+        if G.BATCH_GAUSS_FIT:
+            for e in self.emission_lines:
+                central_z = central/e.w_rest - 1.0
+                if central_z < 0.0:
+                    if central_z > G.NEGATIVE_Z_ERROR:
+                        central_z = 0.0
+                    else:
+                        continue
+                for a in self.emission_lines:
+                    a_central = a.w_rest*(central_z+1.0)
+                    if (e == a) or (a_central > max_w) or (a_central < min_w) or (abs(a_central-central) < 5.0):
+                        continue
+                    batch_fits[(a_central,(a.broad and e.broad))] = None
+
+            keys = list(batch_fits.keys())
+            fits = batch_signal_fits(wavelengths,values,errors,[k[0] for k in keys],values_units=values_units,
+                                     spectrum=self,allow_broad=[k[1] for k in keys])
+            batch_fits = dict(zip(keys,fits))
+
         for e in self.emission_lines:
             #!!! consider e.solution to mean it cannot be a lone solution (that is, the line without other lines)
             #if not e.solution: #changed!!! this line cannot be the ONLY line, but can be the main line if there are others
@@ -3961,7 +4292,8 @@ class Spectrum:
                 eli = signal_score(wavelengths=wavelengths, values=values, errors=errors, central=a_central,
                                    central_z = central_z, values_units=values_units, spectrum=self,
                                    show_plot=False, do_mcmc=False,
-                                   allow_broad= (a.broad and e.broad))
+                                   allow_broad= (a.broad and e.broad),
+                                   fit=batch_fits.get((a_central,(a.broad and e.broad))))
 
                 if eli and a.broad and e.broad and (eli.fit_sigma < eli.fit_sigma_err) and \
                     ((eli.fit_sigma + eli.fit_sigma_err) > GOOD_BROADLINE_SIGMA):
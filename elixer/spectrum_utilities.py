@@ -1827,15 +1827,146 @@ def make_raster_grid(ra,dec,width,resolution):
         return None, None
 
 
-def raster_search(ra_meshgrid,dec_meshgrid,shotlist,cw,aperture=3.0,max_velocity=500.0,max_fwhm=15.0):
+def extract_grid_for_shot(ra_list,dec_list,aperture,shotid,ffsky=False,multiprocess=None):
+    """
+    Force extract at many positions in a single shot with one get_spectra call (so the shot's fibers are loaded
+    once and all the positions are extracted against them)
+
+    :param ra_list: decimal degrees
+    :param dec_list: decimal degrees
+    :param aperture: arcsec
+    :param shotid:
+    :param ffsky:
+    :param multiprocess: passed to get_spectra (default G.GET_SPECTRA_MULTIPROCESS)
+    :return: flux, fluxerr (N positions x N wavebins, rows of NaN where there is no extraction), wave
+             flux is in e-17 (just like HETDEX standard) (NOT flux density)
+             or None, None, None if the extraction failed (vs. just no spectra)
+    """
+    if multiprocess is None:
+        multiprocess = G.GET_SPECTRA_MULTIPROCESS
+
+    num = len(ra_list)
+    flux = np.full((num,len(G.CALFIB_WAVEGRID)),np.nan)
+    fluxerr = np.full((num,len(G.CALFIB_WAVEGRID)),np.nan)
+    wave = np.array(G.CALFIB_WAVEGRID)
+
+    try:
+        coords = SkyCoord(ra=np.array(ra_list) * U.deg, dec=np.array(dec_list) * U.deg)
+        apt = hda_get_spectra(coords, ID=np.arange(num), survey=f"hdr{G.HDR_Version}", shotid=shotid,ffsky=ffsky,
+                              multiprocess=multiprocess, rad=aperture,tpmin=0.0,fiberweights=True)
+
+        if (apt is None) or (len(apt) == 0):
+            log.info(f"No spectra for raster in shot {shotid}")
+            return flux, fluxerr, wave
+
+        # returned from get_spectra as flux density (per AA), so multiply by wavebin width to match the HDF5 reads
+        for row in apt:
+            i = int(row['ID'])
+            flux[i] = np.nan_to_num(row['spec'], nan=0.000) * G.FLUX_WAVEBIN_WIDTH   #in 1e-17 units (like HDF5 read)
+            fluxerr[i] = np.nan_to_num(row['spec_err'], nan=0.000) * G.FLUX_WAVEBIN_WIDTH
+            wave = np.array(row['wavelength'])
+    except Exception as E:
+        print(f"Exception in Elixer::spectrum_utilities::extract_grid_for_shot",E)
+        log.info(f"Exception in Elixer::spectrum_utilities::extract_grid_for_shot",exc_info=True)
+        return None, None, None
+
+    return flux, fluxerr, wave
+
+
+def raster_checkpoint_fn(checkpoint,shotid):
+    """
+    :param checkpoint: checkpoint base name (path and filename prefix)
+    :return: the checkpoint file for the shot's raster extractions
+    """
+    return f"{checkpoint}_raster_{shotid}.npz"
+
+
+def load_raster_checkpoint(fn,ra_list,dec_list,aperture):
+    """
+    :return: flux, fluxerr, wave from a previous (completed) shot extraction over the same grid or None
+    """
+    try:
+        if op.isfile(fn):
+            with np.load(fn,allow_pickle=False) as npz:
+                if np.array_equal(npz['ra'],ra_list) and np.array_equal(npz['dec'],dec_list) and \
+                        (float(npz['aperture']) == aperture):
+                    return np.array(npz['flux']), np.array(npz['fluxerr']), np.array(npz['wave'])
+                log.info(f"Raster checkpoint {fn} does not match the grid. Will re-extract.")
+    except:
+        log.info(f"Unable to read raster checkpoint {fn}",exc_info=True)
+    return None
+
+
+def save_raster_checkpoint(fn,ra_list,dec_list,aperture,flux,fluxerr,wave):
+    """
+    Written to a temporary and renamed so a killed run never leaves a partial checkpoint
+    """
+    import os
+    tmp_fn = fn + ".%d.tmp" % os.getpid()
+    try:
+        with open(tmp_fn,"wb") as f:
+            np.savez(f,ra=ra_list,dec=dec_list,aperture=aperture,flux=flux,fluxerr=fluxerr,wave=wave)
+        os.replace(tmp_fn,fn)
+    except:
+        log.info(f"Unable to write raster checkpoint {fn}",exc_info=True)
+        try:
+            os.remove(tmp_fn)
+        except:
+            pass
+
+
+def _raster_no_extraction(num):
+    """
+    :return: flux, fluxerr, wave for a shot with no extractions at any of the num grid positions (all NaN)
+    """
+    return np.full((num,len(G.CALFIB_WAVEGRID)),np.nan), np.full((num,len(G.CALFIB_WAVEGRID)),np.nan), \
+           np.array(G.CALFIB_WAVEGRID)
+
+
+def _raster_extract_shot(shotid,ra_list,dec_list,aperture,checkpoint=None,multiprocess=None):
+    """
+    Extract the whole grid for one shot (a raster_search pool task), from or to the checkpoint
+    (a failed extraction is not checkpointed, so it is tried again on the next run)
+
+    :return: shotid, flux, fluxerr, wave
+    """
+    fn = None
+    if checkpoint is not None:
+        fn = raster_checkpoint_fn(checkpoint,shotid)
+        result = load_raster_checkpoint(fn,ra_list,dec_list,aperture)
+        if result is not None:
+            log.info(f"Raster shot {shotid} loaded from checkpoint {fn}")
+            return (shotid,) + result
+
+    flux, fluxerr, wave = extract_grid_for_shot(ra_list,dec_list,aperture,shotid,multiprocess=multiprocess)
+
+    if flux is None:
+        log.info(f"Raster shot {shotid} extraction failed. Not checkpointed.")
+        return (shotid,) + _raster_no_extraction(len(ra_list))
+
+    if fn is not None:
+        save_raster_checkpoint(fn,ra_list,dec_list,aperture,flux,fluxerr,wave)
+
+    return shotid, flux, fluxerr, wave
+
+
+def raster_search(ra_meshgrid,dec_meshgrid,shotlist,cw,aperture=3.0,max_velocity=500.0,max_fwhm=15.0,
+                  workers=None,checkpoint=None,keep_checkpoint=False):
     """
     Iterate over the supplied meshgrids and force extract at each point
+    Each shot is extracted (all grid points at once) separately, in parallel over a process pool, then each grid
+    point is stacked over the shots and fit.
+
     :param ra_meshgrid: (see make_raster_grid)
     :param dec_meshgrid:
     :param shotlist: (must be a list, so if just one shot, pass as [shot]
     :param cw: central wavelength (search/extract around this wavelength
     :param aperture: in arcsec
     :param max_velocity: in km/s (max allowance to either side of the specified <cw> to fit)
+    :param workers: number of shots extracted in parallel (default G.RASTER_SEARCH_WORKERS)
+    :param checkpoint: if set, a path and filename prefix for the per-shot extraction checkpoints; shots already
+                       extracted (over the same grid) are loaded rather than re-extracted, so a long raster can resume
+    :param keep_checkpoint: if False, the checkpoints are removed once the raster completes
     :return: meshgrid of (extraction) dictionaries with location and extraction info
     """
 
@@ -1849,97 +1980,68 @@ def raster_search(ra_meshgrid,dec_meshgrid,shotlist,cw,aperture=3.0,max_velocity
         ct = 0
         wct = 0
 
-        #for s in [shotlist[1]]:
-        # bw_events = 0
-        # max_bw_ct = 0
-        # min_bw_ct = 9999
-        # wbw_events = 0
-
         msg = f"Raster extracting emission. RA x Dec x Shots " \
                  f"({np.shape(ra_meshgrid)[1]}x{np.shape(ra_meshgrid)[0]}x{len(shotlist)}) = " \
                  f"{np.shape(ra_meshgrid)[1] * np.shape(ra_meshgrid)[0] * len(shotlist)} extractions."
         log.info(msg)
         print(msg)
 
+        #flattened grid, row-major over (dec,ra) as the meshgrid is stored
+        ra_list = np.array(ra_meshgrid,dtype=float).ravel()
+        dec_list = np.array(dec_meshgrid,dtype=float).ravel()
+
+        if workers is None:
+            workers = G.RASTER_SEARCH_WORKERS
+        workers = max(1,min(int(workers),len(shotlist)))
+
+        shot_results = {}
+        if workers > 1:
+            import concurrent.futures
+            import multiprocessing
+            #fork (not spawn) so the workers inherit the configured global_config state
+            #the shots are already spread over processes, so get_spectra does not need its own pool
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        mp_context=multiprocessing.get_context("fork")) as pool:
+                futures = {pool.submit(_raster_extract_shot,s,ra_list,dec_list,aperture,checkpoint,False) : s
+                           for s in shotlist}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        s, flux, fluxerr, wave = future.result()
+                    except: #i.e. the worker process died; the rest of the shots still count
+                        s = futures[future]
+                        log.error(f"Exception extracting raster shot {s}",exc_info=True)
+                        flux, fluxerr, wave = _raster_no_extraction(len(ra_list))
+                    shot_results[s] = (flux, fluxerr, wave)
+        else:
+            for s in shotlist:
+                s, flux, fluxerr, wave = _raster_extract_shot(s,ra_list,dec_list,aperture,checkpoint)
+                shot_results[s] = (flux, fluxerr, wave)
+
+        num_dec = np.shape(ra_meshgrid)[0]
         for r in range(np.shape(ra_meshgrid)[1]): #columns (x or RA values)
-            for d in range(np.shape(ra_meshgrid)[0]): #rows (y or Dec values)
+            for d in range(num_dec): #rows (y or Dec values)
+                i = d * np.shape(ra_meshgrid)[1] + r
                 exlist = []
                 for s in shotlist:
-                    #print("Shot = ", s)
                     ct += 1
-                    #print(ct)
-                    ex = extract_at_position(ra_meshgrid[d,r], dec_meshgrid[d,r], aperture, s)
-
-                    if ex['flux'] is None:
+                    flux, fluxerr, wave = shot_results[s]
+                    if np.all(np.isnan(flux[i])):
                         continue
 
-                    exlist.append(ex)
+                    exlist.append({'flux': flux[i], 'fluxerr': fluxerr[i], 'wave': wave,
+                                   'ra': ra_meshgrid[d,r], 'dec': dec_meshgrid[d,r], 'shot': s,
+                                   'aperture': aperture, 'ffsky': False})
 
                 if len(exlist) == 0:
                     continue
                 elif len(exlist) == 1:
                     avg_f = exlist[0]['flux']
                     avg_fe = exlist[0]['fluxerr']
-
-                elif len(exlist) > 1:
-                    #make a new ex dictionary with the weighted biweight average of the data and run simple fit
-                    flux = []
-                    fluxe = []
-                    #waves are all the same
-                    for ex in exlist:
-                        flux.append(ex['flux'])
-                        fluxe.append(ex['fluxerr'])
-
-                    flux = np.array(flux)
-                    fluxe = np.array(fluxe)
-
-                    #now weighted biweight
-                    avg_f  = np.zeros(len(flux[0]))
-                    avg_fe = np.zeros(len(flux[0]))
-
-                    # if len(flux[0]) > max_bw_ct:
-                    #     max_bw_ct = len(flux[0])
-                    #
-                    # if len(flux[0]) < min_bw_ct:
-                    #     min_bw_ct = len(flux[0])
-
-                    for i in range(len(flux[0])):
-
-                        wslice_err = np.array([m[i] for m in fluxe])  # all rows, ith index
-                        wslice = np.array([m[i] for m in flux])  # all rows, ith index
-
-                        wslice_err = wslice_err[np.where(wslice != -999)]  # so same as wslice, since these need to line up
-                        wslice = wslice[np.where(wslice != -999)]  # git rid of the out of range interp values
-
-                        # git rid of any nans
-                        wslice_err = wslice_err[~np.isnan(wslice)]  # err first so the wslice is not modified
-                        wslice = wslice[~np.isnan(wslice)]
-
-                        try:
-                            f = weighted_biweight.biweight_location_errors(wslice, errors=wslice_err)
-                            #not really using the errors, but this is good enough?
-                            fe = weighted_biweight.biweight_scale(wslice) / np.sqrt(len(wslice))
-                            #wbw_events += 1
-                        except:
-                            #log.info("Weighted_biweight failed. Switching to normal biweight")
-                            f = weighted_biweight.biweight_location(wslice)
-                            fe = weighted_biweight.biweight_scale(wslice) /np.sqrt(len(wslice))
-                            #bw_events += 1
-
-                        if np.isnan(f):
-                            avg_f[i] = 0
-                            avg_fe[i] = 0
-                        elif np.isnan(fe):
-                            avg_f[i] = f
-                            avg_fe[i] = 0
-                        else:
-                            avg_f[i] = f
-                            avg_fe[i] = fe
                 else:
-                    #something very wrong
-                    #print("********** unexpectedly zero spectra???????")
-                    continue
-                #end if
+                    #weighted biweight average of the data (all wavebins at once; NaN and -999 values are ignored)
+                    avg_f, avg_fe = weighted_biweight.stack_spectra(np.array([x['flux'] for x in exlist]),
+                                                                    np.array([x['fluxerr'] for x in exlist]))
+                ex = exlist[-1]
 
                 #now, fit to Gaussian
                 ex['fit'] = combo_fit_wave(SP.peakdet,avg_f,
@@ -1951,15 +2053,11 @@ def raster_search(ra_meshgrid,dec_meshgrid,shotlist,cw,aperture=3.0,max_velocity
 
                 # kill off bad fits based on snr, rmse, sigma, continuum
                 # overly? generous sigma ... maybe make similar to original?
-                test_good = False
                 if (1.0 < ex['fit']['sigma'] < 20.0) and \
                         (3.0 < ex['fit']['snr'] < 1000.0):
                     if ex['fit']['fitflux'] > 0:
-                        #print("Winner")
                         wct += 1
-                        test_good = True
                 else:  # is bad, wipe out
-                    #print("bad fit")
                     ex['bad_fit'] = copy.copy(ex['fit'])
                     ex['fit']['snr'] = 0
                     ex['fit']['fitflux'] = 0
@@ -1971,32 +2069,15 @@ def raster_search(ra_meshgrid,dec_meshgrid,shotlist,cw,aperture=3.0,max_velocity
 
                 edict[r, d] = ex
 
-                #todo: REMOVE ME
-                if False: #extra debugging
-                    print("**********Remove me**********")
-                    plt.close('all')
-                    plt.figure(figsize=(6,3))
-
-                    plt.axvline(cw,color='k',alpha=0.5)
-                    plt.axvline(cw-cw*max_velocity/3e5,ls="dashed",color='k',alpha=0.5)
-                    plt.axvline(cw+cw*max_velocity/3e5,ls="dashed",color='k',alpha=0.5)
-                    try:
-                        plt.axvline(ex['fit']['x0'],color="r")
-                    except:
-                        pass
-
-                    plt.plot(G.CALFIB_WAVEGRID, avg_f)
-                    plt.xlim(cw-2*cw*max_velocity/3e5,cw+2*cw*max_velocity/3e5)
-
-                    plt.title(f"Good {test_good}: r({r}) d({d}) RA: {ra_meshgrid[d,r]:0.6f}  Dec: {dec_meshgrid[d,r]:0.6f}\n"
-                              f"fwhm = {ex['fit']['sigma']*2.355:0.2f}, flux = {ex['fit']['fitflux']:0.2f}, snr = {ex['fit']['snr']:0.2f}")
-                    plt.tight_layout()
-                    plt.savefig(f"ip_r{str(r).zfill(3)}_d{str(d).zfill(3)}.png")
-
-
         log.info(f"Raster 'good' emission fits ({wct}) / ({ct})")
-        #print("Good fits:", wct)
-        #print(f"Biweights: max_ct ({max_bw_ct}), min_ct ({min_bw_ct}), wbw ({wbw_events}), bw ({bw_events})")
+
+        if (checkpoint is not None) and (not keep_checkpoint):
+            import os
+            for s in shotlist:
+                try:
+                    os.remove(raster_checkpoint_fn(checkpoint,s))
+                except:
+                    pass
 
         return edict
     except:
@@ -4,12 +4,142 @@ except:
     import global_config as G
 
 import sqlite3
+import os
 import os.path as op
 import gzip
+import threading
+from collections import OrderedDict
 
 log = G.Global_Logger('sqlite_logger')
 log.setlevel(G.LOG_LEVEL)
 
+MAX_SQL_VARIABLES = 500 #max keys per SELECT ... IN (...)
+
+
+class BlobReader:
+
+    def __init__(self,db_file,tablename,keyname,valuename=None,decompress=True,cache_size=None):
+        """
+        Read-only (pooled) access to a key:blob table with a multi-key fetch and an LRU cache of the results
+
+        :param db_file: SQLite database filename
+        :param tablename:
+        :param keyname: key column
+        :param valuename: blob column (if None, the 2nd column of the table)
+        :param decompress: if True, the blobs are gzip decompressed
+        :param cache_size: max number of (decompressed) blobs to keep (default G.SQLITE_BLOB_CACHE_SIZE, 0 = no cache)
+        """
+        if cache_size is None:
+            cache_size = G.SQLITE_BLOB_CACHE_SIZE
+        self.db_file = db_file
+        self.tablename = tablename
+        self.keyname = keyname
+        self.valuename = valuename
+        self.decompress = decompress
+        self.cache_size = cache_size
+        self.cache = OrderedDict() #str(key) : blob
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self):
+        """
+        :return: the (shared, read-only) connection (None if the database cannot be opened)
+        """
+        if self.conn is None:
+            try:
+                self.conn = sqlite3.connect("file:" + self.db_file + "?mode=ro",uri=True,check_same_thread=False)
+                if G.SQLITE_MMAP_MB > 0:
+                    self.conn.execute(f"PRAGMA mmap_size={int(G.SQLITE_MMAP_MB * 1024 * 1024)}")
+            except:
+                log.info(f"Exception creating SQLite connection to {self.db_file}",exc_info=True)
+                self.conn = None
+        return self.conn
+
+    def fetch_many(self,keys):
+        """
+        :param keys: iterable of keys
+        :return: dictionary of str(key) : blob for the keys found
+        """
+        keys = list(dict.fromkeys(str(k) for k in keys)) #unique, in order
+        found = {}
+        with self.lock:
+            todo = []
+            for k in keys:
+                if k in self.cache:
+                    self.cache.move_to_end(k)
+                    found[k] = self.cache[k]
+                else:
+                    todo.append(k)
+
+            if len(todo) == 0:
+                return found
+
+            conn = self.connect()
+            if conn is None:
+                return found
+
+            if self.valuename is None:
+                sql_select = f"SELECT * from {self.tablename} where {self.keyname} IN "
+            else:
+                sql_select = f"SELECT {self.keyname}, {self.valuename} from {self.tablename} where {self.keyname} IN "
+
+            rows = []
+            for i in range(0,len(todo),MAX_SQL_VARIABLES):
+                chunk = todo[i:i+MAX_SQL_VARIABLES]
+                cursor = conn.cursor()
+                cursor.execute(sql_select + "(" + ",".join("?" * len(chunk)) + ")",chunk)
+                rows += cursor.fetchall()
+                cursor.close()
+
+            blobs = {}
+            for r in rows:
+                blobs.setdefault(str(r[0]),[]).append(r[1])
+
+            for k, b in blobs.items():
+                if len(b) > 1:
+                    log.info(f"Unexpected number of blobs ({len(b)}) returned for {k}")
+                    continue
+                found[k] = gzip.decompress(b[0]) if self.decompress else b[0]
+                if self.cache_size > 0:
+                    self.cache[k] = found[k]
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        return found
+
+    def fetch(self,key):
+        """
+        :return: blob or None if not found
+        """
+        return self.fetch_many([key]).get(str(key))
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except:
+                    pass
+            self.conn = None
+            self.cache = OrderedDict()
+
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def get_reader(db_file,tablename="blobtable",keyname="blobname",valuename=None,decompress=True):
+    """
+    :return: the (per process) pooled BlobReader for the database table
+    """
+    key = (os.getpid(),op.abspath(db_file),tablename,keyname,valuename,decompress)
+    with _readers_lock:
+        reader = _readers.get(key)
+        if reader is None:
+            reader = BlobReader(db_file,tablename,keyname,valuename,decompress)
+            _readers[key] = reader
+    return reader
+
 
 def create_connection(db_file):
     """ create a database connection to a SQLite database """
@@ -26,49 +156,57 @@ def create_connection(db_file):
 def fetch_blob(db_file,key,tablename="blobtable",keyname="blobname"):
     """
 
-    :param conn:
+    :param db_file:
     :param tablename
     :param keyname:
     :param key:
-    :return:
+    :return: the (decompressed) blob, None if not found, False on an exception
     """
     try:
-        conn = create_connection(db_file)
-
-        if conn is None:
+        if not op.isfile(db_file):
+            log.info(f"SQLite database {db_file} not found")
             return None
 
-        cursor = conn.cursor()
-
-        sql_read_blob = f"""SELECT * from {tablename} where {keyname} = ?"""
-
-        cursor.execute(sql_read_blob, (str(key),))
-        blob = cursor.fetchall()
-        cursor.close()
-        conn.close()
-
-        if blob is not None:
-            if len(blob) == 1:
-                return gzip.decompress(blob[0][1]) #dictionary [0][0] is the key, [0][1] is the payload
-            elif len(blob) == 0:
-                log.info("No matching blob found")
-                return None
-            else:
-                log.info(f"Unexpected number of blobs ({len(blob)}) returned")
-                return None
+        blob = get_reader(db_file,tablename,keyname).fetch(key)
+        if blob is None:
+            log.info("No matching blob found")
         return blob
     except:
         log.info("Exception fetching SQLite blob", exc_info=True)
         return False
 
 
+def fetch_blobs(db_file,keys,tablename="blobtable",keyname="blobname"):
+    """
+    :param db_file:
+    :param keys: iterable of keys
+    :return: dictionary of str(key) : (decompressed) blob for those keys found (empty on an exception)
+    """
+    try:
+        if not op.isfile(db_file):
+            log.info(f"SQLite database {db_file} not found")
+            return {}
+        return get_reader(db_file,tablename,keyname).fetch_many(keys)
+    except:
+        log.info("Exception fetching SQLite blobs", exc_info=True)
+        return {}
+
+
+
+def zpdf_key(fn):
+    """
+    :param fn: zPDF filename, i.e. ..._ID12345.zPDF
+    :return: integer zPDF ID number
+    """
+    return int(op.basename(fn).split('_')[-1].split('.')[0].split('ID')[-1])
+
 
 def fetch_zpdf(db_file,key=None,fn=None):
     """
 
-    :param conn:
+    :param db_file:
     :param key: integer , zPDF ID number
-    :return:
+    :return: the (decompressed) zPDF, None if not found, False on an exception
     """
     try:
 
@@ -76,36 +214,44 @@ def fetch_zpdf(db_file,key=None,fn=None):
             log.debug("Invalid call to fetch_zpdf. Neither key nor fn specified")
             return None
         elif key is None:
-            key = int(op.basename(fn).split('_')[-1].split('.')[0].split('ID')[-1])
+            key = zpdf_key(fn)
 
-        conn = create_connection(db_file)
-
-        if conn is None:
+        if not op.isfile(db_file):
+            log.info(f"SQLite database {db_file} not found")
             return None
 
-        cursor = conn.cursor()
-
-        sql_read_blob = f"""SELECT zpdf_blob from zpdf_table where zpdf_id = ?"""
-
-        cursor.execute(sql_read_blob, (str(key),))
-        blob = cursor.fetchall()
-        #get back a list of tuples (each list entry is one row, the tuple is the row, so
-        #we want the 1st entry (detectid is unique, so should be one or none, and the second column which is the image)
-        cursor.close()
-        conn.close()
-
-        if blob is not None:
-            if len(blob) == 1:
-                return gzip.decompress(blob[0][0])
-            elif len(blob) == 0:
-                log.info("No matching blob found")
-                return None
-            else:
-                log.info(f"Unexpected number of blobs ({len(blob)}) returned")
-                return None
-
+        blob = get_reader(db_file,"zpdf_table","zpdf_id","zpdf_blob").fetch(key)
+        if blob is None:
+            log.info("No matching blob found")
         return blob
     except:
         log.info("Exception fetching SQLite blob", exc_info=True)
         return False
 
+
+def prefetch_zpdfs(db_file,keys=None,fns=None):
+    """
+    Fetch (in one query) the zPDFs for many objects into the reader cache, so the fetch_zpdf() calls
+    that follow do not go to the database
+
+    :param db_file:
+    :param keys: integer zPDF ID numbers
+    :param fns: or the zPDF filenames
+    :return: number of zPDFs found
+    """
+    try:
+        if keys is None:
+            keys = []
+        keys = list(keys)
+        if fns is not None:
+            for fn in fns:
+                try:
+                    keys.append(zpdf_key(fn))
+                except:
+                    pass
+        if (len(keys) == 0) or (not op.isfile(db_file)):
+            return 0
+        return len(get_reader(db_file,"zpdf_table","zpdf_id","zpdf_blob").fetch_many(keys))
+    except:
+        log.info("Exception prefetching zPDFs", exc_info=True)
+        return 0
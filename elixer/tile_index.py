@@ -0,0 +1,105 @@
+"""
+Spatial index over the RA, Dec bounds of imaging tiles (HSC, KPNO, ...) so the tile(s) covering a position
+can be found without scanning every tile.
+
+Tiles are sorted by RA_min; since no tile is wider (in RA) than the widest tile, only the tiles with
+RA_min in [ra - max_width, ra] can contain ra. Those are found with a binary search and then the remaining
+bounds are checked (vectorized) on just that slice.
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import numpy as np
+
+log = G.Global_Logger('tile_index')
+log.setlevel(G.LOG_LEVEL)
+
+
+class TileIndex:
+
+    def __init__(self,tile_dict):
+        """
+        :param tile_dict: dictionary keyed by tile name with (at least) 'RA_min','RA_max','Dec_min','Dec_max'
+                          entries for each tile (i.e. tile_meta.TileMeta, hsc_meta.HSC_META_DICT)
+        """
+        if hasattr(tile_dict,"bounds"): #columnar (tile_meta.TileMeta), no need to build each tile's dictionary
+            keys, bounds = tile_dict.bounds()
+        else:
+            keys = []
+            bounds = []
+            for k in tile_dict.keys():
+                try:
+                    t = tile_dict[k]
+                    bounds.append((t['RA_min'],t['RA_max'],t['Dec_min'],t['Dec_max']))
+                    keys.append(k)
+                except:
+                    log.debug(f"Tile ({k}) missing coordinate bounds. Not indexed.")
+
+        self.keys = np.array(keys,dtype=object)
+        self.positions = {k: i for i, k in enumerate(keys)} #original dict order
+        bounds = np.array(bounds,dtype=float).reshape(-1,4)
+
+        self.order = np.argsort(bounds[:,0],kind='stable') #original (dict) positions, sorted by RA_min
+        self.ra_min = bounds[self.order,0]
+        self.ra_max = bounds[self.order,1]
+        self.dec_min = bounds[self.order,2]
+        self.dec_max = bounds[self.order,3]
+
+        if len(self.keys) > 0:
+            self.max_ra_width = max(0.0,np.max(self.ra_max - self.ra_min))
+        else:
+            self.max_ra_width = 0.0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def overlapping_tiles(self,ra,dec):
+        """
+        All tiles whose bounds contain the position, each with a coverage score (the summed squared distance from
+        the target to the min and max corners; the smaller the score the more centered the target is in the tile,
+        i.e. the better the angular coverage around the target).
+
+        :param ra: decimal degrees
+        :param dec: decimal degrees
+        :return: list of (tile key, score) sorted best (smallest score) first. Ties keep the original dict order.
+        """
+        if len(self.keys) == 0:
+            return []
+
+        left = np.searchsorted(self.ra_min,ra - self.max_ra_width,side='left')
+        right = np.searchsorted(self.ra_min,ra,side='right')
+        if right <= left:
+            return []
+
+        sel = (self.ra_max[left:right] >= ra) & (self.dec_min[left:right] <= dec) & (self.dec_max[left:right] >= dec)
+        idx = np.arange(left,right)[sel]
+        if idx.size == 0:
+            return []
+
+        #back to the original dict order (so ties resolve just as a linear scan over the dict would)
+        idx = idx[np.argsort(self.order[idx],kind='stable')]
+
+        scores = (ra - self.ra_min[idx])**2 + (dec - self.dec_min[idx])**2 + \
+                 (ra - self.ra_max[idx])**2 + (dec - self.dec_max[idx])**2
+
+        best = np.argsort(scores,kind='stable')
+        return [(self.keys[self.order[i]],s) for i, s in zip(idx[best],scores[best])]
+
+    def overlapping_keys(self,ra,dec):
+        """
+        :return: list of keys for all tiles that contain the position, in the original dict order
+        """
+        tiles = self.overlapping_tiles(ra,dec)
+        return [t[0] for t in sorted(tiles,key=lambda t: self.positions[t[0]])]
+
+    def best_tile(self,ra,dec):
+        """
+        :return: key of the tile with the best coverage around the position (or None if no tile covers it)
+        """
+        tiles = self.overlapping_tiles(ra,dec)
+        if len(tiles) == 0:
+            return None
+        return tiles[0][0]
@@ -0,0 +1,243 @@
+"""
+Compact, lazily loaded imaging tile metadata (HSC, KPNO, ...)
+
+The footprint_*.py scripts generate the tile metadata as (very large) python dictionary literals
+(hsc_meta.HSC_META_DICT, kpno_meta.KPNO_META_DICT) that would otherwise be parsed and built into
+thousands of small dictionaries at import by every ELiXer process, whether or not it ever goes near that imaging.
+
+Here the metadata are converted (once) into a columnar numpy structured array saved as a .npy sidecar next to
+the *_meta.py module (no per-tile path strings, those are rebuilt from the key). All later processes just
+memory-map the sidecar (so the pages are shared across the workers on a node) and only on first use.
+If the sidecar cannot be written (i.e. read-only install), the array is simply built in memory.
+
+TileMeta is a read-only, drop-in replacement for the meta dictionaries: same keys, same order, same per-tile
+fields ('RA_min','RA_max','Dec_min','Dec_max','instrument','filter',['tract','pos',]'path').
+"""
+
+try:
+    from elixer import global_config as G
+    from elixer import tile_index
+except:
+    import global_config as G
+    import tile_index
+
+import os
+import os.path as op
+import importlib
+from collections.abc import Mapping
+
+import numpy as np
+
+log = G.Global_Logger('tile_meta')
+log.setlevel(G.LOG_LEVEL)
+
+
+def _import_meta_module(module_name):
+    try:
+        return importlib.import_module("elixer." + module_name)
+    except:
+        return importlib.import_module(module_name)
+
+
+def _dict_to_array(meta_dict):
+    """
+    Convert a tile meta dictionary (from footprint_*.py) into a structured array, one row per tile,
+    in the dictionary order. The 'path' is dropped (rebuilt from the key and the configured image path).
+
+    :param meta_dict: i.e. hsc_meta.HSC_META_DICT
+    :return: numpy structured array
+    """
+    keys = list(meta_dict.keys())
+    if len(keys) == 0:
+        return np.zeros(0,dtype=[('key','U1')])
+
+    first = meta_dict[keys[0]]
+    fields = [f for f in first.keys() if f != 'path']
+
+    dtype = [('key','U%d' % max(len(k) for k in keys))]
+    for f in fields:
+        v = first[f]
+        if isinstance(v,str):
+            dtype.append((f,'U%d' % max(1,max(len(meta_dict[k][f]) for k in keys))))
+        elif isinstance(v,(tuple,list)):
+            dtype.append((f,'i4',(len(v),)))
+        else:
+            dtype.append((f,'f8'))
+
+    arr = np.zeros(len(keys),dtype=dtype)
+    arr['key'] = keys
+    for f in fields:
+        arr[f] = [meta_dict[k][f] for k in keys]
+
+    return arr
+
+
+def load_meta_array(module_name,dict_name):
+    """
+    Load (memory-map) the columnar tile metadata for a *_meta.py module, (re)building the .npy sidecar if it is
+    missing or older than the module.
+
+    :param module_name: i.e. "hsc_meta"
+    :param dict_name: name of the dictionary in that module, i.e. "HSC_META_DICT"
+    :return: numpy structured array (read-only memmap if the sidecar is available)
+    """
+    module_dir = op.dirname(op.abspath(__file__))
+    src_fn = op.join(module_dir,module_name + ".py")
+    npy_fn = op.join(module_dir,module_name + ".npy")
+
+    try:
+        if op.isfile(npy_fn) and ((not op.isfile(src_fn)) or (op.getmtime(npy_fn) >= op.getmtime(src_fn))):
+            return np.load(npy_fn,mmap_mode='r')
+    except:
+        log.info(f"Unable to load tile metadata sidecar {npy_fn}. Will rebuild.",exc_info=True)
+
+    log.info(f"Building tile metadata array from {module_name}.{dict_name} ...")
+    arr = _dict_to_array(getattr(_import_meta_module(module_name),dict_name))
+
+    try:
+        #write to a temporary and rename, so concurrent workers never see a partial file
+        tmp_fn = npy_fn + ".%d.tmp" % os.getpid()
+        with open(tmp_fn,"wb") as f:
+            np.save(f,arr,allow_pickle=False)
+        os.replace(tmp_fn,npy_fn)
+        return np.load(npy_fn,mmap_mode='r')
+    except:
+        log.info(f"Unable to write tile metadata sidecar {npy_fn}. Using in-memory copy.",exc_info=True)
+        try:
+            os.remove(tmp_fn)
+        except:
+            pass
+
+    return arr
+
+
+class TileMeta(Mapping):
+    """
+    Read-only, lazily loaded dictionary-like view of the tile metadata.
+    """
+
+    def __init__(self,module_name,dict_name,path_func=None):
+        """
+        :param module_name: the generated meta module, i.e. "hsc_meta"
+        :param dict_name: the dictionary in that module, i.e. "HSC_META_DICT"
+        :param path_func: function(key,tile) that returns the full path to the tile image
+                          (tile is the dictionary for that tile, without 'path'). If None, 'path' is just the key.
+        """
+        self.module_name = module_name
+        self.dict_name = dict_name
+        self.path_func = path_func
+        self._arr = None
+        self._rows = None #key to row
+        self._tiles = {} #key to (already built) tile dictionary
+        self._columns = {} #field to (already built) column() list
+        self._index = None
+        self._coord_range = None
+
+    @property
+    def array(self):
+        if self._arr is None:
+            self._arr = load_meta_array(self.module_name,self.dict_name)
+        return self._arr
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = {str(k): i for i, k in enumerate(self.array['key'])}
+        return self._rows
+
+    @property
+    def index(self):
+        """
+        tile_index.TileIndex over these tiles (built on first use)
+        """
+        if self._index is None:
+            self._index = tile_index.TileIndex(self)
+        return self._index
+
+    def bounds(self):
+        """
+        :return: list of keys, (N,4) array of RA_min, RA_max, Dec_min, Dec_max (dict order)
+        """
+        arr = self.array
+        return [str(k) for k in arr['key']], np.column_stack((arr['RA_min'],arr['RA_max'],arr['Dec_min'],arr['Dec_max']))
+
+    def coord_range(self):
+        """
+        :return: dictionary of the full range covered by the tiles (same as the *_meta.Image_Coord_Range)
+        """
+        if self._coord_range is None:
+            arr = self.array
+            if len(arr) == 0:
+                self._coord_range = {'RA_min': None, 'RA_max': None, 'Dec_min': None, 'Dec_max': None}
+            else:
+                self._coord_range = {'RA_min': float(np.min(arr['RA_min'])), 'RA_max': float(np.max(arr['RA_max'])),
+                                     'Dec_min': float(np.min(arr['Dec_min'])), 'Dec_max': float(np.max(arr['Dec_max']))}
+        return self._coord_range
+
+    def column(self,field):
+        """
+        All the tiles' values of one field at once (much faster than a lookup per tile)
+
+        :param field: i.e. 'tract' or 'pos' (not 'path')
+        :return: list of the values (as __getitem__ returns them), in key order
+        """
+        if field not in self._columns:
+            col = self.array[field]
+            if col.ndim > 1:
+                self._columns[field] = [tuple(int(x) for x in v) for v in col.tolist()]
+            elif col.dtype.kind in ('U','S'):
+                self._columns[field] = [str(v) for v in col.tolist()]
+            else:
+                self._columns[field] = [float(v) for v in col.tolist()]
+        return self._columns[field]
+
+    def __getitem__(self,key):
+        tile = self._tiles.get(key)
+        if tile is not None:
+            return tile
+
+        row = self.array[self.rows[key]]
+        tile = {}
+        for f in self.array.dtype.names[1:]:
+            v = row[f]
+            if isinstance(v,np.ndarray):
+                tile[f] = tuple(int(x) for x in v)
+            elif isinstance(v,str):
+                tile[f] = str(v)
+            else:
+                tile[f] = float(v)
+
+        if self.path_func is None:
+            tile['path'] = key
+        else:
+            tile['path'] = self.path_func(key,tile)
+        self._tiles[key] = tile
+        return tile
+
+    def __contains__(self,key):
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.array)
+
+
+class CoordRange(Mapping):
+    """
+    Lazy stand-in for an Image_Coord_Range dictionary that is derived from the tile metadata on first access
+    (so that cat_base.Catalog.position_in_cat() works unchanged)
+    """
+
+    def __init__(self,tile_meta):
+        self.tile_meta = tile_meta
+
+    def __getitem__(self,key):
+        return self.tile_meta.coord_range()[key]
+
+    def __iter__(self):
+        return iter(self.tile_meta.coord_range())
+
+    def __len__(self):
+        return len(self.tile_meta.coord_range())
@@ -8,13 +8,12 @@ import math
 import os.path as op
 import tarfile as tar
 
-import sqlite3
-from sqlite3 import Error
-
 try:
     from elixer import global_config as G
+    from elixer import sqlite_utils
 except:
     import global_config as G
+    import sqlite_utils
 
 log = G.Global_Logger('utilities')
 log.setlevel(G.LOG_LEVEL)
@@ -346,31 +345,14 @@ def open_sqlite_file(sqlfn,key):
 
     :param sqlfn:
     :param key:
-    :return:
+    :return: list of (blobvalue,) rows (one, if found) as stored (not decompressed)
     """
 
     try:
-        conn = None
-        try:
-            conn = sqlite3.connect(sqlfn)
-        except:
-            log.info(f"Exception attempting to fetch file {key} from {sqlfn}",exc_info=True)
-
-        if conn is None:
-            log.info(f"Error. SQLite connection is invalid")
-
-        cursor = conn.cursor()
-
-        sql_read_blob = """SELECT blobvalue from blobtable where blobname = ?"""
-
-        cursor.execute(sql_read_blob, (str(blobname),))
-        blobvalue = cursor.fetchall()
-        # get back a list of tuples (each list entry is one row, the tuple is the row, so
-        # we want the 1st entry (detectid is unique, so should be one or none, and the second column which is the image)
-        cursor.close()
-        conn.close()
-
-        return blobvalue
+        blob = sqlite_utils.get_reader(sqlfn,"blobtable","blobname","blobvalue",decompress=False).fetch(key)
+        if blob is None:
+            return []
+        return [(blob,)]
     except:
         log.info(f"Exception attempting to fetch file {key} from {sqlfn}",exc_info=True)
 
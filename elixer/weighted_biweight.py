@@ -10,6 +10,7 @@ log = G.Global_Logger('logger')
 log.setlevel(G.LOG_LEVEL)
 
 import numpy as np
+import warnings
 #from astropy.stats.funcs import median_absolute_deviation
 import random
 import astropy.units as u
@@ -185,26 +186,26 @@ def biweight_location_weights(data, weights, c=6.0, M=None, axis=None):
     factor = 0.5
     weights  = weights/np.nanmedian(weights)*factor 
     
-    u = d / (c * mad)
+    uw = d / (c * mad)
 
     # now remove the outlier points
-    mask = (np.abs(u) >= 1)
+    mask = (np.abs(uw) >= 1)
     #print("number of excluded points ", len(mask[mask]))
     
-    u = (1 - u ** 2) ** 2
+    uw = (1 - uw ** 2) ** 2
     
     weights[~np.isfinite(weights)] = 0
     
-    u = u + weights**2
-    u[weights==0] = 0
+    uw = uw + weights**2
+    uw[weights==0] = 0
     d[weights==0] = 0
-    u[mask] = 0
+    uw[mask] = 0
 
     # along the input axis if data is constant, d will be zero, thus
     # the median value will be returned along that axis
     bwl = None
     try:
-        bwl = M.squeeze() + (d * u).sum(axis=axis) / u.sum(axis=axis)
+        bwl = M.squeeze() + (d * uw).sum(axis=axis) / uw.sum(axis=axis)
     except: #just for logging (note: could trap and call regular biweight, but might want to not hide the fail)
         if not np.isnan(M): #hide the print if this is the common issue, but still raise the exception so caller knows it failed
             log.warning("Exception in weighted_biweight", exc_info=True)
@@ -215,3 +216,193 @@ def biweight_location_weights(data, weights, c=6.0, M=None, axis=None):
         bwl *= saved_units
 
     return bwl
+
+
+#######################################
+# Axis-vectorized forms for stacking
+# Each column (wavelength bin) of an (N spectra x N wave) matrix gets the same result as calling the
+# functions above on just that column's valid (finite, not the sentinel) values, but in one call.
+#######################################
+
+def _stack_arrays(data, errors=None, sentinel=-999.):
+    """
+    :return: data (float64, invalid values as NaN), errors (or None) and the per-column count of valid values
+    """
+    data = np.array(getattr(data, "value", data), dtype=np.float64, ndmin=2)
+    invalid = ~np.isfinite(data)
+    if sentinel is not None:
+        invalid |= (data == sentinel)
+    data[invalid] = np.nan
+
+    if errors is not None:
+        errors = np.array(getattr(errors, "value", errors), dtype=np.float64, ndmin=2)
+        if data.shape != errors.shape:
+            raise ValueError("data.shape != errors.shape")
+        errors[invalid] = np.nan
+
+    return data, errors, np.count_nonzero(~invalid, axis=0)
+
+
+def biweight_location_weights_stack(data, weights, c=6.0, sentinel=-999., max_invalid_frac=0.1):
+    """
+    biweight_location_weights() along axis 0, per column over only the valid (finite and != sentinel) values
+
+    :param data: (N spectra x N wave) array
+    :param weights: (N x N wave) array
+    :param c: tuning constant
+    :param sentinel: "no data" value to ignore (in addition to NaN, inf) or None
+    :param max_invalid_frac: columns with more than this fraction of (otherwise valid) values with zero or invalid
+                             weights are not computed (NaN), same as the ValueError raised by biweight_location_weights
+    :return: array (N wave) of locations (NaN where not computed)
+    """
+    data, weights, n = _stack_arrays(data, weights, sentinel)
+    valid = ~np.isnan(data)
+
+    data[weights == 0] = np.nan
+    weights[~np.isfinite(data)] = np.nan
+    failed = np.count_nonzero(np.isnan(weights) & valid, axis=0) > (max_invalid_frac * n)
+
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) #all NaN columns
+
+        M = np.nanmedian(data, axis=0)
+        d = data - M
+        mad = median_absolute_deviation(data, axis=0, ignore_nan=True)
+        const = (mad == 0.) #return the median if the column is constant
+        mad = np.where(const, 1., mad)
+
+        weights = weights / np.nanmedian(weights, axis=0) * 0.5
+
+        uw = d / (c * mad)
+        mask = (np.abs(uw) >= 1) #outliers
+        uw = (1 - uw ** 2) ** 2
+
+        weights[~np.isfinite(weights)] = 0
+        uw = uw + weights ** 2
+        uw[weights == 0] = 0
+        d[weights == 0] = 0
+        uw[mask] = 0
+
+        bwl = M + (d * uw).sum(axis=0) / uw.sum(axis=0)
+
+    bwl = np.where(const, M, bwl)
+    bwl[failed] = np.nan
+    return bwl
+
+
+def biweight_location_errors_stack(data, errors, c=6.0, sentinel=-999., max_invalid_frac=0.1):
+    """
+    biweight_location_errors() along axis 0 (see biweight_location_weights_stack)
+
+    :param data: (N spectra x N wave) array
+    :param errors: (N x N wave) array (zero errors get zero weight)
+    :return: array (N wave) of locations (NaN where not computed)
+    """
+    data, errors, _ = _stack_arrays(data, errors, sentinel)
+    with np.errstate(divide='ignore'):
+        weights = 1. / np.where(errors == 0, np.inf, errors)
+    return biweight_location_weights_stack(data, weights, c, sentinel, max_invalid_frac)
+
+
+def biweight_scale_stack(data, c=9.0, sentinel=-999.):
+    """
+    astropy biweight_scale along axis 0, per column over only the valid (finite and != sentinel) values
+
+    :param data: (N spectra x N wave) array
+    :return: array (N wave)
+    """
+    data, _, _ = _stack_arrays(data, None, sentinel)
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return biweight_scale(data, c=c, axis=0, ignore_nan=True)
+
+
+def stack_spectra(flux, fluxerr, sentinel=-999.):
+    """
+    Error weighted biweight stack of spectra (as in the per wavebin loops, i.e. spectrum_utilities.raster_search):
+    the location is the error weighted biweight (falling back to the plain biweight where the weights are unusable),
+    the error is the biweight scale / sqrt(N). NaN results are reported as 0.
+
+    :param flux: (N spectra x N wave) array
+    :param fluxerr: (N spectra x N wave) array
+    :param sentinel: "no data" value to ignore (in addition to NaN)
+    :return: stacked flux, stacked flux error (each N wave)
+    """
+    data, _, n = _stack_arrays(flux, None, sentinel)
+
+    f = biweight_location_errors_stack(data, fluxerr, sentinel=sentinel)
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        fallback = np.isnan(f)
+        if np.any(fallback):
+            f[fallback] = biweight_location(data[:, fallback], axis=0, ignore_nan=True)
+        fe = biweight_scale_stack(data, sentinel=sentinel) / np.sqrt(n)
+
+    fe[np.isnan(f) | np.isnan(fe)] = 0
+    f[np.isnan(f)] = 0
+    return f, fe
+
+
+def _stack_spectra_loop(flux, fluxerr, sentinel=-999.):
+    """
+    Reference per wavebin loop (as originally in spectrum_utilities.raster_search), for benchmarking
+    """
+    avg_f = np.zeros(len(flux[0]))
+    avg_fe = np.zeros(len(flux[0]))
+    for i in range(len(flux[0])):
+        wslice_err = np.array([m[i] for m in fluxerr])
+        wslice = np.array([m[i] for m in flux])
+        wslice_err = wslice_err[np.where(wslice != sentinel)]
+        wslice = wslice[np.where(wslice != sentinel)]
+        wslice_err = wslice_err[~np.isnan(wslice)]
+        wslice = wslice[~np.isnan(wslice)]
+        try:
+            f = biweight_location_errors(wslice, errors=wslice_err)
+            fe = biweight_scale(wslice) / np.sqrt(len(wslice))
+        except:
+            f = biweight_location(wslice)
+            fe = biweight_scale(wslice) / np.sqrt(len(wslice))
+
+        if np.isnan(f):
+            avg_f[i] = 0
+            avg_fe[i] = 0
+        elif np.isnan(fe):
+            avg_f[i] = f
+            avg_fe[i] = 0
+        else:
+            avg_f[i] = f
+            avg_fe[i] = fe
+    return avg_f, avg_fe
+
+
+def benchmark_stack(num_spectra=20, num_wave=1036, repeat=3, seed=None):
+    """
+    Time (and compare) stack_spectra against the per wavebin loop on random spectra with some NaNs, sentinels
+    and zero errors
+
+    :return: (loop seconds, vectorized seconds, max abs flux difference, max abs error difference)
+    """
+    import time
+    rng = np.random.default_rng(seed)
+    flux = rng.normal(0., 1., (num_spectra, num_wave))
+    fluxerr = np.abs(rng.normal(0.5, 0.1, (num_spectra, num_wave)))
+    flux[rng.random(flux.shape) < 0.01] = np.nan
+    flux[rng.random(flux.shape) < 0.01] = sentinel = -999.
+    fluxerr[rng.random(flux.shape) < 0.01] = 0.
+
+    t0 = time.time()
+    for _ in range(repeat):
+        loop_f, loop_fe = _stack_spectra_loop(flux, fluxerr, sentinel)
+    t1 = time.time()
+    for _ in range(repeat):
+        vec_f, vec_fe = stack_spectra(flux, fluxerr, sentinel)
+    t2 = time.time()
+
+    return (t1 - t0) / repeat, (t2 - t1) / repeat, np.max(np.abs(loop_f - vec_f)), np.max(np.abs(loop_fe - vec_fe))
+
+
+if __name__ == '__main__':
+    for n in [5, 20, 100]:
+        t_loop, t_vec, df, dfe = benchmark_stack(num_spectra=n, seed=n)
+        print(f"{n:4d} spectra x 1036: loop {t_loop*1000.:8.1f} ms  vectorized {t_vec*1000.:6.1f} ms  "
+              f"({t_loop/max(t_vec,1e-9):5.0f}x)  max diff flux {df:.2e} err {dfe:.2e}")
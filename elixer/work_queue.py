@@ -0,0 +1,270 @@
+"""
+Shared, file-backed work queue for SLURM runs (selixer.py --work_queue).
+
+Instead of each task getting a fixed dispatch_xxxx list, all the detections are written as small batches into a
+queue directory on the shared filesystem and every task (one elixer process per launcher task) repeatedly claims
+the next batch until the queue is empty, so tasks that draw fast detections pick up the work of the slow ones.
+
+SQLite locking is not reliable across nodes on a shared (Lustre) filesystem (see report_db.py), so the queue is
+lock-free: each batch is a file (one detection per line, the same format as a dispatch_xxxx list) and claiming or
+completing it is a single atomic rename between the state directories:
+
+    <queue>/pending/batch_000012                      waiting to be claimed
+    <queue>/claimed/batch_000012.<host>_<pid>         being processed by that task
+    <queue>/done/batch_000012                         finished
+    <queue>/failed/batch_000012                       the task hit an exception processing it
+
+If two tasks try to claim the same batch, only one rename succeeds and the other moves on. Batches still claimed
+when a job ends (the task timed out or died) and failed batches are returned to pending with requeue() (selixer
+--recover), which also queues (add()) the detections of done batches that did not complete (per the manifests).
+"""
+
+try:
+    from elixer import global_config as G
+except:
+    import global_config as G
+
+import os
+import heapq
+import random
+import shutil
+import socket
+import numpy as np
+
+log = G.Global_Logger('work_queue')
+log.setlevel(G.LOG_LEVEL)
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+STATES = (PENDING,CLAIMED,DONE,FAILED)
+BATCH_PREFIX = "batch_"
+
+
+def batch_name(path):
+    """
+    :param path: batch file (in any state)
+    :return: the batch name, without the claiming owner
+    """
+    name = os.path.basename(path)
+    return name.split(".")[0]
+
+
+def exists(queue_dir):
+    return (queue_dir is not None) and all(os.path.isdir(os.path.join(queue_dir,s)) for s in STATES)
+
+
+def write_batch(fn,lines):
+    """
+    Write a batch file (to a temporary, then renamed, so a task never claims a partial batch)
+
+    :param fn: batch file
+    :param lines: one detection each, as for a dispatch_xxxx file
+    """
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn,"w") as f:
+        for line in lines:
+            f.write(str(line).rstrip("\n") + "\n")
+    os.replace(tmp_fn,fn)
+
+
+def create(queue_dir,batches):
+    """
+    (Re)create a queue holding the batches (any old queue at queue_dir is removed)
+
+    :param queue_dir: queue directory
+    :param batches: list of batches, each a list of lines (one detection each, as for a dispatch_xxxx file)
+    :return: number of batches queued
+    """
+    if os.path.isdir(queue_dir):
+        shutil.rmtree(queue_dir)
+    for s in STATES:
+        os.makedirs(os.path.join(queue_dir,s))
+
+    for i, lines in enumerate(batches):
+        write_batch(os.path.join(queue_dir,PENDING,BATCH_PREFIX + str(i).zfill(6)),lines)
+
+    return len(batches)
+
+
+def requeue(queue_dir,failed=True):
+    """
+    Return the claimed (never completed) and, optionally, the failed batches to pending.
+    Only call when no task is working the queue (i.e. from selixer --recover).
+
+    :param queue_dir: queue directory
+    :param failed: if True also requeue the failed batches
+    :return: number of batches requeued
+    """
+    count = 0
+    for state in ((CLAIMED,FAILED) if failed else (CLAIMED,)):
+        src_dir = os.path.join(queue_dir,state)
+        for name in os.listdir(src_dir):
+            try:
+                os.rename(os.path.join(src_dir,name),os.path.join(queue_dir,PENDING,batch_name(name)))
+                count += 1
+            except:
+                log.warning(f"Unable to requeue {name}",exc_info=True)
+    return count
+
+
+def counts(queue_dir):
+    """
+    :return: dictionary of the number of batches in each state
+    """
+    return {s: len(os.listdir(os.path.join(queue_dir,s))) for s in STATES}
+
+
+def read_batches(queue_dir,state=PENDING):
+    """
+    :param queue_dir: queue directory
+    :param state: one of STATES
+    :return: list (by batch name) of the batches in that state, each a list of lines
+    """
+    batches = []
+    state_dir = os.path.join(queue_dir,state)
+    for name in sorted(os.listdir(state_dir)):
+        if not name.startswith(BATCH_PREFIX) or name.endswith(".tmp"):
+            continue
+        try:
+            with open(os.path.join(state_dir,name),"r") as f:
+                batches.append([line.rstrip("\n") for line in f if len(line.strip()) > 0])
+        except:
+            log.warning(f"Unable to read {state} batch {name}",exc_info=True)
+    return batches
+
+
+def pending_batches(queue_dir):
+    """
+    :return: list (by batch name) of the pending batches, each a list of lines
+    """
+    return read_batches(queue_dir,PENDING)
+
+
+def add(queue_dir,batches):
+    """
+    Add more (pending) batches to an existing queue, numbered after every batch already in it (in any state).
+    Only call when no task is working the queue (i.e. from selixer --recover).
+
+    :param queue_dir: queue directory
+    :param batches: list of batches, each a list of lines (one detection each, as for a dispatch_xxxx file)
+    :return: number of batches queued
+    """
+    next_num = 0
+    for state in STATES:
+        for name in os.listdir(os.path.join(queue_dir,state)):
+            try:
+                next_num = max(next_num,int(batch_name(name)[len(BATCH_PREFIX):]) + 1)
+            except:
+                pass
+
+    for i, lines in enumerate(batches):
+        write_batch(os.path.join(queue_dir,PENDING,BATCH_PREFIX + str(next_num + i).zfill(6)),lines)
+
+    return len(batches)
+
+
+def make_batches(dispatch_indices,batch_size=None):
+    """
+    Split each (planned) dispatch into batches, so batches keep the dispatch's locality
+
+    :param dispatch_indices: list of lists of detection indices (see dispatch_plan.plan())
+    :param batch_size: detections per batch (default G.WORK_QUEUE_BATCH_SIZE)
+    :return: list of lists of detection indices
+    """
+    if batch_size is None:
+        batch_size = G.WORK_QUEUE_BATCH_SIZE
+    batch_size = max(1,int(batch_size))
+    batches = []
+    for idx in dispatch_indices:
+        idx = list(idx)
+        for i in range(0,len(idx),batch_size):
+            batches.append(idx[i:i + batch_size])
+    return batches
+
+
+def simulate(batches,tasks,costs=None):
+    """
+    Expected share of the work each task ends up with: the batches, in queue order, each go to the task that
+    frees up first
+
+    :param batches: list of lists of detection indices
+    :param tasks: number of tasks working the queue
+    :param costs: expected cost per detection (default 1.0 each)
+    :return: list (one per task) of lists of detection indices
+    """
+    tasks = max(1,int(tasks))
+    if costs is not None:
+        costs = np.asarray(costs,dtype=float)
+    shares = [[] for _ in range(tasks)]
+    heap = [(0.0,t) for t in range(tasks)]
+    for b in batches:
+        load, t = heapq.heappop(heap)
+        if costs is None:
+            load += len(b)
+        else:
+            load += float(np.sum(costs[list(b)]))
+        shares[t].extend(b)
+        heapq.heappush(heap,(load,t))
+    return shares
+
+
+class WorkQueue:
+    """
+    One task's handle on the queue: claim batches and record their completion
+    """
+
+    def __init__(self,queue_dir,owner=None):
+        self.queue_dir = os.path.abspath(queue_dir)
+        if owner is None:
+            owner = socket.gethostname().split(".")[0] + "_" + str(os.getpid())
+        self.owner = owner
+
+    def claim(self):
+        """
+        :return: the path of the claimed batch file (a dispatch_xxxx style list), or None if the queue is empty
+        """
+        pending_dir = os.path.join(self.queue_dir,PENDING)
+        while True:
+            try:
+                names = [n for n in os.listdir(pending_dir) if n.startswith(BATCH_PREFIX) and not n.endswith(".tmp")]
+            except:
+                log.error(f"Unable to read work queue {self.queue_dir}",exc_info=True)
+                return None
+
+            if len(names) == 0:
+                return None
+
+            #start at a random position so the tasks are not all racing for the same batch
+            names.sort()
+            start = random.randrange(len(names))
+            lost_race = False
+            for name in names[start:] + names[:start]:
+                claimed = os.path.join(self.queue_dir,CLAIMED,name + "." + self.owner)
+                try:
+                    os.rename(os.path.join(pending_dir,name),claimed)
+                    log.info(f"Claimed {name}")
+                    return claimed
+                except FileNotFoundError: #someone else got it first
+                    lost_race = True
+                except:
+                    log.warning(f"Unable to claim {name}",exc_info=True)
+
+            if not lost_race: #none could be claimed, and not because others took them
+                return None
+            #all claimed out from under us; re-list
+
+    def _finish(self,claimed,state):
+        try:
+            os.rename(claimed,os.path.join(self.queue_dir,state,batch_name(claimed)))
+            return True
+        except:
+            log.error(f"Unable to mark {claimed} as {state}",exc_info=True)
+            return False
+
+    def done(self,claimed):
+        return self._finish(claimed,DONE)
+
+    def failed(self,claimed):
+        return self._finish(claimed,FAILED)